@@ -0,0 +1,245 @@
+"""Async client for the billing service.
+
+One pooled ``httpx.AsyncClient`` per process, shared with the tariff
+catalog. Every request has a timeout. Calls that are safe to repeat (GETs,
+confirms, invoice creation with an ``Idempotency-Key``) are retried on
+network errors, 5xx and 429 with full-jitter exponential backoff, so a
+billing restart does not turn into a synchronised retry storm. ``POST
+/trial`` is not idempotent: ``start_trial`` repeats it itself and takes a
+409 on a repeat as the trial an earlier attempt granted.
+
+A circuit breaker counts calls that failed after all their retries. After
+``failure_threshold`` in a row it opens and calls fail fast with
+``BillingUnavailable`` for ``reset_timeout`` seconds. Then one probe call
+is let through (half-open); its outcome closes or re-opens the breaker.
+Handlers therefore learn in microseconds that billing is down instead of
+waiting out timeouts while Telegram's deadlines run.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+
+from vpn_common.metrics.transports import AsyncTimedTransport
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class BillingError(Exception):
+    pass
+
+
+class BillingUnavailable(BillingError):
+    """Billing could not be reached (or the breaker is open); worth retrying later."""
+
+
+class BillingRejected(BillingError):
+    """Billing answered with a 4xx; retrying will not help."""
+
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self.opened = 0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN  # this caller is the probe
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+                logger.warning("Billing circuit opened after %d failures", self.failures)
+            self.state = self.OPEN
+            self._opened_at = self._clock()
+
+
+class BillingClient:
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        client: Optional[httpx.AsyncClient] = None,
+        timeout: float = 3.0,
+        retries: int = 2,
+        backoff: float = 0.2,
+        max_backoff: float = 2.0,
+        max_connections: int = 100,
+        breaker: Optional[CircuitBreaker] = None,
+        rng: Optional[random.Random] = None,
+        token: Optional[str] = None,
+    ) -> None:
+        self.base_url = (base_url or "http://billing:8000").rstrip("/")
+        self._client = client or httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections // 4),
+            transport=AsyncTimedTransport(),
+        )
+        if token:
+            # Billing's payment calls need it; only the bot may confirm a charge.
+            self._client.headers["Authorization"] = f"Bearer {token}"
+        self._owns_client = client is None
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self._random = rng or random.Random()
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        """The pooled client, for other billing readers (the tariff catalog)."""
+
+        return self._client
+
+    async def _request(self, method: str, path: str, retry: bool = True, **kwargs: Any) -> httpx.Response:
+        if not self.breaker.allow():
+            raise BillingUnavailable("Billing circuit is open")
+        probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+        settled = False
+        try:
+            resp = await self._attempts(method, path, self.retries + 1 if retry else 1, **kwargs)
+            self.breaker.record_success()
+            settled = True
+        except asyncio.CancelledError:
+            # A cancelled call says nothing about billing, unless it was the probe.
+            settled = not probe
+            raise
+        finally:
+            # Any other way out, including a cancelled probe, counts as a failure;
+            # otherwise a half-open breaker would never settle.
+            if not settled:
+                self.breaker.record_failure()
+        if resp.status_code >= 400:
+            try:
+                detail = resp.json().get("detail", resp.text)
+            except ValueError:
+                detail = resp.text
+            raise BillingRejected(resp.status_code, str(detail))
+        return resp
+
+    async def _backoff(self, attempt: int) -> None:
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        await asyncio.sleep(self._random.uniform(0, delay))
+
+    async def _attempts(self, method: str, path: str, attempts: int, **kwargs: Any) -> httpx.Response:
+        """The first response that is not worth retrying, or ``BillingUnavailable``."""
+
+        error = "no attempt made"
+        for attempt in range(attempts):
+            if attempt:
+                await self._backoff(attempt)
+            try:
+                resp = await self._client.request(method, path, **kwargs)
+            except httpx.TransportError as exc:
+                error = f"{type(exc).__name__}: {exc}"
+                continue
+            if resp.status_code in RETRY_STATUSES:
+                error = f"HTTP {resp.status_code}"
+                continue
+            return resp
+        raise BillingUnavailable(f"{method} {path} failed after {attempts} attempts: {error}")
+
+    async def start_payment(
+        self,
+        user_id: int,
+        tariff_code: str,
+        idempotency_key: str,
+        promo_code: Optional[str] = None,
+        referral: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Create (or, for a repeated key, return) a pending invoice."""
+
+        resp = await self._request(
+            "POST",
+            "/payments/start",
+            json={"user_id": user_id, "tariff_code": tariff_code, "promo_code": promo_code, "referral": referral},
+            headers={"Idempotency-Key": idempotency_key},
+        )
+        return resp.json()
+
+    async def start_trial(self, user_id: int) -> Dict[str, Any]:
+        """Grant the one-off trial; ``BillingRejected`` (409) once the user has had any subscription."""
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await self._backoff(attempt)
+            try:
+                resp = await self._request("POST", "/trial", retry=False, params={"user_id": user_id})
+            except BillingUnavailable:
+                if attempt == self.retries:
+                    raise
+                continue
+            except BillingRejected as exc:
+                if exc.status_code != 409 or not attempt:
+                    raise
+                # An earlier attempt may have committed the trial and lost its response.
+                granted = await self.subscription(user_id)
+                if granted is None or granted["tariff_code"] != "trial":
+                    raise
+                return granted
+            return resp.json()
+        raise AssertionError("unreachable")
+
+    async def subscription(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Billing's subscription record, or None for a user who never had one."""
+
+        try:
+            resp = await self._request("GET", f"/subscriptions/{user_id}")
+        except BillingRejected as exc:
+            if exc.status_code == 404:
+                return None
+            raise
+        return resp.json()
+
+    async def confirm_payment(self, invoice_id: str, charge_id: str) -> Dict[str, Any]:
+        """Mark the invoice paid by Telegram's ``charge_id``; repeated confirms return the same subscription."""
+
+        resp = await self._request(
+            "POST", f"/payments/{invoice_id}/confirm", json={"telegram_payment_charge_id": charge_id}
+        )
+        return resp.json()
+
+    async def analytics(self) -> Dict[str, Any]:
+        """Subscriber and revenue rollups for the admin menu."""
+
+        resp = await self._request("GET", "/analytics")
+        return resp.json()
+
+    async def close(self) -> None:
+        if self._owns_client:
+            await self._client.aclose()
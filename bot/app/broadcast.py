@@ -0,0 +1,384 @@
+"""Admin broadcasts to every subscriber at a controlled rate.
+
+Recipients are streamed from the subscription repository with keyset
+pagination (``list_user_ids(after, limit)``), so a broadcast never holds more
+than one page of ids plus the messages in flight, whatever the audience
+size. A fixed set of workers sends through one global token bucket. A
+``RetryAfter`` from Telegram pauses the bucket for everyone and retries the
+chat. Blocked users and missing chats are counted but not retried.
+
+Progress is checkpointed as a low-water mark: every recipient with an id up
+to ``last_user_id`` has been handled. Workers finish out of order, so the
+mark only moves past a contiguous run of finished ids. After a crash the
+broadcast resumes from the mark, and at most the messages that were in
+flight (bounded by ``window``) are sent twice.
+"""
+
+from __future__ import annotations
+
+import abc
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from .subscriptions import SubscriptionRepository
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BroadcastState:
+    id: str
+    text: str
+    admin_chat_id: int
+    progress_message_id: Optional[int] = None
+    last_user_id: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    status: str = "running"  # running | done | cancelled
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    @property
+    def handled(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+
+class BroadcastStore(abc.ABC):
+    @abc.abstractmethod
+    async def save(self, state: BroadcastState) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def load(self, broadcast_id: str) -> Optional[BroadcastState]:
+        ...
+
+    @abc.abstractmethod
+    async def running(self) -> List[BroadcastState]:
+        """Broadcasts that were still running when the process stopped."""
+
+
+class MemoryBroadcastStore(BroadcastStore):
+    def __init__(self) -> None:
+        self._states: Dict[str, str] = {}
+
+    async def save(self, state: BroadcastState) -> None:
+        self._states[state.id] = json.dumps(asdict(state))
+
+    async def load(self, broadcast_id: str) -> Optional[BroadcastState]:
+        raw = self._states.get(broadcast_id)
+        return BroadcastState(**json.loads(raw)) if raw else None
+
+    async def running(self) -> List[BroadcastState]:
+        states = [BroadcastState(**json.loads(raw)) for raw in self._states.values()]
+        return [s for s in states if s.status == "running"]
+
+
+class RedisBroadcastStore(BroadcastStore):
+    def __init__(self, client, prefix: str = "broadcast", keep_seconds: int = 7 * 86400) -> None:
+        self._redis = client
+        self._prefix = prefix
+        self._running_key = f"{prefix}:running"
+        self._keep = keep_seconds
+
+    async def save(self, state: BroadcastState) -> None:
+        key = f"{self._prefix}:{state.id}"
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.set(key, json.dumps(asdict(state)), ex=self._keep)
+            if state.status == "running":
+                pipe.sadd(self._running_key, state.id)
+            else:
+                pipe.srem(self._running_key, state.id)
+            await pipe.execute()
+
+    async def load(self, broadcast_id: str) -> Optional[BroadcastState]:
+        raw = await self._redis.get(f"{self._prefix}:{broadcast_id}")
+        return BroadcastState(**json.loads(raw)) if raw else None
+
+    async def running(self) -> List[BroadcastState]:
+        states = []
+        for broadcast_id in await self._redis.smembers(self._running_key):
+            if isinstance(broadcast_id, bytes):
+                broadcast_id = broadcast_id.decode()
+            state = await self.load(broadcast_id)
+            if state is not None and state.status == "running":
+                states.append(state)
+        return states
+
+
+class AsyncTokenBucket:
+    """Global send budget; ``pause`` stalls every caller (flood control)."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, clock: Callable[[], float] = time.monotonic) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+    async def acquire(self) -> None:
+        while True:
+            now = self._clock()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+ProgressCallback = Callable[["Broadcast"], Awaitable[None]]
+
+
+class Broadcast:
+    def __init__(
+        self,
+        bot: Bot,
+        subscriptions: SubscriptionRepository,
+        store: BroadcastStore,
+        state: BroadcastState,
+        bucket: AsyncTokenBucket,
+        workers: int = 16,
+        page_size: int = 500,
+        window: int = 1000,
+        max_attempts: int = 5,
+        checkpoint_interval: float = 1.0,
+        progress_interval: float = 5.0,
+        on_progress: Optional[ProgressCallback] = None,
+    ) -> None:
+        self.bot = bot
+        self.subscriptions = subscriptions
+        self.store = store
+        self.state = state
+        self.bucket = bucket
+        self.workers = workers
+        self.page_size = page_size
+        self.max_attempts = max_attempts
+        self.checkpoint_interval = checkpoint_interval
+        self.progress_interval = progress_interval
+        self.on_progress = on_progress
+        self._window = asyncio.Semaphore(window)
+        self._pending: Deque[int] = deque()
+        self._finished: Set[int] = set()
+        self._cancelled = False
+        self._resumed_handled = state.handled
+        self._resumed_at = time.monotonic()
+
+    @property
+    def id(self) -> str:
+        return self.state.id
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    @property
+    def rate(self) -> float:
+        """Messages handled per second since this process (re)started it."""
+
+        elapsed = time.monotonic() - self._resumed_at
+        return (self.state.handled - self._resumed_handled) / elapsed if elapsed > 0 else 0.0
+
+    def cancel(self) -> None:
+        self._cancelled = True
+
+    async def run(self) -> BroadcastState:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        reporter = asyncio.create_task(self._report())
+        try:
+            workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+            try:
+                await self._produce(queue)
+            finally:
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            self.state.status = "cancelled" if self._cancelled else "done"
+            self.state.finished_at = time.time()
+        finally:
+            # Also runs on task cancellation (shutdown): the checkpoint keeps
+            # status "running", so the broadcast resumes on the next start.
+            reporter.cancel()
+            await asyncio.shield(self.store.save(self.state))
+        await self._notify()
+        return self.state
+
+    async def _produce(self, queue: asyncio.Queue) -> None:
+        after = self.state.last_user_id
+        while not self._cancelled:
+            user_ids = await self.subscriptions.list_user_ids(after=after, limit=self.page_size)
+            if not user_ids:
+                return
+            for user_id in user_ids:
+                await self._window.acquire()
+                if self._cancelled:
+                    return
+                self._pending.append(user_id)
+                await queue.put(user_id)
+            after = user_ids[-1]
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            outcome = await self._deliver(user_id)
+            if outcome == "sent":
+                self.state.sent += 1
+            elif outcome == "blocked":
+                self.state.blocked += 1
+            else:
+                self.state.failed += 1
+            self._finished.add(user_id)
+            while self._pending and self._pending[0] in self._finished:
+                done = self._pending.popleft()
+                self._finished.discard(done)
+                self.state.last_user_id = done
+                self._window.release()
+
+    async def _deliver(self, chat_id: int) -> str:
+        for attempt in range(self.max_attempts):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, self.state.text)
+                return "sent"
+            except TelegramRetryAfter as exc:
+                # Flood control applies to the whole bot, not just this chat.
+                self.bucket.pause(exc.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest as exc:
+                logger.debug("Broadcast %s to %s rejected: %s", self.id, chat_id, exc)
+                return "failed"
+            except (TelegramNetworkError, TelegramServerError) as exc:
+                logger.warning("Broadcast %s to %s failed (attempt %d): %s", self.id, chat_id, attempt + 1, exc)
+                await asyncio.sleep(min(30.0, 0.5 * 2**attempt))
+        return "failed"
+
+    async def _report(self) -> None:
+        last_progress = time.monotonic()
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            await self.store.save(self.state)
+            if time.monotonic() - last_progress >= self.progress_interval:
+                last_progress = time.monotonic()
+                await self._notify()
+
+    async def _notify(self) -> None:
+        if self.on_progress is None:
+            return
+        try:
+            await self.on_progress(self)
+        except Exception:
+            logger.warning("Broadcast progress update failed", exc_info=True)
+
+
+def progress_text(broadcast: Broadcast) -> str:
+    state = broadcast.state
+    title = {"running": "идёт", "done": "завершена", "cancelled": "остановлена"}[state.status]
+    return (
+        f"Рассылка {state.id[:8]} {title}\n"
+        f"Отправлено: {state.sent}, заблокировали бота: {state.blocked}, ошибок: {state.failed}\n"
+        f"Скорость: {broadcast.rate:.1f} сообщ./с"
+    )
+
+
+class BroadcastManager:
+    def __init__(
+        self,
+        subscriptions: SubscriptionRepository,
+        store: Optional[BroadcastStore] = None,
+        rate: float = 25.0,
+        workers: int = 16,
+        page_size: int = 500,
+    ) -> None:
+        self.subscriptions = subscriptions
+        self.store = store or MemoryBroadcastStore()
+        # Telegram allows about 30 messages per second per bot overall.
+        self.bucket = AsyncTokenBucket(rate)
+        self.workers = workers
+        self.page_size = page_size
+        self.active: Dict[str, Broadcast] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    async def start(self, bot: Bot, text: str, admin_chat_id: int, progress_message_id: Optional[int] = None) -> Broadcast:
+        state = BroadcastState(
+            id=uuid.uuid4().hex,
+            text=text,
+            admin_chat_id=admin_chat_id,
+            progress_message_id=progress_message_id,
+        )
+        await self.store.save(state)
+        return self._launch(bot, state)
+
+    async def resume(self, bot: Bot) -> List[Broadcast]:
+        resumed = [self._launch(bot, state) for state in await self.store.running() if state.id not in self.active]
+        for broadcast in resumed:
+            logger.info("Resuming broadcast %s after user %s", broadcast.id, broadcast.state.last_user_id)
+        return resumed
+
+    def _launch(self, bot: Bot, state: BroadcastState) -> Broadcast:
+        async def report(broadcast: Broadcast) -> None:
+            if broadcast.state.progress_message_id is not None:
+                await bot.edit_message_text(
+                    progress_text(broadcast),
+                    chat_id=broadcast.state.admin_chat_id,
+                    message_id=broadcast.state.progress_message_id,
+                )
+
+        broadcast = Broadcast(
+            bot,
+            self.subscriptions,
+            self.store,
+            state,
+            self.bucket,
+            workers=self.workers,
+            page_size=self.page_size,
+            on_progress=report,
+        )
+        self.active[state.id] = broadcast
+        task = asyncio.create_task(broadcast.run(), name=f"broadcast-{state.id}")
+        task.add_done_callback(lambda _: self._forget(state.id))
+        self._tasks[state.id] = task
+        return broadcast
+
+    def _forget(self, broadcast_id: str) -> None:
+        self.active.pop(broadcast_id, None)
+        task = self._tasks.pop(broadcast_id, None)
+        if task is not None and not task.cancelled() and task.exception() is not None:
+            logger.error("Broadcast %s crashed", broadcast_id, exc_info=task.exception())
+
+    def cancel_all(self) -> int:
+        for broadcast in self.active.values():
+            broadcast.cancel()
+        return len(self.active)
+
+    async def stop(self) -> None:
+        """Interrupt running broadcasts, keeping their checkpoints for resume."""
+
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
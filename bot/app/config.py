@@ -1,14 +1,40 @@
 from pydantic_settings import BaseSettings
 from pydantic import AnyHttpUrl   # эта строчка отдельно
-from typing import List
+from typing import List, Optional
 
 
 class Settings(BaseSettings):
     bot_token: str
     bot_admin_ids: List[int]
     billing_url: AnyHttpUrl
+    billing_token: Optional[str] = None
     provisioner_url: AnyHttpUrl
+    provisioner_token: Optional[str] = None
     dashboard_url: AnyHttpUrl
+    redis_url: Optional[str] = None
+    subscription_cache_size: int = 100_000
+    subscription_cache_ttl: float = 5.0
+    webhook_url: Optional[str] = None
+    webhook_path: str = "/webhook"
+    webhook_secret: Optional[str] = None
+    webhook_port: int = 8081
+    update_workers: int = 8
+    update_queue_size: int = 1000
+    throttle_rate: int = 20
+    throttle_period: float = 10.0
+    tap_window: float = 1.0
+    broadcast_rate: float = 25.0
+    broadcast_workers: int = 16
+    broadcast_page_size: int = 500
+    metrics_port: Optional[int] = None
+    events_backend: str = "redis"  # or "memory", "none" (no lifecycle notifications)
+    events_batch_size: int = 100
+    billing_timeout_sec: float = 3.0
+    billing_retries: int = 2
+    billing_breaker_failures: int = 5
+    billing_breaker_reset_sec: float = 30.0
+    # Payments Telegram charged while billing was down; keep it on a volume.
+    payment_queue_path: Optional[str] = "data/payment-confirmations.db"
 
     class Config:
         env_file = ".env"
@@ -18,8 +44,33 @@ class Settings(BaseSettings):
             "bot_token": {"env": "BOT_TOKEN"},
             "bot_admin_ids": {"env": "BOT_ADMIN_IDS"},
             "billing_url": {"env": "BILLING_URL"},
+            "billing_token": {"env": "BILLING_TOKEN"},
             "provisioner_url": {"env": "PROVISIONER_URL"},
+            "provisioner_token": {"env": "PROVISIONER_TOKEN"},
             "dashboard_url": {"env": "DASHBOARD_URL"},
+            "redis_url": {"env": "REDIS_URL"},
+            "subscription_cache_size": {"env": "SUBSCRIPTION_CACHE_SIZE"},
+            "subscription_cache_ttl": {"env": "SUBSCRIPTION_CACHE_TTL"},
+            "webhook_url": {"env": "WEBHOOK_URL"},
+            "webhook_path": {"env": "WEBHOOK_PATH"},
+            "webhook_secret": {"env": "WEBHOOK_SECRET"},
+            "webhook_port": {"env": "WEBHOOK_PORT"},
+            "update_workers": {"env": "UPDATE_WORKERS"},
+            "update_queue_size": {"env": "UPDATE_QUEUE_SIZE"},
+            "throttle_rate": {"env": "THROTTLE_RATE"},
+            "throttle_period": {"env": "THROTTLE_PERIOD"},
+            "tap_window": {"env": "TAP_WINDOW"},
+            "broadcast_rate": {"env": "BROADCAST_RATE"},
+            "broadcast_workers": {"env": "BROADCAST_WORKERS"},
+            "broadcast_page_size": {"env": "BROADCAST_PAGE_SIZE"},
+            "metrics_port": {"env": "METRICS_PORT"},
+            "events_backend": {"env": "EVENTS_BACKEND"},
+            "events_batch_size": {"env": "EVENTS_BATCH_SIZE"},
+            "billing_timeout_sec": {"env": "BILLING_TIMEOUT_SEC"},
+            "billing_retries": {"env": "BILLING_RETRIES"},
+            "billing_breaker_failures": {"env": "BILLING_BREAKER_FAILURES"},
+            "billing_breaker_reset_sec": {"env": "BILLING_BREAKER_RESET_SEC"},
+            "payment_queue_path": {"env": "PAYMENT_QUEUE_PATH"},
         }
 
 
@@ -1,6 +1,9 @@
-from .main_kb import get_buy_menu, get_main_menu, get_profile_menu
+from .main_kb import get_admin_menu, get_buy_menu, get_main_menu, get_profile_menu
+from .registry import KeyboardRegistry
 
 __all__ = [
+    "KeyboardRegistry",
+    "get_admin_menu",
     "get_buy_menu",
     "get_main_menu",
     "get_profile_menu",
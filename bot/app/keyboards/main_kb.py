@@ -1,6 +1,10 @@
+from typing import Any, Dict, Iterable, Optional
+
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 
+from ..tariffs import DEFAULT_TARIFFS
+
 
 def get_main_menu() -> ReplyKeyboardMarkup:
     builder = ReplyKeyboardBuilder()
@@ -20,12 +24,32 @@ def get_main_menu() -> ReplyKeyboardMarkup:
     )
 
 
-def get_buy_menu() -> InlineKeyboardMarkup:
+def _plan_button_text(tariff: Dict[str, Any], monthly_max: Optional[int]) -> str:
+    days = tariff["duration_days"]
+    if days == 30:
+        return f"{tariff['name']} — {tariff['price_stars']} Stars/мес"
+    if days == 365:
+        text = f"{tariff['name']} подписка — {tariff['price_stars']} Stars/год"
+        if monthly_max:
+            discount = round(100 - tariff["price_stars"] * 100 / (monthly_max * 12))
+            if discount > 0:
+                text += f" (–{discount}%)"
+        return text
+    return f"{tariff['name']} — {tariff['price_stars']} Stars/{days} дн."
+
+
+def get_buy_menu(tariffs: Optional[Iterable[Dict[str, Any]]] = None) -> InlineKeyboardMarkup:
+    paid = [t for t in (DEFAULT_TARIFFS if tariffs is None else tariffs) if t["price_stars"] > 0]
+    monthly_max = max((t["price_stars"] for t in paid if t["duration_days"] == 30), default=None)
     builder = InlineKeyboardBuilder()
-    builder.add(InlineKeyboardButton(text="Light — 110 Stars/мес", callback_data="plan_light"))
-    builder.add(InlineKeyboardButton(text="Family — 200 Stars/мес", callback_data="plan_family"))
-    builder.add(InlineKeyboardButton(text="Unlimited — 290 Stars/мес", callback_data="plan_unlimited"))
-    builder.add(InlineKeyboardButton(text="Годовая подписка (–35%)", callback_data="plan_year"))
+    for tariff in paid:
+        builder.add(
+            InlineKeyboardButton(
+                text=_plan_button_text(tariff, monthly_max),
+                callback_data=f"plan_{tariff['code']}",
+            )
+        )
+    builder.add(InlineKeyboardButton(text="У меня есть промокод", callback_data="promo"))
     builder.add(InlineKeyboardButton(text="« Назад", callback_data="back_main"))
     builder.adjust(1)
     return builder.as_markup()
@@ -0,0 +1,41 @@
+"""Prebuilt keyboard markups shared by all handlers.
+
+Every static menu is built once at startup and the same markup object is
+handed to every ``answer()``; handlers must not mutate them. The buy menu is
+derived from the billing tariff catalog and rebuilt only when the catalog
+version changes.
+"""
+
+from __future__ import annotations
+
+from typing import Optional
+
+from aiogram.types import InlineKeyboardMarkup, ReplyKeyboardMarkup
+
+from ..tariffs import TariffCatalog
+from .main_kb import get_admin_menu, get_buy_menu, get_main_menu, get_profile_menu
+
+
+class KeyboardRegistry:
+    def __init__(self, tariffs: Optional[TariffCatalog] = None) -> None:
+        self.tariffs = tariffs or TariffCatalog()
+        self.main: ReplyKeyboardMarkup = get_main_menu()
+        self.admin: ReplyKeyboardMarkup = get_admin_menu()
+        self._profile = {
+            False: get_profile_menu(False),
+            True: get_profile_menu(True),
+        }
+        self._buy: Optional[InlineKeyboardMarkup] = None
+        self._buy_version: Optional[str] = None
+        self.buy_builds = 0
+
+    def profile(self, has_active_sub: bool) -> ReplyKeyboardMarkup:
+        return self._profile[bool(has_active_sub)]
+
+    def buy(self) -> InlineKeyboardMarkup:
+        version = self.tariffs.version
+        if self._buy is None or version != self._buy_version:
+            self._buy = get_buy_menu(self.tariffs.tariffs)
+            self._buy_version = version
+            self.buy_builds += 1
+        return self._buy
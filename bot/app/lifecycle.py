@@ -0,0 +1,129 @@
+"""Subscription lifecycle events from billing and the provisioner.
+
+Billing's renewal reminders arrive on the same stream and go out through the
+same token bucket as the other lifecycle messages.
+
+The bot keeps its own copy of each subscription; these events keep it in
+step with billing and tell the user what happened. Handling is idempotent:
+the copy is overwritten with the newest state per user, a redelivered
+batch is dropped by the consumer before it gets here, and a state event
+older than the last one applied for the user (see ``event_seqs``) is
+skipped. Events older than
+``notify_max_age`` (a backlog replayed after downtime, or the whole log
+when the consumer group is first created) update state silently.
+"""
+
+from __future__ import annotations
+
+import logging
+from dataclasses import replace
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from vpn_common.events import EXTENDED, GRACE, NODE_CHANGED, PAID, REMINDER, REVOKED, TRIAL, Event, latest_per_user
+
+from .broadcast import AsyncTokenBucket
+from .subscriptions import Subscription, SubscriptionRepository
+
+logger = logging.getLogger(__name__)
+
+
+def _date(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def _day(value: datetime) -> str:
+    return value.strftime("%d.%m.%Y")
+
+
+def message_for(event: Event) -> Optional[str]:
+    payload = event.payload
+    if event.type == PAID:
+        return f"Оплата получена, подписка «{payload['tariff_code']}» активна до {_day(_date(payload['active_until']))}"
+    if event.type == EXTENDED:
+        return f"Подписка продлена до {_day(_date(payload['active_until']))}"
+    if event.type == TRIAL:
+        return f"Пробный доступ активирован до {_day(_date(payload['active_until']))}"
+    if event.type == GRACE:
+        return (
+            "Срок подписки истёк. Скорость ограничена до "
+            f"{_day(_date(payload['grace_until']))}, затем доступ будет отключён — продлите подписку"
+        )
+    if event.type == REVOKED:
+        return "Подписка закончилась, доступ отключён. Оформить новую можно через /plans"
+    if event.type == NODE_CHANGED:
+        return f"Ваше устройство перенесено на узел {payload['node_id']}. Скачайте обновлённый конфиг"
+    if event.type == REMINDER:
+        return payload["message"]
+    return None
+
+
+class LifecycleNotifier:
+    def __init__(
+        self,
+        bot: Bot,
+        subscriptions: SubscriptionRepository,
+        bucket: AsyncTokenBucket,
+        notify_max_age: timedelta = timedelta(hours=1),
+    ) -> None:
+        self.bot = bot
+        self.subscriptions = subscriptions
+        self.bucket = bucket
+        self.notify_max_age = notify_max_age
+        self.sent = 0
+
+    async def handle(self, batch: List[Event]) -> None:
+        """Consumer handler: apply the newest state per user, then node moves, notifying each; then send reminders."""
+
+        states = latest_per_user(batch)
+        seqs = await self.subscriptions.event_seqs([event.user_id for event in states])
+        states = [event for event in states if event.seq > seqs[event.user_id]]
+        for event in states + latest_per_user(batch, frozenset({NODE_CHANGED})):
+            if await self._apply(event):
+                await self._notify(event)
+        await self.subscriptions.set_event_seqs({event.user_id: event.seq for event in states})
+        for event in batch:
+            if event.type == REMINDER:
+                await self._notify(event)
+
+    async def _apply(self, event: Event) -> bool:
+        """Update the local subscription; False when there is nothing to tell the user."""
+
+        current = await self.subscriptions.get(event.user_id)
+        if event.type == REVOKED:
+            await self.subscriptions.delete(event.user_id)
+            return True
+        if event.type == NODE_CHANGED:
+            # A move the user asked for in the bot is already recorded there.
+            if current is None or current.node_id == event.payload["node_id"]:
+                return False
+            await self.subscriptions.save(replace(current, node_id=event.payload["node_id"]))
+            return True
+        sub = Subscription(
+            user_id=event.user_id,
+            tariff_code=event.payload["tariff_code"],
+            active_until=_date(event.payload["active_until"]),
+        )
+        if current is not None:
+            if (current.tariff_code, current.active_until) == (sub.tariff_code, sub.active_until):
+                # The payment handler already saved this state and told the user.
+                return False
+            sub = replace(sub, proto=current.proto, node_id=current.node_id)
+        await self.subscriptions.save(sub)
+        return True
+
+    async def _notify(self, event: Event) -> None:
+        text = message_for(event)
+        if text is None or datetime.utcnow() - event.created_at > self.notify_max_age:
+            return
+        await self.bucket.acquire()
+        try:
+            await self.bot.send_message(event.user_id, text)
+            self.sent += 1
+        except TelegramRetryAfter as exc:
+            # Not worth holding the batch for a notification.
+            self.bucket.pause(exc.retry_after)
+        except TelegramAPIError as exc:
+            logger.debug("Lifecycle message to %s not sent: %s", event.user_id, exc)
@@ -1,16 +1,49 @@
 import asyncio
 import logging
-from typing import Dict, Optional
-from dataclasses import dataclass
-from datetime import datetime
+import signal
+from typing import Iterable, Optional
+from dataclasses import replace
+from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, F
-from aiogram.filters import Command, CommandStart
-from aiogram.types import BotCommand, KeyboardButton, Message, ReplyKeyboardMarkup
-from .config import get_settings
+from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import (
+    BotCommand,
+    CallbackQuery,
+    KeyboardButton,
+    LabeledPrice,
+    Message,
+    PreCheckoutQuery,
+    ReplyKeyboardMarkup,
+    URLInputFile,
+)
+from prometheus_client import start_http_server
+from vpn_common.events import AsyncEventConsumer, build_event_stream
+from vpn_common.metrics import observe_queue
+from .billing import BillingClient, BillingError, BillingRejected, CircuitBreaker
+from .broadcast import BroadcastManager, MemoryBroadcastStore, RedisBroadcastStore
+from .config import Settings, get_settings
+from .lifecycle import LifecycleNotifier
+from . import metrics
 # Explicit import from the concrete keyboards module avoids cases where
 # partial package imports leave helpers unavailable at runtime (seen as
 # NameError in docker logs).
-from .keyboards.main_kb import get_buy_menu, get_main_menu, get_profile_menu
+from .keyboards.registry import KeyboardRegistry
+from .subscriptions import (
+    InMemorySubscriptionRepository,
+    Subscription,
+    SubscriptionRepository,
+    build_repository,
+)
+from .payments import CURRENCY, InvoiceView, PaymentConfirmer, build_confirmation_queue, check_pre_checkout, subscription_fields
+from .pipeline import UpdatePipeline
+from .provisioner import ProvisionerClient
+from .tariffs import TariffCatalog
+from .throttling import Throttling, build_throttling
+from .webhook import create_webhook_app
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,94 +58,83 @@ MAIN_KEYBOARD = ReplyKeyboardMarkup(
 )
 
 
-@dataclass
-class Subscription:
-    user_id: int
-    tariff_code: str
-    active_until: datetime
-    proto: str = "amneziawg"
-    node_id: str = "default_nl"
-
-    @property
-    def is_active(self) -> bool:
-        return self.active_until > datetime.utcnow()
-
-
-TARIFFS: Dict[str, Dict[str, str | int]] = {
-    "trial": {"name": "Trial", "duration": 3, "price": 0},
-    "light": {"name": "Light", "duration": 30, "price": 110},
-    "family": {"name": "Family", "duration": 30, "price": 200},
-    "unlimited": {"name": "Unlimited", "duration": 30, "price": 290},
-    "year": {"name": "Годовая", "duration": 365, "price": 290 * 12 * 0.65},
-}
-
-SUBSCRIPTIONS: Dict[int, Subscription] = {}
+# Each invoice is a billing row; this bounds how fast a user can create them.
+INVOICE_RATE_LIMIT = (5, 60)
 
 
-def _get_active_subscription(user_id: int) -> Optional[Subscription]:
-    sub = SUBSCRIPTIONS.get(user_id)
+async def _get_active_subscription(
+    subscriptions: SubscriptionRepository, user_id: int
+) -> Optional[Subscription]:
+    sub = await subscriptions.get(user_id)
     if sub and sub.is_active:
         return sub
     return None
 
 
-def _create_subscription(user_id: int, tariff_code: str) -> Subscription:
-    tariff = TARIFFS.get(tariff_code, TARIFFS["trial"])
-    duration_days = int(tariff.get("duration", 3))
-    sub = Subscription(
-        user_id=user_id,
-        tariff_code=tariff_code,
-        active_until=datetime.utcnow() + timedelta(days=duration_days),
-    )
-    SUBSCRIPTIONS[user_id] = sub
+async def _save_from_billing(subscriptions: SubscriptionRepository, subscription: dict) -> Subscription:
+    """Store billing's subscription, keeping the user's protocol and node."""
+
+    current = await subscriptions.get(subscription["user_id"])
+    sub = Subscription(**subscription_fields(subscription))
+    if current is not None:
+        sub = replace(sub, proto=current.proto, node_id=current.node_id)
+    await subscriptions.save(sub)
     return sub
 
 
-@dataclass
-class Subscription:
-    user_id: int
-    tariff_code: str
-    active_until: datetime
-    proto: str = "amneziawg"
-    node_id: str = "default_nl"
+class BroadcastForm(StatesGroup):
+    text = State()
 
-    @property
-    def is_active(self) -> bool:
-        return self.active_until > datetime.utcnow()
 
+class PromoForm(StatesGroup):
+    code = State()
 
-TARIFFS: Dict[str, Dict[str, str | int]] = {
-    "trial": {"name": "Trial", "duration": 3, "price": 0},
-    "light": {"name": "Light", "duration": 30, "price": 110},
-    "family": {"name": "Family", "duration": 30, "price": 200},
-    "unlimited": {"name": "Unlimited", "duration": 30, "price": 290},
-    "year": {"name": "Годовая", "duration": 365, "price": 290 * 12 * 0.65},
-}
 
-SUBSCRIPTIONS: Dict[int, Subscription] = {}
+# Registered first so that the broadcast text wins over menu-button handlers.
+@router.message(BroadcastForm.text, Command("cancel"))
+async def broadcast_cancel_input(message: Message, state: FSMContext, keyboards: KeyboardRegistry):
+    await state.clear()
+    await message.answer("Рассылка отменена", reply_markup=keyboards.admin)
 
 
-def _get_active_subscription(user_id: int) -> Optional[Subscription]:
-    sub = SUBSCRIPTIONS.get(user_id)
-    if sub and sub.is_active:
-        return sub
-    return None
+@router.message(BroadcastForm.text, F.text)
+async def broadcast_text(
+    message: Message,
+    state: FSMContext,
+    bot: Bot,
+    broadcasts: BroadcastManager,
+    keyboards: KeyboardRegistry,
+):
+    await state.clear()
+    progress = await message.answer("Рассылка запускается…", reply_markup=keyboards.admin)
+    await broadcasts.start(bot, message.text, message.chat.id, progress.message_id)
 
 
-def _create_subscription(user_id: int, tariff_code: str) -> Subscription:
-    tariff = TARIFFS.get(tariff_code, TARIFFS["trial"])
-    duration_days = int(tariff.get("duration", 3))
-    sub = Subscription(
-        user_id=user_id,
-        tariff_code=tariff_code,
-        active_until=datetime.utcnow() + timedelta(days=duration_days),
+@router.message(PromoForm.code, Command("cancel"))
+async def promo_cancel_input(message: Message, state: FSMContext, keyboards: KeyboardRegistry):
+    await state.set_state(None)
+    await message.answer("Ввод промокода отменён", reply_markup=keyboards.main)
+
+
+@router.message(PromoForm.code, F.text, ~F.text.startswith("/"))
+async def promo_code_input(message: Message, state: FSMContext, keyboards: KeyboardRegistry):
+    await _remember_promo(message, state, keyboards, message.text)
+
+
+async def _remember_promo(message: Message, state: FSMContext, keyboards: KeyboardRegistry, code: str) -> None:
+    # Kept in FSM data (not state) until an invoice is issued with it.
+    await state.set_state(None)
+    await state.update_data(promo_code=code.strip())
+    await message.answer(
+        "Промокод сохранён и будет применён к следующему счёту. Выберите тариф:", reply_markup=keyboards.buy()
     )
-    SUBSCRIPTIONS[user_id] = sub
-    return sub
 
 
 @router.message(CommandStart())
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, command: CommandObject, state: FSMContext):
+    if command.args:
+        # Deep link t.me/<bot>?start=ref_<id>; billing binds the referrer on the first invoice.
+        await state.update_data(referral=command.args)
     await message.answer(
         "Привет! Я помогу купить подписку на VPN через Telegram Stars."
         "\nИспользуй кнопки ниже, чтобы узнать тарифы или получить пробный доступ.",
@@ -120,90 +142,502 @@ async def cmd_start(message: Message):
     )
 
 
-@router.message(Command("plans"))
-async def cmd_plans(message: Message):
-    await message.answer(
-        "Доступные тарифы:\n"
-        "• Trial — 0⭐️ на 3 дня, до 2 устройств.\n"
-        "• Light — 110⭐️ на 30 дней, до 2 устройств, скорость до 100 Mbps.\n"
-        "• Family — 200⭐️ на 30 дней, до 5 устройств, скорость до 300 Mbps.\n"
-        "• Unlimited — 290⭐️ на 30 дней, до 8 устройств, безлимитная скорость.",
-        reply_markup=MAIN_KEYBOARD,
-    )
+@router.message(Command("promo"))
+async def cmd_promo(message: Message, command: CommandObject, state: FSMContext, keyboards: KeyboardRegistry):
+    if command.args:
+        await _remember_promo(message, state, keyboards, command.args)
+        return
+    await state.set_state(PromoForm.code)
+    await message.answer("Пришлите промокод или /cancel")
 
 
-@router.message(Command("trial"))
-async def cmd_trial(message: Message):
+@router.callback_query(F.data == "promo")
+async def promo_callback(callback: CallbackQuery, bot: Bot, state: FSMContext):
+    await state.set_state(PromoForm.code)
+    await callback.answer()
+    await bot.send_message(callback.from_user.id, "Пришлите промокод или /cancel")
+
+
+@router.message(Command("plans"))
+async def cmd_plans(message: Message, tariffs: TariffCatalog):
+    await message.answer(tariffs.plans_text(), reply_markup=MAIN_KEYBOARD)
+
+
+@router.message(Command("trial"), flags={"rate_limit": (3, 60)})
+async def cmd_trial(
+    message: Message, subscriptions: SubscriptionRepository, keyboards: KeyboardRegistry, billing: BillingClient
+):
+    try:
+        trial = await billing.start_trial(message.from_user.id)
+    except BillingRejected:
+        await message.answer(
+            "Пробный доступ доступен только до первой подписки. Тарифы: /plans", reply_markup=keyboards.main
+        )
+        return
+    except BillingError as exc:
+        logger.warning("Trial for %s failed: %s", message.from_user.id, exc)
+        await message.answer("Не удалось оформить пробный доступ, попробуйте через пару минут", reply_markup=keyboards.main)
+        return
+    sub = await _save_from_billing(subscriptions, trial)
     await message.answer(
-        "Пробный доступ на 3 дня оформляется мгновенно и без оплаты."
-        "\nНажмите кнопку /trial ещё раз или отправьте /trial вручную, чтобы получить пробный тариф.",
-        reply_markup=MAIN_KEYBOARD,
+        f"Пробный доступ активирован до {sub.active_until:%d.%m.%Y}", reply_markup=keyboards.profile(True)
     )
 
 
-@router.message(F.text == "Продлить подписку")
-async def extend_subscription(message: Message):
-    sub = _get_active_subscription(message.from_user.id)
+@router.message(F.text == "Продлить подписку", flags={"rate_limit": INVOICE_RATE_LIMIT})
+async def extend_subscription(
+    message: Message,
+    bot: Bot,
+    subscriptions: SubscriptionRepository,
+    keyboards: KeyboardRegistry,
+    tariffs: TariffCatalog,
+    billing: BillingClient,
+    state: FSMContext,
+):
+    sub = await subscriptions.get(message.from_user.id)
+    tariff = tariffs.get(sub.tariff_code) if sub is not None else None
+    if tariff is None or tariff["price_stars"] <= 0:
+        # Nothing paid to renew (no subscription or a trial): pick a plan.
+        await message.answer("Выберите тариф:", reply_markup=keyboards.buy())
+        return
+    # The new period is added by billing once the invoice is paid.
+    key = f"tg-m{message.chat.id}-{message.message_id}"
+    error = await _send_invoice(bot, billing, state, message.from_user.id, tariff, key)
+    if error is not None:
+        await message.answer(error, reply_markup=keyboards.profile(sub.is_active))
+
+
+@router.message(F.text == "Сменить протокол/узел", flags={"rate_limit": (3, 60)})
+async def switch_proto(
+    message: Message,
+    subscriptions: SubscriptionRepository,
+    keyboards: KeyboardRegistry,
+    provisioner: ProvisionerClient,
+):
+    sub = await _get_active_subscription(subscriptions, message.from_user.id)
     if not sub:
-        await message.answer("Сначала оформите подписку", reply_markup=get_main_menu())
+        await message.answer("Сначала оформите подписку", reply_markup=keyboards.main)
         return
-    SUBSCRIPTIONS[message.from_user.id] = Subscription(
-        user_id=sub.user_id,
-        tariff_code=sub.tariff_code,
-        active_until=sub.active_until + timedelta(days=30),
+
+    try:
+        node_id = await provisioner.place_node(exclude=[sub.node_id])
+    except Exception as exc:
+        # No other healthy node (or the provisioner is down): switch protocol only.
+        logger.warning("Node placement for %s failed: %s", message.from_user.id, exc)
+        node_id = sub.node_id
+    sub = replace(
+        sub,
+        proto="wireguard" if sub.proto == "amneziawg" else "amneziawg",
+        node_id=node_id,
     )
+    await subscriptions.save(sub)
     await message.answer(
-        "Подписка продлена ещё на 30 дней",
-        reply_markup=get_profile_menu(True),
+        f"Протокол переключен на {sub.proto.upper()} (узел {sub.node_id})",
+        reply_markup=keyboards.profile(True),
     )
 
 
-@router.message(F.text == "Сменить протокол/узел")
-async def switch_proto(message: Message):
-    sub = _get_active_subscription(message.from_user.id)
+DEFAULT_DEVICE = "main"
+
+
+async def _provisioned_device(
+    message: Message,
+    subscriptions: SubscriptionRepository,
+    keyboards: KeyboardRegistry,
+    provisioner: ProvisionerClient,
+) -> Optional[dict]:
+    sub = await _get_active_subscription(subscriptions, message.from_user.id)
     if not sub:
-        await message.answer("Сначала оформите подписку", reply_markup=get_main_menu())
+        await message.answer("Сначала оформите подписку", reply_markup=keyboards.main)
+        return None
+    try:
+        # Cheap when nothing changed: the provisioner returns the stored version.
+        return await provisioner.provision(
+            sub.user_id, sub.proto, DEFAULT_DEVICE, sub.tariff_code, node_id=sub.node_id
+        )
+    except Exception as exc:
+        logger.warning("Provisioning for %s failed: %s", message.from_user.id, exc)
+        await message.answer("Конфиг временно недоступен, попробуйте позже", reply_markup=keyboards.profile(True))
+        return None
+
+
+@router.message(F.text == "Мой конфиг (скачать)", flags={"rate_limit": (5, 60)})
+async def download_config(
+    message: Message,
+    subscriptions: SubscriptionRepository,
+    keyboards: KeyboardRegistry,
+    provisioner: ProvisionerClient,
+):
+    device = await _provisioned_device(message, subscriptions, keyboards, provisioner)
+    if device is None:
         return
+    # aiogram streams the download into the upload; nothing is buffered here.
+    document = URLInputFile(
+        provisioner.config_url(device),
+        filename=f"vpn-{device['protocol']}-{device['node_id']}.conf",
+    )
+    await message.answer_document(
+        document,
+        caption=f"{device['protocol'].upper()}, узел {device['node_id']} (версия {device['config_version']})",
+        reply_markup=keyboards.profile(True),
+    )
 
-    sub.proto = "wireguard" if sub.proto == "amneziawg" else "amneziawg"
-    sub.node_id = "default_fra" if sub.node_id == "default_nl" else "default_nl"
-    await message.answer(
-        f"Протокол переключен на {sub.proto.upper()} (узел {sub.node_id})",
-        reply_markup=get_profile_menu(True),
+
+@router.message(F.text == "QR-код", flags={"rate_limit": (5, 60)})
+async def config_qr(
+    message: Message,
+    subscriptions: SubscriptionRepository,
+    keyboards: KeyboardRegistry,
+    provisioner: ProvisionerClient,
+):
+    device = await _provisioned_device(message, subscriptions, keyboards, provisioner)
+    if device is None:
+        return
+    await message.answer_photo(
+        URLInputFile(provisioner.qr_url(device), filename="qr.png"),
+        caption="Отсканируйте в приложении AmneziaVPN или WireGuard",
+        reply_markup=keyboards.profile(True),
     )
 
 
+def _format_bytes(size: int) -> str:
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ТБ"
+
+
 @router.message(F.text == "Статистика трафика")
-async def traffic_stats(message: Message):
-    sub = _get_active_subscription(message.from_user.id)
+async def traffic_stats(
+    message: Message,
+    subscriptions: SubscriptionRepository,
+    keyboards: KeyboardRegistry,
+    provisioner: ProvisionerClient,
+):
+    sub = await _get_active_subscription(subscriptions, message.from_user.id)
     if not sub:
-        await message.answer("Нет активной подписки", reply_markup=get_main_menu())
+        await message.answer("Нет активной подписки", reply_markup=keyboards.main)
         return
+    try:
+        usage = await provisioner.traffic(message.from_user.id)
+    except Exception as exc:
+        logger.warning("Traffic stats for %s failed: %s", message.from_user.id, exc)
+        await message.answer("Статистика временно недоступна, попробуйте позже", reply_markup=keyboards.profile(True))
+        return
+    if not usage:
+        text = "У вас пока нет подключённых устройств"
+    else:
+        day_rx = sum(p["rx_bytes"] for p in usage["series"][-24:])
+        day_tx = sum(p["tx_bytes"] for p in usage["series"][-24:])
+        lines = [
+            f"За 24 часа: ↓ {_format_bytes(day_tx)} ↑ {_format_bytes(day_rx)}",
+            f"Всего: ↓ {_format_bytes(usage['tx_bytes'])} ↑ {_format_bytes(usage['rx_bytes'])}",
+        ]
+        for device in usage["devices"]:
+            total = device["rx_bytes"] + device["tx_bytes"]
+            lines.append(f"• {device['device_name']} ({device['node_id']}): {_format_bytes(total)}")
+        text = "\n".join(lines)
+    await message.answer(text, reply_markup=keyboards.profile(True))
+
+
+@router.message(F.text == "Купить подписку")
+async def buy_menu(message: Message, keyboards: KeyboardRegistry):
+    await message.answer("Выберите тариф:", reply_markup=keyboards.buy())
+
+
+async def _send_invoice(
+    bot: Bot, billing: BillingClient, state: FSMContext, user_id: int, tariff: dict, idempotency_key: str
+) -> Optional[str]:
+    """Create the invoice in billing and send it as a Stars invoice; the error to show otherwise.
+
+    A promo code entered with /promo and a referral from the /start link go
+    with the invoice and are used up once billing accepts it.
+    """
+
+    data = await state.get_data()
+    promo_code = data.get("promo_code")
+    try:
+        invoice = await billing.start_payment(
+            user_id,
+            tariff["code"],
+            idempotency_key=idempotency_key,
+            promo_code=promo_code,
+            referral=data.get("referral"),
+        )
+    except BillingRejected as exc:
+        if promo_code is None or exc.status_code not in (400, 409):
+            logger.warning("Invoice for %s rejected: %s", user_id, exc.detail)
+            return "Не удалось выставить счёт, выберите тариф ещё раз"
+        await state.update_data(promo_code=None)
+        return "Промокод недействителен или уже использован. Выберите тариф ещё раз, счёт будет без скидки"
+    except BillingError as exc:
+        logger.warning("Invoice for %s failed: %s", user_id, exc)
+        return "Оплата временно недоступна, попробуйте через пару минут"
+    if promo_code is not None or data.get("referral") is not None:
+        await state.update_data(promo_code=None, referral=None)
+    view = InvoiceView(invoice["invoice_id"], user_id, tariff["code"], invoice["amount_stars"])
+    await bot.send_invoice(
+        chat_id=user_id,
+        title=f"VPN {tariff['name']}",
+        description=f"Подписка {tariff['name']} на {tariff['duration_days']} дн.",
+        payload=view.payload,
+        currency=CURRENCY,
+        prices=[LabeledPrice(label=tariff["name"], amount=view.amount_stars)],
+    )
+    return None
+
+
+@router.callback_query(F.data.startswith("plan_"), flags={"rate_limit": INVOICE_RATE_LIMIT})
+async def choose_plan(
+    callback: CallbackQuery, bot: Bot, tariffs: TariffCatalog, billing: BillingClient, state: FSMContext
+):
+    tariff = tariffs.get(callback.data[len("plan_"):])
+    if tariff is None or tariff["price_stars"] <= 0:
+        await callback.answer("Тариф недоступен", show_alert=True)
+        return
+    # A repeated tap is a new callback (and a new invoice); retries of this one are not.
+    error = await _send_invoice(bot, billing, state, callback.from_user.id, tariff, f"tg-{callback.id}")
+    await callback.answer(error, show_alert=error is not None)
+
+
+@router.pre_checkout_query()
+async def pre_checkout(query: PreCheckoutQuery, tariffs: TariffCatalog, payments: PaymentConfirmer):
+    # Answered from local state only: Telegram cancels the payment after 10 seconds.
+    error = check_pre_checkout(
+        query.invoice_payload, query.from_user.id, query.currency, query.total_amount, tariffs, payments.paid
+    )
+    await query.answer(ok=error is None, error_message=error)
+
+
+@router.message(F.successful_payment)
+async def successful_payment(
+    message: Message,
+    subscriptions: SubscriptionRepository,
+    keyboards: KeyboardRegistry,
+    payments: PaymentConfirmer,
+):
+    payment = message.successful_payment
+    view = InvoiceView.from_payload(payment.invoice_payload)
+    if view is None:
+        logger.error("Payment %s with unknown payload %r", payment.telegram_payment_charge_id, payment.invoice_payload)
+        await message.answer("Платёж получен, но счёт не распознан. Напишите в поддержку", reply_markup=keyboards.main)
+        return
+    try:
+        paid = await payments.confirm(message.from_user.id, view.token, payment.telegram_payment_charge_id)
+    except BillingRejected as exc:
+        logger.error("Billing rejected paid invoice %s: %s", view.token, exc.detail)
+        await message.answer("Платёж получен, но не подтверждён. Напишите в поддержку", reply_markup=keyboards.main)
+        return
+    if paid is None:
+        await message.answer(
+            "Платёж получен. Подписка активируется автоматически в течение нескольких минут",
+            reply_markup=keyboards.main,
+        )
+        return
+    sub = await _save_from_billing(subscriptions, paid)
     await message.answer(
-        "Статистика скоро появится. Пока держим вас онлайн!",
-        reply_markup=get_profile_menu(True),
+        f"Оплата прошла! Подписка {sub.tariff_code} активна до {sub.active_until:%d.%m.%Y}",
+        reply_markup=keyboards.profile(True),
     )
 
 
-@router.message(F.text == "« Главное меню")
-async def back_home(message: Message):
-    await message.answer("Возвращаю главное меню", reply_markup=get_main_menu())
+@router.message(F.text == "Личный кабинет")
+async def profile_menu(
+    message: Message, subscriptions: SubscriptionRepository, keyboards: KeyboardRegistry
+):
+    sub = await _get_active_subscription(subscriptions, message.from_user.id)
+    if sub:
+        text = f"Подписка {sub.tariff_code} активна до {sub.active_until:%d.%m.%Y}"
+    else:
+        text = "Активной подписки нет"
+    await message.answer(text, reply_markup=keyboards.profile(sub is not None))
+
+
+@router.callback_query(F.data == "back_main")
+async def back_main_callback(callback: CallbackQuery, keyboards: KeyboardRegistry):
+    await callback.answer()
+    await callback.message.answer("Возвращаю главное меню", reply_markup=keyboards.main)
+
+
+@router.message(F.text.in_({"« Главное меню", "Админ: обратно"}))
+async def back_home(message: Message, keyboards: KeyboardRegistry):
+    await message.answer("Возвращаю главное меню", reply_markup=keyboards.main)
+
+
+@router.message(Command("admin"))
+async def cmd_admin(message: Message, keyboards: KeyboardRegistry, admin_ids: frozenset):
+    if message.from_user.id not in admin_ids:
+        return
+    await message.answer("Админ-панель", reply_markup=keyboards.admin)
+
+
+@router.message(F.text == "Админ: рассылка")
+async def admin_broadcast(
+    message: Message, state: FSMContext, broadcasts: BroadcastManager, admin_ids: frozenset
+):
+    if message.from_user.id not in admin_ids:
+        return
+    if broadcasts.active:
+        await message.answer("Рассылка уже идёт. Остановить: /stop_broadcast")
+        return
+    await state.set_state(BroadcastForm.text)
+    await message.answer("Пришлите текст рассылки или /cancel")
+
+
+@router.message(Command("stop_broadcast"))
+async def stop_broadcast(message: Message, broadcasts: BroadcastManager, admin_ids: frozenset):
+    if message.from_user.id not in admin_ids:
+        return
+    stopped = broadcasts.cancel_all()
+    await message.answer("Рассылка останавливается" if stopped else "Активных рассылок нет")
+
+
+@router.message(F.text == "Админ: метрики")
+async def admin_metrics(message: Message, admin_ids: frozenset, billing: BillingClient):
+    if message.from_user.id not in admin_ids:
+        return
+    try:
+        business = metrics.business_summary(await billing.analytics())
+    except BillingError as exc:
+        business = f"Бизнес-метрики недоступны: {exc}"
+    await message.answer(business + "\n\n" + metrics.summary())
 
 
 def register_service_routes(dp: Dispatcher):
     dp.include_router(router)
 
 
-def create_dispatcher() -> Dispatcher:
-    dp = Dispatcher()
+def create_dispatcher(
+    subscriptions: Optional[SubscriptionRepository] = None,
+    tariffs: Optional[TariffCatalog] = None,
+    admin_ids: Iterable[int] = (),
+    provisioner: Optional[ProvisionerClient] = None,
+    storage: Optional[BaseStorage] = None,
+    throttling: Optional[Throttling] = None,
+    broadcasts: Optional[BroadcastManager] = None,
+    billing: Optional[BillingClient] = None,
+    payments: Optional[PaymentConfirmer] = None,
+) -> Dispatcher:
+    dp = Dispatcher(storage=storage or MemoryStorage())
+    metrics.install_metrics(dp)
+    (throttling or build_throttling()).install(dp)
+    # Handlers receive shared services through aiogram's workflow data.
+    dp["subscriptions"] = subscriptions or InMemorySubscriptionRepository()
+    dp["tariffs"] = tariffs or TariffCatalog()
+    dp["keyboards"] = KeyboardRegistry(dp["tariffs"])
+    dp["admin_ids"] = frozenset(admin_ids)
+    dp["provisioner"] = provisioner or ProvisionerClient()
+    dp["broadcasts"] = broadcasts or BroadcastManager(dp["subscriptions"])
+    dp["billing"] = billing or BillingClient()
+    dp["payments"] = payments or PaymentConfirmer(dp["billing"])
+    observe_queue("payment_confirmations", lambda: len(dp["payments"].queue))
+    observe_queue(
+        "broadcast_in_flight", lambda: sum(b.in_flight for b in dp["broadcasts"].active.values())
+    )
     register_service_routes(dp)
     return dp
 
 
+async def run_webhook(bot: Bot, dp: Dispatcher, settings: Settings) -> None:
+    """Serve updates via webhook until SIGINT/SIGTERM, then drain the queue."""
+
+    pipeline = UpdatePipeline(
+        dp,
+        bot,
+        workers=settings.update_workers,
+        queue_size=settings.update_queue_size,
+    )
+    app = create_webhook_app(
+        pipeline,
+        bot,
+        path=settings.webhook_path,
+        secret_token=settings.webhook_secret,
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", settings.webhook_port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await dp.emit_startup(bot=bot)
+    try:
+        await site.start()
+        await bot.set_webhook(
+            url=settings.webhook_url.rstrip("/") + settings.webhook_path,
+            secret_token=settings.webhook_secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info("Webhook listening on :%s%s", settings.webhook_port, settings.webhook_path)
+        await stop.wait()
+    finally:
+        # Runner cleanup stops accepting requests and drains the pipeline.
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot)
+
+
 def main():
     settings = get_settings()
     bot = Bot(token=settings.bot_token)
-    dp = create_dispatcher()
+    subscriptions = build_repository(
+        redis_url=settings.redis_url,
+        cache_size=settings.subscription_cache_size,
+        cache_ttl=settings.subscription_cache_ttl,
+    )
+    billing = BillingClient(
+        str(settings.billing_url),
+        timeout=settings.billing_timeout_sec,
+        retries=settings.billing_retries,
+        breaker=CircuitBreaker(settings.billing_breaker_failures, settings.billing_breaker_reset_sec),
+        token=settings.billing_token,
+    )
+    # One connection pool to billing for the catalog and payments.
+    tariffs = TariffCatalog(str(settings.billing_url), client=billing.http)
+    payments = PaymentConfirmer(billing, build_confirmation_queue(settings.payment_queue_path))
+    provisioner = ProvisionerClient(str(settings.provisioner_url), token=settings.provisioner_token)
+    redis = None
+    storage: BaseStorage = MemoryStorage()
+    if settings.redis_url:
+        from aiogram.fsm.storage.redis import RedisStorage
+        from redis import asyncio as aioredis
+
+        # One connection pool for FSM state, rate limits and dedup keys,
+        # shared by every bot worker pointed at the same Redis.
+        redis = aioredis.from_url(settings.redis_url)
+        storage = RedisStorage(redis)
+    throttling = build_throttling(
+        redis,
+        rate=settings.throttle_rate,
+        period=settings.throttle_period,
+        tap_window=settings.tap_window,
+    )
+    broadcasts = BroadcastManager(
+        subscriptions,
+        RedisBroadcastStore(redis) if redis is not None else MemoryBroadcastStore(),
+        rate=settings.broadcast_rate,
+        workers=settings.broadcast_workers,
+        page_size=settings.broadcast_page_size,
+    )
+    dp = create_dispatcher(
+        subscriptions,
+        tariffs,
+        settings.bot_admin_ids,
+        provisioner,
+        storage=storage,
+        throttling=throttling,
+        broadcasts=broadcasts,
+        billing=billing,
+        payments=payments,
+    )
+    events = build_event_stream(settings.events_backend, settings.redis_url)
+    lifecycle = None
+    if events is not None:
+        notifier = LifecycleNotifier(bot, subscriptions, broadcasts.bucket)
+        lifecycle = AsyncEventConsumer(events, "bot", notifier.handle, batch_size=settings.events_batch_size)
+        observe_queue("events_bot_pending", lifecycle.pending)
     logging.info("Bot started with billing backend %s", settings.billing_url)
 
     async def run_bot():
@@ -212,9 +646,41 @@ def main():
                 BotCommand(command="start", description="Запустить бота"),
                 BotCommand(command="plans", description="Посмотреть тарифы"),
                 BotCommand(command="trial", description="Получить пробный доступ"),
+                BotCommand(command="promo", description="Ввести промокод"),
             ]
         )
-        await dp.start_polling(bot)
+        tariffs.start()
+
+        async def on_confirmed(user_id: int, paid: dict) -> None:
+            sub = await _save_from_billing(subscriptions, paid)
+            await bot.send_message(user_id, f"Оплата подтверждена, подписка активна до {sub.active_until:%d.%m.%Y}")
+
+        payments.start(on_confirmed)
+        if lifecycle is not None:
+            lifecycle.start()
+        # Picks up broadcasts interrupted by a restart from their checkpoint.
+        await broadcasts.resume(bot)
+        try:
+            if settings.webhook_url:
+                await run_webhook(bot, dp, settings)
+            else:
+                # Polling stays as the zero-config fallback.
+                if settings.metrics_port:
+                    # No webhook server to hang /metrics on in this mode.
+                    start_http_server(settings.metrics_port)
+                await bot.delete_webhook()
+                await dp.start_polling(bot)
+        finally:
+            if lifecycle is not None:
+                await lifecycle.stop()
+            await broadcasts.stop()
+            await payments.stop()
+            await tariffs.stop()
+            await billing.close()
+            await provisioner.close()
+            await subscriptions.close()
+            await storage.close()
+            await bot.session.close()
 
     asyncio.run(run_bot())
 
@@ -0,0 +1,182 @@
+"""Prometheus metrics for the bot: update and handler latency and dropped
+updates. Upstream calls and work-queue depths are reported through
+``vpn_common.metrics`` like in the other services.
+
+Labels only take values from fixed sets: the update type, the handler
+function name and the drop reason. ``summary()`` renders all of it,
+upstreams and queues included, for the admin menu.
+"""
+
+from __future__ import annotations
+
+import math
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject, Update
+from prometheus_client import Counter, Gauge, Histogram
+from vpn_common.metrics import QUEUE_DEPTH, UPSTREAM_LATENCY
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+UPDATE_LATENCY = Histogram("bot_update_duration_seconds", "Time to process an update", ["type"])
+UPDATES = Counter("bot_updates_total", "Processed updates by type and outcome", ["type", "outcome"])
+IN_FLIGHT = Gauge("bot_updates_in_progress", "Updates being processed")
+HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Handler latency", ["handler"])
+DROPPED = Counter("bot_updates_dropped_total", "Updates dropped before reaching a handler", ["reason"])
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer ``update`` middleware; registered before throttling so it sees drops too."""
+
+    def __init__(self) -> None:
+        self._children: Dict[str, Tuple[Histogram, Counter, Counter]] = {}
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        kind = event.event_type if isinstance(event, Update) else type(event).__name__
+        children = self._children.get(kind)
+        if children is None:
+            children = self._children[kind] = (
+                UPDATE_LATENCY.labels(kind),
+                UPDATES.labels(kind, "ok"),
+                UPDATES.labels(kind, "error"),
+            )
+        latency, ok, error = children
+        IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            result = await handler(event, data)
+        except Exception:
+            error.inc()
+            raise
+        else:
+            ok.inc()
+            return result
+        finally:
+            latency.observe(time.perf_counter() - started)
+            IN_FLIGHT.dec()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    def __init__(self) -> None:
+        self._children: Dict[str, Histogram] = {}
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        name = data["handler"].callback.__name__
+        histogram = self._children.get(name)
+        if histogram is None:
+            histogram = self._children[name] = HANDLER_LATENCY.labels(name)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+
+def install_metrics(dp: Dispatcher) -> None:
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    handler_middleware = HandlerMetricsMiddleware()
+    dp.message.middleware(handler_middleware)
+    dp.callback_query.middleware(handler_middleware)
+
+
+def _samples(metric, suffix: str = "") -> Iterator[Tuple[Dict[str, str], float]]:
+    for family in metric.collect():
+        for sample in family.samples:
+            if sample.name.endswith(suffix):
+                yield sample.labels, sample.value
+
+
+def _quantile(buckets: List[Tuple[float, float]], count: float, q: float) -> float:
+    """Upper bound of the bucket holding the ``q`` quantile."""
+
+    rank = q * count
+    for bound, cumulative in sorted(buckets):
+        if cumulative >= rank:
+            return bound
+    return math.inf
+
+
+def _ms(seconds: float) -> str:
+    return "> 10 с" if math.isinf(seconds) else f"{seconds * 1000:.0f} мс"
+
+
+def summary(top: int = 5) -> str:
+    """Short text report for the admin menu."""
+
+    outcomes: Dict[str, float] = defaultdict(float)
+    for labels, value in _samples(UPDATES, "_total"):
+        outcomes[labels["outcome"]] += value
+    in_flight = sum(value for _, value in _samples(IN_FLIGHT))
+    lines = [
+        f"Обновлений: {outcomes['ok'] + outcomes['error']:.0f} (ошибок {outcomes['error']:.0f}), "
+        f"сейчас в обработке: {in_flight:.0f}"
+    ]
+
+    dropped = {labels["reason"]: value for labels, value in _samples(DROPPED, "_total") if value}
+    if dropped:
+        lines.append("Отброшено: " + ", ".join(f"{reason} {value:.0f}" for reason, value in sorted(dropped.items())))
+
+    counts = {labels["handler"]: value for labels, value in _samples(HANDLER_LATENCY, "_count")}
+    buckets: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+    for labels, value in _samples(HANDLER_LATENCY, "_bucket"):
+        buckets[labels["handler"]].append((float(labels["le"]), value))
+    slowest = sorted(
+        ((name, _quantile(buckets[name], count, 0.95), count) for name, count in counts.items() if count),
+        key=lambda item: item[1],
+        reverse=True,
+    )[:top]
+    if slowest:
+        lines.append("Обработчики, p95:")
+        lines.extend(f"• {name}: {_ms(p95)} (вызовов {count:.0f})" for name, p95, count in slowest)
+
+    # host -> [calls, seconds, failed calls]
+    upstreams: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0.0, 0.0])
+    for labels, value in _samples(UPSTREAM_LATENCY, "_count"):
+        stats = upstreams[labels["upstream"]]
+        stats[0] += value
+        if labels["outcome"] in ("5xx", "error"):
+            stats[2] += value
+    for labels, value in _samples(UPSTREAM_LATENCY, "_sum"):
+        upstreams[labels["upstream"]][1] += value
+    if upstreams:
+        lines.append("Внешние сервисы:")
+        lines.extend(
+            f"• {host}: {_ms(total / calls)} в среднем, ошибок {failed:.0f} из {calls:.0f}"
+            for host, (calls, total, failed) in sorted(upstreams.items())
+            if calls
+        )
+
+    queues = [(labels["queue"], value) for labels, value in _samples(QUEUE_DEPTH) if not math.isnan(value)]
+    if queues:
+        lines.append("Очереди: " + ", ".join(f"{name} {value:.0f}" for name, value in sorted(queues)))
+    return "\n".join(lines)
+
+
+def _rate(value: Optional[float]) -> str:
+    return "—" if value is None else f"{value * 100:.1f}%"
+
+
+def business_summary(analytics: Dict[str, Any]) -> str:
+    """Billing's ``GET /analytics`` rollups as text for the admin menu."""
+
+    window = analytics["window"]
+    lines = [
+        f"Активных подписок: {analytics['active']} (платных {analytics['paying']}), "
+        f"в льготном периоде: {analytics['grace']}",
+        f"MRR: {analytics['mrr_stars']} ⭐",
+    ]
+    lines.extend(
+        f"• {tariff['code']}: {tariff['active']} активных, {tariff['grace']} в льготном, MRR {tariff['mrr_stars']} ⭐"
+        for tariff in analytics["tariffs"]
+    )
+    lines.append(
+        f"Триал → оплата: {analytics['conversions']} из {analytics['trials']} ({_rate(analytics['conversion_rate'])})"
+    )
+    lines.append(
+        f"За {analytics['window_days']} дн.: новых платных {window['new_paid']}, ушло {window['churned']} "
+        f"(отток {_rate(analytics['churn_rate'])}), выручка {window['revenue_stars']} ⭐"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,316 @@
+"""Telegram Stars checkout: invoice views, pre-checkout and durable confirmation.
+
+Telegram gives the bot 10 seconds to answer a ``pre_checkout_query``, so it
+is answered without any network call. The invoice payload is the bot's view
+of the invoice (billing token, user, tariff, amount), and Telegram hands it
+back unchanged. Pre-checkout therefore only has to check it against the
+local tariff catalog and a cache of invoices this process already saw paid.
+Any bot replica can answer, whichever one sent the invoice.
+
+After ``successful_payment`` the stars are already charged, so the
+confirmation must reach billing eventually. When billing is unavailable the
+confirmation goes to a ``ConfirmationQueue`` (an SQLite file in production)
+and a background task retries it with backoff. Billing confirms are
+idempotent, so a confirmation replayed after a crash does no harm.
+"""
+
+from __future__ import annotations
+
+import abc
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from .billing import BillingClient, BillingRejected, BillingUnavailable
+from .cache import TTLCache
+from .tariffs import TariffCatalog
+
+logger = logging.getLogger(__name__)
+
+CURRENCY = "XTR"  # Telegram Stars
+PAYLOAD_VERSION = "v1"
+
+
+@dataclass(frozen=True)
+class InvoiceView:
+    token: str
+    user_id: int
+    tariff_code: str
+    amount_stars: int
+
+    @property
+    def payload(self) -> str:
+        # Telegram allows 128 bytes; billing tokens are 27 URL-safe characters.
+        return f"{PAYLOAD_VERSION}:{self.token}:{self.user_id}:{self.tariff_code}:{self.amount_stars}"
+
+    @classmethod
+    def from_payload(cls, payload: str) -> Optional["InvoiceView"]:
+        parts = payload.split(":")
+        if len(parts) != 5 or parts[0] != PAYLOAD_VERSION:
+            return None
+        try:
+            return cls(token=parts[1], user_id=int(parts[2]), tariff_code=parts[3], amount_stars=int(parts[4]))
+        except ValueError:
+            return None
+
+
+def check_pre_checkout(
+    payload: str,
+    user_id: int,
+    currency: str,
+    total_amount: int,
+    tariffs: TariffCatalog,
+    paid: TTLCache,
+) -> Optional[str]:
+    """``None`` to accept, otherwise the reason shown to the user. No I/O."""
+
+    view = InvoiceView.from_payload(payload)
+    if view is None or view.user_id != user_id:
+        return "Счёт не найден, оформите оплату заново"
+    if currency != CURRENCY or total_amount != view.amount_stars:
+        return "Сумма счёта не совпадает, оформите оплату заново"
+    tariff = tariffs.get(view.tariff_code)
+    # Promo codes only lower the price; a higher amount means a stale or forged view.
+    if tariff is None or view.amount_stars > tariff["price_stars"]:
+        return "Тариф больше недоступен, выберите другой"
+    if paid.lookup(view.token)[0]:
+        return "Этот счёт уже оплачен"
+    return None
+
+
+@dataclass
+class Confirmation:
+    token: str
+    user_id: int
+    charge_id: str
+    attempts: int = 0
+    next_at: float = 0.0
+    last_error: str = ""
+
+
+class ConfirmationQueue(abc.ABC):
+    """Payments charged by Telegram but not yet confirmed in billing."""
+
+    @abc.abstractmethod
+    async def put(self, item: Confirmation) -> None:
+        """Add or replace the confirmation for ``item.token``."""
+
+    @abc.abstractmethod
+    async def due(self, now: float, limit: int) -> List[Confirmation]:
+        ...
+
+    @abc.abstractmethod
+    async def remove(self, token: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def fail(self, item: Confirmation, error: str) -> None:
+        """Park a confirmation billing rejected; it needs a human, not retries."""
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        ...
+
+
+class MemoryConfirmationQueue(ConfirmationQueue):
+    def __init__(self) -> None:
+        self._items: Dict[str, Confirmation] = {}
+        self.failed: Dict[str, Confirmation] = {}
+
+    async def put(self, item: Confirmation) -> None:
+        self._items[item.token] = item
+
+    async def due(self, now: float, limit: int) -> List[Confirmation]:
+        items = sorted((i for i in self._items.values() if i.next_at <= now), key=lambda i: i.next_at)
+        return items[:limit]
+
+    async def remove(self, token: str) -> None:
+        self._items.pop(token, None)
+
+    async def fail(self, item: Confirmation, error: str) -> None:
+        self._items.pop(item.token, None)
+        item.last_error = error
+        self.failed[item.token] = item
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class SqliteConfirmationQueue(ConfirmationQueue):
+    """Survives restarts and a Redis outage; keep the file on a volume."""
+
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS confirmations ("
+                " token TEXT PRIMARY KEY, user_id INTEGER NOT NULL, charge_id TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL, next_at REAL NOT NULL, last_error TEXT NOT NULL,"
+                " status TEXT NOT NULL DEFAULT 'pending')"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_confirmations_due ON confirmations (status, next_at)"
+            )
+            self._pending = self._conn.execute(
+                "SELECT count(*) FROM confirmations WHERE status = 'pending'"
+            ).fetchone()[0]
+
+    def _execute(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            self._pending = self._conn.execute(
+                "SELECT count(*) FROM confirmations WHERE status = 'pending'"
+            ).fetchone()[0]
+            return rows
+
+    async def put(self, item: Confirmation) -> None:
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO confirmations (token, user_id, charge_id, attempts, next_at, last_error)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (item.token, item.user_id, item.charge_id, item.attempts, item.next_at, item.last_error),
+        )
+
+    async def due(self, now: float, limit: int) -> List[Confirmation]:
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT token, user_id, charge_id, attempts, next_at, last_error FROM confirmations"
+            " WHERE status = 'pending' AND next_at <= ? ORDER BY next_at LIMIT ?",
+            (now, limit),
+        )
+        return [Confirmation(*row) for row in rows]
+
+    async def remove(self, token: str) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM confirmations WHERE token = ?", (token,))
+
+    async def fail(self, item: Confirmation, error: str) -> None:
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE confirmations SET status = 'failed', last_error = ? WHERE token = ?",
+            (error, item.token),
+        )
+
+    def __len__(self) -> int:
+        return self._pending
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def build_confirmation_queue(path: Optional[str]) -> ConfirmationQueue:
+    return SqliteConfirmationQueue(path) if path else MemoryConfirmationQueue()
+
+
+ConfirmedCallback = Callable[[int, Dict[str, Any]], Awaitable[None]]
+
+
+class PaymentConfirmer:
+    """Confirms paid invoices in billing, parking them in the queue while it is down."""
+
+    def __init__(
+        self,
+        billing: BillingClient,
+        queue: Optional[ConfirmationQueue] = None,
+        interval: float = 5.0,
+        max_delay: float = 300.0,
+        batch_size: int = 50,
+        paid_cache_size: int = 100_000,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.billing = billing
+        self.queue = queue if queue is not None else MemoryConfirmationQueue()
+        self.interval = interval
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.paid: TTLCache = TTLCache(paid_cache_size, ttl=7 * 86400)
+        self._clock = clock
+        self._on_confirmed: Optional[ConfirmedCallback] = None
+        self._task: Optional[asyncio.Task] = None
+        self.queued = self.recovered = 0
+
+    async def confirm(self, user_id: int, token: str, charge_id: str) -> Optional[Dict[str, Any]]:
+        """The confirmed subscription, or ``None`` if the confirmation was queued."""
+
+        self.paid.set(token, True)
+        try:
+            return await self.billing.confirm_payment(token, charge_id)
+        except BillingUnavailable as exc:
+            logger.warning("Billing unavailable, queueing confirmation of %s: %s", token, exc)
+            await self.queue.put(
+                Confirmation(token, user_id, charge_id, next_at=self._clock() + self.interval, last_error=str(exc))
+            )
+            self.queued += 1
+            return None
+
+    def start(self, on_confirmed: ConfirmedCallback) -> None:
+        """Drain the queue in the background; ``on_confirmed`` runs for each recovered payment."""
+
+        self._on_confirmed = on_confirmed
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="payment-confirmations")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def drain(self) -> int:
+        """One pass over the due confirmations; stops at the first sign billing is still down."""
+
+        confirmed = 0
+        for item in await self.queue.due(self._clock(), self.batch_size):
+            try:
+                subscription = await self.billing.confirm_payment(item.token, item.charge_id)
+            except BillingUnavailable as exc:
+                item.attempts += 1
+                item.next_at = self._clock() + min(self.max_delay, self.interval * 2**item.attempts)
+                item.last_error = str(exc)
+                await self.queue.put(item)
+                break
+            except BillingRejected as exc:
+                logger.error(
+                    "Billing rejected paid invoice %s (user %s, charge %s): %s",
+                    item.token, item.user_id, item.charge_id, exc.detail,
+                )
+                await self.queue.fail(item, exc.detail)
+                continue
+            await self.queue.remove(item.token)
+            confirmed += 1
+            self.recovered += 1
+            if self._on_confirmed is not None:
+                try:
+                    await self._on_confirmed(item.user_id, subscription)
+                except Exception:
+                    logger.exception("Post-confirmation hook failed for %s", item.user_id)
+        return confirmed
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.drain()
+            except Exception:
+                logger.exception("Payment confirmation pass failed")
+            await asyncio.sleep(self.interval)
+
+
+def subscription_fields(subscription: Dict[str, Any]) -> Dict[str, Any]:
+    """Billing's subscription JSON as ``Subscription`` keyword arguments."""
+
+    return {
+        "user_id": subscription["user_id"],
+        "tariff_code": subscription["tariff_code"],
+        "active_until": datetime.fromisoformat(subscription["active_until"]),
+    }
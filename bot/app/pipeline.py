@@ -0,0 +1,120 @@
+"""Bounded multi-worker pipeline for incoming Telegram updates.
+
+Every update is routed to one of ``workers`` queues by the id of the user (or
+chat) it came from, so updates from one user are handled strictly in order
+while different users are processed concurrently. Queues are bounded: when a
+worker falls behind, ``submit`` waits, and the webhook turns a timeout into a
+503 so Telegram retries later instead of us buffering without limit.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineClosed(RuntimeError):
+    """Raised when an update is submitted after shutdown started."""
+
+
+def routing_key(update: Update) -> int:
+    """Return the id that must keep its updates ordered (user, else chat)."""
+
+    try:
+        event = update.event
+    except Exception:  # unknown update type
+        return update.update_id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    if chat is None:
+        message = getattr(event, "message", None)
+        chat = getattr(message, "chat", None)
+    if chat is not None:
+        return chat.id
+    return update.update_id
+
+
+class UpdatePipeline:
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        workers: int = 8,
+        queue_size: int = 1000,
+    ) -> None:
+        if workers <= 0:
+            raise ValueError("workers must be positive")
+        self.dispatcher = dispatcher
+        self.bot = bot
+        # Each worker owns a slice of the total capacity.
+        per_worker = max(1, queue_size // workers)
+        self._queues: List[asyncio.Queue[Update]] = [
+            asyncio.Queue(maxsize=per_worker) for _ in range(workers)
+        ]
+        self._tasks: List[asyncio.Task] = []
+        self._closing = False
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks) and not self._closing
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._closing = False
+        self._tasks = [
+            asyncio.create_task(self._worker(queue), name=f"update-worker-{idx}")
+            for idx, queue in enumerate(self._queues)
+        ]
+
+    async def submit(self, update: Update, timeout: Optional[float] = None) -> None:
+        """Enqueue an update, waiting up to ``timeout`` seconds for free space."""
+
+        if self._closing:
+            raise PipelineClosed("pipeline is shutting down")
+        queue = self._queues[routing_key(update) % len(self._queues)]
+        if timeout is None:
+            await queue.put(update)
+        else:
+            await asyncio.wait_for(queue.put(update), timeout)
+
+    async def stop(self, drain_timeout: Optional[float] = 30.0) -> None:
+        """Stop accepting updates, finish queued ones, then stop the workers."""
+
+        self._closing = True
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(q.join() for q in self._queues)), drain_timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Update pipeline drain timed out with %s updates left", self.depth)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, queue: "asyncio.Queue[Update]") -> None:
+        while True:
+            update = await queue.get()
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Failed to process update %s", update.update_id)
+            finally:
+                queue.task_done()
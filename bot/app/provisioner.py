@@ -0,0 +1,80 @@
+"""Thin async client for the provisioner service."""
+
+from __future__ import annotations
+
+from typing import Any, Dict, Iterable, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from vpn_common.metrics.transports import AsyncTimedTransport
+
+
+class ProvisionerClient:
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        client: Optional[httpx.AsyncClient] = None,
+        timeout: float = 5.0,
+        token: Optional[str] = None,
+    ) -> None:
+        self.base_url = (base_url or "http://provisioner:8001").rstrip("/")
+        self._client = client or httpx.AsyncClient(
+            base_url=self.base_url, timeout=timeout, transport=AsyncTimedTransport()
+        )
+        if token:
+            # The provisioner's write calls need it; /provision returns private keys.
+            self._client.headers["Authorization"] = f"Bearer {token}"
+        self._owns_client = client is None
+
+    async def traffic(self, user_id: int, resolution: str = "hour") -> Optional[Dict[str, Any]]:
+        """Usage across all of the user's devices, or None if they have none."""
+
+        resp = await self._client.get(f"/traffic/{user_id}", params={"resolution": resolution})
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.json()
+
+    async def provision(
+        self,
+        user_id: int,
+        protocol: str,
+        device_name: str,
+        tariff_code: str,
+        node_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Provision (or re-read) a device; unchanged devices keep their stored config."""
+
+        resp = await self._client.post(
+            "/provision",
+            json={
+                "user_id": user_id,
+                "protocol": protocol,
+                "device_name": device_name,
+                "tariff_code": tariff_code,
+                "node_id": node_id,
+            },
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    def config_url(self, provisioned: Dict[str, Any]) -> str:
+        # The provisioner's own URLs use its public base; the bot fetches internally,
+        # keeping the signed query that authorizes the download.
+        url = urlsplit(provisioned["config_url"])
+        return f"{self.base_url}{url.path}?{url.query}"
+
+    def qr_url(self, provisioned: Dict[str, Any]) -> str:
+        return f"{self.base_url}/qr/{provisioned['qr_url'].rsplit('/', 1)[-1]}"
+
+    async def place_node(self, exclude: Iterable[str] = ()) -> str:
+        """Least-loaded healthy node, skipping ``exclude`` (e.g. the current one)."""
+
+        resp = await self._client.post("/nodes/place", json={"exclude": list(exclude)})
+        resp.raise_for_status()
+        return resp.json()["node_id"]
+
+    async def close(self) -> None:
+        if self._owns_client:
+            await self._client.aclose()
@@ -0,0 +1,237 @@
+"""Subscription storage shared by all bot workers.
+
+The bot used to keep subscriptions in a module-level dict, which was lost on
+restart and invisible to other worker processes. Handlers now go through a
+``SubscriptionRepository``: Redis in production, an in-memory dict for tests,
+both wrapped in ``CachedSubscriptionRepository`` so hot per-message lookups are
+served from a bounded local cache.
+"""
+
+from __future__ import annotations
+
+import abc
+import bisect
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+from .cache import TTLCache
+
+
+@dataclass
+class Subscription:
+    user_id: int
+    tariff_code: str
+    active_until: datetime
+    proto: str = "amneziawg"
+    node_id: str = "default_nl"
+
+    @property
+    def is_active(self) -> bool:
+        return self.active_until > datetime.utcnow()
+
+
+class SubscriptionRepository(abc.ABC):
+    """Async storage backend for bot subscriptions."""
+
+    @abc.abstractmethod
+    async def get(self, user_id: int) -> Optional[Subscription]:
+        ...
+
+    @abc.abstractmethod
+    async def save(self, sub: Subscription) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def delete(self, user_id: int) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def list_user_ids(self, after: int = 0, limit: int = 1000) -> List[int]:
+        """Return up to ``limit`` user ids greater than ``after`` in ascending order."""
+
+    @abc.abstractmethod
+    async def event_seqs(self, user_ids: Sequence[int]) -> Dict[int, int]:
+        """``seq`` of the last lifecycle event applied per user; 0 for none.
+
+        Kept apart from the subscription so it outlives a revocation.
+        """
+
+    @abc.abstractmethod
+    async def set_event_seqs(self, seqs: Dict[int, int]) -> None:
+        ...
+
+    async def close(self) -> None:
+        return None
+
+
+class InMemorySubscriptionRepository(SubscriptionRepository):
+    """Process-local backend used by tests, benchmarks and single-worker setups."""
+
+    def __init__(self) -> None:
+        self._data: Dict[int, Subscription] = {}
+        self._ids: List[int] = []  # sorted, for keyset pagination
+        self._seqs: Dict[int, int] = {}
+
+    async def get(self, user_id: int) -> Optional[Subscription]:
+        return self._data.get(user_id)
+
+    async def save(self, sub: Subscription) -> None:
+        if sub.user_id not in self._data:
+            bisect.insort(self._ids, sub.user_id)
+        self._data[sub.user_id] = sub
+
+    async def delete(self, user_id: int) -> None:
+        if self._data.pop(user_id, None) is not None:
+            del self._ids[bisect.bisect_left(self._ids, user_id)]
+
+    async def list_user_ids(self, after: int = 0, limit: int = 1000) -> List[int]:
+        start = bisect.bisect_right(self._ids, after)
+        return self._ids[start : start + limit]
+
+    async def event_seqs(self, user_ids: Sequence[int]) -> Dict[int, int]:
+        return {user_id: self._seqs.get(user_id, 0) for user_id in user_ids}
+
+    async def set_event_seqs(self, seqs: Dict[int, int]) -> None:
+        self._seqs.update(seqs)
+
+
+class RedisSubscriptionRepository(SubscriptionRepository):
+    """Redis backend: one hash per user plus a sorted-set index of user ids.
+
+    Per-user keys spread evenly across a Redis Cluster; the index keeps
+    keyset pagination (``ZRANGEBYSCORE``) cheap for bulk readers.
+    """
+
+    def __init__(self, client, prefix: str = "sub") -> None:
+        self._redis = client
+        self._prefix = prefix
+        self._index_key = f"{prefix}:index"
+        self._seqs_key = f"{prefix}:event-seq"
+
+    @classmethod
+    def from_url(cls, url: str, prefix: str = "sub") -> "RedisSubscriptionRepository":
+        from redis import asyncio as aioredis
+
+        return cls(aioredis.from_url(url, decode_responses=True), prefix=prefix)
+
+    def _key(self, user_id: int) -> str:
+        return f"{self._prefix}:{user_id}"
+
+    async def get(self, user_id: int) -> Optional[Subscription]:
+        raw = await self._redis.hgetall(self._key(user_id))
+        if not raw:
+            return None
+        return Subscription(
+            user_id=int(raw["user_id"]),
+            tariff_code=raw["tariff_code"],
+            active_until=datetime.fromisoformat(raw["active_until"]),
+            proto=raw.get("proto", "amneziawg"),
+            node_id=raw.get("node_id", "default_nl"),
+        )
+
+    async def save(self, sub: Subscription) -> None:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                self._key(sub.user_id),
+                mapping={
+                    "user_id": sub.user_id,
+                    "tariff_code": sub.tariff_code,
+                    "active_until": sub.active_until.isoformat(),
+                    "proto": sub.proto,
+                    "node_id": sub.node_id,
+                },
+            )
+            pipe.zadd(self._index_key, {str(sub.user_id): sub.user_id})
+            await pipe.execute()
+
+    async def delete(self, user_id: int) -> None:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self._key(user_id))
+            pipe.zrem(self._index_key, str(user_id))
+            await pipe.execute()
+
+    async def list_user_ids(self, after: int = 0, limit: int = 1000) -> List[int]:
+        ids = await self._redis.zrangebyscore(
+            self._index_key, f"({after}", "+inf", start=0, num=limit
+        )
+        return [int(uid) for uid in ids]
+
+    async def event_seqs(self, user_ids: Sequence[int]) -> Dict[int, int]:
+        if not user_ids:
+            return {}
+        raw = await self._redis.hmget(self._seqs_key, [str(user_id) for user_id in user_ids])
+        return {user_id: int(seq or 0) for user_id, seq in zip(user_ids, raw)}
+
+    async def set_event_seqs(self, seqs: Dict[int, int]) -> None:
+        if seqs:
+            await self._redis.hset(self._seqs_key, mapping={str(k): v for k, v in seqs.items()})
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+class CachedSubscriptionRepository(SubscriptionRepository):
+    """Read-through TTL cache in front of another repository.
+
+    Writes go to the backend first and then refresh the local entry, so this
+    worker never serves its own stale data; other workers converge within
+    ``ttl`` seconds. Misses are cached too, which keeps users without a
+    subscription from hitting the backend on every message.
+    """
+
+    def __init__(
+        self,
+        backend: SubscriptionRepository,
+        maxsize: int = 100_000,
+        ttl: float = 5.0,
+    ) -> None:
+        self.backend = backend
+        self.cache: TTLCache[int, Optional[Subscription]] = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, user_id: int) -> Optional[Subscription]:
+        found, sub = self.cache.lookup(user_id)
+        if found:
+            return sub
+        sub = await self.backend.get(user_id)
+        self.cache.set(user_id, sub)
+        return sub
+
+    async def save(self, sub: Subscription) -> None:
+        try:
+            await self.backend.save(sub)
+        except Exception:
+            self.cache.invalidate(sub.user_id)
+            raise
+        self.cache.set(sub.user_id, sub)
+
+    async def delete(self, user_id: int) -> None:
+        self.cache.invalidate(user_id)
+        await self.backend.delete(user_id)
+        self.cache.invalidate(user_id)
+
+    async def list_user_ids(self, after: int = 0, limit: int = 1000) -> List[int]:
+        return await self.backend.list_user_ids(after=after, limit=limit)
+
+    async def event_seqs(self, user_ids: Sequence[int]) -> Dict[int, int]:
+        return await self.backend.event_seqs(user_ids)
+
+    async def set_event_seqs(self, seqs: Dict[int, int]) -> None:
+        await self.backend.set_event_seqs(seqs)
+
+    async def close(self) -> None:
+        self.cache.clear()
+        await self.backend.close()
+
+
+def build_repository(
+    redis_url: Optional[str] = None,
+    cache_size: int = 100_000,
+    cache_ttl: float = 5.0,
+) -> CachedSubscriptionRepository:
+    backend: SubscriptionRepository
+    if redis_url:
+        backend = RedisSubscriptionRepository.from_url(redis_url)
+    else:
+        backend = InMemorySubscriptionRepository()
+    return CachedSubscriptionRepository(backend, maxsize=cache_size, ttl=cache_ttl)
@@ -0,0 +1,120 @@
+"""Bot-side view of the billing tariff catalog.
+
+Billing is the single source of truth for tariffs. The bot keeps the last
+catalog it saw and revalidates it with ``If-None-Match``, so an unchanged
+catalog costs one empty 304. ``DEFAULT_TARIFFS`` mirrors billing's catalog
+and is only used until the first successful fetch (or in tests).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from vpn_common.metrics.transports import AsyncTimedTransport
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TARIFFS: List[Dict[str, Any]] = [
+    {"code": "trial", "name": "Trial", "price_stars": 0, "duration_days": 3, "speed_limit_mbps": None, "devices": 2, "nodes": 1, "smartdns": True},
+    {"code": "light", "name": "Light", "price_stars": 110, "duration_days": 30, "speed_limit_mbps": 100, "devices": 2, "nodes": 2, "smartdns": True},
+    {"code": "family", "name": "Family", "price_stars": 200, "duration_days": 30, "speed_limit_mbps": 300, "devices": 5, "nodes": 4, "smartdns": True},
+    {"code": "unlimited", "name": "Unlimited", "price_stars": 290, "duration_days": 30, "speed_limit_mbps": None, "devices": 8, "nodes": 6, "smartdns": True},
+    {"code": "year", "name": "Годовая", "price_stars": 2262, "duration_days": 365, "speed_limit_mbps": None, "devices": 8, "nodes": 6, "smartdns": True},
+]
+
+
+def _plural(n: int, one: str, few: str, many: str) -> str:
+    if n % 10 == 1 and n % 100 != 11:
+        return one
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return few
+    return many
+
+
+class TariffCatalog:
+    def __init__(
+        self,
+        billing_url: Optional[str] = None,
+        client: Optional[httpx.AsyncClient] = None,
+        refresh_interval: float = 60.0,
+    ) -> None:
+        self.billing_url = billing_url.rstrip("/") if billing_url else None
+        self._client = client
+        self.refresh_interval = refresh_interval
+        self.etag: Optional[str] = None
+        self.version = "builtin"
+        self._apply(DEFAULT_TARIFFS)
+        self._task: Optional[asyncio.Task] = None
+
+    def _apply(self, tariffs: List[Dict[str, Any]]) -> None:
+        self.tariffs: List[Dict[str, Any]] = tariffs
+        self._by_code: Dict[str, Dict[str, Any]] = {t["code"]: t for t in tariffs}
+        self._plans_text: Optional[str] = None
+
+    def get(self, code: str) -> Optional[Dict[str, Any]]:
+        return self._by_code.get(code)
+
+    def plans_text(self) -> str:
+        """Human-readable tariff list, rendered once per catalog version."""
+
+        if self._plans_text is None:
+            lines = ["Доступные тарифы:"]
+            for t in self.tariffs:
+                days = t["duration_days"]
+                devices = t["devices"]
+                speed = (
+                    f"скорость до {t['speed_limit_mbps']} Mbps"
+                    if t.get("speed_limit_mbps")
+                    else "безлимитная скорость"
+                )
+                lines.append(
+                    f"• {t['name']} — {t['price_stars']}⭐️ на {days} {_plural(days, 'день', 'дня', 'дней')}, "
+                    f"до {devices} {_plural(devices, 'устройства', 'устройств', 'устройств')}, {speed}."
+                )
+            self._plans_text = "\n".join(lines)
+        return self._plans_text
+
+    async def refresh(self) -> bool:
+        """Revalidate against billing; returns True when the catalog changed."""
+
+        if not self.billing_url:
+            return False
+        client = self._client or httpx.AsyncClient(timeout=5.0, transport=AsyncTimedTransport())
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        try:
+            resp = await client.get(f"{self.billing_url}/tariffs", headers=headers)
+            if resp.status_code == 304:
+                return False
+            resp.raise_for_status()
+            tariffs = resp.json()
+        finally:
+            if self._client is None:
+                await client.aclose()
+        self.etag = resp.headers.get("ETag")
+        self.version = resp.headers.get("X-Catalog-Version") or self.etag or self.version
+        self._apply(tariffs)
+        logger.info("Tariff catalog updated to version %s", self.version)
+        return True
+
+    def start(self) -> None:
+        if self._task is None and self.billing_url:
+            self._task = asyncio.create_task(self._refresh_loop(), name="tariff-catalog")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception as exc:
+                # Keep serving the last known catalog while billing is unreachable.
+                logger.warning("Tariff catalog refresh failed: %s", exc)
+            await asyncio.sleep(self.refresh_interval)
@@ -0,0 +1,279 @@
+"""Per-user rate limiting and duplicate suppression for incoming updates.
+
+``ThrottlingMiddleware`` runs as an outer ``update`` middleware. It drops:
+- redelivered updates (same ``update_id``, e.g. webhook retries);
+- double taps (the same text or callback data from the same user within
+  ``tap_window`` seconds);
+- updates beyond the user's sliding-window budget.
+
+Handlers can ask for a stricter budget with the ``rate_limit`` flag, e.g.
+``flags={"rate_limit": (1, 60)}``; ``HandlerRateLimitMiddleware`` enforces
+it per user and handler. Limits only bound load: a handler that grants
+something (time, trials, devices) must be safe to call at any rate, with
+billing or the provisioner deciding, not the throttle.
+
+The limiter is a sliding-window counter: per key it stores only the current
+window index, its count and the previous window's count, and estimates the
+rate by weighting the previous window by its remaining overlap. That is
+O(1) memory per active user, against a log of timestamps that grows with
+the limit. Redis variants make limits and dedup shared across bot workers.
+"""
+
+from __future__ import annotations
+
+import abc
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+
+from .cache import TTLCache
+from .metrics import DROPPED
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+_DROPPED_DUPLICATE = DROPPED.labels("duplicate")
+_DROPPED_THROTTLED = DROPPED.labels("throttled")
+_DROPPED_HANDLER_LIMIT = DROPPED.labels("handler_limit")
+
+
+class RateLimiter(abc.ABC):
+    @abc.abstractmethod
+    async def hit(self, key: str, limit: int, window: float) -> bool:
+        """Count one event for ``key``; False if it exceeds ``limit`` per ``window``."""
+
+
+def _advance(state: List[float], now: float, window: float) -> None:
+    index = now // window
+    if index != state[0]:
+        # Moving one window on keeps the old count as "previous"; a longer
+        # gap means both windows are empty.
+        state[2] = state[1] if index == state[0] + 1 else 0
+        state[1] = 0
+        state[0] = index
+
+
+def _estimate(state: List[float], now: float, window: float) -> float:
+    elapsed = (now - state[0] * window) / window
+    return state[2] * (1.0 - elapsed) + state[1]
+
+
+class MemoryRateLimiter(RateLimiter):
+    def __init__(self, maxsize: int = 100_000, clock: Callable[[], float] = time.time) -> None:
+        self.maxsize = maxsize
+        self._clock = clock
+        # key -> [window index, current count, previous count, expires at]
+        self._state: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._state)
+
+    async def hit(self, key: str, limit: int, window: float) -> bool:
+        now = self._clock()
+        state = self._state.get(key)
+        if state is None:
+            state = self._state[key] = [now // window, 0, 0, 0.0]
+        else:
+            self._state.move_to_end(key)
+            _advance(state, now, window)
+        state[3] = (state[0] + 2) * window
+        allowed = _estimate(state, now, window) < limit
+        if allowed:
+            state[1] += 1
+        self._evict(now)
+        return allowed
+
+    def _evict(self, now: float) -> None:
+        # Least recently used first; stop at the first entry still in use.
+        while self._state:
+            key, state = next(iter(self._state.items()))
+            if state[3] > now and len(self._state) <= self.maxsize:
+                break
+            del self._state[key]
+
+
+_SLIDING_WINDOW_LUA = """
+local now = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local window = tonumber(ARGV[3])
+local index = math.floor(now / window)
+local state = redis.call('HMGET', KEYS[1], 'i', 'c', 'p')
+local i = tonumber(state[1]) or index
+local c = tonumber(state[2]) or 0
+local p = tonumber(state[3]) or 0
+if index == i + 1 then
+  p = c
+  c = 0
+elseif index > i + 1 then
+  p = 0
+  c = 0
+end
+local allowed = 0
+if p * (1 - (now - index * window) / window) + c < limit then
+  c = c + 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'i', index, 'c', c, 'p', p)
+redis.call('PEXPIRE', KEYS[1], math.ceil(window * 2000))
+return allowed
+"""
+
+
+class RedisRateLimiter(RateLimiter):
+    def __init__(self, client, prefix: str = "rl", clock: Callable[[], float] = time.time) -> None:
+        self._redis = client
+        self._prefix = prefix
+        self._clock = clock
+        self._script = client.register_script(_SLIDING_WINDOW_LUA)
+
+    async def hit(self, key: str, limit: int, window: float) -> bool:
+        allowed = await self._script(keys=[f"{self._prefix}:{key}"], args=[self._clock(), limit, window])
+        return bool(int(allowed))
+
+
+class Deduplicator(abc.ABC):
+    @abc.abstractmethod
+    async def seen(self, key: str) -> bool:
+        """Mark ``key`` as seen; True if it already was within the TTL."""
+
+
+class MemoryDeduplicator(Deduplicator):
+    def __init__(self, ttl: float, maxsize: int = 100_000) -> None:
+        self._seen: TTLCache[str, bool] = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def seen(self, key: str) -> bool:
+        found, _ = self._seen.lookup(key)
+        if not found:
+            self._seen.set(key, True)
+        return found
+
+
+class RedisDeduplicator(Deduplicator):
+    def __init__(self, client, ttl: float, prefix: str) -> None:
+        self._redis = client
+        self._ttl_ms = max(1, int(ttl * 1000))
+        self._prefix = prefix
+
+    async def seen(self, key: str) -> bool:
+        created = await self._redis.set(f"{self._prefix}:{key}", 1, nx=True, px=self._ttl_ms)
+        return not created
+
+
+def _tap_key(update: Update) -> Optional[str]:
+    if update.message is not None and update.message.text:
+        payload = "m:" + update.message.text
+    elif update.callback_query is not None and update.callback_query.data:
+        payload = "c:" + update.callback_query.data
+    else:
+        return None
+    return hashlib.blake2b(payload.encode(), digest_size=8).hexdigest()
+
+
+def _is_payment(update: Update) -> bool:
+    # Money is moving: rate limits must never drop these.
+    return update.pre_checkout_query is not None or (
+        update.message is not None and update.message.successful_payment is not None
+    )
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(
+        self,
+        limiter: RateLimiter,
+        updates: Deduplicator,
+        taps: Deduplicator,
+        rate: int = 20,
+        period: float = 10.0,
+    ) -> None:
+        self.limiter = limiter
+        self.updates = updates
+        self.taps = taps
+        self.rate = rate
+        self.period = period
+        self.duplicates = 0
+        self.throttled = 0
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        if isinstance(event, Update) and await self.updates.seen(str(event.update_id)):
+            self.duplicates += 1
+            _DROPPED_DUPLICATE.inc()
+            return None
+        user = data.get("event_from_user")
+        if user is not None and isinstance(event, Update) and not _is_payment(event):
+            tap = _tap_key(event)
+            if tap is not None and await self.taps.seen(f"{user.id}:{tap}"):
+                self.duplicates += 1
+                _DROPPED_DUPLICATE.inc()
+                return None
+            if not await self.limiter.hit(f"u:{user.id}", self.rate, self.period):
+                self.throttled += 1
+                _DROPPED_THROTTLED.inc()
+                return None
+        return await handler(event, data)
+
+
+class HandlerRateLimitMiddleware(BaseMiddleware):
+    """Inner middleware enforcing a handler's ``rate_limit`` flag."""
+
+    def __init__(self, limiter: RateLimiter) -> None:
+        self.limiter = limiter
+        self.throttled = 0
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        limit: Optional[Tuple[int, float]] = get_flag(data, "rate_limit")
+        user = data.get("event_from_user")
+        if limit is None or user is None:
+            return await handler(event, data)
+        name = data["handler"].callback.__name__
+        if await self.limiter.hit(f"h:{name}:{user.id}", *limit):
+            return await handler(event, data)
+        self.throttled += 1
+        _DROPPED_HANDLER_LIMIT.inc()
+        if isinstance(event, Message):
+            await event.answer("Слишком часто. Попробуйте чуть позже.")
+        elif isinstance(event, CallbackQuery):
+            await event.answer("Слишком часто. Попробуйте чуть позже.")
+        return None
+
+
+class Throttling:
+    def __init__(
+        self,
+        limiter: RateLimiter,
+        updates: Deduplicator,
+        taps: Deduplicator,
+        rate: int = 20,
+        period: float = 10.0,
+    ) -> None:
+        self.middleware = ThrottlingMiddleware(limiter, updates, taps, rate=rate, period=period)
+        self.handler_middleware = HandlerRateLimitMiddleware(limiter)
+
+    def install(self, dp: Dispatcher) -> None:
+        # Outer update middlewares run after aiogram's own UserContextMiddleware,
+        # so ``event_from_user`` is already resolved here.
+        dp.update.outer_middleware(self.middleware)
+        # Inner middlewares on the dispatcher apply to handlers of nested routers.
+        dp.message.middleware(self.handler_middleware)
+        dp.callback_query.middleware(self.handler_middleware)
+
+
+def build_throttling(
+    redis=None,
+    rate: int = 20,
+    period: float = 10.0,
+    tap_window: float = 1.0,
+    update_ttl: float = 300.0,
+) -> Throttling:
+    if redis is not None:
+        limiter: RateLimiter = RedisRateLimiter(redis)
+        updates: Deduplicator = RedisDeduplicator(redis, update_ttl, prefix="upd")
+        taps: Deduplicator = RedisDeduplicator(redis, tap_window, prefix="tap")
+    else:
+        limiter = MemoryRateLimiter()
+        updates = MemoryDeduplicator(update_ttl)
+        taps = MemoryDeduplicator(tap_window)
+    return Throttling(limiter, updates, taps, rate=rate, period=period)
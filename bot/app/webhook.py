@@ -0,0 +1,71 @@
+"""aiohttp webhook entry point feeding the update pipeline."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Optional
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.types import Update
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from vpn_common.metrics import observe_queue, render
+
+from .pipeline import PipelineClosed, UpdatePipeline
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def create_webhook_app(
+    pipeline: UpdatePipeline,
+    bot: Bot,
+    path: str = "/webhook",
+    secret_token: Optional[str] = None,
+    submit_timeout: float = 5.0,
+) -> web.Application:
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret_token and request.headers.get(SECRET_HEADER) != secret_token:
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception:
+            logger.warning("Rejected malformed webhook payload")
+            return web.Response(status=400)
+        try:
+            await pipeline.submit(update, timeout=submit_timeout)
+        except (asyncio.TimeoutError, PipelineClosed):
+            # Telegram redelivers on non-2xx, which is our backpressure signal.
+            return web.Response(status=503)
+        return web.Response()
+
+    async def health(_: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "status": "ok" if pipeline.running else "stopping",
+                "queue_depth": pipeline.depth,
+                "processed": pipeline.processed,
+                "failed": pipeline.failed,
+            }
+        )
+
+    async def metrics(_: web.Request) -> web.Response:
+        return web.Response(body=render(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+    async def on_startup(_: web.Application) -> None:
+        pipeline.start()
+
+    async def on_shutdown(_: web.Application) -> None:
+        await pipeline.stop()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
+    observe_queue("updates", lambda: pipeline.depth)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
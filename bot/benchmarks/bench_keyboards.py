@@ -0,0 +1,66 @@
+"""Cost of producing reply markups per handler call.
+
+Compares building menus with the keyboard builders on every call (the old
+handlers) against reusing the ``KeyboardRegistry`` markups, and shows how
+often the buy menu is rebuilt while the catalog version stays the same.
+Run from ``bot/``::
+
+    python -m benchmarks.bench_keyboards --calls 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from typing import Callable
+
+from app.keyboards import KeyboardRegistry, get_buy_menu, get_main_menu, get_profile_menu
+from app.tariffs import DEFAULT_TARIFFS, TariffCatalog
+
+
+def _rate(label: str, calls: int, fn: Callable[[int], object]) -> None:
+    started = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<22} {calls / elapsed:>12,.0f} calls/s  {elapsed / calls * 1e6:7.2f} µs/call")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=100_000)
+    args = parser.parse_args()
+
+    tariffs = TariffCatalog()
+    registry = KeyboardRegistry(tariffs)
+
+    def rebuild(i: int) -> object:
+        kind = i % 3
+        if kind == 0:
+            return get_main_menu()
+        if kind == 1:
+            return get_profile_menu(bool(i & 1))
+        return get_buy_menu(tariffs.tariffs)
+
+    def cached(i: int) -> object:
+        kind = i % 3
+        if kind == 0:
+            return registry.main
+        if kind == 1:
+            return registry.profile(bool(i & 1))
+        return registry.buy()
+
+    _rate("builders per call", args.calls, rebuild)
+    _rate("registry", args.calls, cached)
+    print(f"buy menu builds: {registry.buy_builds}")
+
+    # A catalog update invalidates the buy menu exactly once.
+    tariffs._apply([dict(t) for t in DEFAULT_TARIFFS])
+    tariffs.version = "bench-2"
+    for i in range(1000):
+        registry.buy()
+    print(f"buy menu builds after catalog change: {registry.buy_builds}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Per-update overhead of the throttling middleware.
+
+Pushes synthetic updates through ``ThrottlingMiddleware`` and
+``HandlerRateLimitMiddleware`` around a no-op handler, with the in-memory
+backends and with Redis (``--redis-url``; fakeredis if installed and no URL
+is given), and reports the cost per update next to the bare handler call
+plus limiter memory per active user. Run from ``bot/``::
+
+    python -m benchmarks.bench_throttling --updates 200000 --users 10000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from aiogram.types import User
+
+from app.throttling import MemoryRateLimiter, build_throttling
+
+from .telegram_stub import make_message_update
+
+TEXTS = ["/start", "/plans", "Личный кабинет", "Статистика трафика", "Продлить подписку"]
+
+
+async def _noop(event, data):
+    return None
+
+
+async def _run(label: str, throttling, updates, users, baseline: float = 0.0) -> float:
+    outer = throttling.middleware
+    inner = throttling.handler_middleware
+    handler = SimpleNamespace(callback=_noop)
+
+    async def dispatch(event, data):
+        data["handler"] = handler
+        return await inner(_noop, event, data)
+
+    started = time.perf_counter()
+    for update in updates:
+        user = users[update.message.from_user.id]
+        await outer(dispatch, update, {"event_from_user": user})
+    per_update = (time.perf_counter() - started) / len(updates)
+    print(
+        f"{label:<10} {per_update * 1e6:7.2f} µs/update (+{(per_update - baseline) * 1e6:6.2f})  "
+        f"duplicates={outer.duplicates} throttled={outer.throttled}"
+    )
+    return per_update
+
+
+async def main_async(args) -> None:
+    rnd = random.Random(args.seed)
+    users = {uid: User(id=uid, is_bot=False, first_name="u") for uid in range(1, args.users + 1)}
+    # Unique texts: every update takes the full path (dedup miss + limiter)
+    # instead of being dropped early as a double tap.
+    updates = [
+        make_message_update(rnd.randint(1, args.users), f"{rnd.choice(TEXTS)} {i}") for i in range(args.updates)
+    ]
+
+    started = time.perf_counter()
+    for update in updates:
+        await _noop(update, {"event_from_user": users[update.message.from_user.id]})
+    baseline = (time.perf_counter() - started) / len(updates)
+    print(f"{'handler':<10} {baseline * 1e6:7.2f} µs/update")
+
+    await _run("memory", build_throttling(), updates, users, baseline)
+
+    redis, label = None, "redis"
+    if args.redis_url:
+        from redis import asyncio as aioredis
+
+        redis = aioredis.from_url(args.redis_url)
+    else:
+        try:
+            import fakeredis
+        except ImportError:
+            pass
+        else:
+            redis, label = fakeredis.FakeAsyncRedis(), "fakeredis"
+    if redis is not None:
+        sample = updates[: args.redis_updates]
+        await _run(label, build_throttling(redis), sample, users, baseline)
+        await redis.aclose()
+
+    tracemalloc.start()
+    limiter = MemoryRateLimiter(maxsize=args.users * 2)
+    before = tracemalloc.get_traced_memory()[0]
+    for uid in users:
+        await limiter.hit(f"u:{uid}", 20, 10.0)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"limiter state: {used / len(limiter):.0f} B per active user ({len(limiter)} users)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--redis-url", default=None)
+    parser.add_argument("--redis-updates", type=int, default=20_000, help="updates for the Redis run")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Replay synthetic Message updates through ``create_dispatcher()``.
+
+Compares handling updates one after another (what polling does) with the
+webhook ``UpdatePipeline``. Run from ``bot/``::
+
+    python -m benchmarks.bench_updates --updates 20000 --users 2000 --latency 0.02
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+
+from app.main import create_dispatcher
+from app.pipeline import UpdatePipeline
+from app.subscriptions import Subscription, build_repository
+
+from .telegram_stub import make_message_update, stub_billing, stub_bot, stub_provisioner
+
+TEXTS = ["/start", "/plans", "/trial", "Статистика трафика", "Продлить подписку", "« Главное меню"]
+
+
+async def _seed(repo, users: int) -> None:
+    until = datetime.utcnow() + timedelta(days=30)
+    for user_id in range(1, users + 1, 2):
+        await repo.save(Subscription(user_id=user_id, tariff_code="light", active_until=until))
+
+
+def _updates(count: int, users: int, seed: int):
+    rnd = random.Random(seed)
+    return [make_message_update(rnd.randint(1, users), rnd.choice(TEXTS)) for _ in range(count)]
+
+
+async def run_sequential(dp, args) -> float:
+    # The bot router can only be attached once per process, so both runs
+    # share a dispatcher and just get a fresh repository.
+    repo = build_repository()
+    await _seed(repo, args.users)
+    dp["subscriptions"] = repo
+    bot = stub_bot(args.latency)
+    updates = _updates(args.updates, args.users, args.seed)
+    started = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return len(updates) / (time.perf_counter() - started)
+
+
+async def run_pipeline(dp, args) -> float:
+    repo = build_repository()
+    await _seed(repo, args.users)
+    dp["subscriptions"] = repo
+    bot = stub_bot(args.latency)
+    pipeline = UpdatePipeline(dp, bot, workers=args.workers, queue_size=args.queue_size)
+    updates = _updates(args.updates, args.users, args.seed)
+    pipeline.start()
+    started = time.perf_counter()
+    for update in updates:
+        await pipeline.submit(update)
+    await pipeline.stop(drain_timeout=None)
+    elapsed = time.perf_counter() - started
+    assert pipeline.processed == len(updates), (pipeline.processed, pipeline.failed)
+    return len(updates) / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=20_000)
+    parser.add_argument("--users", type=int, default=2_000)
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--queue-size", type=int, default=4096)
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated Bot API RTT, seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-sequential", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, force=True)
+
+    dp = create_dispatcher(provisioner=stub_provisioner(), billing=stub_billing())
+    if not args.skip_sequential:
+        rate = asyncio.run(run_sequential(dp, args))
+        print(f"sequential: {rate:,.0f} updates/s")
+    rate = asyncio.run(run_pipeline(dp, args))
+    print(f"pipeline({args.workers} workers): {rate:,.0f} updates/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+"""End-to-end load test: simulated users across the bot, billing and the provisioner.
+
+``--users`` users arrive over ``--ramp`` seconds and each walks
+
+    start → plans → trial → buy → config → extend
+
+with a seeded think time between steps. Not everyone gets to the end:
+``--buy`` of them pay and ``--extend`` of the buyers pay again. Every step
+sends the updates a real client would send into ``create_dispatcher()``. A
+purchase is the full Stars flow: the stub Bot API captures the invoice, and
+the harness replies with ``pre_checkout_query`` and ``successful_payment``
+updates carrying its payload.
+
+The bot runs in this process against a stub Bot API with ``--latency`` RTT.
+Billing and the provisioner are real: local uvicorn processes on temporary
+SQLite and filesystem storage. Each service is its own ``app`` package, so
+they cannot share this process. Alternatively, ``--billing-url`` and
+``--provisioner-url`` point at running ones (e.g. ``docker compose``), with
+``--billing-token`` and ``--provisioner-token`` set to their ``BILLING_TOKEN``
+and ``PROVISIONER_TOKEN``.
+
+The same ``--seed`` gives the same users, paths, tariffs, think times and
+arrival order; the workload fingerprint in the report shows it. The
+report covers throughput, p50/p95/p99 per step, failures per step, and the
+slowest bot handlers and service routes by total time. Run from ``bot/``::
+
+    python -m benchmarks.loadtest --users 500 --ramp 10 --seed 7
+    python -m benchmarks.loadtest --billing-url http://localhost:8010 --provisioner-url http://localhost:8011 \
+        --billing-token "$BILLING_TOKEN" --provisioner-token "$PROVISIONER_TOKEN"
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+from aiogram import Bot
+from aiogram.methods import AnswerPreCheckoutQuery, SendDocument, SendInvoice, TelegramMethod
+from prometheus_client.parser import text_string_to_metric_families
+
+from app import metrics
+from app.billing import BillingClient
+from app.main import create_dispatcher
+from app.payments import PaymentConfirmer
+from app.provisioner import ProvisionerClient
+from app.subscriptions import InMemorySubscriptionRepository
+from app.tariffs import TariffCatalog
+from app.throttling import build_throttling
+
+from .telegram_stub import (
+    StubSession,
+    make_callback_update,
+    make_message_update,
+    make_payment_update,
+    make_pre_checkout_update,
+)
+
+ROOT = Path(__file__).resolve().parents[2]
+STEPS = ["start", "plans", "trial", "buy", "config", "extend"]
+PAID_TARIFFS = ["light", "family", "unlimited", "year"]
+LOADTEST_TOKEN = "loadtest-provisioner-token"  # for the local provisioner
+LOADTEST_BILLING_TOKEN = "loadtest-billing-token"  # for the local billing
+TARIFF_WEIGHTS = [60, 20, 15, 5]
+
+
+class StepFailed(Exception):
+    pass
+
+
+class LoadSession(StubSession):
+    """Stub Bot API that hands invoices and pre-checkout answers back to the simulated users."""
+
+    def __init__(self, latency: float) -> None:
+        super().__init__(latency, record=False)
+        self.invoices: Dict[int, SendInvoice] = {}
+        self.pre_checkout: Dict[str, bool] = {}
+        self.documents: Dict[int, int] = defaultdict(int)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod[Any], timeout: Optional[int] = None) -> Any:
+        result = await super().make_request(bot, method, timeout)
+        if isinstance(method, SendInvoice):
+            self.invoices[int(method.chat_id)] = method
+        elif isinstance(method, AnswerPreCheckoutQuery):
+            self.pre_checkout[method.pre_checkout_query_id] = method.ok
+        elif isinstance(method, SendDocument):
+            self.documents[int(method.chat_id)] += 1
+        return result
+
+
+@dataclass
+class UserPlan:
+    user_id: int
+    arrival: float
+    steps: List[str]
+    tariff: str
+    think: List[float]
+
+
+@dataclass
+class Report:
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    failures: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    errors: Dict[str, str] = field(default_factory=dict)
+    updates: int = 0
+
+
+def build_plan(users: int, seed: int, ramp: float, think: float, buy: float, extend: float) -> List[UserPlan]:
+    rnd = random.Random(seed)
+    plans = []
+    for user_id in range(1, users + 1):
+        steps = ["start", "plans", "trial"]
+        if rnd.random() < buy:
+            steps += ["buy", "config"]
+            if rnd.random() < extend:
+                steps.append("extend")
+        plans.append(
+            UserPlan(
+                user_id=10_000_000 + user_id,
+                arrival=rnd.uniform(0, ramp),
+                steps=steps,
+                tariff=rnd.choices(PAID_TARIFFS, TARIFF_WEIGHTS)[0],
+                think=[rnd.expovariate(1 / think) if think else 0.0 for _ in steps],
+            )
+        )
+    return plans
+
+
+def fingerprint(plans: List[UserPlan]) -> str:
+    digest = hashlib.sha1()
+    for plan in plans:
+        digest.update(f"{plan.user_id}:{plan.arrival:.6f}:{','.join(plan.steps)}:{plan.tariff}:".encode())
+        digest.update(",".join(f"{t:.6f}" for t in plan.think).encode())
+    return digest.hexdigest()[:12]
+
+
+class Simulation:
+    def __init__(self, dp, bot: Bot, session: LoadSession, repo: InMemorySubscriptionRepository) -> None:
+        self.dp = dp
+        self.bot = bot
+        self.session = session
+        self.repo = repo
+        self.report = Report()
+
+    async def _feed(self, update) -> None:
+        self.report.updates += 1
+        await self.dp.feed_update(self.bot, update)
+
+    async def _message(self, user_id: int, text: str) -> None:
+        await self._feed(make_message_update(user_id, text))
+
+    async def _purchase(self, plan: UserPlan, *updates) -> None:
+        """Send ``updates`` that end in an invoice, then pay it."""
+
+        before = await self.repo.get(plan.user_id)
+        for update in updates:
+            await self._feed(update)
+        invoice = self.session.invoices.pop(plan.user_id, None)
+        if invoice is None:
+            raise StepFailed("no invoice sent")
+        amount = invoice.prices[0].amount
+        query = make_pre_checkout_update(plan.user_id, invoice.payload, amount)
+        await self._feed(query)
+        if not self.session.pre_checkout.pop(query.pre_checkout_query.id, False):
+            raise StepFailed("pre-checkout rejected")
+        await self._feed(make_payment_update(plan.user_id, invoice.payload, amount))
+        after = await self.repo.get(plan.user_id)
+        if after is None or (before is not None and after.active_until <= before.active_until):
+            raise StepFailed("subscription not granted")
+
+    async def step(self, plan: UserPlan, name: str) -> None:
+        user_id = plan.user_id
+        if name == "start":
+            await self._message(user_id, "/start")
+        elif name == "plans":
+            await self._message(user_id, "/plans")
+        elif name == "trial":
+            await self._message(user_id, "/trial")
+            if await self.repo.get(user_id) is None:
+                raise StepFailed("trial not granted")
+        elif name == "buy":
+            await self._purchase(
+                plan,
+                make_message_update(user_id, "Купить подписку"),
+                make_callback_update(user_id, f"plan_{plan.tariff}"),
+            )
+        elif name == "config":
+            before = self.session.documents[user_id]
+            await self._message(user_id, "Мой конфиг (скачать)")
+            if self.session.documents[user_id] == before:
+                raise StepFailed("no config sent")
+        elif name == "extend":
+            await self._message(user_id, "Личный кабинет")
+            await self._purchase(plan, make_message_update(user_id, "Продлить подписку"))
+
+    async def run_user(self, plan: UserPlan, started: float) -> None:
+        await asyncio.sleep(max(0.0, started + plan.arrival - time.perf_counter()))
+        for name, think in zip(plan.steps, plan.think):
+            begin = time.perf_counter()
+            try:
+                await self.step(plan, name)
+            except Exception as exc:
+                self.report.failures[name] += 1
+                self.report.errors.setdefault(name, f"{type(exc).__name__}: {exc}")
+                return  # a user whose step failed gives up
+            self.report.latencies[name].append(time.perf_counter() - begin)
+            await asyncio.sleep(think)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def local_services(workdir: str) -> Iterator[Tuple[str, str]]:
+    """Billing and the provisioner as uvicorn processes on throwaway storage."""
+
+    common = dict(os.environ, EVENTS_BACKEND="memory", PYTHONDONTWRITEBYTECODE="1")
+    services = {
+        "billing": dict(
+            common,
+            DATABASE_URL=f"sqlite:///{workdir}/billing.db",
+            REMINDERS_BACKEND="memory",
+            PROVISIONER_URL="",
+            BACKUP_STORE="filesystem",
+            BACKUP_STORE_PATH=f"{workdir}/backups",
+            BILLING_TOKEN=LOADTEST_BILLING_TOKEN,
+        ),
+        "provisioner": dict(
+            common,
+            OBJECT_STORE="filesystem",
+            OBJECT_STORE_PATH=f"{workdir}/objects",
+            TRAFFIC_SOURCE="none",
+            PROVISIONER_TOKEN=LOADTEST_TOKEN,
+        ),
+    }
+    processes, urls = [], []
+    try:
+        for name, env in services.items():
+            if name == "provisioner":
+                # Device and speed limits come from billing's catalog, fetched on startup.
+                env = dict(env, BILLING_URL=urls[0])
+            port = _free_port()
+            log = open(f"{workdir}/{name}.log", "wb")
+            processes.append(
+                subprocess.Popen(
+                    [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+                    cwd=ROOT / "services" / name,
+                    env=env,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                )
+            )
+            urls.append(f"http://127.0.0.1:{port}")
+            _wait_healthy(urls[-1], processes[-1])
+        yield urls[0], urls[1]
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+
+def _wait_healthy(url: str, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode}; see its log in the work directory")
+        try:
+            if httpx.get(f"{url}/health", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become healthy in {timeout:.0f}s")
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def _bot_handlers(top: int) -> List[Tuple[str, float, float]]:
+    totals: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0.0])
+    for family in metrics.HANDLER_LATENCY.collect():
+        for sample in family.samples:
+            if sample.name.endswith("_count"):
+                totals[sample.labels["handler"]][0] += sample.value
+            elif sample.name.endswith("_sum"):
+                totals[sample.labels["handler"]][1] += sample.value
+    return sorted(((name, s, c) for name, (c, s) in totals.items() if c), key=lambda r: r[1], reverse=True)[:top]
+
+
+def _service_routes(url: str, top: int) -> List[Tuple[str, float, float]]:
+    totals: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0.0])
+    text = httpx.get(f"{url}/metrics", timeout=5.0).text
+    for family in text_string_to_metric_families(text):
+        if family.name != "http_request_duration_seconds":
+            continue
+        for sample in family.samples:
+            route = f"{sample.labels['method']} {sample.labels['route']}"
+            if sample.name.endswith("_count"):
+                totals[route][0] += sample.value
+            elif sample.name.endswith("_sum"):
+                totals[route][1] += sample.value
+    return sorted(((name, s, c) for name, (c, s) in totals.items() if c), key=lambda r: r[1], reverse=True)[:top]
+
+
+def _print_hot(title: str, rows: List[Tuple[str, float, float]]) -> None:
+    print(title)
+    for name, total, count in rows:
+        print(f"  {name:<40} {total:8.2f}s total  {count:7.0f} calls  {total / count * 1000:8.1f} ms mean")
+
+
+async def simulate(args, billing_url: str, provisioner_url: str, plans: List[UserPlan]) -> Tuple[Report, float]:
+    session = LoadSession(args.latency)
+    bot = Bot("42:LOADTEST", session=session)
+    repo = InMemorySubscriptionRepository()
+    limits = httpx.Limits(max_connections=args.connections)
+    billing = BillingClient(
+        billing_url,
+        client=httpx.AsyncClient(
+            base_url=billing_url,
+            timeout=10.0,
+            limits=limits,
+            headers={"Authorization": f"Bearer {args.billing_token}"},
+        ),
+    )
+    tariffs = TariffCatalog(billing_url, client=billing.http)
+    await tariffs.refresh()
+    provisioner = ProvisionerClient(
+        provisioner_url,
+        client=httpx.AsyncClient(
+            base_url=provisioner_url,
+            timeout=10.0,
+            limits=limits,
+            headers={"Authorization": f"Bearer {args.provisioner_token}"},
+        ),
+    )
+    dp = create_dispatcher(
+        repo,
+        tariffs,
+        provisioner=provisioner,
+        # Simulated users tap on purpose; keep the per-user limits, drop tap dedup.
+        throttling=build_throttling(tap_window=0.001),
+        billing=billing,
+        payments=PaymentConfirmer(billing),
+    )
+    sim = Simulation(dp, bot, session, repo)
+    started = time.perf_counter()
+    await asyncio.gather(*(sim.run_user(plan, started) for plan in plans))
+    elapsed = time.perf_counter() - started
+    await billing.http.aclose()
+    await provisioner._client.aclose()
+    return sim.report, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which users arrive")
+    parser.add_argument("--think", type=float, default=0.5, help="mean pause between steps, seconds")
+    parser.add_argument("--buy", type=float, default=0.6, help="share of users who pay")
+    parser.add_argument("--extend", type=float, default=0.3, help="share of buyers who pay again")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub Bot API RTT, seconds")
+    parser.add_argument("--connections", type=int, default=100, help="HTTP pool size per service")
+    parser.add_argument("--billing-url", default=None)
+    parser.add_argument("--provisioner-url", default=None)
+    parser.add_argument("--billing-token", default=LOADTEST_BILLING_TOKEN)
+    parser.add_argument("--provisioner-token", default=LOADTEST_TOKEN)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR, force=True)
+
+    plans = build_plan(args.users, args.seed, args.ramp, args.think, args.buy, args.extend)
+    flows = sum(len(plan.steps) for plan in plans)
+    print(f"{args.users} users, {flows} steps, seed {args.seed}, workload {fingerprint(plans)}")
+
+    with contextlib.ExitStack() as stack:
+        if args.billing_url and args.provisioner_url:
+            billing_url, provisioner_url = args.billing_url.rstrip("/"), args.provisioner_url.rstrip("/")
+        else:
+            workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="loadtest-"))
+            billing_url, provisioner_url = stack.enter_context(local_services(workdir))
+        report, elapsed = asyncio.run(simulate(args, billing_url, provisioner_url, plans))
+
+        done = sum(len(v) for v in report.latencies.values())
+        print(
+            f"{elapsed:.1f}s wall, {report.updates / elapsed:,.0f} updates/s, {done / elapsed:,.1f} steps/s, "
+            f"{sum(report.failures.values())} failed steps"
+        )
+        print(f"{'step':<8} {'count':>6} {'failed':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for name in STEPS:
+            values = report.latencies.get(name, [])
+            if not values and not report.failures.get(name):
+                continue
+            cells = [_percentile(values, p) * 1000 for p in (50, 95, 99)] + [max(values) * 1000] if values else [0.0] * 4
+            print(f"{name:<8} {len(values):>6} {report.failures.get(name, 0):>6} " + " ".join(f"{v:8.1f}" for v in cells))
+        for name, error in report.errors.items():
+            print(f"first {name} failure: {error}")
+        _print_hot("slowest bot handlers (total time):", _bot_handlers(args.top))
+        for label, url in (("billing", billing_url), ("provisioner", provisioner_url)):
+            try:
+                _print_hot(f"slowest {label} routes (total time):", _service_routes(url, args.top))
+            except httpx.HTTPError as exc:
+                print(f"{label} metrics unavailable: {exc}")
+
+
+if __name__ == "__main__":
+    main()
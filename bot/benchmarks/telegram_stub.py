@@ -0,0 +1,134 @@
+"""Offline stand-ins for the Telegram Bot API and backend services used by benchmarks."""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+from datetime import datetime
+from typing import Any, List
+
+import httpx
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import CallbackQuery, Chat, Message, PreCheckoutQuery, SuccessfulPayment, Update, User
+
+from app.billing import BillingClient
+from app.provisioner import ProvisionerClient
+
+
+class StubSession(BaseSession):
+    """Answers every API call with ``True`` after an optional simulated RTT."""
+
+    def __init__(self, latency: float = 0.0, record: bool = True) -> None:
+        super().__init__()
+        self.latency = latency
+        self.record = record
+        self.calls: List[TelegramMethod[Any]] = []
+        self.count = 0
+
+    async def make_request(self, bot: Bot, method: TelegramMethod[Any], timeout: int | None = None) -> Any:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.count += 1
+        if self.record:
+            self.calls.append(method)
+        return True
+
+    async def stream_content(self, *args: Any, **kwargs: Any):
+        yield b""
+
+    async def close(self) -> None:
+        return None
+
+
+def stub_bot(latency: float = 0.0, record: bool = True) -> Bot:
+    return Bot("42:BENCHMARK", session=StubSession(latency, record))
+
+
+_update_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> User:
+    return User(id=user_id, is_bot=False, first_name=f"user{user_id}")
+
+
+def make_message_update(user_id: int, text: str) -> Update:
+    update_id = next(_update_ids)
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            from_user=_user(user_id),
+            text=text,
+        ),
+    )
+
+
+def make_callback_update(user_id: int, data: str) -> Update:
+    update_id = next(_update_ids)
+    return Update(
+        update_id=update_id,
+        callback_query=CallbackQuery(
+            id=str(update_id), from_user=_user(user_id), chat_instance=str(user_id), data=data
+        ),
+    )
+
+
+def make_pre_checkout_update(user_id: int, payload: str, amount: int, currency: str = "XTR") -> Update:
+    update_id = next(_update_ids)
+    return Update(
+        update_id=update_id,
+        pre_checkout_query=PreCheckoutQuery(
+            id=str(update_id),
+            from_user=_user(user_id),
+            currency=currency,
+            total_amount=amount,
+            invoice_payload=payload,
+        ),
+    )
+
+
+def make_payment_update(user_id: int, payload: str, amount: int, currency: str = "XTR") -> Update:
+    update_id = next(_update_ids)
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            from_user=_user(user_id),
+            successful_payment=SuccessfulPayment(
+                currency=currency,
+                total_amount=amount,
+                invoice_payload=payload,
+                telegram_payment_charge_id=f"charge-{update_id}",
+                provider_payment_charge_id="",
+            ),
+        ),
+    )
+
+
+def stub_provisioner() -> ProvisionerClient:
+    """Provisioner that knows no devices (every lookup is a 404)."""
+
+    transport = httpx.MockTransport(lambda request: httpx.Response(404, json={"detail": "No devices for user"}))
+    return ProvisionerClient(client=httpx.AsyncClient(transport=transport, base_url="http://provisioner"))
+
+
+def stub_billing() -> BillingClient:
+    """Billing that issues every invoice and has already granted every trial."""
+
+    invoices = itertools.count(1)
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/payments/start":
+            token = f"{next(invoices):027d}"
+            return httpx.Response(200, json={"status": "pending", "amount_stars": 1, "invoice_id": token})
+        if request.url.path == "/trial":
+            return httpx.Response(409, json={"detail": "Trial is only available before the first subscription"})
+        return httpx.Response(404, json={"detail": "Not found"})
+
+    return BillingClient(client=httpx.AsyncClient(transport=httpx.MockTransport(handle), base_url="http://billing"))
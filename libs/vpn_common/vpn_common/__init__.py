@@ -0,0 +1 @@
+"""Code shared by the bot, billing, the provisioner and the dashboard."""
@@ -0,0 +1,503 @@
+"""Subscription lifecycle events on a Redis Streams log.
+
+Billing writes events to its outbox (``app/outbox.py``) in the transaction that
+changes the subscription, and a relay publishes them to one stream. Every
+service reads the stream through its own consumer group, so each group sees
+every event and replicas within a group share the work. A consumer acks a
+batch only after its handler succeeded. Entries left unacked (handler error,
+crashed replica) are claimed again after ``claim_idle`` seconds, so delivery
+is at least once. Handlers must therefore be idempotent. Consumers drop
+event ids they have already handled (a bounded window), and
+``latest_per_user`` lets a handler apply only the newest state of each user
+in a batch.
+
+Across batches a state event can still arrive late: an entry claimed from a
+crashed replica may carry a PAID that billing superseded with a REVOKED the
+handler has already applied. State events are ordered per user by ``seq``
+(the outbox row id; billing changes one user's state under that user's row
+lock, so a later change gets a larger id), and handlers keep the last
+applied ``seq`` per user, ``Watermarks`` or their own storage, to skip
+older ones.
+
+``MemoryEventStream`` is an in-process stand-in with the same group
+semantics, for tests and single-process runs.
+
+Billing and the provisioner consume on a thread (``EventConsumer``), the bot
+as an asyncio task (``AsyncEventConsumer``).
+"""
+
+from __future__ import annotations
+
+import abc
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+STREAM = "subscription-events"
+
+PAID, EXTENDED, TRIAL, GRACE, REVOKED, NODE_CHANGED = "paid", "extended", "trial", "grace", "revoked", "node_changed"
+# A due renewal reminder from billing's scheduler; published directly, not via the outbox.
+REMINDER = "reminder"
+# Events that carry the full subscription state; the newest one wins.
+STATE_EVENTS = frozenset({PAID, EXTENDED, TRIAL, GRACE, REVOKED})
+
+
+@dataclass(frozen=True)
+class Event:
+    id: str  # unique; billing uses the outbox row id
+    type: str
+    user_id: int
+    payload: Dict[str, Any] = field(default_factory=dict)
+    created_at: datetime = field(default_factory=datetime.utcnow)
+
+    def to_fields(self) -> Dict[str, str]:
+        return {
+            "id": self.id,
+            "type": self.type,
+            "user_id": str(self.user_id),
+            "payload": json.dumps(self.payload, default=str),
+            "created_at": self.created_at.isoformat(),
+        }
+
+    @classmethod
+    def from_fields(cls, fields: Dict[Any, Any]) -> "Event":
+        data = {_text(k): _text(v) for k, v in fields.items()}
+        return cls(
+            id=data["id"],
+            type=data["type"],
+            user_id=int(data["user_id"]),
+            payload=json.loads(data["payload"]),
+            created_at=datetime.fromisoformat(data["created_at"]),
+        )
+
+    @property
+    def seq(self) -> int:
+        """Order of a user's state events; only billing's events have one."""
+
+        return int(self.id)
+
+
+def _text(value: Any) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+@dataclass(frozen=True)
+class Delivery:
+    entry_id: str
+    event: Event
+
+
+def latest_per_user(events: Iterable[Event], types: frozenset = STATE_EVENTS) -> List[Event]:
+    """Newest event of ``types`` for each user, in stream order."""
+
+    latest: Dict[int, Event] = {}
+    for event in events:
+        if event.type in types:
+            latest.pop(event.user_id, None)
+            latest[event.user_id] = event
+    return list(latest.values())
+
+
+class Watermarks:
+    """``seq`` of the last state event applied per user, in memory.
+
+    ``fresh`` filters a batch before it is applied, ``advance`` records it
+    afterwards, so a failed batch is not marked applied. ``snapshot`` and
+    ``restore`` let a service keep the marks across restarts.
+    """
+
+    def __init__(self) -> None:
+        self._seqs: Dict[int, int] = {}
+
+    def fresh(self, events: Iterable[Event]) -> List[Event]:
+        return [event for event in events if event.seq > self._seqs.get(event.user_id, 0)]
+
+    def advance(self, events: Iterable[Event]) -> None:
+        for event in events:
+            if event.seq > self._seqs.get(event.user_id, 0):
+                self._seqs[event.user_id] = event.seq
+
+    def __len__(self) -> int:
+        return len(self._seqs)
+
+    def snapshot(self) -> bytes:
+        return json.dumps(self._seqs).encode()
+
+    def restore(self, raw: bytes) -> int:
+        """Merge a ``snapshot``; marks already set here are kept if newer."""
+
+        for user_id, seq in json.loads(raw).items():
+            self._seqs[int(user_id)] = max(seq, self._seqs.get(int(user_id), 0))
+        return len(self._seqs)
+
+
+class EventStream(abc.ABC):
+    @abc.abstractmethod
+    def publish(self, events: Sequence[Event]) -> None:
+        """Append ``events`` in order, in one round trip."""
+
+    @abc.abstractmethod
+    def ensure_group(self, group: str) -> None:
+        """Create ``group`` at the start of the retained log if it does not exist."""
+
+    @abc.abstractmethod
+    def read(self, group: str, consumer: str, count: int, block: float) -> List[Delivery]:
+        """Up to ``count`` new entries for ``consumer``, waiting up to ``block`` seconds."""
+
+    @abc.abstractmethod
+    def claim(self, group: str, consumer: str, min_idle: float, count: int) -> List[Delivery]:
+        """Take over entries delivered but not acked for ``min_idle`` seconds."""
+
+    @abc.abstractmethod
+    def ack(self, group: str, entry_ids: Sequence[str]) -> None:
+        ...
+
+    @abc.abstractmethod
+    def pending(self, group: str) -> int:
+        """Entries delivered to ``group`` and not acked yet."""
+
+
+class _Group:
+    def __init__(self, last: int) -> None:
+        self.last = last
+        # seq -> (consumer, delivered_at), oldest first
+        self.pending: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+
+
+class MemoryEventStream(EventStream):
+    def __init__(self, maxlen: int = 100_000, clock: Callable[[], float] = time.monotonic) -> None:
+        self.maxlen = maxlen
+        self._clock = clock
+        self._entries: List[Event] = []
+        self._first = 1  # seq of _entries[0]
+        self._groups: Dict[str, _Group] = {}
+        self._cond = threading.Condition()
+
+    @property
+    def _next(self) -> int:
+        return self._first + len(self._entries)
+
+    def publish(self, events: Sequence[Event]) -> None:
+        with self._cond:
+            self._entries.extend(events)
+            overflow = len(self._entries) - self.maxlen
+            # Trim in chunks so appends stay amortised O(1).
+            if overflow > self.maxlen // 10:
+                del self._entries[:overflow]
+                self._first += overflow
+            self._cond.notify_all()
+
+    def ensure_group(self, group: str) -> None:
+        with self._cond:
+            self._groups.setdefault(group, _Group(self._first - 1))
+
+    def _delivery(self, seq: int) -> Optional[Delivery]:
+        if seq < self._first:
+            return None  # trimmed
+        return Delivery(f"{seq}-0", self._entries[seq - self._first])
+
+    def read(self, group: str, consumer: str, count: int, block: float) -> List[Delivery]:
+        deadline = self._clock() + block
+        with self._cond:
+            state = self._groups[group]
+            while state.last + 1 >= self._next:
+                remaining = deadline - self._clock()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+            state.last = max(state.last, self._first - 1)
+            now = self._clock()
+            deliveries = []
+            for seq in range(state.last + 1, min(state.last + 1 + count, self._next)):
+                state.pending[seq] = (consumer, now)
+                deliveries.append(self._delivery(seq))
+            state.last += len(deliveries)
+            return deliveries
+
+    def claim(self, group: str, consumer: str, min_idle: float, count: int) -> List[Delivery]:
+        now = self._clock()
+        with self._cond:
+            state = self._groups[group]
+            deliveries = []
+            for seq, (_, delivered_at) in list(state.pending.items()):
+                if len(deliveries) >= count:
+                    break
+                if now - delivered_at < min_idle:
+                    continue
+                delivery = self._delivery(seq)
+                if delivery is None:
+                    del state.pending[seq]
+                    continue
+                state.pending[seq] = (consumer, now)
+                deliveries.append(delivery)
+            return deliveries
+
+    def ack(self, group: str, entry_ids: Sequence[str]) -> None:
+        with self._cond:
+            pending = self._groups[group].pending
+            for entry_id in entry_ids:
+                pending.pop(int(entry_id.split("-", 1)[0]), None)
+
+    def pending(self, group: str) -> int:
+        state = self._groups.get(group)
+        return len(state.pending) if state else 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RedisEventStream(EventStream):
+    def __init__(self, client, stream: str = STREAM, maxlen: int = 1_000_000) -> None:
+        self.client = client
+        self.stream = stream
+        self.maxlen = maxlen
+
+    def publish(self, events: Sequence[Event]) -> None:
+        pipe = self.client.pipeline(transaction=False)
+        for event in events:
+            pipe.xadd(self.stream, event.to_fields(), maxlen=self.maxlen, approximate=True)
+        pipe.execute()
+
+    def ensure_group(self, group: str) -> None:
+        from redis.exceptions import ResponseError
+
+        try:
+            self.client.xgroup_create(self.stream, group, id="0", mkstream=True)
+        except ResponseError as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
+
+    @staticmethod
+    def _deliveries(entries) -> List[Delivery]:
+        # Entries trimmed from the stream come back without fields.
+        return [Delivery(_text(entry_id), Event.from_fields(fields)) for entry_id, fields in entries if fields]
+
+    def read(self, group: str, consumer: str, count: int, block: float) -> List[Delivery]:
+        resp = self.client.xreadgroup(
+            group, consumer, {self.stream: ">"}, count=count, block=int(block * 1000) or None
+        )
+        if not resp:
+            return []
+        if isinstance(resp, dict):  # RESP3
+            return self._deliveries(next(iter(resp.values()))[0])
+        return self._deliveries(resp[0][1])
+
+    def claim(self, group: str, consumer: str, min_idle: float, count: int) -> List[Delivery]:
+        resp = self.client.xautoclaim(self.stream, group, consumer, int(min_idle * 1000), start_id="0-0", count=count)
+        return self._deliveries(resp[1])
+
+    def ack(self, group: str, entry_ids: Sequence[str]) -> None:
+        if entry_ids:
+            self.client.xack(self.stream, group, *entry_ids)
+
+    def pending(self, group: str) -> int:
+        return self.client.xpending(self.stream, group)["pending"]
+
+
+class EventStreamConfigError(ValueError):
+    pass
+
+
+def build_event_stream(backend: str, redis_url: Optional[str] = None) -> Optional[EventStream]:
+    """``redis``, ``memory`` or ``none`` (events disabled).
+
+    Misconfiguration fails loudly: an in-memory stream in a process of its
+    own would silently drop every event.
+    """
+
+    if backend == "none":
+        return None
+    if backend == "memory":
+        return MemoryEventStream()
+    if backend != "redis":
+        raise EventStreamConfigError(f"Unknown events backend {backend!r}")
+    if not redis_url:
+        raise EventStreamConfigError("The redis events backend needs a Redis URL (REDIS_URL)")
+    import redis
+
+    return RedisEventStream(redis.Redis.from_url(redis_url))
+
+
+class _Consumer:
+    """Group bookkeeping shared by the thread and asyncio consumers."""
+
+    def __init__(
+        self,
+        stream: EventStream,
+        group: str,
+        handler: Callable[[List[Event]], Any],
+        consumer: Optional[str] = None,
+        batch_size: int = 100,
+        block: float = 1.0,
+        claim_idle: float = 30.0,
+        remember: int = 100_000,
+        retry_delay: float = 1.0,
+    ) -> None:
+        self.stream = stream
+        self.group = group
+        self.handler = handler
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.batch_size = batch_size
+        self.block = block
+        self.claim_idle = claim_idle
+        self.remember = remember
+        self.retry_delay = retry_delay
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._last_claim = 0.0
+        self._ready = False
+        self.processed = self.duplicates = self.failures = 0
+        self.last_lag_seconds = 0.0
+
+    def pending(self) -> int:
+        return self.stream.pending(self.group)
+
+    def _claim_due(self) -> bool:
+        now = time.monotonic()
+        if now - self._last_claim < self.claim_idle / 2:
+            return False
+        self._last_claim = now
+        return True
+
+    def _fresh(self, deliveries: List[Delivery]) -> List[Event]:
+        fresh, ids = [], set()
+        for delivery in deliveries:
+            event_id = delivery.event.id
+            if event_id in self._seen or event_id in ids:
+                self.duplicates += 1
+                continue
+            ids.add(event_id)
+            fresh.append(delivery.event)
+        return fresh
+
+    def _handled(self, events: List[Event]) -> None:
+        for event in events:
+            self._seen[event.id] = None
+        while len(self._seen) > self.remember:
+            self._seen.popitem(last=False)
+        self.processed += len(events)
+        if events:
+            self.last_lag_seconds = (datetime.utcnow() - events[-1].created_at).total_seconds()
+
+
+class EventConsumer(_Consumer):
+    """Feeds one consumer group to ``handler`` in batches, on a background thread."""
+
+    handler: Callable[[List[Event]], None]
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"events-{self.group}", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout=self.block + 5)
+            self._thread = None
+
+    def poll(self) -> int:
+        """Handle one batch, stale entries first; returns the events handled."""
+
+        if not self._ready:
+            self.stream.ensure_group(self.group)
+            self._ready = True
+        deliveries: List[Delivery] = []
+        if self._claim_due():
+            deliveries = self.stream.claim(self.group, self.consumer, self.claim_idle, self.batch_size)
+        if not deliveries:
+            deliveries = self.stream.read(self.group, self.consumer, self.batch_size, self.block)
+        if not deliveries:
+            return 0
+        fresh = self._fresh(deliveries)
+        if fresh:
+            # Raising leaves the batch unacked; it is claimed again later.
+            self.handler(fresh)
+        self._handled(fresh)
+        self.stream.ack(self.group, [d.entry_id for d in deliveries])
+        return len(fresh)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                self.failures += 1
+                logger.exception("Event consumer %s failed; retrying", self.group)
+                self._stop.wait(self.retry_delay)
+
+
+class AsyncEventConsumer(_Consumer):
+    """Feeds one consumer group to an async ``handler`` in batches, as an asyncio task.
+
+    Stream calls are blocking, so they run in the default executor.
+    """
+
+    handler: Callable[[List[Event]], Awaitable[None]]
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"events-{self.group}")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def poll(self) -> int:
+        """Handle one batch, stale entries first; returns the events handled."""
+
+        if not self._ready:
+            await asyncio.to_thread(self.stream.ensure_group, self.group)
+            self._ready = True
+        deliveries: List[Delivery] = []
+        if self._claim_due():
+            deliveries = await asyncio.to_thread(
+                self.stream.claim, self.group, self.consumer, self.claim_idle, self.batch_size
+            )
+        if not deliveries:
+            deliveries = await asyncio.to_thread(
+                self.stream.read, self.group, self.consumer, self.batch_size, self.block
+            )
+        if not deliveries:
+            return 0
+        fresh = self._fresh(deliveries)
+        if fresh:
+            await self.handler(fresh)
+        self._handled(fresh)
+        await asyncio.to_thread(self.stream.ack, self.group, [d.entry_id for d in deliveries])
+        return len(fresh)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failures += 1
+                logger.exception("Event consumer %s failed; retrying", self.group)
+                await asyncio.sleep(self.retry_delay)
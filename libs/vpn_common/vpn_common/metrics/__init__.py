@@ -0,0 +1,37 @@
+"""Prometheus instrumentation shared by the bot and the backend services.
+
+This module holds what every process reports: work-queue depths, read when
+Prometheus scrapes so the hot path never updates them, and the latency of
+outgoing HTTP calls, labelled with the upstream host. ``asgi`` adds the
+per-route middleware of the FastAPI services, ``transports`` the timed
+``httpx`` transports. The bot keeps its update metrics in its own package.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Callable
+
+from prometheus_client import REGISTRY, Gauge, Histogram, generate_latest
+
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds", "Outgoing HTTP calls until response headers", ["upstream", "outcome"]
+)
+QUEUE_DEPTH = Gauge("work_queue_depth", "Items waiting in a background work queue", ["queue"])
+
+
+def observe_queue(name: str, depth: Callable[[], float]) -> None:
+    """Report ``depth()`` as ``work_queue_depth{queue=name}`` on every scrape."""
+
+    def read() -> float:
+        # A failing source (e.g. Redis down) must not break the whole scrape.
+        try:
+            return float(depth())
+        except Exception:
+            return math.nan
+
+    QUEUE_DEPTH.labels(name).set_function(read)
+
+
+def render() -> bytes:
+    return generate_latest(REGISTRY)
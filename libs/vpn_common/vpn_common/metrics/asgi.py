@@ -0,0 +1,76 @@
+"""Per-route request metrics for the FastAPI services.
+
+Label values are bounded by construction. Routes are reported by their
+template (``/jobs/{job_id}``, never the raw path), anything that matched no
+route as ``<unmatched>``, unusual methods as ``OTHER`` and statuses by class
+(``2xx``).
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Dict, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import render
+
+METHODS = frozenset({"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"})
+UNMATCHED = "<unmatched>"
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Request latency by route template", ["method", "route"]
+)
+REQUESTS = Counter("http_requests_total", "Requests by route template and status class", ["method", "route", "status"])
+IN_FLIGHT = Gauge("http_requests_in_progress", "Requests currently being served")
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware; cheaper than ``BaseHTTPMiddleware`` per request."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        # Label lookups are cached per (method, route); the set is bounded by the route table.
+        self._children: Dict[Tuple[str, str], Tuple[Histogram, Dict[int, Counter]]] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            IN_FLIGHT.dec()
+            self._observe(scope, status, elapsed)
+
+    def _observe(self, scope: Scope, status: int, elapsed: float) -> None:
+        # FastAPI stores the matched route in the scope while routing.
+        route = getattr(scope.get("route"), "path", None) or UNMATCHED
+        method = scope["method"] if scope["method"] in METHODS else "OTHER"
+        children = self._children.get((method, route))
+        if children is None:
+            children = self._children[(method, route)] = (REQUEST_LATENCY.labels(method, route), {})
+        histogram, counters = children
+        histogram.observe(elapsed)
+        status_class = status // 100
+        counter = counters.get(status_class)
+        if counter is None:
+            counter = counters[status_class] = REQUESTS.labels(method, route, f"{status_class}xx")
+        counter.inc()
+
+
+def metrics_response() -> Response:
+    return Response(content=render(), media_type=CONTENT_TYPE_LATEST)
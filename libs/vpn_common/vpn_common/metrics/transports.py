@@ -0,0 +1,50 @@
+"""``httpx`` transports that time outgoing calls into ``upstream_request_duration_seconds``."""
+
+from __future__ import annotations
+
+import time
+from typing import Optional
+
+import httpx
+
+from . import UPSTREAM_LATENCY
+
+
+def _observe(request: httpx.Request, outcome: str, started: float) -> None:
+    UPSTREAM_LATENCY.labels(request.url.host, outcome).observe(time.perf_counter() - started)
+
+
+class TimedTransport(httpx.BaseTransport):
+    def __init__(self, transport: Optional[httpx.BaseTransport] = None) -> None:
+        self._transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = self._transport.handle_request(request)
+        except Exception:
+            _observe(request, "error", started)
+            raise
+        _observe(request, f"{response.status_code // 100}xx", started)
+        return response
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncTimedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: Optional[httpx.AsyncBaseTransport] = None) -> None:
+        self._transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            _observe(request, "error", started)
+            raise
+        _observe(request, f"{response.status_code // 100}xx", started)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
@@ -1,17 +1,10 @@
 #!/usr/bin/env bash
 set -euo pipefail
 
-# Базовый шаблон бэкапа Postgres -> S3-совместимое хранилище
-# Требует переменные: POSTGRES_*, MINIO_* и установленный rclone с конфигом `r2:`
+# Бэкап Postgres и бакета конфигов через воркер billing (app/backup.py):
+# потоковый pg_dump -> параллельный gzip -> multipart-загрузка в MinIO, без временных файлов.
+# Команды: run (по умолчанию), verify, list, prune.
 
-TIMESTAMP=$(date +"%Y%m%d_%H%M%S")
-FILE="backup_${TIMESTAMP}.sql.gz"
+COMMAND="${1:-run}"
 
-echo "Dumping Postgres..."
-pg_dump -h "$POSTGRES_HOST" -p "$POSTGRES_PORT" -U "$POSTGRES_USER" "$POSTGRES_DB" | gzip > "$FILE"
-
-echo "Uploading to object storage..."
-rclone copy "$FILE" r2:vpn-config-backups/
-
-rm "$FILE"
-echo "Backup completed: $FILE"
+docker compose exec -T billing python -m app.backup "$COMMAND"
@@ -7,6 +7,9 @@ set -euo pipefail
 IFACES=(wg0 amnezia0)
 TARGET_RATE_DOWN="900Mbit"
 TARGET_RATE_UP="900Mbit"
+# With SHAPING_BACKEND=tc the provisioner owns the egress root (HTB with
+# per-peer classes); only the ingress side is left to CAKE then.
+PER_PEER_SHAPING="${PER_PEER_SHAPING:-0}"
 
 if ! command -v cake-autorate >/dev/null 2>&1; then
   echo "Installing cake-autorate via pipx..."
@@ -15,7 +18,9 @@ fi
 
 for IFACE in "${IFACES[@]}"; do
   echo "Applying CAKE to ${IFACE}"
-  tc qdisc replace dev "${IFACE}" root cake bandwidth "${TARGET_RATE_DOWN}"
+  if [[ "${PER_PEER_SHAPING}" != "1" ]]; then
+    tc qdisc replace dev "${IFACE}" root cake bandwidth "${TARGET_RATE_DOWN}"
+  fi
   tc qdisc replace dev "${IFACE}" ingress cake bandwidth "${TARGET_RATE_UP}"
   cake-autorate --iface "${IFACE}" --autorate-ingress --autorate-egress &
 done
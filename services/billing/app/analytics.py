@@ -0,0 +1,461 @@
+"""Subscriber and revenue rollups for the dashboard and the bot admin menu.
+
+Nothing here scans subscriptions or invoices on a read. Every trial,
+payment and expiry transition updates the rollups inside the transaction
+that makes the change, so they are exactly as consistent as the data.
+
+* ``analytics_members`` is each user's last counted contribution: status
+  (active, grace, gone), tariff, whether they pay, and their MRR share.
+  An event computes the new row and applies ``new - old`` to the counters,
+  so a transition that changes nothing writes nothing.
+* ``analytics_counters`` holds gauges (active, grace and paying users and
+  MRR per tariff) and all-time totals. ``analytics_daily`` holds per-day
+  totals (trials, conversions, new payers, churn, revenue).
+
+Both are split into ``shards`` rows per counter by ``user_id``. Concurrent
+payments then update different rows instead of queueing on one hot row
+lock in Postgres. A read sums at most shards x counters rows
+(``snapshot``), independent of the number of users.
+
+MRR counts active paying users at their last payment scaled to 30 days, so
+the yearly plan adds ``2262 * 30 / 365`` a month. Churn is a paying user
+reaching ``revoked``; a renewal during grace is not churn.
+
+``python -m app.analytics backfill`` rebuilds all three tables from
+``subscriptions`` and ``invoices`` in one pass over each. Trials leave no
+invoice, so trial history comes from existing member rows and current trial
+subscriptions; a trial that was never recorded cannot be counted.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+from collections import Counter
+from dataclasses import asdict, dataclass, replace
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Integer,
+    PrimaryKeyConstraint,
+    SmallInteger,
+    String,
+    Table,
+    delete,
+    func,
+    insert,
+    select,
+    text,
+)
+from sqlalchemy.engine import Connection, Engine
+
+from .db import metadata, upsert_insert
+from .expiry import ACTIVE, GRACE, REVOKED, Transition, subscriptions
+from .ledger import Invoice, invoices
+from .schemas import Subscription, Tariff
+
+logger = logging.getLogger(__name__)
+
+analytics_members = Table(
+    "analytics_members",
+    metadata,
+    Column("user_id", BigInteger, primary_key=True, autoincrement=False),
+    Column("tariff_code", String(32), nullable=False),
+    Column("status", String(16), nullable=False),
+    Column("paying", Boolean, nullable=False),
+    Column("mrr_stars", Integer, nullable=False),
+    Column("trial_at", DateTime, nullable=True),
+    Column("first_paid_at", DateTime, nullable=True),
+)
+
+analytics_counters = Table(
+    "analytics_counters",
+    metadata,
+    Column("metric", String(32), nullable=False),
+    Column("key", String(32), nullable=False),
+    Column("shard", SmallInteger, nullable=False),
+    Column("value", BigInteger, nullable=False),
+    PrimaryKeyConstraint("metric", "key", "shard", name="pk_analytics_counters"),
+)
+
+analytics_daily = Table(
+    "analytics_daily",
+    metadata,
+    Column("day", Date, nullable=False),
+    Column("metric", String(32), nullable=False),
+    Column("shard", SmallInteger, nullable=False),
+    Column("value", BigInteger, nullable=False),
+    PrimaryKeyConstraint("day", "metric", "shard", name="pk_analytics_daily"),
+)
+
+# Member status; "gone" users count nowhere but keep their trial/payment history.
+COUNTED_ACTIVE, COUNTED_GRACE, GONE = "active", "grace", "gone"
+_STATUS = {ACTIVE: COUNTED_ACTIVE, GRACE: COUNTED_GRACE, REVOKED: GONE}
+
+# Daily and all-time event totals.
+TRIALS, CONVERSIONS, NEW_PAID, CHURNED, PAYMENTS, REVENUE = (
+    "trials",
+    "conversions",
+    "new_paid",
+    "churned",
+    "payments",
+    "revenue_stars",
+)
+TOTAL = ""  # counter key of all-time totals
+
+MRR_DAYS = 30
+TRIAL_TARIFF = "trial"
+
+
+@dataclass(frozen=True)
+class Member:
+    user_id: int
+    tariff_code: str
+    status: str
+    paying: bool
+    mrr_stars: int
+    trial_at: Optional[datetime] = None
+    first_paid_at: Optional[datetime] = None
+
+    def gauges(self) -> Dict[Tuple[str, str], int]:
+        """This member's share of the per-tariff gauges."""
+
+        if self.status == GONE:
+            return {}
+        shares = {(self.status, self.tariff_code): 1}
+        if self.status == COUNTED_ACTIVE and self.paying:
+            shares[("paying", self.tariff_code)] = 1
+            shares[("mrr_stars", self.tariff_code)] = self.mrr_stars
+        return shares
+
+
+def monthly_stars(amount_stars: int, duration_days: int) -> int:
+    return round(amount_stars * MRR_DAYS / max(1, duration_days))
+
+
+class Analytics:
+    def __init__(
+        self,
+        engine: Engine,
+        resolve_tariff: Callable[[str], Optional[Tariff]],
+        shards: int = 16,
+        clock: Callable[[], datetime] = datetime.utcnow,
+    ) -> None:
+        self.engine = engine
+        self.resolve_tariff = resolve_tariff
+        self.shards = max(1, shards)
+        self._clock = clock
+
+    # -- incremental updates, called inside the writing transaction --------
+
+    def trial(self, conn: Connection, sub: Subscription) -> None:
+        before = self._member(conn, sub.user_id)
+        now = self._clock()
+        first_trial = before is None or before.trial_at is None
+        after = Member(
+            user_id=sub.user_id,
+            tariff_code=sub.tariff_code,
+            status=COUNTED_ACTIVE,
+            paying=False,
+            mrr_stars=0,
+            trial_at=now if first_trial else before.trial_at,
+            first_paid_at=before.first_paid_at if before else None,
+        )
+        self._apply(conn, before, after, {TRIALS: 1} if first_trial else {}, now)
+
+    def paid(self, conn: Connection, invoice: Invoice) -> None:
+        before = self._member(conn, invoice.user_id)
+        now = invoice.paid_at or self._clock()
+        tariff = self.resolve_tariff(invoice.tariff_code)
+        duration = tariff.duration_days if tariff is not None else MRR_DAYS
+        first_payment = before is None or before.first_paid_at is None
+        after = Member(
+            user_id=invoice.user_id,
+            tariff_code=invoice.tariff_code,
+            status=COUNTED_ACTIVE,
+            paying=True,
+            mrr_stars=monthly_stars(invoice.amount_stars, duration),
+            trial_at=before.trial_at if before else None,
+            first_paid_at=now if first_payment else before.first_paid_at,
+        )
+        events = {PAYMENTS: 1, REVENUE: invoice.amount_stars}
+        if first_payment:
+            events[NEW_PAID] = 1
+            if after.trial_at is not None:
+                events[CONVERSIONS] = 1
+        self._apply(conn, before, after, events, now)
+
+    def transition(self, conn: Connection, transition: Transition) -> None:
+        status = _STATUS[transition.to_state]
+        before = self._member(conn, transition.subscription.user_id)
+        if before is not None and before.status == status:
+            return  # new -> active: already counted as active
+        after = (
+            replace(before, status=status)
+            if before is not None
+            else self._untracked(transition.subscription, status)
+        )
+        events = {CHURNED: 1} if status == GONE and after.paying else {}
+        self._apply(conn, before, after, events, self._clock())
+
+    def _untracked(self, sub: Subscription, status: str) -> Member:
+        """A user from before analytics existed; best guess until a backfill."""
+
+        tariff = self.resolve_tariff(sub.tariff_code)
+        paying = sub.tariff_code != TRIAL_TARIFF
+        mrr = monthly_stars(tariff.price_stars, tariff.duration_days) if paying and tariff else 0
+        return Member(sub.user_id, sub.tariff_code, status, paying, mrr)
+
+    def _member(self, conn: Connection, user_id: int) -> Optional[Member]:
+        # FOR UPDATE waits out a running backfill on Postgres (see ``backfill``).
+        row = conn.execute(
+            select(analytics_members).where(analytics_members.c.user_id == user_id).with_for_update()
+        ).first()
+        return Member(**row._mapping) if row else None
+
+    def _apply(
+        self,
+        conn: Connection,
+        before: Optional[Member],
+        after: Member,
+        events: Dict[str, int],
+        now: datetime,
+    ) -> None:
+        shard = after.user_id % self.shards
+        deltas: Counter = Counter(after.gauges())
+        deltas.subtract(before.gauges() if before else {})
+        deltas.update({(metric, TOTAL): value for metric, value in events.items()})
+        self._write_member(conn, after)
+        self._increment(
+            conn,
+            analytics_counters,
+            [{"metric": m, "key": k, "shard": shard, "value": v} for (m, k), v in deltas.items() if v],
+            ("metric", "key", "shard"),
+        )
+        self._increment(
+            conn,
+            analytics_daily,
+            [{"day": now.date(), "metric": m, "shard": shard, "value": v} for m, v in events.items() if v],
+            ("day", "metric", "shard"),
+        )
+
+    def _write_member(self, conn: Connection, member: Member) -> None:
+        values = asdict(member)
+        stmt = upsert_insert(self.engine, analytics_members).values(**values)
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[analytics_members.c.user_id],
+                set_={k: v for k, v in values.items() if k != "user_id"},
+            )
+        )
+
+    def _increment(self, conn: Connection, table: Table, rows: List[dict], keys: Tuple[str, ...]) -> None:
+        if not rows:
+            return
+        # One statement, rows in key order: concurrent writers lock them in the same order.
+        rows.sort(key=lambda row: tuple(row[k] for k in keys))
+        stmt = upsert_insert(self.engine, table).values(rows)
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[table.c[k] for k in keys],
+                set_={"value": table.c.value + stmt.excluded.value},
+            )
+        )
+
+    # -- reads -------------------------------------------------------------
+
+    def snapshot(self, days: int = 30) -> dict:
+        """Current gauges, all-time totals and the last ``days`` days; O(shards x metrics)."""
+
+        now = self._clock()
+        since = (now - timedelta(days=days - 1)).date()
+        with self.engine.connect() as conn:
+            counters = conn.execute(
+                select(analytics_counters.c.metric, analytics_counters.c.key, func.sum(analytics_counters.c.value))
+                .group_by(analytics_counters.c.metric, analytics_counters.c.key)
+            ).all()
+            recent = conn.execute(
+                select(analytics_daily.c.metric, func.sum(analytics_daily.c.value))
+                .where(analytics_daily.c.day >= since)
+                .group_by(analytics_daily.c.metric)
+            ).all()
+        tariffs: Dict[str, Dict[str, int]] = {}
+        totals: Dict[str, int] = {}
+        for metric, key, value in counters:
+            if key == TOTAL:
+                totals[metric] = int(value)
+            else:
+                tariffs.setdefault(key, {"active": 0, "grace": 0, "paying": 0, "mrr_stars": 0})[metric] = int(value)
+        window = {metric: 0 for metric in (TRIALS, CONVERSIONS, NEW_PAID, CHURNED, PAYMENTS, REVENUE)}
+        window.update({metric: int(value) for metric, value in recent})
+        paying = sum(t["paying"] for t in tariffs.values())
+        # Payers at the start of the window, ignoring comebacks of churned users.
+        paying_then = paying - window[NEW_PAID] + window[CHURNED]
+        trials = totals.get(TRIALS, 0)
+        return {
+            "generated_at": now,
+            "active": sum(t["active"] for t in tariffs.values()),
+            "grace": sum(t["grace"] for t in tariffs.values()),
+            "paying": paying,
+            "mrr_stars": sum(t["mrr_stars"] for t in tariffs.values()),
+            "tariffs": [dict(code=code, **values) for code, values in sorted(tariffs.items()) if any(values.values())],
+            "trials": trials,
+            "conversions": totals.get(CONVERSIONS, 0),
+            "conversion_rate": round(totals.get(CONVERSIONS, 0) / trials, 4) if trials else None,
+            "revenue_stars": totals.get(REVENUE, 0),
+            "window_days": days,
+            "window": window,
+            "churn_rate": round(window[CHURNED] / paying_then, 4) if paying_then > 0 else None,
+        }
+
+    # -- backfill ----------------------------------------------------------
+
+    def backfill(self, chunk_size: int = 5000) -> Dict[str, int]:
+        """Rebuild every rollup from ``subscriptions`` and ``invoices``.
+
+        Runs in one transaction. On Postgres the rollup tables are locked
+        against writers first: payments and transitions that commit while
+        it runs wait, then apply their change on top of the rebuilt rows.
+        Readers keep seeing the old rollups until the commit.
+        """
+
+        with self.engine.begin() as conn:
+            if self.engine.dialect.name == "postgresql":
+                conn.execute(
+                    text("LOCK TABLE analytics_members, analytics_counters, analytics_daily IN EXCLUSIVE MODE")
+                )
+            trials = dict(
+                conn.execute(
+                    select(analytics_members.c.user_id, analytics_members.c.trial_at).where(
+                        analytics_members.c.trial_at.is_not(None)
+                    )
+                ).all()
+            )
+            # SQLite: taking the write lock here keeps the reads below consistent.
+            for table in (analytics_members, analytics_counters, analytics_daily):
+                conn.execute(delete(table))
+            members, daily = self._rebuild(conn, trials)
+            counters: Counter = Counter()
+            for member in members.values():
+                shard = member.user_id % self.shards
+                for (metric, key), value in member.gauges().items():
+                    counters[(metric, key, shard)] += value
+            for (day, metric, shard), value in daily.items():
+                counters[(metric, TOTAL, shard)] += value
+            self._bulk_insert(conn, analytics_members, (asdict(m) for m in members.values()), chunk_size)
+            self._bulk_insert(
+                conn,
+                analytics_counters,
+                ({"metric": m, "key": k, "shard": s, "value": v} for (m, k, s), v in counters.items() if v),
+                chunk_size,
+            )
+            self._bulk_insert(
+                conn,
+                analytics_daily,
+                ({"day": d, "metric": m, "shard": s, "value": v} for (d, m, s), v in daily.items() if v),
+                chunk_size,
+            )
+        return {"members": len(members), "counters": len(counters), "daily": len(daily)}
+
+    def _rebuild(
+        self, conn: Connection, trials: Dict[int, datetime]
+    ) -> Tuple[Dict[int, Member], Counter]:
+        daily: Counter = Counter()  # (day, metric, shard) -> value
+        first_paid: Dict[int, datetime] = {}
+        last_paid: Dict[int, Tuple[str, int]] = {}  # user -> (tariff, amount) of the latest payment
+        paid_rows = conn.execute(
+            select(invoices.c.user_id, invoices.c.tariff_code, invoices.c.amount_stars, invoices.c.paid_at)
+            .where(invoices.c.status == "paid")
+            .order_by(invoices.c.id)
+            .execution_options(yield_per=10_000)
+        )
+        for user_id, tariff_code, amount, paid_at in paid_rows:
+            shard, day = user_id % self.shards, paid_at.date()
+            daily[(day, PAYMENTS, shard)] += 1
+            daily[(day, REVENUE, shard)] += amount
+            first_paid.setdefault(user_id, paid_at)
+            last_paid[user_id] = (tariff_code, amount)
+
+        trial = self.resolve_tariff(TRIAL_TARIFF)
+        trial_days = trial.duration_days if trial is not None else 3
+        members: Dict[int, Member] = {}
+        sub_rows = conn.execute(
+            select(
+                subscriptions.c.user_id,
+                subscriptions.c.tariff_code,
+                subscriptions.c.state,
+                subscriptions.c.active_until,
+                subscriptions.c.grace_until,
+            ).execution_options(yield_per=10_000)
+        )
+        for user_id, tariff_code, state, active_until, grace_until in sub_rows:
+            trial_at = trials.get(user_id)
+            if trial_at is None and tariff_code == TRIAL_TARIFF:
+                trial_at = active_until - timedelta(days=trial_days)
+            paying = tariff_code != TRIAL_TARIFF and user_id in last_paid
+            mrr = 0
+            if paying:
+                paid_tariff = self.resolve_tariff(last_paid[user_id][0])
+                mrr = monthly_stars(last_paid[user_id][1], paid_tariff.duration_days if paid_tariff else MRR_DAYS)
+            # A "new" row is active (or about to transition, which updates the rollups).
+            status = _STATUS.get(state, COUNTED_ACTIVE)
+            member = Member(user_id, tariff_code, status, paying, mrr, trial_at, first_paid.get(user_id))
+            members[user_id] = member
+            shard = user_id % self.shards
+            if trial_at is not None:
+                daily[(trial_at.date(), TRIALS, shard)] += 1
+            if member.first_paid_at is not None:
+                daily[(member.first_paid_at.date(), NEW_PAID, shard)] += 1
+                if trial_at is not None and trial_at <= member.first_paid_at:
+                    daily[(member.first_paid_at.date(), CONVERSIONS, shard)] += 1
+            if status == GONE and paying:
+                daily[(grace_until.date(), CHURNED, shard)] += 1
+        return members, daily
+
+    @staticmethod
+    def _bulk_insert(conn: Connection, table: Table, rows: Iterable[dict], chunk_size: int) -> None:
+        chunk: List[dict] = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                conn.execute(insert(table), chunk)
+                chunk = []
+        if chunk:
+            conn.execute(insert(table), chunk)
+
+
+def _day_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(type(value).__name__)
+
+
+def main() -> None:
+    from .catalog import catalog
+    from .config import get_settings
+    from .db import create_db_engine, get_database_url
+
+    parser = argparse.ArgumentParser(description="Billing analytics rollups")
+    parser.add_argument("command", choices=("backfill", "show"))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    settings = get_settings()
+    engine = create_db_engine(get_database_url(settings))
+    metadata.create_all(engine)
+    analytics = Analytics(engine, catalog.get, shards=settings.analytics_shards)
+    if args.command == "backfill":
+        print(json.dumps(analytics.backfill()))
+    else:
+        print(json.dumps(analytics.snapshot(settings.analytics_window_days), default=_day_default, indent=2))
+
+
+if __name__ == "__main__":
+    main()
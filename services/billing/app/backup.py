@@ -0,0 +1,879 @@
+"""Database and config backups streamed straight into object storage.
+
+``pg_dump`` writes plain SQL to a pipe. The worker cuts it into
+``block_size`` blocks and gzips them on a thread pool (zlib releases the
+GIL), each block as its own gzip member; concatenated members are a valid
+``.gz`` that ``gunzip``/``zcat`` read as one stream. Compressed blocks feed a
+multipart upload in order with ``upload_workers`` parts in flight. Nothing
+touches local disk, and memory stays at a few blocks and parts whatever the
+database size. A failed dump aborts the upload and writes no manifest, so a
+partial dump never counts as a backup.
+
+Each dump ``db/<stamp>.sql.gz`` has a manifest ``db/<stamp>.json`` with size
+and SHA-256 of the compressed and of the raw stream. ``verify()`` reads the
+backup back, decompresses it as a stream, checks both and, if a restore
+command is configured (e.g. ``psql`` against a scratch database), pipes the
+SQL into it.
+
+The configs bucket is exported incrementally: objects are copied to
+``configs/objects/<key>/<etag>`` and an object whose ETag matches the last
+snapshot is skipped. Each run writes ``configs/snapshots/<stamp>.json``
+mapping every key to its copy.
+
+Retention keeps the newest ``keep_last`` verified backups plus the newest
+verified backup of each of the last ``keep_daily`` days; unverified dumps
+never count toward either. Config snapshots follow the same rule by run, and
+config copies no remaining snapshot refers to are deleted afterwards.
+"""
+
+from __future__ import annotations
+
+import abc
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import shlex
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from sqlalchemy.engine import make_url
+
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+MIB = 1024 * 1024
+# S3 rejects multipart parts below 5 MiB (except the last one).
+MIN_PART_SIZE = 5 * MIB
+STAMP_FORMAT = "%Y%m%d_%H%M%S_%f"
+DB_PREFIX = "db/"
+SNAPSHOT_PREFIX = "configs/snapshots/"
+OBJECT_PREFIX = "configs/objects/"
+
+
+class BackupError(Exception):
+    pass
+
+
+class DumpFailed(BackupError):
+    pass
+
+
+class VerificationFailed(BackupError):
+    pass
+
+
+class BackupInProgress(BackupError):
+    pass
+
+
+@dataclass(frozen=True)
+class StoredObject:
+    key: str
+    etag: str
+    size: int
+
+
+class Digest:
+    """Running size and SHA-256 of the bytes passed to ``update``."""
+
+    def __init__(self) -> None:
+        self.size = 0
+        self._sha = hashlib.sha256()
+
+    def update(self, data: bytes) -> None:
+        self.size += len(data)
+        self._sha.update(data)
+
+    def hexdigest(self) -> str:
+        return self._sha.hexdigest()
+
+
+def tap(chunks: Iterable[bytes], digest: Digest) -> Iterator[bytes]:
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+class ChunkReader:
+    """Read-only file object over an iterator of chunks, for streaming uploads."""
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._pending: deque = deque()
+        self._buffered = 0
+        self._eof = False
+        self.digest = Digest()
+
+    def read(self, size: int = -1) -> bytes:
+        # Fill up to ``size`` so callers appending reads get one piece per part.
+        while not self._eof and (size < 0 or self._buffered < size):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._eof = True
+            elif chunk:
+                self._pending.append(chunk)
+                self._buffered += len(chunk)
+        want = self._buffered if size < 0 else min(size, self._buffered)
+        parts, taken = [], 0
+        while taken < want:
+            chunk = self._pending.popleft()
+            if taken + len(chunk) > want:
+                cut = want - taken
+                self._pending.appendleft(chunk[cut:])
+                chunk = chunk[:cut]
+            parts.append(chunk)
+            taken += len(chunk)
+        self._buffered -= taken
+        data = parts[0] if len(parts) == 1 else b"".join(parts)
+        self.digest.update(data)
+        return data
+
+
+def compress_parallel(chunks: Iterable[bytes], level: int = 6, workers: Optional[int] = None) -> Iterator[bytes]:
+    """Gzip each chunk as its own member on ``workers`` threads, yielding in order."""
+
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gzip") as pool:
+        # Bounded look-ahead keeps every worker busy without buffering the dump.
+        pending: deque = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(gzip.compress, chunk, level, mtime=0))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def decompress_stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Inverse of ``compress_parallel``: any number of concatenated gzip members."""
+
+    decoder = zlib.decompressobj(wbits=31)
+    fed = False
+    for chunk in chunks:
+        while chunk:
+            fed = True
+            out = decoder.decompress(chunk)
+            if out:
+                yield out
+            if decoder.eof:
+                chunk = decoder.unused_data
+                decoder = zlib.decompressobj(wbits=31)
+                fed = False
+            else:
+                chunk = b""
+    if fed:
+        raise VerificationFailed("truncated gzip stream")
+
+
+# -- storage --------------------------------------------------------------
+
+
+class BackupStore(abc.ABC):
+    @abc.abstractmethod
+    def upload(
+        self,
+        key: str,
+        data: BinaryIO,
+        part_size: int = 16 * MIB,
+        workers: int = 1,
+        content_type: str = "application/octet-stream",
+    ) -> None:
+        """Store ``data``, read to EOF, as ``key``; nothing is left behind on error."""
+
+    @abc.abstractmethod
+    def stream(self, key: str, chunk_size: int = MIB) -> Optional[Iterator[bytes]]:
+        """Chunks of the object, or None if it does not exist."""
+
+    @abc.abstractmethod
+    def list(self, prefix: str = "") -> Iterator[StoredObject]:
+        """Objects under ``prefix`` in key order."""
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        """Remove ``key``; missing keys are not an error."""
+
+    def put(self, key: str, data: bytes, content_type: str = "application/octet-stream") -> None:
+        self.upload(key, io.BytesIO(data), content_type=content_type)
+
+    def get(self, key: str) -> Optional[bytes]:
+        chunks = self.stream(key)
+        return None if chunks is None else b"".join(chunks)
+
+    def copy_from(self, source: "BackupStore", key: str, dest_key: str) -> bool:
+        """Copy ``key`` of ``source`` to ``dest_key``; False if it is gone."""
+
+        chunks = source.stream(key)
+        if chunks is None:
+            return False
+        self.upload(dest_key, ChunkReader(chunks))
+        return True
+
+    def ensure_ready(self) -> None:
+        """Create the bucket/directory if needed."""
+
+
+class FileSystemBackupStore(BackupStore):
+    """Stand-in for a bucket in tests and local runs. ETags are mtime and size."""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f"invalid object key {key!r}")
+        return path
+
+    def ensure_ready(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+
+    def upload(
+        self,
+        key: str,
+        data: BinaryIO,
+        part_size: int = 16 * MIB,
+        workers: int = 1,
+        content_type: str = "application/octet-stream",
+    ) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written next to the target and renamed, like a multipart complete.
+        # There are no parts to buffer here, so write in small pieces.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                while True:
+                    part = data.read(min(part_size, MIB))
+                    if not part:
+                        break
+                    fh.write(part)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def stream(self, key: str, chunk_size: int = MIB) -> Optional[Iterator[bytes]]:
+        try:
+            fh = open(self._path(key), "rb")
+        except FileNotFoundError:
+            return None
+
+        def chunks() -> Iterator[bytes]:
+            with fh:
+                while True:
+                    chunk = fh.read(chunk_size)
+                    if not chunk:
+                        return
+                    yield chunk
+
+        return chunks()
+
+    def list(self, prefix: str = "") -> Iterator[StoredObject]:
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.startswith(".upload-"):
+                    continue
+                path = os.path.join(dirpath, name)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    found.append((key, path))
+        for key, path in sorted(found):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield StoredObject(key, f"{st.st_mtime_ns:x}-{st.st_size:x}", st.st_size)
+
+    def delete(self, key: str) -> None:
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class MinioBackupStore(BackupStore):
+    def __init__(self, client, bucket: str) -> None:
+        self.client = client
+        self.bucket = bucket
+
+    def ensure_ready(self) -> None:
+        if not self.client.bucket_exists(self.bucket):
+            self.client.make_bucket(self.bucket)
+
+    def upload(
+        self,
+        key: str,
+        data: BinaryIO,
+        part_size: int = 16 * MIB,
+        workers: int = 1,
+        content_type: str = "application/octet-stream",
+    ) -> None:
+        # Unknown length: minio-py reads one part at a time, keeps ``workers``
+        # uploads in flight and aborts the multipart upload if ``read`` raises.
+        self.client.put_object(
+            self.bucket,
+            key,
+            data,
+            length=-1,
+            part_size=max(part_size, MIN_PART_SIZE),
+            num_parallel_uploads=workers,
+            content_type=content_type,
+        )
+
+    def put(self, key: str, data: bytes, content_type: str = "application/octet-stream") -> None:
+        self.client.put_object(self.bucket, key, io.BytesIO(data), len(data), content_type=content_type)
+
+    def stream(self, key: str, chunk_size: int = MIB) -> Optional[Iterator[bytes]]:
+        from minio.error import S3Error
+
+        try:
+            resp = self.client.get_object(self.bucket, key)
+        except S3Error as exc:
+            if exc.code == "NoSuchKey":
+                return None
+            raise
+
+        def chunks() -> Iterator[bytes]:
+            try:
+                yield from resp.stream(chunk_size)
+            finally:
+                resp.close()
+                resp.release_conn()
+
+        return chunks()
+
+    def list(self, prefix: str = "") -> Iterator[StoredObject]:
+        for obj in self.client.list_objects(self.bucket, prefix=prefix, recursive=True):
+            yield StoredObject(obj.object_name, (obj.etag or "").strip('"'), obj.size or 0)
+
+    def delete(self, key: str) -> None:
+        self.client.remove_object(self.bucket, key)
+
+    def copy_from(self, source: BackupStore, key: str, dest_key: str) -> bool:
+        if not isinstance(source, MinioBackupStore) or source.client is not self.client:
+            return super().copy_from(source, key, dest_key)
+        from minio.commonconfig import CopySource
+        from minio.error import S3Error
+
+        # Same server: copy without the bytes passing through this process.
+        try:
+            self.client.copy_object(self.bucket, dest_key, CopySource(source.bucket, key))
+        except S3Error as exc:
+            if exc.code == "NoSuchKey":
+                return False
+            raise
+        return True
+
+
+# -- dump sources ---------------------------------------------------------
+
+
+class DumpSource(abc.ABC):
+    @abc.abstractmethod
+    def blocks(self, block_size: int) -> Iterator[bytes]:
+        """The plain SQL dump in blocks; raises ``DumpFailed`` at the end if it failed."""
+
+
+class PgDumpSource(DumpSource):
+    def __init__(self, url: str, extra_args: Iterable[str] = ()) -> None:
+        self.url = make_url(url)
+        self.extra_args = list(extra_args)
+
+    def command(self) -> List[str]:
+        return [
+            "pg_dump",
+            "--format=plain",
+            "--no-owner",
+            "--host", self.url.host or "localhost",
+            "--port", str(self.url.port or 5432),
+            "--username", self.url.username or "postgres",
+            *self.extra_args,
+            self.url.database,
+        ]
+
+    def blocks(self, block_size: int) -> Iterator[bytes]:
+        env = dict(os.environ, PGPASSWORD=self.url.password or "")
+        # stderr goes to the service log.
+        proc = subprocess.Popen(self.command(), stdout=subprocess.PIPE, env=env)
+        try:
+            while True:
+                block = proc.stdout.read(block_size)
+                if not block:
+                    break
+                yield block
+            if proc.wait() != 0:
+                raise DumpFailed(f"pg_dump exited with code {proc.returncode}")
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+
+class SqliteDumpSource(DumpSource):
+    """``iterdump()`` of a SQLite file, for local runs with ``DATABASE_URL=sqlite:///``."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def blocks(self, block_size: int) -> Iterator[bytes]:
+        try:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        except sqlite3.Error as exc:
+            raise DumpFailed(str(exc)) from exc
+        try:
+            lines: List[bytes] = []
+            size = 0
+            for line in conn.iterdump():
+                data = (line + "\n").encode()
+                lines.append(data)
+                size += len(data)
+                if size >= block_size:
+                    yield b"".join(lines)
+                    lines, size = [], 0
+            if lines:
+                yield b"".join(lines)
+        except sqlite3.Error as exc:
+            raise DumpFailed(str(exc)) from exc
+        finally:
+            conn.close()
+
+
+def build_dump_source(database_url: str) -> DumpSource:
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend == "postgresql":
+        return PgDumpSource(database_url)
+    if backend == "sqlite" and url.database and url.database != ":memory:":
+        return SqliteDumpSource(url.database)
+    raise BackupError(f"cannot back up {backend} database {url.database!r}")
+
+
+# -- manifests and retention ----------------------------------------------
+
+
+def _stamp(moment: datetime) -> str:
+    return moment.strftime(STAMP_FORMAT)
+
+
+def _stamp_of(key: str) -> str:
+    return key.rsplit("/", 1)[-1].split(".", 1)[0]
+
+
+@dataclass
+class BackupManifest:
+    key: str
+    started_at: datetime
+    finished_at: datetime
+    size: int
+    sha256: str
+    raw_size: int
+    raw_sha256: str
+    verified_at: Optional[datetime] = None
+    restore_checked: bool = False
+
+    def to_json(self) -> bytes:
+        return json.dumps(asdict(self), default=datetime.isoformat).encode()
+
+    @classmethod
+    def from_json(cls, raw: bytes) -> "BackupManifest":
+        data = json.loads(raw)
+        for name in ("started_at", "finished_at", "verified_at"):
+            if data.get(name):
+                data[name] = datetime.fromisoformat(data[name])
+        return cls(**data)
+
+    @property
+    def manifest_key(self) -> str:
+        return self.key[: -len(".sql.gz")] + ".json"
+
+
+@dataclass
+class ConfigSnapshot:
+    key: str
+    created_at: datetime
+    # source key -> (etag, size); the copy lives at ``object_key(key, etag)``
+    objects: Dict[str, Tuple[str, int]] = field(default_factory=dict)
+    copied: int = 0
+    skipped: int = 0
+
+    def to_json(self) -> bytes:
+        return json.dumps(asdict(self), default=datetime.isoformat).encode()
+
+    @classmethod
+    def from_json(cls, raw: bytes) -> "ConfigSnapshot":
+        data = json.loads(raw)
+        data["created_at"] = datetime.fromisoformat(data["created_at"])
+        data["objects"] = {key: tuple(value) for key, value in data["objects"].items()}
+        return cls(**data)
+
+
+def object_key(key: str, etag: str) -> str:
+    return f"{OBJECT_PREFIX}{key}/{etag}"
+
+
+def expired(stamps: Iterable[str], now: datetime, keep_last: int, keep_daily: int) -> List[str]:
+    """Stamps outside the newest ``keep_last`` and the last-of-day for ``keep_daily`` days."""
+
+    ordered = sorted(set(stamps), reverse=True)
+    keep = set(ordered[: max(1, keep_last)])
+    cutoff = (now - timedelta(days=keep_daily)).date()
+    days = set()
+    for stamp in ordered:
+        day = datetime.strptime(stamp, STAMP_FORMAT).date()
+        if day > cutoff and day not in days:
+            days.add(day)
+            keep.add(stamp)
+    return [stamp for stamp in ordered if stamp not in keep]
+
+
+# -- worker ---------------------------------------------------------------
+
+
+@dataclass
+class BackupRun:
+    database: Optional[BackupManifest]
+    configs: Optional[ConfigSnapshot]
+    pruned: int
+    finished_at: datetime
+
+    def summary(self) -> Dict[str, object]:
+        configs = None
+        if self.configs is not None:
+            configs = {
+                "key": self.configs.key,
+                "objects": len(self.configs.objects),
+                "copied": self.configs.copied,
+                "skipped": self.configs.skipped,
+            }
+        return {
+            "database": asdict(self.database) if self.database is not None else None,
+            "configs": configs,
+            "pruned": self.pruned,
+            "finished_at": self.finished_at,
+        }
+
+
+class BackupWorker:
+    """Runs backups on demand (``trigger``/``run``) and every ``interval`` seconds if set."""
+
+    def __init__(
+        self,
+        store: BackupStore,
+        dump: Optional[DumpSource] = None,
+        configs: Optional[BackupStore] = None,
+        block_size: int = MIB,
+        part_size: int = 16 * MIB,
+        compress_workers: Optional[int] = None,
+        upload_workers: int = 4,
+        level: int = 6,
+        keep_last: int = 7,
+        keep_daily: int = 30,
+        restore_command: Optional[List[str]] = None,
+        interval: float = 0.0,
+        clock: Callable[[], datetime] = datetime.utcnow,
+    ) -> None:
+        self.store = store
+        self.dump = dump
+        self.configs = configs
+        self.block_size = block_size
+        self.part_size = part_size
+        self.compress_workers = compress_workers or os.cpu_count() or 1
+        self.upload_workers = upload_workers
+        self.level = level
+        self.keep_last = max(1, keep_last)
+        self.keep_daily = keep_daily
+        self.restore_command = restore_command
+        self.interval = interval
+        self._clock = clock
+        self._running = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_run: Optional[BackupRun] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="backups", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def trigger(self) -> None:
+        self._wake.set()
+
+    @property
+    def running(self) -> bool:
+        return self._running.locked()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.interval or None)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                self.run()
+            except BackupInProgress:
+                pass
+            except Exception:
+                logger.exception("Backup run failed")
+
+    def run(self) -> BackupRun:
+        """Dump and verify the database, snapshot configs, then prune."""
+
+        if not self._running.acquire(blocking=False):
+            raise BackupInProgress("a backup is already running")
+        try:
+            self.store.ensure_ready()
+            database = snapshot = None
+            if self.dump is not None:
+                database = self.verify(self.backup_database())
+            if self.configs is not None:
+                snapshot = self.snapshot_configs()
+            pruned = self.prune()
+            self.last_run = BackupRun(database, snapshot, pruned, self._clock())
+            return self.last_run
+        finally:
+            self._running.release()
+
+    # -- database ---------------------------------------------------------
+
+    def backup_database(self) -> BackupManifest:
+        if self.dump is None:
+            raise BackupError("no database source configured")
+        started = self._clock()
+        key = f"{DB_PREFIX}{_stamp(started)}.sql.gz"
+        raw = Digest()
+        packed = ChunkReader(
+            compress_parallel(tap(self.dump.blocks(self.block_size), raw), self.level, self.compress_workers)
+        )
+        self.store.upload(key, packed, self.part_size, self.upload_workers, content_type="application/gzip")
+        manifest = BackupManifest(
+            key=key,
+            started_at=started,
+            finished_at=self._clock(),
+            size=packed.digest.size,
+            sha256=packed.digest.hexdigest(),
+            raw_size=raw.size,
+            raw_sha256=raw.hexdigest(),
+        )
+        # Written last: a dump without a manifest is not a backup.
+        self.store.put(manifest.manifest_key, manifest.to_json(), content_type="application/json")
+        logger.info("Backed up database to %s: %s -> %s bytes", key, raw.size, packed.digest.size)
+        return manifest
+
+    def backups(self) -> List[BackupManifest]:
+        """Database backups, newest first."""
+
+        manifests = []
+        for obj in self.store.list(DB_PREFIX):
+            if obj.key.endswith(".json"):
+                raw = self.store.get(obj.key)
+                if raw is not None:
+                    manifests.append(BackupManifest.from_json(raw))
+        return sorted(manifests, key=lambda m: m.key, reverse=True)
+
+    def verify(self, manifest: BackupManifest, restore: bool = True) -> BackupManifest:
+        """Read a backup back, check its hashes and optionally feed it to the restore command."""
+
+        chunks = self.store.stream(manifest.key)
+        if chunks is None:
+            raise VerificationFailed(f"{manifest.key} is missing")
+        packed, raw = Digest(), Digest()
+        command = self.restore_command if restore else None
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE) if command else None
+        try:
+            for data in decompress_stream(tap(chunks, packed)):
+                raw.update(data)
+                if proc is not None:
+                    proc.stdin.write(data)
+            if proc is not None:
+                proc.stdin.close()
+                if proc.wait() != 0:
+                    raise VerificationFailed(f"restore of {manifest.key} exited with code {proc.returncode}")
+        except (BrokenPipeError, zlib.error) as exc:
+            raise VerificationFailed(f"restore of {manifest.key} failed: {exc}") from exc
+        finally:
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        if (packed.size, packed.hexdigest()) != (manifest.size, manifest.sha256):
+            raise VerificationFailed(f"{manifest.key} does not match its manifest")
+        if (raw.size, raw.hexdigest()) != (manifest.raw_size, manifest.raw_sha256):
+            raise VerificationFailed(f"{manifest.key} decompresses to different content")
+        manifest.verified_at = self._clock()
+        manifest.restore_checked = proc is not None
+        self.store.put(manifest.manifest_key, manifest.to_json(), content_type="application/json")
+        return manifest
+
+    # -- configs ----------------------------------------------------------
+
+    def snapshots(self) -> List[str]:
+        """Config snapshot keys, newest first."""
+
+        return sorted((obj.key for obj in self.store.list(SNAPSHOT_PREFIX)), reverse=True)
+
+    def _load_snapshot(self, key: str) -> Optional[ConfigSnapshot]:
+        raw = self.store.get(key)
+        return ConfigSnapshot.from_json(raw) if raw is not None else None
+
+    def snapshot_configs(self) -> ConfigSnapshot:
+        if self.configs is None:
+            raise BackupError("no configs bucket configured")
+        keys = self.snapshots()
+        previous = self._load_snapshot(keys[0]) if keys else None
+        known = previous.objects if previous is not None else {}
+        created = self._clock()
+        snapshot = ConfigSnapshot(key=f"{SNAPSHOT_PREFIX}{_stamp(created)}.json", created_at=created)
+        changed: List[StoredObject] = []
+        for obj in self.configs.list():
+            if known.get(obj.key, ("",))[0] == obj.etag:
+                snapshot.objects[obj.key] = known[obj.key]
+                snapshot.skipped += 1
+            else:
+                changed.append(obj)
+
+        def copy(obj: StoredObject) -> bool:
+            return self.store.copy_from(self.configs, obj.key, object_key(obj.key, obj.etag))
+
+        # Config objects are small; the cost is round trips, so copy in parallel.
+        with ThreadPoolExecutor(max_workers=self.upload_workers, thread_name_prefix="backup-copy") as pool:
+            for obj, copied in zip(changed, pool.map(copy, changed)):
+                if copied:  # deleted since the listing otherwise
+                    snapshot.objects[obj.key] = (obj.etag, obj.size)
+                    snapshot.copied += 1
+        self.store.put(snapshot.key, snapshot.to_json(), content_type="application/json")
+        logger.info("Config snapshot %s: %s copied, %s unchanged", snapshot.key, snapshot.copied, snapshot.skipped)
+        return snapshot
+
+    # -- retention --------------------------------------------------------
+
+    def prune(self) -> int:
+        """Apply retention to database backups and config snapshots; returns objects deleted."""
+
+        now = self._clock()
+        deleted = 0
+        db_keys: Dict[str, List[str]] = {}
+        for obj in self.store.list(DB_PREFIX):
+            db_keys.setdefault(_stamp_of(obj.key), []).append(obj.key)
+        # Only a backup that read back correctly counts; failed verifications
+        # must not push the last good backups out of retention.
+        verified = [_stamp_of(m.key) for m in self.backups() if m.verified_at is not None]
+        stale = expired(verified, now, self.keep_last, self.keep_daily)
+        # Dumps without a manifest or that failed verification: drop them once
+        # a later one verified, and keep at most ``keep_last`` newer ones (which
+        # may still be in progress or verified by hand).
+        newest = max(verified, default="")
+        unverified = sorted((stamp for stamp in db_keys if stamp not in verified), reverse=True)
+        stale += [stamp for stamp in unverified if stamp < newest]
+        stale += [stamp for stamp in unverified if stamp > newest][max(1, self.keep_last):]
+        for stamp in stale:
+            for key in db_keys[stamp]:
+                self.store.delete(key)
+                deleted += 1
+
+        snapshots = {_stamp_of(key): key for key in self.snapshots()}
+        stale = expired(snapshots, now, self.keep_last, self.keep_daily)
+        for stamp in stale:
+            self.store.delete(snapshots.pop(stamp))
+            deleted += 1
+        if stale:
+            referenced = set()
+            for key in snapshots.values():
+                snapshot = self._load_snapshot(key)
+                if snapshot is not None:
+                    referenced.update(object_key(k, etag) for k, (etag, _) in snapshot.objects.items())
+            for obj in self.store.list(OBJECT_PREFIX):
+                if obj.key not in referenced:
+                    self.store.delete(obj.key)
+                    deleted += 1
+        return deleted
+
+
+def build_backup_worker(settings: Settings, database_url: str) -> BackupWorker:
+    if settings.backup_store == "filesystem":
+        store: BackupStore = FileSystemBackupStore(settings.backup_store_path)
+        configs: Optional[BackupStore] = (
+            FileSystemBackupStore(settings.backup_configs_path) if settings.backup_configs_path else None
+        )
+    else:
+        from minio import Minio
+
+        endpoint = urlparse(settings.minio_endpoint)
+        client = Minio(
+            endpoint.netloc or endpoint.path,
+            access_key=settings.minio_root_user,
+            secret_key=settings.minio_root_password,
+            secure=endpoint.scheme == "https",
+        )
+        store = MinioBackupStore(client, settings.backup_bucket)
+        configs = MinioBackupStore(client, settings.minio_bucket)
+    try:
+        dump: Optional[DumpSource] = build_dump_source(database_url)
+    except BackupError as exc:
+        logger.warning("Database backups disabled: %s", exc)
+        dump = None
+    return BackupWorker(
+        store,
+        dump=dump,
+        configs=configs,
+        block_size=settings.backup_block_mb * MIB,
+        part_size=settings.backup_part_mb * MIB,
+        compress_workers=settings.backup_compress_workers or None,
+        upload_workers=settings.backup_upload_workers,
+        keep_last=settings.backup_keep_last,
+        keep_daily=settings.backup_keep_daily,
+        restore_command=shlex.split(settings.backup_restore_command) if settings.backup_restore_command else None,
+        interval=settings.backup_interval_sec,
+    )
+
+
+def main() -> None:
+    from .config import get_settings
+    from .db import get_database_url
+
+    parser = argparse.ArgumentParser(description="Billing backups")
+    parser.add_argument("command", choices=("run", "verify", "list", "prune"))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    settings = get_settings()
+    worker = build_backup_worker(settings, get_database_url(settings))
+    if args.command == "run":
+        print(json.dumps(worker.run().summary(), default=datetime.isoformat, indent=2))
+    elif args.command == "verify":
+        backups = worker.backups()
+        if not backups:
+            raise SystemExit("no backups")
+        print(worker.verify(backups[0]).to_json().decode())
+    elif args.command == "list":
+        for manifest in worker.backups():
+            print(manifest.key, manifest.size, manifest.verified_at or "unverified")
+    else:
+        print(worker.prune())
+
+
+if __name__ == "__main__":
+    main()
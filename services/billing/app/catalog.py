@@ -0,0 +1,59 @@
+"""Versioned tariff catalog.
+
+Tariffs are validated and serialized once when the catalog is built. Lookups
+by code are a dict probe, and ``GET /tariffs`` serves the prebuilt JSON body
+with an ETag derived from its content, so clients can revalidate with
+``If-None-Match`` and get an empty 304 back.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from .schemas import Tariff
+
+
+class TariffCatalog:
+    def __init__(self, tariffs: Iterable[Tariff]) -> None:
+        self._tariffs: List[Tariff] = list(tariffs)
+        self._by_code: Dict[str, Tariff] = {t.code: t for t in self._tariffs}
+        if len(self._by_code) != len(self._tariffs):
+            raise ValueError("duplicate tariff codes in catalog")
+        self.body: bytes = json.dumps(
+            [t.model_dump(mode="json") for t in self._tariffs],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ).encode()
+        self.version: str = hashlib.sha256(self.body).hexdigest()[:16]
+        self.etag: str = f'"{self.version}"'
+
+    def get(self, code: str) -> Optional[Tariff]:
+        return self._by_code.get(code)
+
+    def __iter__(self) -> Iterator[Tariff]:
+        return iter(self._tariffs)
+
+    def __len__(self) -> int:
+        return len(self._tariffs)
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """True when an ``If-None-Match`` header already names this version."""
+
+        if not if_none_match:
+            return False
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in candidates or self.etag in candidates
+
+
+TARIFFS = [
+    Tariff(code="trial", name="Trial", price_stars=0, duration_days=3, devices=2, nodes=1),
+    Tariff(code="light", name="Light", price_stars=110, duration_days=30, speed_limit_mbps=100, devices=2, nodes=2),
+    Tariff(code="family", name="Family", price_stars=200, duration_days=30, speed_limit_mbps=300, devices=5, nodes=4),
+    Tariff(code="unlimited", name="Unlimited", price_stars=290, duration_days=30, devices=8, nodes=6, smartdns=True, speed_limit_mbps=None),
+    # Unlimited billed yearly with the advertised 35% discount.
+    Tariff(code="year", name="Годовая", price_stars=2262, duration_days=365, devices=8, nodes=6, smartdns=True, speed_limit_mbps=None),
+]
+
+catalog = TariffCatalog(TARIFFS)
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings
 
 
@@ -15,6 +17,46 @@ class Settings(BaseSettings):
     minio_bucket: str = "configs"
     telegram_payment_provider: str = "stars"
     allowed_origins: str = "*"
+    database_url: Optional[str] = None
+    invoice_secret: str = "change-me-invoice-secret"
+    # Bearer token for admin endpoints (promo campaigns); unset disables them.
+    admin_token: Optional[str] = None
+    # Bearer token the bot sends to start and confirm payments; unset disables them.
+    billing_token: Optional[str] = None
+    reminders_backend: str = "redis"
+    reminders_rate_per_sec: float = 30.0
+    reminders_interval_sec: float = 60.0
+    provisioner_url: Optional[str] = "http://provisioner:8001"
+    provisioner_token: Optional[str] = None
+    expiry_batch_size: int = 500
+    promo_bloom_capacity: int = 1_000_000
+    promo_bloom_error_rate: float = 0.001
+    promo_refresh_sec: float = 30.0
+    # How long an unpaid invoice holds a use of its promo code.
+    promo_hold_sec: float = 3600.0
+    # Percent of a payment credited to the referrer, their referrer, ...
+    referral_reward_percents: str = "10,5"
+    events_backend: str = "redis"  # or "memory", "none" (no lifecycle events)
+    events_batch_size: int = 100
+    outbox_interval_sec: float = 5.0
+    backup_store: str = "minio"
+    backup_bucket: str = "backups"
+    backup_store_path: str = "/var/lib/billing/backups"
+    # Filesystem stand-in for the configs bucket when BACKUP_STORE=filesystem.
+    backup_configs_path: Optional[str] = None
+    # 0 runs backups only on demand (POST /backups, python -m app.backup run).
+    backup_interval_sec: float = 0.0
+    backup_block_mb: int = 1
+    backup_part_mb: int = 16
+    backup_compress_workers: int = 0
+    backup_upload_workers: int = 4
+    backup_keep_last: int = 7
+    backup_keep_daily: int = 30
+    # e.g. "psql -q -v ON_ERROR_STOP=1 postgresql://.../restore_check"
+    backup_restore_command: Optional[str] = None
+    # Rows per rollup counter; more shards, less row-lock contention, slower reads.
+    analytics_shards: int = 16
+    analytics_window_days: int = 30
 
     class Config:
         env_file = ".env"
@@ -34,6 +76,38 @@ class Settings(BaseSettings):
             "minio_bucket": {"env": "MINIO_BUCKET"},
             "telegram_payment_provider": {"env": "TELEGRAM_PAYMENT_PROVIDER"},
             "allowed_origins": {"env": "ALLOWED_ORIGINS"},
+            "database_url": {"env": "DATABASE_URL"},
+            "invoice_secret": {"env": "INVOICE_SECRET"},
+            "admin_token": {"env": "ADMIN_TOKEN"},
+            "billing_token": {"env": "BILLING_TOKEN"},
+            "reminders_backend": {"env": "REMINDERS_BACKEND"},
+            "reminders_rate_per_sec": {"env": "REMINDERS_RATE_PER_SEC"},
+            "reminders_interval_sec": {"env": "REMINDERS_INTERVAL_SEC"},
+            "provisioner_url": {"env": "PROVISIONER_URL"},
+            "provisioner_token": {"env": "PROVISIONER_TOKEN"},
+            "expiry_batch_size": {"env": "EXPIRY_BATCH_SIZE"},
+            "promo_bloom_capacity": {"env": "PROMO_BLOOM_CAPACITY"},
+            "promo_bloom_error_rate": {"env": "PROMO_BLOOM_ERROR_RATE"},
+            "promo_refresh_sec": {"env": "PROMO_REFRESH_SEC"},
+            "promo_hold_sec": {"env": "PROMO_HOLD_SEC"},
+            "referral_reward_percents": {"env": "REFERRAL_REWARD_PERCENTS"},
+            "events_backend": {"env": "EVENTS_BACKEND"},
+            "events_batch_size": {"env": "EVENTS_BATCH_SIZE"},
+            "outbox_interval_sec": {"env": "OUTBOX_INTERVAL_SEC"},
+            "backup_store": {"env": "BACKUP_STORE"},
+            "backup_bucket": {"env": "BACKUP_BUCKET"},
+            "backup_store_path": {"env": "BACKUP_STORE_PATH"},
+            "backup_configs_path": {"env": "BACKUP_CONFIGS_PATH"},
+            "backup_interval_sec": {"env": "BACKUP_INTERVAL_SEC"},
+            "backup_block_mb": {"env": "BACKUP_BLOCK_MB"},
+            "backup_part_mb": {"env": "BACKUP_PART_MB"},
+            "backup_compress_workers": {"env": "BACKUP_COMPRESS_WORKERS"},
+            "backup_upload_workers": {"env": "BACKUP_UPLOAD_WORKERS"},
+            "backup_keep_last": {"env": "BACKUP_KEEP_LAST"},
+            "backup_keep_daily": {"env": "BACKUP_KEEP_DAILY"},
+            "backup_restore_command": {"env": "BACKUP_RESTORE_COMMAND"},
+            "analytics_shards": {"env": "ANALYTICS_SHARDS"},
+            "analytics_window_days": {"env": "ANALYTICS_WINDOW_DAYS"},
         }
 
 
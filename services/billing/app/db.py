@@ -0,0 +1,33 @@
+from sqlalchemy import MetaData, Table, create_engine
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+from .config import Settings
+
+metadata = MetaData()
+
+
+def get_database_url(settings: Settings) -> str:
+    if settings.database_url:
+        return settings.database_url
+    return (
+        f"postgresql+psycopg2://{settings.postgres_user}:{settings.postgres_password}"
+        f"@{settings.postgres_host}:{settings.postgres_port}/{settings.postgres_db}"
+    )
+
+
+def create_db_engine(url: str) -> Engine:
+    if url.startswith("sqlite"):
+        # FastAPI runs sync endpoints in a thread pool.
+        return create_engine(url, connect_args={"check_same_thread": False})
+    return create_engine(url, pool_size=10, max_overflow=20, pool_pre_ping=True)
+
+
+def upsert_insert(engine: Engine, table: Table):
+    """Dialect ``INSERT`` supporting ``on_conflict_do_update/nothing``."""
+
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    if engine.dialect.name == "sqlite":
+        return sqlite.insert(table)
+    raise NotImplementedError(f"upsert is not implemented for {engine.dialect.name}")
@@ -0,0 +1,320 @@
+"""Subscription expiry: active -> grace (throttled) -> revoked.
+
+Each subscription row stores its current ``state`` and ``next_transition_at``
+(now for a new or renewed subscription whose limits still have to reach the
+provisioner, the paid deadline while active, the grace deadline while in
+grace, NULL once revoked). The index on ``next_transition_at`` is the expiration queue:
+finding the next wake-up is one index probe, and a sweep reads only the due
+rows in deadline order. Work is O(due), not O(subscriptions).
+
+The sweeper sleeps until the earliest deadline (``upsert`` wakes it up). It applies due transitions in batches: one provisioner call
+per batch, then a conditional UPDATE per row. Rows renewed in the meantime
+no longer match their old state and deadline and are left alone. State
+lives in the database and is only advanced after the provisioner
+accepted the batch, so a crash or restart re-runs at most the batch in
+flight; both provisioner calls are idempotent.
+
+``on_transition`` runs inside the transaction that applies a transition,
+which is where billing records grace/revoked events in its outbox. With the
+event stream enabled the provisioner follows those events, and the
+actions only log.
+"""
+
+from __future__ import annotations
+
+import abc
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import httpx
+from sqlalchemy import BigInteger, Column, DateTime, Index, Integer, String, Table, and_, func, select, update
+from sqlalchemy.engine import Connection, Engine
+from vpn_common.metrics.transports import TimedTransport
+
+from .db import metadata, upsert_insert
+from .models import billing_rules
+from .schemas import Subscription
+
+subscriptions = Table(
+    "subscriptions",
+    metadata,
+    Column("user_id", BigInteger, primary_key=True, autoincrement=False),
+    Column("tariff_code", String(32), nullable=False),
+    Column("active_until", DateTime, nullable=False),
+    Column("grace_until", DateTime, nullable=False),
+    Column("speed_limit_mbps", Integer, nullable=True),
+    Column("state", String(16), nullable=False),
+    Column("next_transition_at", DateTime, nullable=True),
+    Index("ix_subscriptions_next_transition", "next_transition_at"),
+)
+
+logger = logging.getLogger(__name__)
+
+NEW, ACTIVE, GRACE, REVOKED = "new", "active", "grace", "revoked"
+
+# Stand-in dates of the row ``paid_until`` creates to lock a first payment.
+_NEVER = datetime(1970, 1, 1)
+
+
+def state_at(sub: Subscription, now: datetime) -> tuple[str, Optional[datetime]]:
+    """The state a subscription is in at ``now`` and when it changes next."""
+
+    if now < sub.active_until:
+        return ACTIVE, sub.active_until
+    if now < sub.grace_until:
+        return GRACE, sub.grace_until
+    return REVOKED, None
+
+
+@dataclass(frozen=True)
+class Transition:
+    subscription: Subscription
+    from_state: str
+    to_state: str
+    due_at: datetime
+    next_at: Optional[datetime]
+
+
+class ExpiryActions(abc.ABC):
+    @abc.abstractmethod
+    def push_limits(self, subs: List[Subscription]) -> None:
+        """Send tariff limit and deadlines; the provisioner derives the rate."""
+
+    @abc.abstractmethod
+    def revoke(self, subs: List[Subscription]) -> None:
+        """Cut these users off."""
+
+
+class LoggingActions(ExpiryActions):
+    def push_limits(self, subs: List[Subscription]) -> None:
+        logger.info("Updating speed limits of %d subscriptions", len(subs))
+
+    def revoke(self, subs: List[Subscription]) -> None:
+        logger.info("Revoking %d subscriptions", len(subs))
+
+
+class ProvisionerActions(ExpiryActions):
+    def __init__(
+        self,
+        base_url: str,
+        token: Optional[str] = None,
+        client: Optional[httpx.Client] = None,
+        timeout: float = 10.0,
+    ) -> None:
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self._client = client or httpx.Client(
+            base_url=base_url.rstrip("/"), timeout=timeout, headers=headers, transport=TimedTransport()
+        )
+
+    def push_limits(self, subs: List[Subscription]) -> None:
+        items = [
+            {
+                "user_id": sub.user_id,
+                "speed_limit_mbps": sub.speed_limit_mbps,
+                "active_until": sub.active_until.isoformat(),
+                "grace_until": sub.grace_until.isoformat(),
+                "grace_speed_mbps": billing_rules.grace_speed_mbps,
+            }
+            for sub in subs
+        ]
+        self._client.post("/shaping/batch", json={"items": items}).raise_for_status()
+
+    def revoke(self, subs: List[Subscription]) -> None:
+        self._client.post("/revoke", json={"user_ids": [sub.user_id for sub in subs]}).raise_for_status()
+
+    def close(self) -> None:
+        self._client.close()
+
+
+class ExpirySweeper:
+    def __init__(
+        self,
+        engine: Engine,
+        actions: ExpiryActions,
+        batch_size: int = 500,
+        max_sleep: float = 300.0,
+        clock: Callable[[], datetime] = datetime.utcnow,
+        on_transition: Optional[Callable[[Connection, Transition], None]] = None,
+    ) -> None:
+        self.engine = engine
+        self.actions = actions
+        self.batch_size = batch_size
+        # Runs in the transaction that applies the transition (outbox events).
+        self.on_transition = on_transition
+        # Upper bound on sleeping, to notice rows written by other replicas.
+        self.max_sleep = max_sleep
+        self._clock = clock
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.transitions: Dict[str, int] = {ACTIVE: 0, GRACE: 0, REVOKED: 0}
+
+    def _row(self, sub: Subscription) -> dict:
+        return {
+            "user_id": sub.user_id,
+            "tariff_code": sub.tariff_code,
+            "active_until": sub.active_until,
+            "grace_until": sub.grace_until,
+            "speed_limit_mbps": sub.speed_limit_mbps,
+            # Due at once: the sweeper pushes the new limits to the
+            # provisioner (or throttles/revokes if already past a deadline).
+            "state": NEW,
+            "next_transition_at": self._clock(),
+        }
+
+    def upsert(self, sub: Subscription, conn: Optional[Connection] = None) -> Optional[str]:
+        """Record a new or renewed subscription and reschedule it; returns the previous state.
+
+        With ``conn`` the write joins the caller's transaction, and the
+        caller calls ``wake()`` after committing.
+        """
+
+        if conn is None:
+            with self.engine.begin() as conn:
+                previous = self.upsert(sub, conn)
+            self.wake()
+            return previous
+        values = self._row(sub)
+        previous = conn.execute(select(subscriptions.c.state).where(subscriptions.c.user_id == sub.user_id)).scalar()
+        stmt = upsert_insert(self.engine, subscriptions).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[subscriptions.c.user_id],
+            set_={k: v for k, v in values.items() if k != "user_id"},
+        )
+        conn.execute(stmt)
+        return previous
+
+    def create(self, sub: Subscription, conn: Connection) -> bool:
+        """Record a first subscription; False if the user has or had one already."""
+
+        stmt = upsert_insert(self.engine, subscriptions).values(**self._row(sub))
+        return conn.execute(stmt.on_conflict_do_nothing(index_elements=[subscriptions.c.user_id])).rowcount == 1
+
+    def paid_until(self, conn: Connection, user_id: int) -> Optional[datetime]:
+        """End of the user's current period; locks the row until the caller commits.
+
+        ``FOR UPDATE`` locks nothing before a user's first payment, so a
+        revoked, never-due row is inserted first: concurrent first payments
+        then queue on it instead of both starting from now. The caller
+        overwrites it with ``upsert`` in the same transaction.
+        """
+
+        placeholder = upsert_insert(self.engine, subscriptions).values(
+            user_id=user_id,
+            tariff_code="",
+            active_until=_NEVER,
+            grace_until=_NEVER,
+            state=REVOKED,
+            next_transition_at=None,
+        )
+        conn.execute(placeholder.on_conflict_do_nothing(index_elements=[subscriptions.c.user_id]))
+        return conn.execute(
+            select(subscriptions.c.active_until).where(subscriptions.c.user_id == user_id).with_for_update()
+        ).scalar()
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def get(self, user_id: int) -> Optional[dict]:
+        with self.engine.connect() as conn:
+            row = conn.execute(select(subscriptions).where(subscriptions.c.user_id == user_id)).first()
+        return dict(row._mapping) if row else None
+
+    def next_due(self) -> Optional[datetime]:
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.min(subscriptions.c.next_transition_at))).scalar()
+
+    def backlog(self) -> int:
+        """Transitions that are due but not applied yet."""
+
+        query = select(func.count()).where(subscriptions.c.next_transition_at <= self._clock())
+        with self.engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+    def _due(self, now: datetime) -> List[Transition]:
+        query = (
+            select(subscriptions)
+            .where(subscriptions.c.next_transition_at <= now)
+            .order_by(subscriptions.c.next_transition_at)
+            .limit(self.batch_size)
+        )
+        with self.engine.connect() as conn:
+            rows = conn.execute(query).all()
+        due = []
+        for row in rows:
+            sub = Subscription(
+                user_id=row.user_id,
+                tariff_code=row.tariff_code,
+                active_until=row.active_until,
+                grace_until=row.grace_until,
+                speed_limit_mbps=row.speed_limit_mbps,
+            )
+            to_state, next_at = state_at(sub, now)
+            due.append(Transition(sub, row.state, to_state, row.next_transition_at, next_at))
+        return due
+
+    def sweep(self) -> int:
+        """Apply every transition due now; returns how many were applied."""
+
+        now = self._clock()
+        applied = 0
+        while True:
+            due = self._due(now)
+            if not due:
+                return applied
+            limited = [t.subscription for t in due if t.to_state != REVOKED]
+            if limited:
+                self.actions.push_limits(limited)
+            revoked = [t.subscription for t in due if t.to_state == REVOKED]
+            if revoked:
+                self.actions.revoke(revoked)
+            with self.engine.begin() as conn:
+                for t in due:
+                    result = conn.execute(
+                        update(subscriptions)
+                        .where(
+                            and_(
+                                subscriptions.c.user_id == t.subscription.user_id,
+                                subscriptions.c.state == t.from_state,
+                                subscriptions.c.next_transition_at == t.due_at,
+                            )
+                        )
+                        .values(state=t.to_state, next_transition_at=t.next_at)
+                    )
+                    if result.rowcount:
+                        self.transitions[t.to_state] += 1
+                        if self.on_transition is not None:
+                            self.on_transition(conn, t)
+            applied += len(due)
+            if len(due) < self.batch_size:
+                return applied
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="expiry", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            delay = self.max_sleep
+            try:
+                self.sweep()
+                next_wake = self.next_due()
+                if next_wake is not None:
+                    delay = min(delay, max(0.0, (next_wake - self._clock()).total_seconds()))
+            except Exception:
+                logger.exception("Expiry sweep failed; retrying")
+                delay = min(delay, 30.0)
+            self._wakeup.wait(delay)
@@ -0,0 +1,282 @@
+"""Invoice ledger with idempotent creation and exactly-once confirmation.
+
+Invoice ids handed to clients are compact tokens: the row's primary key plus
+a truncated HMAC of it, both base64url-encoded (27 characters, safe for a
+Telegram ``start`` parameter). Forged or mangled tokens are rejected before
+touching the database; valid ones resolve with a primary-key probe, so
+confirm latency does not depend on ledger size. A confirm records the
+Telegram charge that paid the invoice; one charge can pay only one invoice.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import struct
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Optional, Tuple
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    String,
+    Table,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+from .db import metadata
+from .models import billing_rules
+from .schemas import Tariff
+
+invoices = Table(
+    "invoices",
+    metadata,
+    Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True),
+    Column("idempotency_key", String(128), nullable=True, unique=True),
+    Column("user_id", BigInteger, nullable=False),
+    Column("tariff_code", String(32), nullable=False),
+    Column("amount_stars", Integer, nullable=False),
+    Column("status", String(16), nullable=False, default="pending"),
+    Column("created_at", DateTime, nullable=False),
+    Column("paid_at", DateTime, nullable=True),
+    Column("active_until", DateTime, nullable=True),
+    Column("grace_until", DateTime, nullable=True),
+    Column("speed_limit_mbps", Integer, nullable=True),
+    Column("promo_code_id", BigInteger, nullable=True),
+    Column("charge_id", String(128), nullable=True, unique=True),
+    Index("ix_invoices_user_created", "user_id", "created_at"),
+)
+
+_ID_BYTES = 8
+_SIG_BYTES = 12
+_ID_CHARS = 11  # len(urlsafe_b64encode(8 bytes)) without padding
+_TOKEN_CHARS = _ID_CHARS + 16
+
+
+class InvoiceError(Exception):
+    """Base class for ledger errors surfaced as HTTP errors by the API."""
+
+
+class InvalidInvoice(InvoiceError):
+    pass
+
+
+class InvoiceNotFound(InvoiceError):
+    pass
+
+
+class IdempotencyConflict(InvoiceError):
+    pass
+
+
+class ChargeConflict(InvoiceError):
+    pass
+
+
+@dataclass(frozen=True)
+class Invoice:
+    id: int
+    token: str
+    user_id: int
+    tariff_code: str
+    amount_stars: int
+    status: str
+    created_at: datetime
+    paid_at: Optional[datetime] = None
+    active_until: Optional[datetime] = None
+    grace_until: Optional[datetime] = None
+    speed_limit_mbps: Optional[int] = None
+    promo_code_id: Optional[int] = None
+    charge_id: Optional[str] = None
+
+
+def _b64(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class InvoiceLedger:
+    def __init__(self, engine: Engine, secret: str) -> None:
+        self.engine = engine
+        self._secret = secret.encode()
+
+    def _sign(self, invoice_pk: int) -> bytes:
+        return hmac.new(self._secret, struct.pack(">Q", invoice_pk), hashlib.sha256).digest()[:_SIG_BYTES]
+
+    def token_for(self, invoice_pk: int) -> str:
+        return _b64(struct.pack(">Q", invoice_pk)) + _b64(self._sign(invoice_pk))
+
+    def parse_token(self, token: str) -> int:
+        if len(token) != _TOKEN_CHARS:
+            raise InvalidInvoice("Malformed invoice")
+        try:
+            raw_id = _unb64(token[:_ID_CHARS])
+            signature = _unb64(token[_ID_CHARS:])
+        except (ValueError, TypeError):
+            raise InvalidInvoice("Malformed invoice") from None
+        if len(raw_id) != _ID_BYTES:
+            raise InvalidInvoice("Malformed invoice")
+        (invoice_pk,) = struct.unpack(">Q", raw_id)
+        if not hmac.compare_digest(signature, self._sign(invoice_pk)):
+            raise InvalidInvoice("Bad invoice signature")
+        return invoice_pk
+
+    def _row_to_invoice(self, row) -> Invoice:
+        return Invoice(
+            id=row.id,
+            token=self.token_for(row.id),
+            user_id=row.user_id,
+            tariff_code=row.tariff_code,
+            amount_stars=row.amount_stars,
+            status=row.status,
+            created_at=row.created_at,
+            paid_at=row.paid_at,
+            active_until=row.active_until,
+            grace_until=row.grace_until,
+            speed_limit_mbps=row.speed_limit_mbps,
+            promo_code_id=row.promo_code_id,
+            charge_id=row.charge_id,
+        )
+
+    def _get_by_pk(self, conn, invoice_pk: int) -> Optional[Invoice]:
+        row = conn.execute(select(invoices).where(invoices.c.id == invoice_pk)).first()
+        return self._row_to_invoice(row) if row else None
+
+    def get(self, token: str) -> Invoice:
+        invoice_pk = self.parse_token(token)
+        with self.engine.connect() as conn:
+            invoice = self._get_by_pk(conn, invoice_pk)
+        if invoice is None:
+            raise InvoiceNotFound("Unknown invoice")
+        return invoice
+
+    def create(
+        self,
+        user_id: int,
+        tariff: Tariff,
+        amount_stars: int,
+        idempotency_key: Optional[str] = None,
+        promo_code_id: Optional[int] = None,
+        on_created: Optional[Callable[[Connection, Invoice], None]] = None,
+    ) -> Invoice:
+        """Create a pending invoice; repeating ``idempotency_key`` returns the original.
+
+        ``on_created`` runs in the creating transaction (e.g. to hold a
+        promo code's use); if it raises, no invoice is created. Replays of an
+        idempotency key do not run it again.
+        """
+
+        now = datetime.utcnow()
+        try:
+            with self.engine.begin() as conn:
+                result = conn.execute(
+                    insert(invoices).values(
+                        idempotency_key=idempotency_key,
+                        user_id=user_id,
+                        tariff_code=tariff.code,
+                        amount_stars=amount_stars,
+                        status="pending",
+                        created_at=now,
+                        promo_code_id=promo_code_id,
+                    )
+                )
+                invoice = self._get_by_pk(conn, result.inserted_primary_key[0])
+                if on_created is not None:
+                    on_created(conn, invoice)
+                return invoice
+        except IntegrityError:
+            if idempotency_key is None:
+                raise
+            with self.engine.connect() as conn:
+                row = conn.execute(
+                    select(invoices).where(invoices.c.idempotency_key == idempotency_key)
+                ).first()
+            if row is None:
+                raise  # violated some other constraint
+        existing = self._row_to_invoice(row)
+        if existing.user_id != user_id or existing.tariff_code != tariff.code:
+            raise IdempotencyConflict("Idempotency key reused for a different payment")
+        return existing
+
+    def confirm(
+        self,
+        token: str,
+        resolve_tariff: Callable[[str], Optional[Tariff]],
+        grace_days: Optional[int] = None,
+        on_paid: Optional[Callable[[Connection, Invoice], None]] = None,
+        paid_until: Optional[Callable[[Connection, int], Optional[datetime]]] = None,
+        charge_id: Optional[str] = None,
+    ) -> Tuple[Invoice, bool]:
+        """Mark an invoice paid exactly once.
+
+        Returns the paid invoice and whether this call performed the
+        transition. Concurrent retries race on a conditional UPDATE; losers
+        read back the winner's subscription dates instead of granting again.
+        ``on_paid`` runs once, inside the transaction that wins.
+
+        ``paid_until`` returns the end of the user's current subscription;
+        the new period starts there if it is still in the future, so an
+        early renewal keeps the days left.
+
+        ``charge_id`` is stored on the invoice. Repeating a confirm with the
+        same charge is a no-op; another charge for a paid invoice, or a charge
+        that already paid a different invoice, raises ``ChargeConflict``.
+        """
+
+        invoice_pk = self.parse_token(token)
+        grace_days = billing_rules.grace_days if grace_days is None else grace_days
+        with self.engine.begin() as conn:
+            invoice = self._get_by_pk(conn, invoice_pk)
+            if invoice is None:
+                raise InvoiceNotFound("Unknown invoice")
+            if invoice.status != "pending":
+                return _same_charge(invoice, charge_id), False
+            tariff = resolve_tariff(invoice.tariff_code)
+            if tariff is None:
+                raise InvoiceNotFound("Unknown tariff")
+            now = datetime.utcnow()
+            current = paid_until(conn, invoice.user_id) if paid_until is not None else None
+            active_until = max(now, current or now) + timedelta(days=tariff.duration_days)
+            try:
+                result = conn.execute(
+                    update(invoices)
+                    .where(invoices.c.id == invoice_pk, invoices.c.status == "pending")
+                    .values(
+                        status="paid",
+                        paid_at=now,
+                        active_until=active_until,
+                        grace_until=active_until + timedelta(days=grace_days),
+                        speed_limit_mbps=tariff.speed_limit_mbps,
+                        charge_id=charge_id,
+                    )
+                )
+            except IntegrityError:
+                raise ChargeConflict("Charge already paid another invoice") from None
+            transitioned = result.rowcount == 1
+            if transitioned:
+                invoice = self._get_by_pk(conn, invoice_pk)
+                if on_paid is not None:
+                    on_paid(conn, invoice)
+        if not transitioned:
+            # Lost the race: return the row as committed by the winner.
+            with self.engine.connect() as conn:
+                invoice = _same_charge(self._get_by_pk(conn, invoice_pk), charge_id)
+        return invoice, transitioned
+
+
+def _same_charge(invoice: Invoice, charge_id: Optional[str]) -> Invoice:
+    if charge_id is not None and invoice.charge_id != charge_id:
+        raise ChargeConflict("Invoice was paid by another charge")
+    return invoice
@@ -1,12 +1,161 @@
-from datetime import datetime, timedelta
-from fastapi import FastAPI, HTTPException
+import hmac
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from .config import get_settings
-from .schemas import Tariff, PaymentIntent, PaymentStatus, Subscription, NotificationSchedule
+from sqlalchemy.exc import IntegrityError
+from vpn_common.events import EXTENDED, GRACE, PAID, REVOKED, TRIAL, Event, EventConsumer, EventStream, build_event_stream, latest_per_user
+from vpn_common.metrics import observe_queue
+from vpn_common.metrics.asgi import MetricsMiddleware, metrics_response
+from .analytics import Analytics
+from .backup import build_backup_worker
+from .catalog import catalog
+from .config import Settings, get_settings
+from .db import create_db_engine, get_database_url, metadata
+from .expiry import ACTIVE, NEW, ExpiryActions, ExpirySweeper, LoggingActions, ProvisionerActions, Transition
+from .ledger import ChargeConflict, IdempotencyConflict, Invoice, InvalidInvoice, InvoiceLedger, InvoiceNotFound
+from .models import billing_rules
+from .outbox import Outbox
+from .promo import InvalidPromo, PromoEngine, PromoError
+from .ratelimit import TokenBucket
+from .referrals import ReferralTree, parse_referral
+from .reminders import EventStreamSink, LoggingSink, MemoryReminderStore, RedisReminderStore, ReminderManager
+from .schemas import (
+    NotificationSchedule,
+    PaymentConfirmation,
+    PaymentIntent,
+    PaymentStatus,
+    PromoCampaignRequest,
+    PromoQuote,
+    Subscription,
+    Tariff,
+)
 
-app = FastAPI(title="Billing Service", version="0.1.0")
 settings = get_settings()
 
+NOTIFICATION_SCHEDULE = [
+    NotificationSchedule(trigger_hours_before_end=72, message="Продлите со скидкой 15%"),
+    NotificationSchedule(trigger_hours_before_end=24, message="Подписка заканчивается завтра"),
+    NotificationSchedule(trigger_hours_before_end=1, message="Подписка заканчивается через час"),
+]
+
+
+def build_reminder_manager(settings: Settings, events: Optional[EventStream]) -> ReminderManager:
+    bucket = TokenBucket(rate=settings.reminders_rate_per_sec)
+    if settings.reminders_backend == "redis":
+        import redis
+
+        store = RedisReminderStore(redis.Redis(host=settings.redis_host, port=settings.redis_port))
+    else:
+        store = MemoryReminderStore()
+    # The bot reads reminders from the lifecycle stream; without one they are only logged.
+    sink = EventStreamSink(events) if events is not None else LoggingSink()
+    return ReminderManager(
+        NOTIFICATION_SCHEDULE,
+        store=store,
+        sink=sink,
+        bucket=bucket,
+        interval=settings.reminders_interval_sec,
+    )
+
+
+def build_expiry_actions(settings: Settings) -> ExpiryActions:
+    # With lifecycle events the provisioner follows grace/revoked events instead.
+    if settings.provisioner_url and settings.events_backend == "none":
+        return ProvisionerActions(settings.provisioner_url, settings.provisioner_token)
+    return LoggingActions()
+
+
+_SUBSCRIPTION_FIELDS = ("tariff_code", "active_until", "grace_until", "speed_limit_mbps")
+
+
+def _event_payload(sub: Subscription) -> dict:
+    return {
+        "tariff_code": sub.tariff_code,
+        "active_until": sub.active_until,
+        "grace_until": sub.grace_until,
+        "speed_limit_mbps": sub.speed_limit_mbps,
+        "grace_speed_mbps": billing_rules.grace_speed_mbps,
+    }
+
+
+def _subscription_from(event: Event) -> Subscription:
+    return Subscription(user_id=event.user_id, **{k: event.payload[k] for k in _SUBSCRIPTION_FIELDS})
+
+
+engine = create_db_engine(get_database_url(settings))
+events = build_event_stream(settings.events_backend, f"redis://{settings.redis_host}:{settings.redis_port}/0")
+reminders = build_reminder_manager(settings, events)
+outbox = Outbox(engine, events, interval=settings.outbox_interval_sec)
+backups = build_backup_worker(settings, get_database_url(settings))
+ledger = InvoiceLedger(engine, settings.invoice_secret)
+analytics = Analytics(engine, catalog.get, shards=settings.analytics_shards)
+
+
+def _on_transition(conn, transition: Transition) -> None:
+    analytics.transition(conn, transition)
+    if transition.to_state in (GRACE, REVOKED):
+        outbox.add(conn, transition.to_state, transition.subscription.user_id, _event_payload(transition.subscription))
+
+
+expiry = ExpirySweeper(
+    engine,
+    build_expiry_actions(settings),
+    batch_size=settings.expiry_batch_size,
+    on_transition=_on_transition,
+)
+promos = PromoEngine(
+    engine,
+    settings.invoice_secret,
+    bloom_capacity=settings.promo_bloom_capacity,
+    bloom_error_rate=settings.promo_bloom_error_rate,
+    refresh_interval=settings.promo_refresh_sec,
+    hold_seconds=settings.promo_hold_sec,
+)
+referrals = ReferralTree(
+    engine, levels=[int(p) for p in settings.referral_reward_percents.split(",") if p.strip()]
+)
+
+
+def _schedule_reminders(batch: list[Event]) -> None:
+    for event in latest_per_user(batch):
+        if event.type == REVOKED:
+            reminders.unschedule_subscription(event.user_id)
+        elif event.type in (PAID, EXTENDED, TRIAL):
+            # Overwrites the user's pending reminders, so redelivery is harmless.
+            reminders.schedule_subscription(_subscription_from(event))
+
+
+reminder_events = (
+    EventConsumer(events, "reminders", _schedule_reminders, batch_size=settings.events_batch_size)
+    if events is not None
+    else None
+)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    metadata.create_all(engine)
+    promos.refresh()
+    reminders.start()
+    expiry.start()
+    outbox.start()
+    if reminder_events is not None:
+        reminder_events.start()
+    backups.start()
+    try:
+        yield
+    finally:
+        backups.stop()
+        if reminder_events is not None:
+            reminder_events.stop()
+        outbox.stop()
+        expiry.stop()
+        reminders.stop()
+
+
+app = FastAPI(title="Billing Service", version="0.1.0", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[settings.allowed_origins] if settings.allowed_origins != "*" else ["*"],
@@ -14,19 +163,37 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Added last so it is outermost and also times CORS handling.
+app.add_middleware(MetricsMiddleware)
+observe_queue("reminders", reminders.store.pending)
+observe_queue("expiry_due", expiry.backlog)
+observe_queue("outbox_unpublished", outbox.backlog)
+if reminder_events is not None:
+    observe_queue("events_reminders_pending", reminder_events.pending)
 
-TARIFFS = [
-    Tariff(code="trial", name="Trial", price_stars=0, duration_days=3, devices=2, nodes=1),
-    Tariff(code="light", name="Light", price_stars=110, duration_days=30, speed_limit_mbps=100, devices=2, nodes=2),
-    Tariff(code="family", name="Family", price_stars=200, duration_days=30, speed_limit_mbps=300, devices=5, nodes=4),
-    Tariff(code="unlimited", name="Unlimited", price_stars=290, duration_days=30, devices=8, nodes=6, smartdns=True, speed_limit_mbps=None),
-]
 
-NOTIFICATION_SCHEDULE = [
-    NotificationSchedule(trigger_hours_before_end=72, message="Продлите со скидкой 15%"),
-    NotificationSchedule(trigger_hours_before_end=24, message="Подписка заканчивается завтра"),
-    NotificationSchedule(trigger_hours_before_end=1, message="Подписка заканчивается через час"),
-]
+def require_admin(authorization: Optional[str] = Header(default=None)) -> None:
+    """``Authorization: Bearer $ADMIN_TOKEN``; admin endpoints are off while no token is set."""
+
+    if not settings.admin_token:
+        raise HTTPException(status_code=403, detail="Admin API is disabled")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), settings.admin_token.encode()):
+        raise HTTPException(status_code=401, detail="Admin token required", headers={"WWW-Authenticate": "Bearer"})
+
+
+def require_service(authorization: Optional[str] = Header(default=None)) -> None:
+    """``Authorization: Bearer $BILLING_TOKEN``, held by the bot; off while no token is set.
+
+    Guards the calls that create invoices and mark them paid. Only the bot
+    sees Telegram's ``successful_payment``, so only it may confirm.
+    """
+
+    if not settings.billing_token:
+        raise HTTPException(status_code=403, detail="Service API is disabled")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), settings.billing_token.encode()):
+        raise HTTPException(status_code=401, detail="Service token required", headers={"WWW-Authenticate": "Bearer"})
 
 
 @app.get("/health")
@@ -34,48 +201,195 @@ def health():
     return {"status": "ok", "provider": settings.telegram_payment_provider}
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return metrics_response()
+
+
 @app.get("/tariffs", response_model=list[Tariff])
-def list_tariffs():
-    return TARIFFS
+def list_tariffs(if_none_match: Optional[str] = Header(default=None)):
+    headers = {
+        "ETag": catalog.etag,
+        "X-Catalog-Version": catalog.version,
+        "Cache-Control": "public, max-age=60",
+    }
+    if catalog.matches(if_none_match):
+        return Response(status_code=304, headers=headers)
+    return Response(content=catalog.body, media_type="application/json", headers=headers)
 
 
-@app.post("/payments/start", response_model=PaymentStatus)
-def start_payment(intent: PaymentIntent):
-    tariff = next((t for t in TARIFFS if t.code == intent.tariff_code), None)
+@app.post("/payments/start", response_model=PaymentStatus, dependencies=[Depends(require_service)])
+def start_payment(intent: PaymentIntent, idempotency_key: Optional[str] = Header(default=None)):
+    tariff = catalog.get(intent.tariff_code)
     if not tariff:
         raise HTTPException(status_code=404, detail="Unknown tariff")
-    invoice_id = f"invoice-{intent.user_id}-{intent.tariff_code}-{int(datetime.utcnow().timestamp())}"
+    referrer_id = parse_referral(intent.referral)
+    if referrer_id is not None:
+        referrals.bind(intent.user_id, referrer_id)
+    amount, promo_code_id, on_created = tariff.price_stars, None, None
+    try:
+        if intent.promo_code:
+            quote = promos.quote(intent.promo_code, tariff, user_id=intent.user_id)
+            amount, promo_code_id = quote.amount_stars, quote.code_id
+            # Only a hold: the use is taken when the invoice is paid.
+            on_created = lambda conn, invoice: promos.reserve(conn, quote, invoice)  # noqa: E731
+        invoice = ledger.create(
+            user_id=intent.user_id,
+            tariff=tariff,
+            amount_stars=amount,
+            idempotency_key=idempotency_key,
+            promo_code_id=promo_code_id,
+            on_created=on_created,
+        )
+    except InvalidPromo as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except (IdempotencyConflict, PromoError) as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
     return PaymentStatus(
-        status="pending",
-        amount_stars=tariff.price_stars,
-        invoice_id=invoice_id,
-        redirect_url=f"https://t.me/pay?start={invoice_id}",
+        status=invoice.status,
+        amount_stars=invoice.amount_stars,
+        invoice_id=invoice.token,
+        redirect_url=f"https://t.me/pay?start={invoice.token}",
     )
 
 
-@app.post("/payments/{invoice_id}/confirm", response_model=Subscription)
-def confirm_payment(invoice_id: str):
-    parts = invoice_id.split("-")
-    if len(parts) < 4:
-        raise HTTPException(status_code=400, detail="Malformed invoice")
-    _, user_id, tariff_code, _ = parts
-    tariff = next((t for t in TARIFFS if t.code == tariff_code), None)
-    if not tariff:
-        raise HTTPException(status_code=404, detail="Unknown tariff")
-    now = datetime.utcnow()
-    grace = now + timedelta(days=tariff.duration_days + 3)
+def _subscription_of(invoice: Invoice) -> Subscription:
     return Subscription(
-        user_id=int(user_id),
-        tariff_code=tariff_code,
-        active_until=now + timedelta(days=tariff.duration_days),
-        grace_until=grace,
-        speed_limit_mbps=tariff.speed_limit_mbps if tariff.speed_limit_mbps else None,
+        user_id=invoice.user_id,
+        tariff_code=invoice.tariff_code,
+        active_until=invoice.active_until,
+        grace_until=invoice.grace_until,
+        speed_limit_mbps=invoice.speed_limit_mbps,
     )
 
 
+def _on_paid(conn, invoice: Invoice) -> None:
+    """Everything a payment changes, committed with the invoice itself."""
+
+    referrals.accrue(conn, invoice)
+    if invoice.promo_code_id is not None:
+        promos.redeem(conn, invoice)
+    subscription = _subscription_of(invoice)
+    previous = expiry.upsert(subscription, conn)
+    analytics.paid(conn, invoice)
+    event_type = EXTENDED if previous in (NEW, ACTIVE, GRACE) else PAID
+    payload = dict(_event_payload(subscription), amount_stars=invoice.amount_stars, invoice_id=invoice.token)
+    outbox.add(conn, event_type, invoice.user_id, payload)
+
+
+@app.post("/payments/{invoice_id}/confirm", response_model=Subscription, dependencies=[Depends(require_service)])
+def confirm_payment(invoice_id: str, payment: PaymentConfirmation):
+    try:
+        invoice, transitioned = ledger.confirm(
+            invoice_id,
+            catalog.get,
+            on_paid=_on_paid,
+            paid_until=expiry.paid_until,
+            charge_id=payment.telegram_payment_charge_id,
+        )
+    except InvalidInvoice as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except InvoiceNotFound as exc:
+        raise HTTPException(status_code=404, detail=str(exc))
+    except ChargeConflict as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    if transitioned:
+        expiry.wake()
+        outbox.notify()
+    return _subscription_of(invoice)
+
+
 @app.post("/trial", response_model=Subscription)
 def create_trial(user_id: int):
-    return Subscription.trial(user_id=user_id)
+    """One trial per user, only before their first subscription of any kind."""
+
+    subscription = Subscription.trial(user_id=user_id)
+    with engine.begin() as conn:
+        # Revoked rows are kept, so a row means the user has or had a subscription.
+        if not expiry.create(subscription, conn):
+            raise HTTPException(status_code=409, detail="Trial is only available before the first subscription")
+        analytics.trial(conn, subscription)
+        outbox.add(conn, TRIAL, user_id, _event_payload(subscription))
+    expiry.wake()
+    outbox.notify()
+    return subscription
+
+
+@app.get("/subscriptions/{user_id}")
+def subscription_state(user_id: int):
+    row = expiry.get(user_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Unknown subscription")
+    return row
+
+
+@app.get("/analytics")
+def analytics_snapshot(days: int = Query(default=settings.analytics_window_days, ge=1, le=366)):
+    """Subscriber and revenue rollups; reads a fixed number of rows."""
+
+    return analytics.snapshot(days)
+
+
+@app.post("/promo/campaigns", dependencies=[Depends(require_admin)])
+def create_promo_campaign(request: PromoCampaignRequest):
+    """Create a campaign and stream its codes, one per line, as they are stored."""
+
+    try:
+        codes = promos.create_campaign(
+            name=request.name,
+            discount_percent=request.discount_percent,
+            count=request.count,
+            max_uses=request.max_uses,
+            expires_at=request.expires_at,
+            tariff_codes=request.tariff_codes,
+            prefix=request.prefix,
+        )
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Campaign already exists")
+    return StreamingResponse((code + "\n" for code in codes), media_type="text/plain")
+
+
+@app.get("/promo/{code}", response_model=PromoQuote)
+def quote_promo(code: str, tariff_code: str):
+    tariff = catalog.get(tariff_code)
+    if not tariff:
+        raise HTTPException(status_code=404, detail="Unknown tariff")
+    try:
+        quote = promos.quote(code, tariff)
+    except InvalidPromo as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except PromoError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    return PromoQuote(
+        campaign=quote.campaign,
+        discount_percent=quote.discount_percent,
+        tariff_code=tariff.code,
+        price_stars=tariff.price_stars,
+        amount_stars=quote.amount_stars,
+    )
+
+
+@app.get("/referrals/{user_id}")
+def referral_summary(user_id: int):
+    return referrals.summary(user_id)
+
+
+@app.post("/backups", status_code=202, dependencies=[Depends(require_admin)])
+def start_backup():
+    if backups.running:
+        raise HTTPException(status_code=409, detail="Backup already running")
+    backups.trigger()
+    return {"status": "scheduled"}
+
+
+@app.get("/backups", dependencies=[Depends(require_admin)])
+def list_backups():
+    return {
+        "running": backups.running,
+        "last_run": backups.last_run.summary() if backups.last_run else None,
+        "database": backups.backups(),
+        "config_snapshots": backups.snapshots(),
+    }
 
 
 @app.get("/notifications", response_model=list[NotificationSchedule])
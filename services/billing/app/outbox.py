@@ -0,0 +1,173 @@
+"""Transactional outbox for subscription lifecycle events.
+
+``add()`` inserts the event through the caller's connection, so it commits
+or rolls back together with the state change that caused it. A relay thread
+publishes unpublished rows to the event stream in id order. It marks them
+published in the transaction that selected them; on Postgres that select
+uses ``FOR UPDATE SKIP LOCKED``, so billing replicas relay disjoint batches.
+A crash between publishing and the commit publishes the batch again. The
+event id is the row id, so consumers drop the duplicates.
+
+``notify()`` wakes the relay right after a commit, so an event reaches the
+stream within milliseconds. The ``interval`` poll only picks up rows
+committed by other replicas. Published rows are deleted after ``keep``.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    String,
+    Table,
+    Text,
+    delete,
+    func,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.engine import Connection, Engine
+from vpn_common.events import Event, EventStream
+
+from .db import metadata
+
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True),
+    Column("event_type", String(32), nullable=False),
+    Column("user_id", BigInteger, nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+    Column("published_at", DateTime, nullable=True),
+)
+# Only the unpublished tail is indexed: the relay's scan stays O(batch).
+Index(
+    "ix_outbox_unpublished",
+    outbox.c.id,
+    postgresql_where=outbox.c.published_at.is_(None),
+    sqlite_where=outbox.c.published_at.is_(None),
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    def __init__(
+        self,
+        engine: Engine,
+        stream: Optional[EventStream],
+        batch_size: int = 500,
+        interval: float = 5.0,
+        keep: timedelta = timedelta(days=1),
+        clock: Callable[[], datetime] = datetime.utcnow,
+    ) -> None:
+        self.engine = engine
+        self.stream = stream
+        self.batch_size = batch_size
+        self.interval = interval
+        self.keep = keep
+        self._clock = clock
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_purge = datetime.min
+        self.published = 0
+
+    def add(self, conn: Connection, event_type: str, user_id: int, payload: Dict[str, Any]) -> None:
+        """Record an event in the caller's transaction; ``notify()`` after commit."""
+
+        if self.stream is None:
+            return
+        conn.execute(
+            insert(outbox).values(
+                event_type=event_type,
+                user_id=user_id,
+                payload=json.dumps(payload, default=str),
+                created_at=self._clock(),
+            )
+        )
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def backlog(self) -> int:
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.count()).where(outbox.c.published_at.is_(None))).scalar()
+
+    def publish_pending(self) -> int:
+        """Relay unpublished events until none are left; returns how many were published."""
+
+        if self.stream is None:
+            return 0
+        published = 0
+        while True:
+            with self.engine.begin() as conn:
+                rows = conn.execute(
+                    select(outbox)
+                    .where(outbox.c.published_at.is_(None))
+                    .order_by(outbox.c.id)
+                    .limit(self.batch_size)
+                    .with_for_update(skip_locked=True)
+                ).all()
+                if not rows:
+                    return published
+                self.stream.publish(
+                    [
+                        Event(
+                            id=str(row.id),
+                            type=row.event_type,
+                            user_id=row.user_id,
+                            payload=json.loads(row.payload),
+                            created_at=row.created_at,
+                        )
+                        for row in rows
+                    ]
+                )
+                conn.execute(
+                    update(outbox).where(outbox.c.id.in_([row.id for row in rows])).values(published_at=self._clock())
+                )
+            published += len(rows)
+            self.published += len(rows)
+            if len(rows) < self.batch_size:
+                return published
+
+    def purge(self) -> int:
+        cutoff = self._clock() - self.keep
+        with self.engine.begin() as conn:
+            return conn.execute(delete(outbox).where(outbox.c.published_at < cutoff)).rowcount
+
+    def start(self) -> None:
+        if self._thread is None and self.stream is not None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                self.publish_pending()
+                if self._clock() - self._last_purge > timedelta(hours=1):
+                    self._last_purge = self._clock()
+                    self.purge()
+            except Exception:
+                logger.exception("Outbox relay failed; retrying")
+            self._wakeup.wait(self.interval)
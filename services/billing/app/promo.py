@@ -0,0 +1,476 @@
+"""Promo codes: bulk campaigns, hashed lookups and atomic usage limits.
+
+Codes are never stored in clear. Each row keeps a keyed 16-byte hash of the
+normalized code under a unique index, so validating a code is one index
+probe and a leaked table does not reveal usable codes. In front of the probe
+sits a Bloom filter of every known hash. A code that is not in the filter is
+rejected without touching the database, which keeps brute-force guessing
+cheap for us. The filter is filled incrementally by row id. After a miss it
+is refreshed from the database at most once per ``refresh_interval``, so
+codes created by another replica become valid within that interval.
+
+Usage limits are enforced by a conditional ``UPDATE ... SET uses = uses + 1
+WHERE uses < max_uses`` together with a (code, user) redemption row, so
+concurrent redemptions never exceed the limit and a user cannot redeem the
+same code twice. Creating an invoice only holds a use for ``hold_seconds``;
+the hold becomes a redemption when the invoice is paid. Holds of abandoned
+invoices lapse: the next reservation of the code releases them, and a lapsed
+hold does not stop the same user from trying again.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import logging
+import math
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, Iterator, Optional, Sequence
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    LargeBinary,
+    String,
+    Table,
+    delete,
+    func,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+from .db import metadata, upsert_insert
+from .ledger import Invoice
+from .schemas import Tariff
+
+logger = logging.getLogger(__name__)
+
+promo_campaigns = Table(
+    "promo_campaigns",
+    metadata,
+    Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True),
+    Column("name", String(64), nullable=False, unique=True),
+    Column("discount_percent", Integer, nullable=False),
+    # Comma-separated tariff codes the campaign applies to; NULL means all.
+    Column("tariff_codes", String(256), nullable=True),
+    Column("expires_at", DateTime, nullable=True),
+    Column("created_at", DateTime, nullable=False),
+)
+
+promo_codes = Table(
+    "promo_codes",
+    metadata,
+    Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True),
+    Column("code_hash", LargeBinary(16), nullable=False, unique=True),
+    Column("campaign_id", BigInteger, ForeignKey("promo_campaigns.id"), nullable=False),
+    Column("max_uses", Integer, nullable=True),  # NULL: unlimited
+    Column("uses", Integer, nullable=False, default=0),
+)
+
+promo_redemptions = Table(
+    "promo_redemptions",
+    metadata,
+    Column("code_id", BigInteger, primary_key=True, autoincrement=False),
+    Column("user_id", BigInteger, primary_key=True, autoincrement=False),
+    Column("invoice_id", BigInteger, nullable=False),
+    Column("held_until", DateTime, nullable=True),
+    Column("redeemed_at", DateTime, nullable=True),  # NULL while only held
+)
+
+# Crockford's base32 without I, L, O and U: nothing to misread when typing.
+ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+CODE_LENGTH = 10  # 50 bits
+
+
+class PromoError(Exception):
+    """Base class for promo errors surfaced as HTTP errors by the API."""
+
+
+class InvalidPromo(PromoError):
+    pass
+
+
+class PromoExhausted(PromoError):
+    pass
+
+
+class PromoAlreadyUsed(PromoError):
+    pass
+
+
+def normalize(code: str) -> str:
+    return code.strip().upper().replace("-", "").replace(" ", "")
+
+
+_FROM_B32 = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ234567", ALPHABET)
+
+
+def random_codes(count: int, prefix: str = "") -> set:
+    """Up to ``count`` distinct random codes (duplicates within a chunk collapse)."""
+
+    # Each base32 character carries 5 random bits; encode one buffer per call.
+    chars = count * CODE_LENGTH
+    raw = base64.b32encode(secrets.token_bytes(-(-chars // 8) * 5)).decode().translate(_FROM_B32)
+    return {prefix + raw[i : i + CODE_LENGTH] for i in range(0, chars, CODE_LENGTH)}
+
+
+class BloomFilter:
+    """Bit array probed with double hashing over an already uniform digest."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001) -> None:
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, digest: bytes) -> Iterator[int]:
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, digest: bytes) -> None:
+        self.update((digest,))
+
+    def update(self, digests: Iterable[bytes]) -> None:
+        # Hot path when loading millions of hashes: no per-position generator.
+        bits, size, hashes = self._bits, self.size, range(self.hashes)
+        added = 0
+        for digest in digests:
+            h1 = int.from_bytes(digest[:8], "little")
+            h2 = int.from_bytes(digest[8:16], "little") | 1
+            for i in hashes:
+                pos = (h1 + i * h2) % size
+                bits[pos >> 3] |= 1 << (pos & 7)
+            added += 1
+        self.count += added
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+
+@dataclass(frozen=True)
+class Campaign:
+    id: int
+    name: str
+    discount_percent: int
+    tariff_codes: Optional[frozenset]
+    expires_at: Optional[datetime]
+
+
+@dataclass(frozen=True)
+class Quote:
+    code_id: int
+    campaign: str
+    discount_percent: int
+    amount_stars: int
+
+
+class PromoEngine:
+    def __init__(
+        self,
+        engine: Engine,
+        secret: str,
+        bloom_capacity: int = 1_000_000,
+        bloom_error_rate: float = 0.001,
+        refresh_interval: float = 30.0,
+        use_bloom: bool = True,
+        hold_seconds: float = 3600.0,
+        clock: Callable[[], datetime] = datetime.utcnow,
+    ) -> None:
+        self.engine = engine
+        self._key = hashlib.blake2b(secret.encode()).digest()
+        self.bloom_error_rate = bloom_error_rate
+        self.refresh_interval = refresh_interval
+        self.use_bloom = use_bloom
+        self.hold = timedelta(seconds=hold_seconds)
+        self._clock = clock
+        self._bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+        self._watermark = 0  # highest promo_codes.id in the filter
+        self._refreshed_at = float("-inf")
+        self._lock = threading.Lock()
+        self._campaigns: Dict[int, Campaign] = {}
+        # (discount, price) -> discounted price; a handful of distinct pairs.
+        self._prices: Dict[tuple, int] = {}
+        self.bloom_rejects = 0
+
+    def digest(self, code: str) -> bytes:
+        return self._digest(normalize(code))
+
+    def _digest(self, normalized: str) -> bytes:
+        # Keyed BLAKE2b is a MAC on its own; one C call instead of HMAC's two.
+        return hashlib.blake2b(normalized.encode(), key=self._key, digest_size=16).digest()
+
+    # -- campaigns -------------------------------------------------------
+
+    def create_campaign(
+        self,
+        name: str,
+        discount_percent: int,
+        count: int,
+        max_uses: Optional[int] = 1,
+        expires_at: Optional[datetime] = None,
+        tariff_codes: Optional[Sequence[str]] = None,
+        prefix: str = "",
+        chunk_size: int = 10_000,
+    ) -> Iterator[str]:
+        """Create a campaign and yield its ``count`` new codes.
+
+        Codes are inserted chunk by chunk as the iterator is consumed, so a
+        million-code campaign is streamed, never held in memory at once.
+        """
+
+        if not 0 < discount_percent <= 100:
+            raise ValueError("discount_percent must be within 1..100")
+        prefix = normalize(prefix)
+        with self.engine.begin() as conn:
+            campaign_id = conn.execute(
+                insert(promo_campaigns).values(
+                    name=name,
+                    discount_percent=discount_percent,
+                    tariff_codes=",".join(tariff_codes) if tariff_codes else None,
+                    expires_at=expires_at,
+                    created_at=self._clock(),
+                )
+            ).inserted_primary_key[0]
+        return self._generate(campaign_id, count, max_uses, prefix, chunk_size)
+
+    def _generate(self, campaign_id: int, count: int, max_uses: Optional[int], prefix: str, chunk_size: int) -> Iterator[str]:
+        remaining = count
+        while remaining:
+            by_digest = {self._digest(code): code for code in random_codes(min(chunk_size, remaining), prefix)}
+            stmt = (
+                upsert_insert(self.engine, promo_codes)
+                .on_conflict_do_nothing(index_elements=[promo_codes.c.code_hash])
+                .returning(promo_codes.c.id, promo_codes.c.code_hash)
+            )
+            rows = [
+                {"code_hash": digest, "campaign_id": campaign_id, "max_uses": max_uses, "uses": 0}
+                for digest in by_digest
+            ]
+            with self.engine.begin() as conn:
+                # Collisions with existing codes are skipped and regenerated.
+                inserted = conn.execute(stmt, rows).all()
+            with self._lock:
+                self._bloom.update(row.code_hash for row in inserted)
+            for row in inserted:
+                yield by_digest[row.code_hash]
+            remaining -= len(inserted)
+
+    def _campaign(self, conn: Connection, campaign_id: int) -> Campaign:
+        campaign = self._campaigns.get(campaign_id)
+        if campaign is None:
+            row = conn.execute(select(promo_campaigns).where(promo_campaigns.c.id == campaign_id)).one()
+            campaign = Campaign(
+                id=row.id,
+                name=row.name,
+                discount_percent=row.discount_percent,
+                tariff_codes=frozenset(row.tariff_codes.split(",")) if row.tariff_codes else None,
+                expires_at=row.expires_at,
+            )
+            self._campaigns[campaign_id] = campaign
+        return campaign
+
+    # -- Bloom filter ----------------------------------------------------
+
+    def refresh(self, chunk_size: int = 100_000) -> int:
+        """Add codes created since the last refresh; returns how many."""
+
+        added = 0
+        with self._lock:
+            self._refreshed_at = time.monotonic()
+            with self.engine.connect() as conn:
+                while True:
+                    rows = conn.execute(
+                        select(promo_codes.c.id, promo_codes.c.code_hash)
+                        .where(promo_codes.c.id > self._watermark)
+                        .order_by(promo_codes.c.id)
+                        .limit(chunk_size)
+                    ).all()
+                    if not rows:
+                        break
+                    if self._bloom.count + len(rows) > self._bloom.capacity:
+                        # Past its capacity the false-positive rate climbs;
+                        # start over with twice the room.
+                        self._bloom = BloomFilter(2 * (self._bloom.count + len(rows)), self.bloom_error_rate)
+                        self._watermark = 0
+                        continue
+                    self._bloom.update(row.code_hash for row in rows)
+                    self._watermark = rows[-1].id
+                    added += len(rows)
+        return added
+
+    def _maybe_known(self, digest: bytes) -> bool:
+        if not self.use_bloom or digest in self._bloom:
+            return True
+        if time.monotonic() - self._refreshed_at >= self.refresh_interval:
+            self.refresh()
+            return digest in self._bloom
+        return False
+
+    # -- validation and redemption ---------------------------------------
+
+    def price(self, tariff: Tariff, discount_percent: int) -> int:
+        key = (discount_percent, tariff.price_stars)
+        amount = self._prices.get(key)
+        if amount is None:
+            # Round down to whole stars, but never give a paid tariff away.
+            amount = tariff.price_stars * (100 - discount_percent) // 100
+            if tariff.price_stars and discount_percent < 100:
+                amount = max(1, amount)
+            self._prices[key] = amount
+        return amount
+
+    def quote(self, code: str, tariff: Tariff, user_id: Optional[int] = None) -> Quote:
+        """Validate ``code`` for ``tariff`` and price it; does not consume a use.
+
+        A use already held by ``user_id`` (an earlier unpaid invoice) counts
+        as available to them.
+        """
+
+        digest = self.digest(code)
+        if not self._maybe_known(digest):
+            self.bloom_rejects += 1
+            raise InvalidPromo("Unknown promo code")
+        with self.engine.connect() as conn:
+            row = conn.execute(select(promo_codes).where(promo_codes.c.code_hash == digest)).first()
+            if row is None:
+                raise InvalidPromo("Unknown promo code")
+            campaign = self._campaign(conn, row.campaign_id)
+            # Lapsed holds still count in ``uses`` until the next reservation.
+            exhausted = row.max_uses is not None and row.uses >= row.max_uses
+            if exhausted:
+                exhausted = row.uses - self._lapsed(conn, row.id) >= row.max_uses and not (
+                    user_id is not None and self._holds(conn, row.id, user_id)
+                )
+        if campaign.expires_at is not None and campaign.expires_at <= self._clock():
+            raise InvalidPromo("Promo code expired")
+        if campaign.tariff_codes is not None and tariff.code not in campaign.tariff_codes:
+            raise InvalidPromo("Promo code does not apply to this tariff")
+        if exhausted:
+            raise PromoExhausted("Promo code has been used up")
+        return Quote(
+            code_id=row.id,
+            campaign=campaign.name,
+            discount_percent=campaign.discount_percent,
+            amount_stars=self.price(tariff, campaign.discount_percent),
+        )
+
+    def _lapsed_clause(self, code_id: int):
+        return (
+            (promo_redemptions.c.code_id == code_id)
+            & promo_redemptions.c.redeemed_at.is_(None)
+            & (promo_redemptions.c.held_until <= self._clock())
+        )
+
+    def _lapsed(self, conn: Connection, code_id: int) -> int:
+        return conn.execute(
+            select(func.count()).select_from(promo_redemptions).where(self._lapsed_clause(code_id))
+        ).scalar_one()
+
+    def _holds(self, conn: Connection, code_id: int, user_id: int) -> bool:
+        return (
+            conn.execute(
+                select(promo_redemptions.c.invoice_id).where(
+                    promo_redemptions.c.code_id == code_id,
+                    promo_redemptions.c.user_id == user_id,
+                    promo_redemptions.c.redeemed_at.is_(None),
+                    promo_redemptions.c.held_until > self._clock(),
+                )
+            ).first()
+            is not None
+        )
+
+    def reserve(self, conn: Connection, quote: Quote, invoice: Invoice) -> None:
+        """Hold one use of the quoted code for ``invoice``, in its transaction."""
+
+        released = conn.execute(delete(promo_redemptions).where(self._lapsed_clause(quote.code_id))).rowcount
+        if released:
+            conn.execute(
+                update(promo_codes)
+                .where(promo_codes.c.id == quote.code_id)
+                .values(uses=promo_codes.c.uses - released)
+            )
+        key = (promo_redemptions.c.code_id == quote.code_id) & (promo_redemptions.c.user_id == invoice.user_id)
+        held_until = self._clock() + self.hold
+        existing = conn.execute(select(promo_redemptions.c.redeemed_at).where(key)).first()
+        if existing is not None:
+            if existing.redeemed_at is not None:
+                raise PromoAlreadyUsed("Promo code already used by this user")
+            # A new invoice for the same purchase takes over the user's hold.
+            conn.execute(update(promo_redemptions).where(key).values(invoice_id=invoice.id, held_until=held_until))
+            return
+        try:
+            conn.execute(
+                insert(promo_redemptions).values(
+                    code_id=quote.code_id,
+                    user_id=invoice.user_id,
+                    invoice_id=invoice.id,
+                    held_until=held_until,
+                )
+            )
+        except IntegrityError as exc:
+            raise PromoAlreadyUsed("Promo code already used by this user") from exc
+        result = conn.execute(
+            update(promo_codes)
+            .where(
+                promo_codes.c.id == quote.code_id,
+                (promo_codes.c.max_uses.is_(None)) | (promo_codes.c.uses < promo_codes.c.max_uses),
+            )
+            .values(uses=promo_codes.c.uses + 1)
+        )
+        if result.rowcount != 1:
+            raise PromoExhausted("Promo code has been used up")
+
+    def redeem(self, conn: Connection, invoice: Invoice) -> None:
+        """Turn the hold for a paid ``invoice`` into a redemption, in its transaction.
+
+        The stars are already charged at this point, so the discount is
+        honoured even if the hold lapsed and was released meanwhile: the use
+        is taken again, past ``max_uses`` if need be.
+        """
+
+        now = self._clock()
+        key = (promo_redemptions.c.code_id == invoice.promo_code_id) & (promo_redemptions.c.user_id == invoice.user_id)
+        result = conn.execute(
+            update(promo_redemptions)
+            .where(key, promo_redemptions.c.redeemed_at.is_(None))
+            .values(invoice_id=invoice.id, held_until=None, redeemed_at=now)
+        )
+        if result.rowcount == 1:
+            return
+        if conn.execute(select(promo_redemptions.c.invoice_id).where(key)).first() is not None:
+            logger.warning("Invoice %s paid with promo code %s the user already redeemed", invoice.id, invoice.promo_code_id)
+            return
+        logger.warning("Invoice %s paid after its promo hold lapsed", invoice.id)
+        conn.execute(
+            insert(promo_redemptions).values(
+                code_id=invoice.promo_code_id, user_id=invoice.user_id, invoice_id=invoice.id, redeemed_at=now
+            )
+        )
+        conn.execute(
+            update(promo_codes).where(promo_codes.c.id == invoice.promo_code_id).values(uses=promo_codes.c.uses + 1)
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "bloom_codes": self._bloom.count,
+            "bloom_bytes": self._bloom.nbytes,
+            "bloom_rejects": self.bloom_rejects,
+        }
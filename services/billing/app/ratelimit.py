@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Optional
+
+# Refill arithmetic accumulates float error; treat a deficit this small as paid.
+_EPSILON = 1e-9
+
+
+class TokenBucket:
+    """Thread-safe token bucket; ``acquire`` blocks until enough tokens exist."""
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens + _EPSILON >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1) -> None:
+        if tokens > self.capacity:
+            raise ValueError("cannot acquire more tokens than bucket capacity")
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens + _EPSILON >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            self._sleep(wait)
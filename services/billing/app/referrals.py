@@ -0,0 +1,139 @@
+"""Referral tree and reward accrual.
+
+Every user has at most one referrer, bound on their first payment attempt.
+A user who has already invited somebody cannot be bound. This keeps the
+graph a forest, so walking up from any user always ends.
+When an invoice is paid, each ancestor up to ``len(levels)`` hops away is
+credited ``levels[i]`` percent of the amount. The accrual runs inside the
+confirming transaction, and ``(invoice_id, level)`` is unique, so a reward is
+credited exactly once.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Sequence
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    Table,
+    UniqueConstraint,
+    func,
+    insert,
+    select,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+from .db import metadata
+from .ledger import Invoice
+
+referrals = Table(
+    "referrals",
+    metadata,
+    Column("user_id", BigInteger, primary_key=True, autoincrement=False),
+    Column("referrer_id", BigInteger, nullable=False, index=True),
+    Column("created_at", DateTime, nullable=False),
+)
+
+referral_rewards = Table(
+    "referral_rewards",
+    metadata,
+    Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True),
+    Column("beneficiary_id", BigInteger, nullable=False),
+    Column("invoice_id", BigInteger, nullable=False),
+    Column("level", Integer, nullable=False),
+    Column("amount_stars", Integer, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+    UniqueConstraint("invoice_id", "level", name="uq_referral_rewards_invoice_level"),
+    Index("ix_referral_rewards_beneficiary", "beneficiary_id"),
+)
+
+
+def parse_referral(value: Optional[str]) -> Optional[int]:
+    """Referrer id from a ``/start`` payload such as ``ref_123`` or ``123``."""
+
+    if not value:
+        return None
+    value = value.strip()
+    if value.startswith("ref_"):
+        value = value[4:]
+    return int(value) if value.isdigit() else None
+
+
+class ReferralTree:
+    def __init__(
+        self,
+        engine: Engine,
+        levels: Sequence[int] = (10, 5),
+        clock: Callable[[], datetime] = datetime.utcnow,
+    ) -> None:
+        self.engine = engine
+        self.levels = tuple(levels)
+        self._clock = clock
+
+    def bind(self, user_id: int, referrer_id: int) -> bool:
+        """Attach ``user_id`` under ``referrer_id``; False if not allowed or already bound."""
+
+        if user_id == referrer_id:
+            return False
+        with self.engine.begin() as conn:
+            # A user with invitees of their own could otherwise close a cycle.
+            if conn.execute(select(referrals.c.user_id).where(referrals.c.referrer_id == user_id).limit(1)).first():
+                return False
+            try:
+                with conn.begin_nested():
+                    conn.execute(
+                        insert(referrals).values(user_id=user_id, referrer_id=referrer_id, created_at=self._clock())
+                    )
+            except IntegrityError:
+                return False
+        return True
+
+    def ancestors(self, conn: Connection, user_id: int) -> List[int]:
+        chain: List[int] = []
+        current = user_id
+        for _ in self.levels:
+            referrer = conn.execute(select(referrals.c.referrer_id).where(referrals.c.user_id == current)).scalar()
+            if referrer is None or referrer in chain:
+                break
+            chain.append(referrer)
+            current = referrer
+        return chain
+
+    def accrue(self, conn: Connection, invoice: Invoice) -> int:
+        """Credit the payer's ancestors for ``invoice``; runs in the confirm transaction."""
+
+        rows = [
+            {
+                "beneficiary_id": beneficiary,
+                "invoice_id": invoice.id,
+                "level": level,
+                "amount_stars": invoice.amount_stars * percent // 100,
+                "created_at": self._clock(),
+            }
+            for level, (beneficiary, percent) in enumerate(
+                zip(self.ancestors(conn, invoice.user_id), self.levels), start=1
+            )
+        ]
+        rows = [row for row in rows if row["amount_stars"] > 0]
+        if rows:
+            conn.execute(insert(referral_rewards), rows)
+        return len(rows)
+
+    def summary(self, user_id: int) -> Dict[str, object]:
+        with self.engine.connect() as conn:
+            referrer = conn.execute(select(referrals.c.referrer_id).where(referrals.c.user_id == user_id)).scalar()
+            invited = conn.execute(
+                select(func.count()).select_from(referrals).where(referrals.c.referrer_id == user_id)
+            ).scalar_one()
+            earned = conn.execute(
+                select(func.coalesce(func.sum(referral_rewards.c.amount_stars), 0)).where(
+                    referral_rewards.c.beneficiary_id == user_id
+                )
+            ).scalar_one()
+        return {"user_id": user_id, "referrer_id": referrer, "invited": invited, "earned_stars": earned}
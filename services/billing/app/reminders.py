@@ -1,68 +1,356 @@
+"""Time-bucketed lifecycle reminders.
+
+Instead of one APScheduler job per subscription and schedule entry, due
+reminders live in a sorted store (a Redis sorted set in production, minute
+buckets in memory for tests) scored by their fire time. A single dispatcher
+thread claims everything that is due with one range query per batch and hands
+it to a batched sink through a token bucket, so Telegram's broadcast limit is
+respected no matter how many reminders come due in the same minute. In
+production the sink publishes ``reminder`` events to the lifecycle stream,
+and the bot sends them with its other lifecycle messages.
+"""
+
 from __future__ import annotations
 
+import abc
+import heapq
+import logging
+import threading
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Iterable
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
 
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.date import DateTrigger
+from vpn_common.events import REMINDER, Event, EventStream
 
+from .ratelimit import TokenBucket
 from .schemas import NotificationSchedule, Subscription
 
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+# A reminder is stored as a single integer: user id, phase bit and the
+# "hours before end" offset. Re-scheduling a subscription therefore
+# overwrites its pending reminders instead of piling up duplicates.
+_HOURS_BITS = 10
+_PHASE_BIT = 1 << _HOURS_BITS
+_PHASES = ("active", "grace")
+
+
+def encode_reminder(user_id: int, entry: NotificationSchedule) -> int:
+    if not 0 <= entry.trigger_hours_before_end < _PHASE_BIT:
+        raise ValueError("trigger_hours_before_end out of range")
+    phase = _PHASE_BIT if entry.phase == "grace" else 0
+    return (user_id << (_HOURS_BITS + 1)) | phase | entry.trigger_hours_before_end
+
+
+def decode_reminder(reminder_id: int) -> Tuple[int, str, int]:
+    user_id = reminder_id >> (_HOURS_BITS + 1)
+    phase = _PHASES[1] if reminder_id & _PHASE_BIT else _PHASES[0]
+    return user_id, phase, reminder_id & (_PHASE_BIT - 1)
+
+
+def _to_ts(moment: datetime) -> float:
+    return (moment - EPOCH).total_seconds()
+
+
+@dataclass(frozen=True)
+class Reminder:
+    user_id: int
+    entry: NotificationSchedule
+    fire_at: datetime
+
+
+class ReminderStore(abc.ABC):
+    """Sorted collection of ``reminder_id -> fire timestamp``."""
+
+    @abc.abstractmethod
+    def add_many(self, items: Iterable[Tuple[int, float]]) -> None:
+        """Insert or reschedule reminders."""
+
+    @abc.abstractmethod
+    def remove_many(self, reminder_ids: Iterable[int]) -> None:
+        ...
+
+    @abc.abstractmethod
+    def claim_due(self, now_ts: float, limit: int) -> List[Tuple[int, float]]:
+        """Atomically remove and return up to ``limit`` reminders due by ``now_ts``."""
+
+    @abc.abstractmethod
+    def pending(self) -> int:
+        ...
+
+
+class MemoryReminderStore(ReminderStore):
+    """Local stand-in grouping reminders into per-minute buckets.
+
+    ``claim_due`` walks buckets in time order via a heap of bucket keys, so a
+    claim only touches due reminders. Rescheduled or removed reminders are
+    skipped lazily when their old bucket is drained.
+    """
+
+    def __init__(self, bucket_seconds: int = 60) -> None:
+        self.bucket_seconds = bucket_seconds
+        self._scores: Dict[int, float] = {}
+        self._buckets: Dict[int, List[int]] = {}
+        self._bucket_heap: List[int] = []
+        self._lock = threading.Lock()
+
+    def add_many(self, items: Iterable[Tuple[int, float]]) -> None:
+        with self._lock:
+            for reminder_id, ts in items:
+                self._scores[reminder_id] = ts
+                bucket = int(ts // self.bucket_seconds)
+                members = self._buckets.get(bucket)
+                if members is None:
+                    self._buckets[bucket] = members = []
+                    heapq.heappush(self._bucket_heap, bucket)
+                members.append(reminder_id)
+
+    def remove_many(self, reminder_ids: Iterable[int]) -> None:
+        with self._lock:
+            for reminder_id in reminder_ids:
+                self._scores.pop(reminder_id, None)
+
+    def claim_due(self, now_ts: float, limit: int) -> List[Tuple[int, float]]:
+        claimed: List[Tuple[int, float]] = []
+        with self._lock:
+            while self._bucket_heap and len(claimed) < limit:
+                bucket = self._bucket_heap[0]
+                if bucket * self.bucket_seconds > now_ts:
+                    break
+                members = self._buckets[bucket]
+                keep: List[int] = []
+                for idx, reminder_id in enumerate(members):
+                    if len(claimed) >= limit:
+                        keep.extend(members[idx:])
+                        break
+                    ts = self._scores.get(reminder_id)
+                    if ts is None or int(ts // self.bucket_seconds) != bucket:
+                        continue  # removed or moved to another bucket
+                    if ts > now_ts:
+                        keep.append(reminder_id)
+                        continue
+                    del self._scores[reminder_id]
+                    claimed.append((reminder_id, ts))
+                if keep:
+                    self._buckets[bucket] = keep
+                    if len(claimed) < limit:
+                        break  # the rest of this bucket is not due yet
+                else:
+                    del self._buckets[bucket]
+                    heapq.heappop(self._bucket_heap)
+        claimed.sort(key=lambda item: item[1])
+        return claimed
+
+    def pending(self) -> int:
+        return len(self._scores)
+
+
+_CLAIM_SCRIPT = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #items, 2 do
+    redis.call('ZREM', KEYS[1], items[i])
+end
+return items
+"""
+
+
+class RedisReminderStore(ReminderStore):
+    """Redis sorted set scored by fire timestamp; survives restarts and is
+    safe to drain from several billing replicas at once."""
+
+    def __init__(self, client, key: str = "reminders:due", chunk_size: int = 10_000) -> None:
+        self._redis = client
+        self.key = key
+        self.chunk_size = chunk_size
+        self._claim = client.register_script(_CLAIM_SCRIPT)
+
+    def add_many(self, items: Iterable[Tuple[int, float]]) -> None:
+        pipe = self._redis.pipeline(transaction=False)
+        chunk: Dict[str, float] = {}
+        for reminder_id, ts in items:
+            chunk[str(reminder_id)] = ts
+            if len(chunk) >= self.chunk_size:
+                pipe.zadd(self.key, chunk)
+                chunk = {}
+        if chunk:
+            pipe.zadd(self.key, chunk)
+        pipe.execute()
+
+    def remove_many(self, reminder_ids: Iterable[int]) -> None:
+        members = [str(reminder_id) for reminder_id in reminder_ids]
+        if members:
+            self._redis.zrem(self.key, *members)
+
+    def claim_due(self, now_ts: float, limit: int) -> List[Tuple[int, float]]:
+        raw = self._claim(keys=[self.key], args=[now_ts, limit])
+        return [(int(raw[i]), float(raw[i + 1])) for i in range(0, len(raw), 2)]
+
+    def pending(self) -> int:
+        return int(self._redis.zcard(self.key))
+
+
+class NotificationSink(abc.ABC):
+    @abc.abstractmethod
+    def send_batch(self, reminders: Sequence[Reminder]) -> None:
+        ...
+
+
+class LoggingSink(NotificationSink):
+    def send_batch(self, reminders: Sequence[Reminder]) -> None:
+        for reminder in reminders:
+            logger.info(
+                "[reminder] user=%s phase=%s +%sh message=%s",
+                reminder.user_id,
+                reminder.entry.phase,
+                reminder.entry.trigger_hours_before_end,
+                reminder.entry.message,
+            )
+
+
+class EventStreamSink(NotificationSink):
+    """Publishes a whole batch to the lifecycle event stream in one round trip.
+
+    The event id is derived from the reminder and its fire time, so a batch
+    re-queued after a failed publish is dropped by the bot if it got through.
+    """
+
+    def __init__(self, stream: EventStream) -> None:
+        self.stream = stream
+
+    def send_batch(self, reminders: Sequence[Reminder]) -> None:
+        if not reminders:
+            return
+        self.stream.publish(
+            [
+                Event(
+                    id=f"reminder-{encode_reminder(r.user_id, r.entry)}-{int(_to_ts(r.fire_at))}",
+                    type=REMINDER,
+                    user_id=r.user_id,
+                    payload={
+                        "phase": r.entry.phase,
+                        "hours_before_end": r.entry.trigger_hours_before_end,
+                        "message": r.entry.message,
+                    },
+                    created_at=r.fire_at,
+                )
+                for r in reminders
+            ]
+        )
+
 
 class ReminderManager:
-    """Simple APScheduler wrapper for lifecycle reminders."""
+    """Schedules lifecycle reminders and dispatches them in rate-limited batches."""
 
     def __init__(
         self,
         schedule: Iterable[NotificationSchedule],
-        timezone: str = "UTC",
+        store: Optional[ReminderStore] = None,
+        sink: Optional[NotificationSink] = None,
+        bucket: Optional[TokenBucket] = None,
+        batch_size: int = 1000,
+        interval: float = 60.0,
+        clock: Callable[[], datetime] = datetime.utcnow,
     ) -> None:
         self.schedule = list(schedule)
-        self._scheduler = BackgroundScheduler(timezone=timezone)
-        self._started = False
+        self._entries = {(e.phase, e.trigger_hours_before_end): e for e in self.schedule}
+        self.store = store or MemoryReminderStore()
+        self.sink = sink or LoggingSink()
+        # Telegram allows roughly 30 broadcast messages per second.
+        self.bucket = bucket or TokenBucket(rate=30, capacity=30)
+        self.batch_size = batch_size
+        self.interval = interval
+        self._clock = clock
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.dispatched = 0
+        self.last_lag_seconds = 0.0
+        self.max_lag_seconds = 0.0
 
     def start(self) -> None:
-        if not self._started:
-            self._scheduler.start()
-            self._started = True
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="reminders", daemon=True)
+            self._thread.start()
 
     def stop(self) -> None:
-        if self._started:
-            self._scheduler.shutdown(wait=False)
-            self._started = False
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout=self.interval)
+            self._thread = None
+
+    def _fire_times(self, subscription: Subscription) -> Iterable[Tuple[int, float]]:
+        now = self._clock()
+        for entry in self.schedule:
+            end = subscription.active_until if entry.phase == "active" else subscription.grace_until
+            fire_at = end - timedelta(hours=entry.trigger_hours_before_end)
+            if fire_at <= now:
+                continue
+            yield encode_reminder(subscription.user_id, entry), _to_ts(fire_at)
 
     def schedule_subscription(self, subscription: Subscription) -> None:
-        """Create reminder jobs for a subscription lifecycle."""
+        """Create or move the reminders for a subscription lifecycle."""
 
-        if not self._started:
-            # Avoid silently failing during unit tests/startup
-            self.start()
+        self.unschedule_subscription(subscription.user_id)
+        self.store.add_many(self._fire_times(subscription))
 
-        for entry in self.schedule:
-            if entry.phase == "active":
-                fire_at = subscription.active_until - timedelta(
-                    hours=entry.trigger_hours_before_end
-                )
-            else:
-                fire_at = subscription.grace_until - timedelta(
-                    hours=entry.trigger_hours_before_end
-                )
+    def schedule_many(self, subscriptions: Iterable[Subscription]) -> None:
+        """Bulk variant for backfills; does not clear previously stored entries."""
 
-            if fire_at <= datetime.utcnow():
-                continue
+        self.store.add_many(
+            item for subscription in subscriptions for item in self._fire_times(subscription)
+        )
 
-            trigger = DateTrigger(run_date=fire_at)
-            self._scheduler.add_job(
-                self._emit_notification,
-                trigger=trigger,
-                args=[subscription.user_id, entry],
-                id=f"notify-{subscription.user_id}-{subscription.tariff_code}-{entry.phase}-{entry.trigger_hours_before_end}-{fire_at.timestamp()}",
-                replace_existing=True,
-            )
+    def unschedule_subscription(self, user_id: int) -> None:
+        self.store.remove_many(encode_reminder(user_id, entry) for entry in self.schedule)
 
-    @staticmethod
-    def _emit_notification(user_id: int, entry: NotificationSchedule) -> None:
-        # Placeholder for integration with Telegram bot webhook/Redis queue
-        print(
-            f"[reminder] user={user_id} phase={entry.phase} +{entry.trigger_hours_before_end}h message={entry.message}"
-        )
+    def dispatch_due(self, now: Optional[datetime] = None) -> int:
+        """Drain every reminder due by ``now``; returns how many were sent."""
+
+        now = now or self._clock()
+        now_ts = _to_ts(now)
+        sent = 0
+        while not self._stop.is_set():
+            claimed = self.store.claim_due(now_ts, self.batch_size)
+            if not claimed:
+                break
+            sent += self._dispatch_batch(claimed)
+            if len(claimed) < self.batch_size:
+                break
+        return sent
+
+    def _dispatch_batch(self, claimed: List[Tuple[int, float]]) -> int:
+        reminders: List[Reminder] = []
+        for reminder_id, ts in claimed:
+            user_id, phase, hours = decode_reminder(reminder_id)
+            entry = self._entries.get((phase, hours))
+            if entry is None:
+                continue  # schedule entry was removed since it was stored
+            reminders.append(Reminder(user_id, entry, EPOCH + timedelta(seconds=ts)))
+
+        chunk_size = max(1, int(self.bucket.capacity))
+        for start in range(0, len(reminders), chunk_size):
+            chunk = reminders[start : start + chunk_size]
+            self.bucket.acquire(len(chunk))
+            try:
+                self.sink.send_batch(chunk)
+            except Exception:
+                logger.exception("Reminder sink failed, re-queueing %s reminders", len(reminders) - start)
+                self.store.add_many(
+                    (encode_reminder(r.user_id, r.entry), _to_ts(r.fire_at)) for r in reminders[start:]
+                )
+                return start
+            lag = (self._clock() - chunk[-1].fire_at).total_seconds()
+            self.last_lag_seconds = lag
+            self.max_lag_seconds = max(self.max_lag_seconds, lag)
+            self.dispatched += len(chunk)
+        return len(reminders)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.dispatch_due()
+            except Exception:
+                logger.exception("Reminder dispatch cycle failed")
+            self._stop.wait(self.interval)
@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Literal, Optional
 from pydantic import BaseModel, Field
 
 
@@ -21,6 +21,10 @@ class PaymentIntent(BaseModel):
     promo_code: Optional[str] = None
 
 
+class PaymentConfirmation(BaseModel):
+    telegram_payment_charge_id: str = Field(..., min_length=1, max_length=128)
+
+
 class PaymentStatus(BaseModel):
     status: str
     amount_stars: int
@@ -47,6 +51,25 @@ class Subscription(BaseModel):
         )
 
 
+class PromoCampaignRequest(BaseModel):
+    name: str
+    discount_percent: int = Field(..., ge=1, le=100)
+    count: int = Field(..., ge=1, le=10_000_000)
+    max_uses: Optional[int] = Field(default=1, ge=1, description="Uses per code; null for unlimited")
+    expires_at: Optional[datetime] = None
+    tariff_codes: Optional[list[str]] = None
+    prefix: str = ""
+
+
+class PromoQuote(BaseModel):
+    campaign: str
+    discount_percent: int
+    tariff_code: str
+    price_stars: int
+    amount_stars: int
+
+
 class NotificationSchedule(BaseModel):
     trigger_hours_before_end: int = Field(..., description="Hours before end to notify")
     message: str
+    phase: Literal["active", "grace"] = "active"
@@ -0,0 +1,152 @@
+"""Backup pipeline: compression throughput, streaming memory, incremental configs.
+
+Generates ``--mb`` MiB of ``INSERT`` statements as a stand-in for
+``pg_dump`` and
+
+* compares single-stream gzip with ``compress_parallel`` at 1..``--workers``
+  threads (throughput and ratio);
+* streams the dump through compression into a filesystem bucket, reporting
+  peak Python memory against dump size, and verifies it back;
+* fails a dump half way and checks nothing is left in the bucket;
+* snapshots ``--objects`` config files, then again unchanged, then with 1%
+  rewritten, counting copies;
+* runs a backup every 12 hours of a fake clock for 60 days and reports what
+  retention keeps.
+
+Run from ``services/billing``::
+
+    python -m benchmarks.bench_backup --mb 256 --workers 8 --objects 20000
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import zlib
+from datetime import datetime, timedelta
+from typing import Iterator
+
+from app.backup import (
+    MIB,
+    BackupWorker,
+    DumpFailed,
+    DumpSource,
+    FileSystemBackupStore,
+    compress_parallel,
+)
+
+
+class SyntheticDump(DumpSource):
+    def __init__(self, size: int, fail_at: int = 0, seed: int = 1) -> None:
+        self.size = size
+        self.fail_at = fail_at
+        rnd = random.Random(seed)
+        rows = []
+        for i in range(20_000):
+            rows.append(
+                f"INSERT INTO invoices VALUES ({i}, {rnd.randrange(10**9)}, 'light', {rnd.randrange(50, 900)}, "
+                f"'{rnd.getrandbits(128):032x}', 'paid', '2026-0{rnd.randrange(1, 10)}-1{rnd.randrange(10)}');\n"
+            )
+        sample = "".join(rows).encode()
+        self._period = len(sample)
+        self._ring = sample * 2  # any block up to one period is a single slice
+
+    def blocks(self, block_size: int) -> Iterator[bytes]:
+        sent = 0
+        offset = 0
+        while sent < self.size:
+            if self.fail_at and sent >= self.fail_at:
+                raise DumpFailed("synthetic failure")
+            block = self._ring[offset : offset + min(block_size, self.size - sent, self._period)]
+            offset = (offset + len(block)) % self._period
+            sent += len(block)
+            yield block
+
+
+def _throughput(dump: SyntheticDump, workers: int) -> tuple:
+    started = time.perf_counter()
+    if workers == 0:
+        encoder = zlib.compressobj(6, zlib.DEFLATED, 31)
+        packed = sum(len(encoder.compress(block)) for block in dump.blocks(MIB)) + len(encoder.flush())
+    else:
+        packed = sum(len(chunk) for chunk in compress_parallel(dump.blocks(MIB), 6, workers))
+    elapsed = time.perf_counter() - started
+    return dump.size / MIB / elapsed, dump.size / packed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mb", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--objects", type=int, default=20_000)
+    args = parser.parse_args()
+    size = args.mb * MIB
+    print(f"{os.cpu_count()} CPUs, {args.mb} MiB synthetic dump")
+
+    dump = SyntheticDump(size)
+    rate, ratio = _throughput(dump, 0)
+    print(f"gzip single stream         {rate:7.1f} MiB/s  ratio {ratio:.2f}")
+    workers = 1
+    while workers <= args.workers:
+        rate, ratio = _throughput(dump, workers)
+        print(f"compress_parallel x{workers:<3}     {rate:7.1f} MiB/s  ratio {ratio:.2f}")
+        workers *= 2
+
+    with tempfile.TemporaryDirectory() as bucket, tempfile.TemporaryDirectory() as configs_dir:
+        store = FileSystemBackupStore(bucket)
+        worker = BackupWorker(store, dump=dump, compress_workers=args.workers)
+        tracemalloc.start()
+        started = time.perf_counter()
+        manifest = worker.backup_database()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        started = time.perf_counter()
+        worker.verify(manifest)
+        verify_elapsed = time.perf_counter() - started
+        print(
+            f"dump -> bucket             {args.mb / elapsed:7.1f} MiB/s  {manifest.size / MIB:.1f} MiB stored, "
+            f"peak memory {peak / MIB:.1f} MiB; verify {args.mb / verify_elapsed:.1f} MiB/s"
+        )
+
+        failing = BackupWorker(store, dump=SyntheticDump(size, fail_at=size // 2))
+        before = sorted(obj.key for obj in store.list())
+        try:
+            failing.backup_database()
+        except DumpFailed:
+            pass
+        left = sorted(obj.key for obj in store.list())
+        print(f"failed dump                objects before {len(before)}, after {len(left)} (no partial backup)")
+
+        source = FileSystemBackupStore(configs_dir)
+        for i in range(args.objects):
+            source.put(f"configs/{i}/main/v1.conf", os.urandom(300))
+        incremental = BackupWorker(store, configs=source, upload_workers=8)
+        for label in ("first snapshot", "unchanged", "1% rewritten"):
+            if label == "1% rewritten":
+                for i in range(0, args.objects, 100):
+                    source.put(f"configs/{i}/main/v1.conf", os.urandom(300))
+            started = time.perf_counter()
+            snapshot = incremental.snapshot_configs()
+            elapsed = time.perf_counter() - started
+            print(
+                f"configs {label:<18} {elapsed:6.2f}s  copied {snapshot.copied:>6}  skipped {snapshot.skipped:>6}"
+            )
+
+    with tempfile.TemporaryDirectory() as bucket:
+        now = [datetime(2026, 1, 1)]
+        retained = BackupWorker(
+            FileSystemBackupStore(bucket), dump=SyntheticDump(64 * 1024), keep_last=7, keep_daily=30, clock=lambda: now[0]
+        )
+        for _ in range(120):
+            retained.run()
+            now[0] += timedelta(hours=12)
+        print(f"retention after 120 runs   {len(retained.backups())} backups kept (7 newest + 1/day for 30 days)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Expiry sweep cost against a large subscription table.
+
+Fills ``subscriptions`` with ``--size`` rows whose deadlines are spread over
+the next 30 days, then advances a fake clock so that ``--due`` of them cross
+a deadline and times the sweep (index range scan over the due rows) against
+a naive full scan that evaluates every row. Run from ``services/billing``::
+
+    python -m benchmarks.bench_expiry --size 1000000 --due 1000
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from sqlalchemy import insert, select
+
+from app.db import create_db_engine, metadata
+from app.expiry import ACTIVE, ExpiryActions, ExpirySweeper, subscriptions
+from app.schemas import Subscription
+
+
+class CountingActions(ExpiryActions):
+    def __init__(self) -> None:
+        self.pushed = self.revoked = self.calls = 0
+
+    def push_limits(self, subs: List[Subscription]) -> None:
+        self.pushed += len(subs)
+        self.calls += 1
+
+    def revoke(self, subs: List[Subscription]) -> None:
+        self.revoked += len(subs)
+        self.calls += 1
+
+
+class Clock:
+    def __init__(self, now: datetime) -> None:
+        self.now = now
+
+    def __call__(self) -> datetime:
+        return self.now
+
+
+def _fill(engine, size: int, start: datetime, due: int, chunk: int = 50_000) -> None:
+    # ``due`` rows expire within the first minute; the rest over 30 days.
+    span = 30 * 86400
+    for offset in range(0, size, chunk):
+        rows = []
+        for i in range(offset, min(size, offset + chunk)):
+            seconds = 1 + i % 59 if i < due else 60 + (i * 7919) % span
+            active_until = start + timedelta(seconds=seconds)
+            rows.append(
+                {
+                    "user_id": i,
+                    "tariff_code": "light",
+                    "active_until": active_until,
+                    "grace_until": active_until + timedelta(days=3),
+                    "speed_limit_mbps": 100,
+                    "state": ACTIVE,
+                    "next_transition_at": active_until,
+                }
+            )
+        with engine.begin() as conn:
+            conn.execute(insert(subscriptions), rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None, help="SQLAlchemy URL (default: temporary SQLite file)")
+    parser.add_argument("--size", type=int, default=1_000_000)
+    parser.add_argument("--due", type=int, default=1000)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    engine = create_db_engine(args.url or f"sqlite:///{os.path.join(tmpdir, 'expiry.db')}")
+    metadata.create_all(engine)
+    start = datetime(2024, 1, 1)
+    clock = Clock(start)
+    actions = CountingActions()
+    sweeper = ExpirySweeper(engine, actions, clock=clock)
+
+    t = time.perf_counter()
+    _fill(engine, args.size, start, args.due)
+    print(f"filled {args.size:,} subscriptions in {time.perf_counter() - t:.1f}s")
+
+    t = time.perf_counter()
+    print(f"next wake-up: {sweeper.next_due()} ({(time.perf_counter() - t) * 1e3:.2f} ms)")
+
+    clock.now = start + timedelta(minutes=1)
+    t = time.perf_counter()
+    with engine.connect() as conn:
+        due = sum(1 for row in conn.execute(select(subscriptions)) if row.next_transition_at <= clock.now)
+    print(f"full-scan baseline: found {due} due rows in {(time.perf_counter() - t) * 1e3:.1f} ms")
+    t = time.perf_counter()
+    applied = sweeper.sweep()
+    print(f"sweep: {applied} transitions in {actions.calls} provisioner calls, {(time.perf_counter() - t) * 1e3:.1f} ms")
+
+    t = time.perf_counter()
+    applied = sweeper.sweep()
+    print(f"idle sweep: {applied} transitions, {(time.perf_counter() - t) * 1e3:.2f} ms")
+
+
+
+if __name__ == "__main__":
+    main()
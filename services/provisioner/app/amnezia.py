@@ -3,7 +3,13 @@
 from textwrap import dedent
 
 
-def build_profile(public_host: str, public_port: int, device_name: str) -> str:
+def build_profile(
+    public_host: str,
+    public_port: int,
+    device_name: str,
+    address: str = "10.7.0.2/32",
+    private_key: str = "<generated>",
+) -> str:
     """Return a mock Amnezia configuration string.
 
     In production this would call the dedicated Amnezia container API to mint
@@ -14,8 +20,8 @@ def build_profile(public_host: str, public_port: int, device_name: str) -> str:
         f"""
         # AmneziaWG profile generated for {device_name}
         [Interface]
-        PrivateKey = <generated>
-        Address = 10.7.0.2/32
+        PrivateKey = {private_key}
+        Address = {address}
         DNS = 1.1.1.1
 
         [Peer]
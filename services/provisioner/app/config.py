@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings
 
 
@@ -11,6 +13,46 @@ class Settings(BaseSettings):
     minio_root_user: str = "admin"
     minio_root_password: str = "changeme123"
     minio_bucket: str = "configs"
+    public_host: str = "vpn.example.com"
+    wireguard_port: int = 51820
+    node_subnets: str = "default_nl=10.7.0.0/16,default_fra=10.8.0.0/16"
+    keypool_size: int = 2000
+    service_base_url: str = "http://localhost:8001"
+    object_store: str = "minio"
+    object_store_path: str = "/tmp/provisioner-objects"
+    qr_workers: int = 4
+    traffic_source: str = "command"
+    traffic_commands: str = "wg show all dump;awg show all dump"
+    traffic_fixture_path: str = ""
+    traffic_interval_sec: float = 30.0
+    traffic_minute_slots: int = 60
+    traffic_hour_slots: int = 48
+    traffic_day_slots: int = 31
+    shaping_backend: str = "dryrun"
+    shaping_interfaces: str = "wireguard=wg0,amneziawg=amnezia0"
+    shaping_nodes: str = ""
+    shaping_link_mbps: int = 1000
+    shaping_interval_sec: float = 2.0
+    shaping_persist_sec: float = 60.0
+    grace_speed_mbps: int = 10
+    config_cache_mb: int = 32
+    config_versions_kept: int = 3
+    config_downloads: str = "stream"  # or "presigned": redirect to the bucket
+    config_url_ttl_sec: int = 300
+    # Download links in config_url are HMAC-signed with this secret and expire.
+    config_link_secret: str = "change-me-config-link-secret"
+    config_link_ttl_sec: int = 86400
+    billing_url: Optional[str] = "http://billing:8000"
+    # Bearer token billing and the bot send on write calls; those calls are refused while unset.
+    provisioner_token: Optional[str] = None
+    tariffs_refresh_sec: float = 60.0
+    node_probe: str = "stub"
+    node_endpoints: str = ""
+    node_probe_interval_sec: float = 10.0
+    node_probe_timeout_sec: float = 2.0
+    redis_url: Optional[str] = None
+    events_backend: str = "redis"  # or "memory", "none" (no lifecycle events)
+    events_batch_size: int = 100
 
     class Config:
         env_file = ".env"
@@ -26,6 +68,44 @@ class Settings(BaseSettings):
             "minio_root_user": {"env": "MINIO_ROOT_USER"},
             "minio_root_password": {"env": "MINIO_ROOT_PASSWORD"},
             "minio_bucket": {"env": "MINIO_BUCKET"},
+            "public_host": {"env": "PUBLIC_HOST"},
+            "wireguard_port": {"env": "WIREGUARD_PORT"},
+            "node_subnets": {"env": "NODE_SUBNETS"},
+            "keypool_size": {"env": "KEYPOOL_SIZE"},
+            "service_base_url": {"env": "SERVICE_BASE_URL"},
+            "object_store": {"env": "OBJECT_STORE"},
+            "object_store_path": {"env": "OBJECT_STORE_PATH"},
+            "qr_workers": {"env": "QR_WORKERS"},
+            "traffic_source": {"env": "TRAFFIC_SOURCE"},
+            "traffic_commands": {"env": "TRAFFIC_COMMANDS"},
+            "traffic_fixture_path": {"env": "TRAFFIC_FIXTURE_PATH"},
+            "traffic_interval_sec": {"env": "TRAFFIC_INTERVAL_SEC"},
+            "traffic_minute_slots": {"env": "TRAFFIC_MINUTE_SLOTS"},
+            "traffic_hour_slots": {"env": "TRAFFIC_HOUR_SLOTS"},
+            "traffic_day_slots": {"env": "TRAFFIC_DAY_SLOTS"},
+            "shaping_backend": {"env": "SHAPING_BACKEND"},
+            "shaping_interfaces": {"env": "SHAPING_INTERFACES"},
+            "shaping_nodes": {"env": "SHAPING_NODES"},
+            "shaping_link_mbps": {"env": "SHAPING_LINK_MBPS"},
+            "shaping_interval_sec": {"env": "SHAPING_INTERVAL_SEC"},
+            "shaping_persist_sec": {"env": "SHAPING_PERSIST_SEC"},
+            "grace_speed_mbps": {"env": "GRACE_SPEED_MBPS"},
+            "config_cache_mb": {"env": "CONFIG_CACHE_MB"},
+            "config_versions_kept": {"env": "CONFIG_VERSIONS_KEPT"},
+            "config_downloads": {"env": "CONFIG_DOWNLOADS"},
+            "config_url_ttl_sec": {"env": "CONFIG_URL_TTL_SEC"},
+            "config_link_secret": {"env": "CONFIG_LINK_SECRET"},
+            "config_link_ttl_sec": {"env": "CONFIG_LINK_TTL_SEC"},
+            "billing_url": {"env": "BILLING_URL"},
+            "provisioner_token": {"env": "PROVISIONER_TOKEN"},
+            "tariffs_refresh_sec": {"env": "TARIFFS_REFRESH_SEC"},
+            "node_probe": {"env": "NODE_PROBE"},
+            "node_endpoints": {"env": "NODE_ENDPOINTS"},
+            "node_probe_interval_sec": {"env": "NODE_PROBE_INTERVAL_SEC"},
+            "node_probe_timeout_sec": {"env": "NODE_PROBE_TIMEOUT_SEC"},
+            "redis_url": {"env": "REDIS_URL"},
+            "events_backend": {"env": "EVENTS_BACKEND"},
+            "events_batch_size": {"env": "EVENTS_BATCH_SIZE"},
         }
 
 
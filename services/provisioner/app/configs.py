@@ -0,0 +1,244 @@
+"""Per-device client configs persisted in object storage under versioned keys.
+
+Each device has a manifest at ``configs/<user>/<device>/manifest.json``
+pointing at its current config ``configs/<user>/<device>/v<n>.conf``. It
+also records a fingerprint of the inputs that config was built from:
+protocol, node, tunnel address and server endpoint. ``/provision`` only
+builds a new version, with a fresh keypair, when the fingerprint changes.
+Repeated provisions of an unchanged device reuse the stored config and
+keys. The newest ``keep`` versions are retained and older ones are deleted.
+Manifests also carry the tunnel address, so the address book can be rebuilt
+from them after a restart (``manifests()``).
+
+A byte-bounded LRU of config bodies and a count-bounded LRU of manifests sit
+in front of the store, so hot devices are served without a round trip.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from .storage import ObjectStore
+
+
+@dataclass(frozen=True)
+class ConfigInputs:
+    protocol: str
+    node_id: str
+    address: str
+    endpoint: str  # public host:port the client connects to
+
+    @property
+    def fingerprint(self) -> str:
+        raw = json.dumps(asdict(self), sort_keys=True).encode()
+        return hashlib.sha256(raw).hexdigest()[:32]
+
+
+@dataclass
+class ConfigVersion:
+    user_id: int
+    device_name: str
+    version: int
+    key: str
+    fingerprint: str
+    sha256: str  # of the body; doubles as ETag and QR digest
+    protocol: str
+    node_id: str
+    size: int
+    created_at: datetime
+    public_key: Optional[str] = None
+    address: Optional[str] = None
+    # (version, key) of older configs still in the store, newest first.
+    history: List[Tuple[int, str]] = field(default_factory=list)
+
+    def to_json(self) -> bytes:
+        data = asdict(self)
+        data["created_at"] = self.created_at.isoformat()
+        return json.dumps(data).encode()
+
+    @classmethod
+    def from_json(cls, raw: bytes) -> "ConfigVersion":
+        data = json.loads(raw)
+        data["created_at"] = datetime.fromisoformat(data["created_at"])
+        data["history"] = [tuple(item) for item in data.get("history", [])]
+        return cls(**data)
+
+    def key_for(self, version: int) -> Optional[str]:
+        if version == self.version:
+            return self.key
+        return next((key for v, key in self.history if v == version), None)
+
+
+def device_prefix(user_id: int, device_name: str) -> str:
+    return f"configs/{user_id}/{quote(device_name, safe='')}"
+
+
+class ConfigStore:
+    def __init__(
+        self,
+        store: ObjectStore,
+        cache_bytes: int = 32 * 1024 * 1024,
+        manifest_cache: int = 100_000,
+        keep: int = 3,
+        stripes: int = 64,
+    ) -> None:
+        self.store = store
+        self.cache_bytes = cache_bytes
+        self.manifest_cache = manifest_cache
+        self.keep = max(1, keep)
+        self._bodies: "OrderedDict[str, bytes]" = OrderedDict()
+        self._body_bytes = 0
+        self._manifests: "OrderedDict[Tuple[int, str], Optional[ConfigVersion]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Serialises the check-and-write per device without one global lock.
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self.hits = self.misses = self.writes = 0
+
+    # -- LRU ------------------------------------------------------------
+
+    def _cache_body(self, key: str, body: bytes) -> None:
+        if len(body) > self.cache_bytes:
+            return
+        with self._lock:
+            old = self._bodies.pop(key, None)
+            if old is not None:
+                self._body_bytes -= len(old)
+            self._bodies[key] = body
+            self._body_bytes += len(body)
+            while self._body_bytes > self.cache_bytes:
+                _, evicted = self._bodies.popitem(last=False)
+                self._body_bytes -= len(evicted)
+
+    def cached(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            body = self._bodies.get(key)
+            if body is not None:
+                self._bodies.move_to_end(key)
+                self.hits += 1
+            return body
+
+    def _cache_manifest(self, device: Tuple[int, str], manifest: Optional[ConfigVersion]) -> None:
+        with self._lock:
+            self._manifests[device] = manifest
+            self._manifests.move_to_end(device)
+            if len(self._manifests) > self.manifest_cache:
+                self._manifests.popitem(last=False)
+
+    @property
+    def cached_bytes(self) -> int:
+        return self._body_bytes
+
+    # -- reads ------------------------------------------------------------
+
+    def current(self, user_id: int, device_name: str) -> Optional[ConfigVersion]:
+        device = (user_id, device_name)
+        with self._lock:
+            if device in self._manifests:
+                self._manifests.move_to_end(device)
+                return self._manifests[device]
+        raw = self.store.get(f"{device_prefix(user_id, device_name)}/manifest.json")
+        manifest = ConfigVersion.from_json(raw) if raw is not None else None
+        self._cache_manifest(device, manifest)
+        return manifest
+
+    def manifests(self) -> Iterator[ConfigVersion]:
+        """Every device's current manifest, straight from the store."""
+
+        for key in self.store.keys("configs/"):
+            if key.endswith("/manifest.json"):
+                raw = self.store.get(key)
+                if raw is not None:
+                    yield ConfigVersion.from_json(raw)
+
+    def read(self, key: str) -> Optional[bytes]:
+        body = self.cached(key)
+        if body is None:
+            self.misses += 1
+            body = self.store.get(key)
+            if body is not None:
+                self._cache_body(key, body)
+        return body
+
+    # -- writes -----------------------------------------------------------
+
+    def lock(self, user_id: int, device_name: str) -> threading.Lock:
+        return self._stripes[hash((user_id, device_name)) % len(self._stripes)]
+
+    def save(
+        self,
+        user_id: int,
+        device_name: str,
+        inputs: ConfigInputs,
+        body: bytes,
+        public_key: Optional[str] = None,
+        previous: Optional[ConfigVersion] = None,
+    ) -> ConfigVersion:
+        """Store ``body`` as the device's next version; call under ``lock()``."""
+
+        prefix = device_prefix(user_id, device_name)
+        version = previous.version + 1 if previous else 1
+        history: List[Tuple[int, str]] = []
+        if previous is not None:
+            history = [(previous.version, previous.key)] + previous.history
+        key = f"{prefix}/v{version}.conf"
+        manifest = ConfigVersion(
+            user_id=user_id,
+            device_name=device_name,
+            version=version,
+            key=key,
+            fingerprint=inputs.fingerprint,
+            sha256=hashlib.sha256(body).hexdigest(),
+            protocol=inputs.protocol,
+            node_id=inputs.node_id,
+            size=len(body),
+            created_at=datetime.utcnow(),
+            public_key=public_key,
+            address=inputs.address,
+            history=history[: self.keep - 1],
+        )
+        # Body first: a reader following the manifest must find the object.
+        self.store.put(key, body, content_type="text/plain; charset=utf-8")
+        self.store.put(f"{prefix}/manifest.json", manifest.to_json(), content_type="application/json")
+        for _, stale in history[self.keep - 1 :]:
+            self.store.delete(stale)
+            self._forget_body(stale)
+        self._cache_body(key, body)
+        self._cache_manifest((user_id, device_name), manifest)
+        self.writes += 1
+        return manifest
+
+    def drop(self, user_id: int, device_name: str) -> None:
+        """Delete every stored version of a released device."""
+
+        with self.lock(user_id, device_name):
+            manifest = self.current(user_id, device_name)
+            if manifest is None:
+                return
+            prefix = device_prefix(user_id, device_name)
+            self.store.delete(f"{prefix}/manifest.json")
+            for key in [manifest.key] + [key for _, key in manifest.history]:
+                self.store.delete(key)
+                self._forget_body(key)
+            self._cache_manifest((user_id, device_name), None)
+
+    def _forget_body(self, key: str) -> None:
+        with self._lock:
+            body = self._bodies.pop(key, None)
+            if body is not None:
+                self._body_bytes -= len(body)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "cached_bytes": self._body_bytes,
+            "cached_manifests": len(self._manifests),
+        }
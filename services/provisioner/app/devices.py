@@ -0,0 +1,104 @@
+"""Per-user device slots enforcing the tariff's device limit.
+
+Each user has an ``OrderedDict`` of device name -> last-seen time, kept in
+least-recently-seen order, so the slot count is ``len()`` and the eviction
+victim is the first entry: both O(1). "Seen" means provisioned, downloaded
+or moving traffic. Reserving a slot for a new device when the user is at
+their limit evicts the least recently seen device(s) and returns them to the
+caller for deprovisioning. The limit is the tariff's ``devices`` from
+billing's catalog (``tariffs.py``).
+
+All work for one user (reserve, lease, evict, release) runs under that
+user's lock from ``hold()``. Locks are striped, so concurrent provisions for
+the same user serialise while different users rarely contend.
+
+Slots live in memory. On startup they are rebuilt from the stored configs
+(``restore``), with each config's creation time standing in for "last seen"
+until traffic or a download refreshes it.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+class DeviceRegistry:
+    def __init__(
+        self,
+        stripes: int = 256,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self._clock = clock
+        self._users: Dict[int, "OrderedDict[str, float]"] = {}
+        self._stripes = [threading.RLock() for _ in range(stripes)]
+        self.evictions = 0
+
+    def hold(self, user_id: int) -> threading.RLock:
+        """The lock serialising everything done to ``user_id``'s devices."""
+
+        return self._stripes[user_id % len(self._stripes)]
+
+    def reserve(self, user_id: int, device_name: str, limit: int) -> List[str]:
+        """Take (or refresh) a slot for ``device_name``; returns evicted device names."""
+
+        if limit < 1:
+            raise ValueError("device limit must be at least 1")
+        now = self._clock()
+        with self.hold(user_id):
+            devices = self._users.setdefault(user_id, OrderedDict())
+            evicted = []
+            if device_name in devices:
+                devices.move_to_end(device_name)
+            else:
+                # A downgrade can leave more devices than the new limit allows.
+                while len(devices) >= limit:
+                    evicted.append(devices.popitem(last=False)[0])
+            devices[device_name] = now
+            self.evictions += len(evicted)
+            return evicted
+
+    def touch(self, user_id: int, device_name: str, when: Optional[float] = None) -> None:
+        with self.hold(user_id):
+            devices = self._users.get(user_id)
+            if devices is not None and device_name in devices:
+                devices[device_name] = self._clock() if when is None else when
+                devices.move_to_end(device_name)
+
+    def touch_many(self, seen: Iterable[Tuple[int, str]], when: Optional[float] = None) -> None:
+        when = self._clock() if when is None else when
+        for user_id, device_name in seen:
+            self.touch(user_id, device_name, when)
+
+    def release(self, user_id: int, device_name: str) -> bool:
+        with self.hold(user_id):
+            devices = self._users.get(user_id)
+            if devices is None or devices.pop(device_name, None) is None:
+                return False
+            if not devices:
+                del self._users[user_id]
+            return True
+
+    def restore(self, entries: Iterable[Tuple[int, str, float]]) -> int:
+        """Re-take ``(user, device, last_seen)`` slots without evicting; returns how many."""
+
+        restored = 0
+        for user_id, device_name, seen in sorted(entries, key=lambda entry: entry[2]):
+            with self.hold(user_id):
+                self._users.setdefault(user_id, OrderedDict())[device_name] = seen
+            restored += 1
+        return restored
+
+    def count(self, user_id: int) -> int:
+        devices = self._users.get(user_id)
+        return len(devices) if devices else 0
+
+    def devices(self, user_id: int) -> List[Tuple[str, float]]:
+        """``(device_name, last_seen)`` from most to least recently seen."""
+
+        with self.hold(user_id):
+            return list(reversed(self._users.get(user_id, {}).items()))
+
+    def __len__(self) -> int:
+        return sum(len(devices) for devices in list(self._users.values()))
@@ -0,0 +1,197 @@
+"""Tunnel address allocation from per-node subnets.
+
+Each subnet is tracked by a bitmap (one bit per address, 8 KiB for a /16)
+plus a stack of freed offsets and a high-water mark, so both ``allocate``
+and ``release`` are O(1) regardless of pool size or fragmentation. Leases
+are held in memory only; on startup they are rebuilt from the addresses
+recorded in the config manifests (``AddressBook.restore``).
+"""
+
+from __future__ import annotations
+
+import ipaddress
+import logging
+import threading
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PoolExhausted(RuntimeError):
+    pass
+
+
+class SubnetAllocator:
+    def __init__(self, network: str | ipaddress.IPv4Network, reserved: int = 1) -> None:
+        self.network = ipaddress.ip_network(network)
+        # Offset 0 is the network address and the last one is broadcast; the
+        # first ``reserved`` hosts belong to the node itself (gateway/DNS).
+        self._first = 1 + reserved
+        self._last = self.network.num_addresses - 2
+        if self._last < self._first:
+            raise ValueError(f"{self.network} has no assignable addresses")
+        self._bitmap = bytearray((self.network.num_addresses + 7) // 8)
+        self._freed = array("L")
+        self._next = self._first
+        self._used = 0
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        return self._last - self._first + 1
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    def _is_set(self, offset: int) -> bool:
+        return bool(self._bitmap[offset >> 3] & (1 << (offset & 7)))
+
+    def _set(self, offset: int) -> None:
+        self._bitmap[offset >> 3] |= 1 << (offset & 7)
+
+    def _clear(self, offset: int) -> None:
+        self._bitmap[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+
+    def _offset(self, address: str | ipaddress.IPv4Address) -> int:
+        offset = int(ipaddress.ip_address(address)) - int(self.network.network_address)
+        if not self._first <= offset <= self._last:
+            raise ValueError(f"{address} is not assignable in {self.network}")
+        return offset
+
+    def allocate(self) -> ipaddress.IPv4Address:
+        with self._lock:
+            while self._freed:
+                offset = self._freed.pop()
+                if not self._is_set(offset):  # may have been reserve()d meanwhile
+                    break
+            else:
+                while self._next <= self._last and self._is_set(self._next):
+                    self._next += 1  # skip addresses taken by reserve()
+                if self._next > self._last:
+                    raise PoolExhausted(f"no free addresses left in {self.network}")
+                offset = self._next
+                self._next += 1
+            self._set(offset)
+            self._used += 1
+        return self.network.network_address + offset
+
+    def reserve(self, address: str | ipaddress.IPv4Address) -> None:
+        """Mark a specific address as taken, e.g. when restoring persisted leases."""
+
+        offset = self._offset(address)
+        with self._lock:
+            if self._is_set(offset):
+                raise ValueError(f"{address} is already allocated")
+            self._set(offset)
+            self._used += 1
+
+    def release(self, address: str | ipaddress.IPv4Address) -> None:
+        offset = self._offset(address)
+        with self._lock:
+            if not self._is_set(offset):
+                return
+            self._clear(offset)
+            self._used -= 1
+            self._freed.append(offset)
+
+    def __contains__(self, address: str | ipaddress.IPv4Address) -> bool:
+        try:
+            return self._is_set(self._offset(address))
+        except ValueError:
+            return False
+
+
+LeaseKey = Tuple[int, str]
+
+
+class AddressBook:
+    """Per-node allocators plus the device -> address leases handed out."""
+
+    def __init__(self, subnets: Dict[str, str]) -> None:
+        self.pools = {node_id: SubnetAllocator(net) for node_id, net in subnets.items()}
+        self._leases: Dict[LeaseKey, Tuple[str, ipaddress.IPv4Address]] = {}
+        self._devices: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_spec(cls, spec: str) -> "AddressBook":
+        """Parse ``node=cidr,node=cidr`` as used in the NODE_SUBNETS setting."""
+
+        subnets = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            node_id, _, cidr = item.partition("=")
+            subnets[node_id.strip()] = cidr.strip()
+        return cls(subnets)
+
+    def lease(self, user_id: int, device_name: str, node_id: str) -> ipaddress.IPv4Address:
+        """Return the device's address on ``node_id``, allocating on first use.
+
+        Moving a device to another node releases its old address.
+        """
+
+        pool = self.pools.get(node_id)
+        if pool is None:
+            raise KeyError(f"unknown node {node_id}")
+        key = (user_id, device_name)
+        with self._lock:
+            current = self._leases.get(key)
+            if current and current[0] == node_id:
+                return current[1]
+            address = pool.allocate()
+            self._leases[key] = (node_id, address)
+            self._devices.setdefault(user_id, set()).add(device_name)
+        if current:
+            self.pools[current[0]].release(current[1])
+        return address
+
+    def release(self, user_id: int, device_name: str) -> Optional[ipaddress.IPv4Address]:
+        with self._lock:
+            current = self._leases.pop((user_id, device_name), None)
+            devices = self._devices.get(user_id)
+            if devices is not None:
+                devices.discard(device_name)
+                if not devices:
+                    del self._devices[user_id]
+        if current is None:
+            return None
+        self.pools[current[0]].release(current[1])
+        return current[1]
+
+    def restore(self, leases: Iterable[Tuple[int, str, str, str]]) -> int:
+        """Re-take persisted ``(user, device, node, address)`` leases; returns how many.
+
+        Leases on unknown nodes or addresses already taken are skipped; those
+        devices get a fresh address on their next provision.
+        """
+
+        restored = 0
+        for user_id, device_name, node_id, address in leases:
+            pool = self.pools.get(node_id)
+            try:
+                if pool is None:
+                    raise ValueError(f"unknown node {node_id}")
+                ip = ipaddress.ip_address(address)
+                pool.reserve(ip)
+            except ValueError as exc:
+                logger.warning("Not restoring lease of %s/%s: %s", user_id, device_name, exc)
+                continue
+            with self._lock:
+                self._leases[(user_id, device_name)] = (node_id, ip)
+                self._devices.setdefault(user_id, set()).add(device_name)
+            restored += 1
+        return restored
+
+    def lease_of(self, user_id: int, device_name: str) -> Optional[Tuple[str, ipaddress.IPv4Address]]:
+        """``(node_id, address)`` of the device's lease, if it has one."""
+
+        return self._leases.get((user_id, device_name))
+
+    def node_of(self, user_id: int, device_name: str) -> Optional[str]:
+        current = self._leases.get((user_id, device_name))
+        return current[0] if current else None
+
+    def devices(self, user_id: int) -> List[str]:
+        with self._lock:
+            return sorted(self._devices.get(user_id, ()))
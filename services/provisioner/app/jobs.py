@@ -0,0 +1,156 @@
+"""Background batch jobs with NDJSON result streaming.
+
+A job fans its items out to a fixed number of asyncio workers (bounded
+concurrency), records every outcome as a pre-serialized NDJSON line in
+completion order, and tracks progress/failures. Any number of readers can
+stream the lines, including ones that attach after the job started; jobs keep
+running if a reader disconnects.
+
+Results are delivered once: the first reader that streams a finished job to
+the end releases its lines, so finished jobs kept for status polling hold
+only counters and errors. Reading results takes the job's ``token``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import secrets
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Any], Awaitable[Dict[str, Any]]]
+
+
+class BatchJob:
+    def __init__(self, items: Sequence[Any], handler: Handler, concurrency: int) -> None:
+        self.id = uuid.uuid4().hex
+        self.token = secrets.token_urlsafe(16)
+        self.items = items
+        self.total = len(items)
+        self.done = 0
+        self.failed = 0
+        self.errors: List[Dict[str, Any]] = []
+        self.status = "pending"
+        self.created_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+        self.delivered = False
+        self._handler = handler
+        self._concurrency = max(1, min(concurrency, self.total or 1))
+        self._lines: List[bytes] = []
+        self._changed = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "cancelled")
+
+    def start(self) -> None:
+        self.status = "running"
+        self._task = asyncio.create_task(self._run(), name=f"batch-{self.id}")
+
+    def cancel(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        next_index = iter(range(self.total))
+
+        async def worker() -> None:
+            for index in next_index:
+                try:
+                    result = await self._handler(self.items[index])
+                    line = {"index": index, "ok": True, "result": result}
+                except Exception as exc:
+                    line = {"index": index, "ok": False, "error": str(exc) or type(exc).__name__}
+                await self._record(line)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(self._concurrency)))
+            self.status = "completed"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+        finally:
+            self.finished_at = datetime.utcnow()
+            self.items = ()  # inputs are no longer needed
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def _record(self, line: Dict[str, Any]) -> None:
+        if line["ok"]:
+            self.done += 1
+        else:
+            self.failed += 1
+            self.errors.append({"index": line["index"], "error": line["error"]})
+        self._lines.append(json.dumps(line, default=str, ensure_ascii=False).encode() + b"\n")
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """Yield result lines as they are produced, from the first one on."""
+
+        position = 0
+        while not self.delivered:
+            if position < len(self._lines):
+                chunk = b"".join(self._lines[position:])
+                position = len(self._lines)
+                yield chunk
+                continue
+            if self.finished:
+                self.delivered = True
+                self._lines = []
+                return
+            async with self._changed:
+                if position >= len(self._lines) and not self.finished:
+                    await self._changed.wait()
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "errors": self.errors,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "delivered": self.delivered,
+        }
+
+
+class JobRegistry:
+    """Keeps running jobs plus the most recent ``keep_finished`` finished ones."""
+
+    def __init__(self, keep_finished: int = 50) -> None:
+        self.keep_finished = keep_finished
+        self._jobs: "OrderedDict[str, BatchJob]" = OrderedDict()
+
+    def submit(self, items: Sequence[Any], handler: Handler, concurrency: int) -> BatchJob:
+        job = BatchJob(items, handler, concurrency)
+        self._jobs[job.id] = job
+        job.start()
+        self._evict()
+        return job
+
+    @property
+    def backlog(self) -> int:
+        """Items of running jobs that have not been handled yet."""
+
+        return sum(job.total - job.done - job.failed for job in self._jobs.values() if not job.finished)
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        return self._jobs.get(job_id)
+
+    def _evict(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job_id]
+
+    def cancel_all(self) -> None:
+        for job in self._jobs.values():
+            job.cancel()
@@ -0,0 +1,93 @@
+"""WireGuard/AmneziaWG key material.
+
+Generating an X25519 keypair is cheap on its own but adds up during a burst of
+thousands of provisions, so a background thread keeps a pool of pre-generated
+pairs topped up and ``/provision`` only pops one.
+"""
+
+from __future__ import annotations
+
+import base64
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Optional
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+logger = logging.getLogger(__name__)
+
+_RAW = serialization.Encoding.Raw
+
+
+@dataclass(frozen=True)
+class KeyPair:
+    private_key: str
+    public_key: str
+
+
+def generate_keypair() -> KeyPair:
+    private = X25519PrivateKey.generate()
+    private_raw = private.private_bytes(_RAW, serialization.PrivateFormat.Raw, serialization.NoEncryption())
+    public_raw = private.public_key().public_bytes(_RAW, serialization.PublicFormat.Raw)
+    return KeyPair(
+        private_key=base64.b64encode(private_raw).decode(),
+        public_key=base64.b64encode(public_raw).decode(),
+    )
+
+
+class KeyPool:
+    def __init__(self, size: int = 2000, low_water: Optional[int] = None) -> None:
+        self.size = size
+        self.low_water = low_water if low_water is not None else size // 4
+        self._pairs: Deque[KeyPair] = deque()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._pairs)
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="keypool", daemon=True)
+            self._thread.start()
+            self._wakeup.set()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def fill(self, count: Optional[int] = None) -> None:
+        """Synchronously top the pool up (to ``size`` by default)."""
+
+        target = self.size if count is None else min(self.size, len(self._pairs) + count)
+        while len(self._pairs) < target and not self._stop.is_set():
+            self._pairs.append(generate_keypair())
+
+    def take(self) -> KeyPair:
+        try:
+            pair = self._pairs.popleft()
+        except IndexError:
+            # Pool drained by a burst: pay the generation cost inline.
+            self.misses += 1
+            pair = generate_keypair()
+        if len(self._pairs) < self.low_water:
+            self._wakeup.set()
+        return pair
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self.fill()
+            except Exception:
+                logger.exception("Key pool refill failed")
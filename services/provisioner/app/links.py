@@ -0,0 +1,42 @@
+"""Signed, expiring download links for device configs.
+
+A config holds the device's WireGuard private key, so ``/configs/{user}/{device}``
+only serves requests carrying ``expires`` and ``sig`` query parameters: a
+truncated HMAC-SHA256 of the user, the device and the expiry time. Links are
+minted by the provisioner itself (``config_url`` in its responses) and need
+no server-side state; they stop working after ``ttl`` or when the secret
+changes.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import time
+from typing import Callable, Dict, Optional
+
+_SIG_BYTES = 16
+
+
+class ConfigLinks:
+    def __init__(self, secret: str, ttl: float, clock: Callable[[], float] = time.time) -> None:
+        self._secret = secret.encode()
+        self.ttl = ttl
+        self._clock = clock
+
+    def _sign(self, user_id: int, device_name: str, expires: int) -> str:
+        message = f"{user_id}\n{device_name}\n{expires}".encode()
+        digest = hmac.new(self._secret, message, hashlib.sha256).digest()[:_SIG_BYTES]
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+    def params(self, user_id: int, device_name: str) -> Dict[str, str]:
+        """Query parameters that authorize a download until ``ttl`` from now."""
+
+        expires = int(self._clock() + self.ttl)
+        return {"expires": str(expires), "sig": self._sign(user_id, device_name, expires)}
+
+    def verify(self, user_id: int, device_name: str, expires: Optional[int], sig: Optional[str]) -> bool:
+        if expires is None or sig is None or expires < self._clock():
+            return False
+        return hmac.compare_digest(sig, self._sign(user_id, device_name, expires))
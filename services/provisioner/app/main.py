@@ -1,33 +1,702 @@
-from datetime import datetime, timedelta
-from fastapi import FastAPI
+import asyncio
+import hmac
+import logging
+import re
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+from urllib.parse import quote, urlencode
+from fastapi import Depends, FastAPI, Header, HTTPException, Response
+from fastapi.responses import RedirectResponse, StreamingResponse
+from vpn_common.events import (
+    EXTENDED,
+    NODE_CHANGED,
+    PAID,
+    REVOKED,
+    TRIAL,
+    Event,
+    EventConsumer,
+    Watermarks,
+    build_event_stream,
+    latest_per_user,
+)
+from vpn_common.metrics import observe_queue
+from vpn_common.metrics.asgi import MetricsMiddleware, metrics_response
+from . import amnezia, wireguard
 from .config import get_settings
-from .schemas import ProvisionRequest, ProvisionResponse
+from .configs import ConfigInputs, ConfigStore, ConfigVersion
+from .devices import DeviceRegistry
+from .ipam import AddressBook, PoolExhausted
+from .jobs import JobRegistry
+from .keys import KeyPool
+from .links import ConfigLinks
+from .nodes import NodeRegistry, NoEligibleNode, build_probe, parse_endpoints
+from .qr import FORMATS, QRCache
+from .schemas import (
+    BatchProvisionRequest,
+    BatchShapingRequest,
+    DeviceConfig,
+    DeviceSlots,
+    JobStatus,
+    NodeStatus,
+    Placement,
+    PlacementRequest,
+    ProvisionRequest,
+    ProvisionResponse,
+    RevokeRequest,
+    ShapingPolicy,
+    ShapingState,
+)
+from .shaping import POLICIES_KEY as SHAPING_POLICIES, Policy, ShapingController, build_shaping_backend
+from .storage import build_object_store
+from .tariffs import CATALOG_KEY, CatalogUnavailable, TariffCatalog, TariffLimits, UnknownTariff
+from .traffic import SNAPSHOT_KEY as TRAFFIC_SNAPSHOT, TrafficCollector, TrafficStore, build_sources
+
+logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Provisioner Service", version="0.1.0")
 settings = get_settings()
+addresses = AddressBook.from_spec(settings.node_subnets)
+keypool = KeyPool(size=settings.keypool_size)
+object_store = build_object_store(settings)
+qr_cache = QRCache(object_store, workers=settings.qr_workers)
+configs = ConfigStore(
+    object_store,
+    cache_bytes=settings.config_cache_mb * 1024 * 1024,
+    keep=settings.config_versions_kept,
+)
+links = ConfigLinks(settings.config_link_secret, settings.config_link_ttl_sec)
+jobs = JobRegistry()
+traffic = TrafficStore(
+    minute_slots=settings.traffic_minute_slots,
+    hour_slots=settings.traffic_hour_slots,
+    day_slots=settings.traffic_day_slots,
+)
+devices = DeviceRegistry()
+tariffs = TariffCatalog(
+    settings.billing_url,
+    persist=lambda raw: object_store.put(CATALOG_KEY, raw, content_type="application/json"),
+    refresh_interval=settings.tariffs_refresh_sec,
+)
+collector = TrafficCollector(
+    traffic,
+    build_sources(settings),
+    interval=settings.traffic_interval_sec,
+    on_active=devices.touch_many,
+)
+shaping = ShapingController(
+    build_shaping_backend(settings),
+    {node_id: str(pool.network) for node_id, pool in addresses.pools.items()},
+    link_mbps=settings.shaping_link_mbps,
+    grace_speed_mbps=settings.grace_speed_mbps,
+    nodes={n.strip() for n in settings.shaping_nodes.split(",") if n.strip()},
+    persist=lambda raw: object_store.put(SHAPING_POLICIES, raw, content_type="application/json"),
+    persist_interval=settings.shaping_persist_sec,
+)
+nodes = NodeRegistry(
+    {node_id: pool.capacity for node_id, pool in addresses.pools.items()},
+    build_probe(settings),
+    endpoints=parse_endpoints(settings.node_endpoints),
+    peer_count=lambda node_id: addresses.pools[node_id].used,
+    interval=settings.node_probe_interval_sec,
+    timeout=settings.node_probe_timeout_sec,
+)
+events = build_event_stream(settings.events_backend, settings.redis_url)
+# seq of the last billing event applied per user; saved like the shaping policies.
+event_marks = Watermarks()
+EVENT_MARKS = "events/marks.json"
+_marks_saved_at = float("-inf")
+SHAPING_INTERFACES = dict(
+    item.strip().split("=", 1) for item in settings.shaping_interfaces.split(",") if "=" in item
+)
+
+QR_NAME = re.compile(r"^(?P<digest>[0-9a-f]{64})\.(?P<fmt>png|svg)$")
+ADDRESS_LINE = re.compile(r"^Address\s*=\s*([0-9.]+)", re.MULTILINE)
+QR_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def _stored_address(manifest: ConfigVersion) -> Optional[str]:
+    if manifest.address is not None:
+        return manifest.address
+    # Manifests written before the address was recorded: read it off the config.
+    body = configs.read(manifest.key)
+    match = ADDRESS_LINE.search(body.decode()) if body is not None else None
+    return match.group(1) if match else None
+
+
+def _restore_state() -> None:
+    """Rebuild the in-memory device state from the config manifests and the traffic snapshot."""
+
+    snapshot = object_store.get(TRAFFIC_SNAPSHOT)
+    if snapshot is not None:
+        try:
+            logger.info("Restored traffic history of %d peers", traffic.restore(snapshot))
+        except ValueError as exc:
+            logger.warning("Discarding traffic snapshot: %s", exc)
+    catalog = object_store.get(CATALOG_KEY)
+    if catalog is not None:
+        logger.info("Restored %d tariffs", tariffs.load(catalog))
+    policies = object_store.get(SHAPING_POLICIES)
+    if policies is not None:
+        logger.info("Restored shaping policies of %d users", shaping.restore_policies(policies))
+    marks = object_store.get(EVENT_MARKS)
+    if marks is not None:
+        logger.info("Restored event marks of %d users", event_marks.restore(marks))
+    stale = set(traffic.devices())
+    leases, slots, shaped = [], [], []
+    for manifest in configs.manifests():
+        address = _stored_address(manifest)
+        if address is not None:
+            leases.append((manifest.user_id, manifest.device_name, manifest.node_id, address))
+            if manifest.protocol in SHAPING_INTERFACES:
+                shaped.append((manifest.user_id, manifest.device_name, SHAPING_INTERFACES[manifest.protocol]))
+        # created_at is naive UTC; a lower bound for "last seen" until traffic is sampled.
+        created = manifest.created_at.replace(tzinfo=timezone.utc).timestamp()
+        slots.append((manifest.user_id, manifest.device_name, created))
+        if manifest.public_key is not None:
+            traffic.register(manifest.public_key, manifest.user_id, manifest.device_name, manifest.node_id)
+            stale.discard((manifest.user_id, manifest.device_name))
+    for user_id, device_name in stale:  # released after the snapshot was taken
+        traffic.unregister(user_id, device_name)
+    logger.info("Restored %d address leases", addresses.restore(leases))
+    for user_id, device_name, interface in shaped:
+        lease = addresses.lease_of(user_id, device_name)
+        if lease is not None:  # skipped leases get shaped on their next provision
+            shaping.attach(user_id, device_name, lease[0], interface, lease[1])
+    logger.info("Restored %d device slots", devices.restore(slots))
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    keypool.start()
+    collector.start()
+    shaping.start(settings.shaping_interval_sec)
+    nodes.start()
+    try:
+        await asyncio.to_thread(object_store.ensure_ready)
+    except Exception:
+        logger.exception("Object storage is not reachable; QR downloads will fail")
+    # Not optional: without the stored leases new devices would get taken addresses.
+    await asyncio.to_thread(_restore_state)
+    tariffs.start()
+    if subscription_events is not None:
+        subscription_events.start()
+    try:
+        yield
+    finally:
+        if subscription_events is not None:
+            subscription_events.stop()
+            await asyncio.to_thread(_save_event_marks, True)
+        jobs.cancel_all()
+        await nodes.stop()
+        collector.stop()
+        try:
+            await asyncio.to_thread(object_store.put, TRAFFIC_SNAPSHOT, traffic.snapshot())
+        except Exception:
+            logger.exception("Could not save the traffic snapshot")
+        shaping.stop()
+        tariffs.stop()
+        keypool.stop()
+        qr_cache.shutdown()
+
+
+app = FastAPI(title="Provisioner Service", version="0.1.0", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+observe_queue("qr_render", lambda: qr_cache.pending)
+observe_queue("provision_jobs", lambda: jobs.backlog)
+observe_queue("shaping_dirty", lambda: shaping.pending)
+observe_queue("unhealthy_nodes", lambda: len(nodes) - nodes.healthy)
+
+OPENVPN_CONFIG = "client\nproto udp\nremote vpn.example.com 1194"
+
+
+def require_service(authorization: Optional[str] = Header(default=None)) -> None:
+    """``Authorization: Bearer $PROVISIONER_TOKEN``, held by billing and the bot; off while no token is set.
 
-SAMPLE_CONFIGS = {
-    "amneziawg": "[Interface]\nPrivateKey=CHANGEME...",
-    "wireguard": "[Interface]\nPrivateKey=CHANGEME...",
-    "openvpn": "client\nproto udp\nremote vpn.example.com 1194",
-}
+    Guards every call that mints, returns or removes configs, or changes a
+    user's limits. Users download configs through the signed ``config_url``.
+    """
 
-QR_BASE = "https://api.qrserver.com/v1/create-qr-code/?size=200x200&data="
+    if not settings.provisioner_token:
+        raise HTTPException(status_code=403, detail="Service API is disabled")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), settings.provisioner_token.encode()):
+        raise HTTPException(status_code=401, detail="Service token required", headers={"WWW-Authenticate": "Bearer"})
 
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "bucket": settings.minio_bucket}
+    return {"status": "ok", "bucket": settings.minio_bucket, "keypool": len(keypool)}
 
 
-@app.post("/provision", response_model=ProvisionResponse)
-def provision(req: ProvisionRequest):
-    config = SAMPLE_CONFIGS.get(req.protocol, "")
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return metrics_response()
+
+
+class ProvisionFailed(Exception):
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _build_config(req: ProvisionRequest, address) -> Tuple[str, Optional[str]]:
+    """Fresh config text and the device's public key (None for OpenVPN)."""
+
+    public_key = None
+    if req.protocol == "openvpn":
+        config = OPENVPN_CONFIG
+    else:
+        keys = keypool.take()
+        public_key = keys.public_key
+        builder = amnezia.build_profile if req.protocol == "amneziawg" else wireguard.build_profile
+        config = builder(
+            settings.public_host,
+            settings.wireguard_port,
+            req.device_name,
+            address=f"{address}/32",
+            private_key=keys.private_key,
+        )
+    return config + f"\n# device={req.device_name}", public_key
+
+
+def _config_url(user_id: int, device_name: str) -> str:
+    path = f"/configs/{user_id}/{quote(device_name, safe='')}"
+    return f"{settings.service_base_url.rstrip('/')}{path}?{urlencode(links.params(user_id, device_name))}"
+
+
+def _qr_url(digest: str) -> str:
+    return f"{settings.service_base_url.rstrip('/')}/qr/{digest}.png"
+
+
+def _tariff(code: str) -> TariffLimits:
+    try:
+        return tariffs.get(code)
+    except UnknownTariff as exc:
+        raise ProvisionFailed(422, str(exc))
+    except CatalogUnavailable as exc:
+        raise ProvisionFailed(503, str(exc))
+
+
+def _provision(req: ProvisionRequest) -> ProvisionResponse:
+    """Provision under the user's device lock, then take its slot and evict over the limit."""
+
+    tariff = _tariff(req.tariff_code)
+    with devices.hold(req.user_id):
+        response = _provision_device(req, tariff)
+        # Only after success, so a failed provision never costs a device.
+        evicted = devices.reserve(req.user_id, req.device_name, tariff.devices)
+        for device_name in evicted:
+            _deprovision(req.user_id, device_name)
+    response.evicted = evicted
+    return response
+
+
+def _provision_device(req: ProvisionRequest, tariff: TariffLimits) -> ProvisionResponse:
+    if req.node_id is None:
+        # Re-provisioning keeps the device where it is; new ones get placed.
+        node_id = addresses.node_of(req.user_id, req.device_name)
+        if node_id is None:
+            try:
+                node_id = nodes.place()
+            except NoEligibleNode:
+                raise ProvisionFailed(503, "No healthy node with free capacity")
+        req = req.model_copy(update={"node_id": node_id})
+    try:
+        address = addresses.lease(req.user_id, req.device_name, req.node_id)
+    except KeyError:
+        raise ProvisionFailed(404, "Unknown node")
+    except PoolExhausted:
+        raise ProvisionFailed(503, "Node address pool exhausted")
+
+    inputs = ConfigInputs(req.protocol, req.node_id, str(address), f"{settings.public_host}:{settings.wireguard_port}")
+    with configs.lock(req.user_id, req.device_name):
+        stored = configs.current(req.user_id, req.device_name)
+        body = None
+        if stored is not None and stored.fingerprint == inputs.fingerprint:
+            body = configs.read(stored.key)
+        moved_from = None
+        if body is None:
+            config, public_key = _build_config(req, address)
+            if stored is not None and stored.node_id != req.node_id:
+                moved_from = stored.node_id
+            stored = configs.save(req.user_id, req.device_name, inputs, config.encode(), public_key, previous=stored)
+        else:
+            config, public_key = body.decode(), stored.public_key
+    if moved_from is not None:
+        _publish_node_changed(req, moved_from, stored.version)
+    if public_key is not None:
+        traffic.register(public_key, req.user_id, req.device_name, req.node_id)
+    policy = shaping.policy(req.user_id)
+    if policy is None:
+        # Billing pushes the full state via events or PUT /shaping; until then use the tariff's speed.
+        policy = Policy(tariff.speed_limit_mbps, grace_speed_mbps=settings.grace_speed_mbps)
+        shaping.set_policy(req.user_id, policy)
+    interface = SHAPING_INTERFACES.get(req.protocol)
+    if interface:
+        shaping.attach(req.user_id, req.device_name, req.node_id, interface, address)
+    digest = qr_cache.ensure(config)
     expires = datetime.utcnow() + timedelta(hours=1)
     return ProvisionResponse(
         protocol=req.protocol,
-        config=config + f"\n# device={req.device_name}",
-        qr_url=f"{QR_BASE}{req.device_name}-{req.protocol}",
+        config=config,
+        qr_url=_qr_url(digest),
         expires_at=expires,
-        speed_limit_mbps=100 if req.tariff_code == "light" else None,
+        speed_limit_mbps=policy.rate_at(datetime.utcnow()),
+        node_id=req.node_id,
+        address=str(address),
+        public_key=public_key,
+        config_version=stored.version,
+        config_url=_config_url(req.user_id, req.device_name),
+    )
+
+
+def _publish_node_changed(req: ProvisionRequest, previous_node_id: str, version: int) -> None:
+    """Tell the bot a device moved, so the user fetches the new config. Best effort."""
+
+    if events is None:
+        return
+    event = Event(
+        id=uuid.uuid4().hex,
+        type=NODE_CHANGED,
+        user_id=req.user_id,
+        payload={
+            "device_name": req.device_name,
+            "protocol": req.protocol,
+            "node_id": req.node_id,
+            "previous_node_id": previous_node_id,
+            "config_version": version,
+        },
+    )
+    try:
+        events.publish([event])
+    except Exception:
+        logger.exception("Could not publish node change for %s/%s", req.user_id, req.device_name)
+
+
+@app.post("/provision", response_model=ProvisionResponse, dependencies=[Depends(require_service)])
+def provision(req: ProvisionRequest):
+    """Mint or re-read a device config. The body includes the private key, hence the token."""
+
+    try:
+        return _provision(req)
+    except ProvisionFailed as exc:
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail)
+
+
+@app.get("/nodes", response_model=list[NodeStatus])
+def list_nodes():
+    return nodes.snapshot()
+
+
+@app.post("/nodes/place", response_model=Placement)
+def place_node(body: PlacementRequest):
+    """Pick a node for a new device or a node switch, e.g. excluding the current one."""
+
+    try:
+        return Placement(node_id=nodes.place(exclude=body.exclude))
+    except NoEligibleNode as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+
+
+async def _provision_item(req: ProvisionRequest) -> dict:
+    response = await asyncio.to_thread(_provision, req)
+    # No private keys in job results: clients fetch the config via config_url.
+    return response.model_dump(mode="json", exclude={"config"})
+
+
+def _submit_batch(batch: BatchProvisionRequest):
+    return jobs.submit(batch.items, _provision_item, batch.concurrency)
+
+
+@app.post("/provision/batch", dependencies=[Depends(require_service)])
+async def provision_batch(batch: BatchProvisionRequest):
+    """Provision many devices, streaming one NDJSON line per item as it completes."""
+
+    job = _submit_batch(batch)
+    return StreamingResponse(
+        job.stream(),
+        media_type="application/x-ndjson",
+        headers={"X-Job-Id": job.id},
+    )
+
+
+@app.post("/jobs/provision", response_model=JobStatus, status_code=202, dependencies=[Depends(require_service)])
+async def submit_provision_job(batch: BatchProvisionRequest):
+    job = _submit_batch(batch)
+    results_url = f"{settings.service_base_url.rstrip('/')}/jobs/{job.id}/results?token={job.token}"
+    return dict(job.summary(), results_url=results_url)
+
+
+def _get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+
+@app.get("/jobs/{job_id}", response_model=JobStatus)
+async def job_status(job_id: str):
+    return _get_job(job_id).summary()
+
+
+@app.get("/jobs/{job_id}/results")
+async def job_results(job_id: str, token: Optional[str] = None):
+    """Stream the job's results once, to the holder of its token."""
+
+    job = _get_job(job_id)
+    if token is None or not hmac.compare_digest(token, job.token):
+        raise HTTPException(status_code=403, detail="Invalid job token")
+    if job.delivered:
+        raise HTTPException(status_code=410, detail="Job results already delivered")
+    return StreamingResponse(job.stream(), media_type="application/x-ndjson")
+
+
+@app.delete("/jobs/{job_id}", response_model=JobStatus)
+async def cancel_job(job_id: str):
+    job = _get_job(job_id)
+    job.cancel()
+    return job.summary()
+
+
+def _deprovision(user_id: int, device_name: str):
+    with devices.hold(user_id):
+        devices.release(user_id, device_name)
+        address = addresses.release(user_id, device_name)
+        if address is not None:
+            traffic.unregister(user_id, device_name)
+            shaping.detach(user_id, device_name)
+            configs.drop(user_id, device_name)
+    return address
+
+
+@app.delete("/provision/{user_id}/{device_name}", dependencies=[Depends(require_service)])
+def deprovision(user_id: int, device_name: str):
+    address = _deprovision(user_id, device_name)
+    if address is None:
+        raise HTTPException(status_code=404, detail="Unknown device")
+    return {"status": "released", "address": str(address)}
+
+
+def _revoke_users(user_ids: List[int]) -> int:
+    released = 0
+    for user_id in user_ids:
+        with devices.hold(user_id):
+            for device_name in addresses.devices(user_id):
+                if _deprovision(user_id, device_name) is not None:
+                    released += 1
+    return released
+
+
+@app.post("/revoke", dependencies=[Depends(require_service)])
+def revoke(body: RevokeRequest):
+    """Release every device of the given users (expired subscriptions)."""
+
+    released = _revoke_users(body.user_ids)
+    return {"status": "revoked", "users": len(body.user_ids), "devices": released}
+
+
+def _shaping_state(user_id: int) -> ShapingState:
+    policy = shaping.policy(user_id)
+    if policy is None:
+        raise HTTPException(status_code=404, detail="No shaping policy for user")
+    return ShapingState(
+        user_id=user_id,
+        speed_limit_mbps=policy.speed_limit_mbps,
+        active_until=policy.active_until,
+        grace_until=policy.grace_until,
+        grace_speed_mbps=policy.grace_speed_mbps,
+        current_limit_mbps=policy.rate_at(datetime.utcnow()),
+        devices=shaping.applied_rates(user_id),
+    )
+
+
+def _policy_from(body: ShapingPolicy) -> Policy:
+    return Policy(
+        speed_limit_mbps=body.speed_limit_mbps,
+        active_until=body.active_until,
+        grace_until=body.grace_until,
+        grace_speed_mbps=body.grace_speed_mbps or settings.grace_speed_mbps,
+    )
+
+
+# The device the bot hands out first; billing events mint it ahead of the download.
+DEFAULT_DEVICE = "main"
+DEFAULT_PROTOCOL = "amneziawg"
+
+
+def _on_events(batch: List[Event]) -> None:
+    """Billing lifecycle events, newest per user: shaping, first config, revocation.
+
+    Replays are harmless: policies are overwritten, a user who already has a
+    device is not provisioned again and revoking twice releases nothing.
+    Events older than the last one applied for the user are skipped, so a
+    late PAID cannot bring back a revoked user.
+    """
+
+    latest = event_marks.fresh(latest_per_user(batch))
+    revoked = []
+    for event in latest:
+        if event.type == REVOKED:
+            revoked.append(event.user_id)
+            continue
+        shaping.set_policy(event.user_id, _policy_from(ShapingPolicy.model_validate(event.payload)))
+        if event.type in (PAID, EXTENDED, TRIAL) and not addresses.devices(event.user_id):
+            req = ProvisionRequest(
+                user_id=event.user_id,
+                protocol=DEFAULT_PROTOCOL,
+                device_name=DEFAULT_DEVICE,
+                tariff_code=event.payload["tariff_code"],
+            )
+            try:
+                _provision(req)
+            except ProvisionFailed as exc:
+                # The bot provisions on download; no point holding the batch.
+                logger.warning("Could not mint a config for %s: %s", event.user_id, exc.detail)
+    if revoked:
+        _revoke_users(revoked)
+    event_marks.advance(latest)
+    _save_event_marks()
+
+
+def _save_event_marks(force: bool = False) -> None:
+    global _marks_saved_at
+
+    if not force and time.monotonic() - _marks_saved_at < settings.shaping_persist_sec:
+        return
+    _marks_saved_at = time.monotonic()
+    try:
+        object_store.put(EVENT_MARKS, event_marks.snapshot(), content_type="application/json")
+    except Exception:
+        logger.exception("Could not save the event marks")
+
+
+subscription_events = (
+    EventConsumer(events, "provisioner", _on_events, batch_size=settings.events_batch_size)
+    if events is not None
+    else None
+)
+if subscription_events is not None:
+    observe_queue("events_provisioner_pending", subscription_events.pending)
+
+
+@app.put("/shaping/{user_id}", response_model=ShapingState, dependencies=[Depends(require_service)])
+def set_shaping_policy(user_id: int, body: ShapingPolicy):
+    """Subscription state from billing; tc changes follow on the next reconcile."""
+
+    shaping.set_policy(user_id, _policy_from(body))
+    return _shaping_state(user_id)
+
+
+@app.post("/shaping/batch", dependencies=[Depends(require_service)])
+def set_shaping_policies(body: BatchShapingRequest):
+    for item in body.items:
+        shaping.set_policy(item.user_id, _policy_from(item))
+    return {"status": "ok", "users": len(body.items)}
+
+
+@app.get("/shaping/{user_id}", response_model=ShapingState)
+def get_shaping_state(user_id: int):
+    return _shaping_state(user_id)
+
+
+@app.get("/qr/{name}")
+async def qr_image(name: str, if_none_match: Optional[str] = Header(default=None)):
+    match = QR_NAME.match(name)
+    if not match:
+        raise HTTPException(status_code=404, detail="Unknown QR code")
+    digest, fmt = match["digest"], match["fmt"]
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": QR_CACHE_CONTROL}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    data = await qr_cache.fetch(digest, fmt)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Unknown QR code")
+    return Response(content=data, media_type=FORMATS[fmt], headers=headers)
+
+
+@app.get("/devices/{user_id}", response_model=DeviceSlots)
+def list_devices(user_id: int, tariff_code: Optional[str] = None):
+    """The user's devices, most recently seen first; ``limit`` needs the tariff."""
+
+    try:
+        limit = _tariff(tariff_code).devices if tariff_code else None
+    except ProvisionFailed as exc:
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail)
+    return DeviceSlots(
+        user_id=user_id,
+        limit=limit,
+        devices=[
+            {"device_name": name, "last_seen": datetime.utcfromtimestamp(seen)}
+            for name, seen in devices.devices(user_id)
+        ],
+    )
+
+
+def _device_config(manifest: ConfigVersion) -> DeviceConfig:
+    return DeviceConfig(
+        device_name=manifest.device_name,
+        version=manifest.version,
+        protocol=manifest.protocol,
+        node_id=manifest.node_id,
+        size=manifest.size,
+        created_at=manifest.created_at,
+        config_url=_config_url(manifest.user_id, manifest.device_name),
+        qr_url=_qr_url(manifest.sha256),
     )
+
+
+@app.get("/configs/{user_id}", response_model=list[DeviceConfig])
+def list_configs(user_id: int):
+    found = (configs.current(user_id, device_name) for device_name in addresses.devices(user_id))
+    return [_device_config(manifest) for manifest in found if manifest is not None]
+
+
+@app.get("/configs/{user_id}/{device_name}")
+async def download_config(
+    user_id: int,
+    device_name: str,
+    version: Optional[int] = None,
+    expires: Optional[int] = None,
+    sig: Optional[str] = None,
+    if_none_match: Optional[str] = Header(default=None),
+):
+    """Current (or a retained older) config: redirect to the bucket or stream it.
+
+    Only through a signed link from ``config_url``: the body has the private key.
+    """
+
+    if not links.verify(user_id, device_name, expires, sig):
+        raise HTTPException(status_code=403, detail="Invalid or expired config link")
+    manifest = await asyncio.to_thread(configs.current, user_id, device_name)
+    devices.touch(user_id, device_name)
+    key = manifest.key_for(version or manifest.version) if manifest is not None else None
+    if key is None:
+        raise HTTPException(status_code=404, detail="Unknown config")
+    # Versions are immutable, so the version number is a strong validator.
+    etag = f'"v{version or manifest.version}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+        # ASCII fallback plus RFC 5987 form for Cyrillic device names.
+        "Content-Disposition": f"attachment; filename=\"config.conf\"; filename*=UTF-8''{quote(device_name, safe='')}.conf",
+    }
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    if settings.config_downloads == "presigned":
+        url = await asyncio.to_thread(
+            object_store.presign, key, timedelta(seconds=settings.config_url_ttl_sec)
+        )
+        if url is not None:
+            return RedirectResponse(url, status_code=307, headers={"Cache-Control": "no-store"})
+    body = configs.cached(key)
+    if body is not None:
+        return Response(content=body, media_type="text/plain; charset=utf-8", headers=headers)
+    chunks = await asyncio.to_thread(object_store.stream, key)
+    if chunks is None:
+        raise HTTPException(status_code=404, detail="Unknown config")
+    # Starlette pulls a sync iterator on its thread pool, chunk by chunk.
+    return StreamingResponse(chunks, media_type="text/plain; charset=utf-8", headers=headers)
@@ -0,0 +1,290 @@
+"""Node registry: health and load probes plus least-loaded placement.
+
+Every node is probed concurrently on an asyncio loop (a TCP connect in
+production, a simulated delay locally). The registry keeps an EWMA of the
+probe latency and of the node's peer count. A node is marked down after
+``unhealthy_after`` failed probes in a row and up again on the next success.
+
+A node's placement score is its utilization (peers over address capacity)
+scaled by ``1 + latency / latency_budget``: nodes fill in proportion to
+their capacity, and a slower node takes a proportionally smaller share
+rather than none at all. The peer EWMA follows
+increases immediately and only smooths decreases. Healthy nodes with room
+sit in a min-heap keyed by that score. Entries carry a version, and a state
+change pushes a fresh entry instead of searching the heap, so both a probe
+update and ``place`` are O(log n). Each placement also bumps the node's
+pending count until the next probe reports the real figure, so a burst of
+new users spreads across nodes instead of landing on the one that looked
+emptiest at the last probe.
+"""
+
+from __future__ import annotations
+
+import abc
+import asyncio
+import heapq
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+
+class NoEligibleNode(RuntimeError):
+    pass
+
+
+@dataclass
+class ProbeResult:
+    latency: float  # seconds
+    peers: Optional[int] = None  # None: the probe cannot see peers
+
+
+@dataclass
+class NodeState:
+    node_id: str
+    capacity: int
+    endpoint: Optional[str] = None
+    latency: Optional[float] = None  # EWMA, seconds
+    peers: float = 0.0  # EWMA
+    pending: int = 0  # placements since the last probe
+    healthy: bool = True  # optimistic until the first probe says otherwise
+    failures: int = 0
+    last_probe: Optional[datetime] = None
+    version: int = field(default=0, repr=False)
+
+    @property
+    def load(self) -> float:
+        return (self.peers + self.pending) / self.capacity
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "node_id": self.node_id,
+            "healthy": self.healthy,
+            "capacity": self.capacity,
+            "peers": round(self.peers + self.pending),
+            "load": round(self.load, 4),
+            "latency_ms": None if self.latency is None else round(self.latency * 1000, 2),
+            "last_probe": self.last_probe,
+        }
+
+
+class NodeProbe(abc.ABC):
+    @abc.abstractmethod
+    async def probe(self, node: NodeState) -> ProbeResult:
+        """Measure ``node``; raise on failure."""
+
+
+class TcpProbe(NodeProbe):
+    """Times a TCP handshake with the node's ``host:port`` endpoint."""
+
+    async def probe(self, node: NodeState) -> ProbeResult:
+        if not node.endpoint:
+            raise ValueError(f"no endpoint configured for {node.node_id}")
+        host, _, port = node.endpoint.rpartition(":")
+        started = time.perf_counter()
+        _, writer = await asyncio.open_connection(host, int(port))
+        latency = time.perf_counter() - started
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return ProbeResult(latency)
+
+
+class StubProbe(NodeProbe):
+    """Simulated round trips for local runs, benchmarks and tests."""
+
+    def __init__(
+        self,
+        latencies: Optional[Dict[str, float]] = None,
+        default: float = 0.02,
+        jitter: float = 0.2,
+        failure_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.latencies = latencies or {}
+        self.default = default
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+
+    async def probe(self, node: NodeState) -> ProbeResult:
+        base = self.latencies.get(node.node_id, self.default)
+        latency = base * (1 + self.jitter * (self._random.random() * 2 - 1))
+        await asyncio.sleep(latency)
+        if self._random.random() < self.failure_rate:
+            raise ConnectionError(f"{node.node_id} did not answer")
+        return ProbeResult(latency)
+
+
+def build_probe(settings: Settings) -> NodeProbe:
+    if settings.node_probe == "tcp":
+        return TcpProbe()
+    return StubProbe()
+
+
+def parse_endpoints(spec: str) -> Dict[str, str]:
+    """Parse ``node=host:port,node=host:port`` as used in NODE_ENDPOINTS."""
+
+    endpoints = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        node_id, _, endpoint = item.partition("=")
+        endpoints[node_id.strip()] = endpoint.strip()
+    return endpoints
+
+
+class NodeRegistry:
+    def __init__(
+        self,
+        capacities: Dict[str, int],
+        probe: NodeProbe,
+        endpoints: Optional[Dict[str, str]] = None,
+        peer_count: Optional[Callable[[str], int]] = None,
+        interval: float = 10.0,
+        timeout: float = 2.0,
+        alpha: float = 0.3,
+        latency_budget: float = 0.1,
+        unhealthy_after: int = 2,
+        concurrency: int = 64,
+        clock: Callable[[], datetime] = datetime.utcnow,
+    ) -> None:
+        endpoints = endpoints or {}
+        self.probe = probe
+        self.peer_count = peer_count
+        self.interval = interval
+        self.timeout = timeout
+        self.alpha = alpha
+        self.latency_budget = latency_budget
+        self.unhealthy_after = unhealthy_after
+        self.concurrency = concurrency
+        self._clock = clock
+        self._nodes = {
+            node_id: NodeState(node_id, max(1, capacity), endpoints.get(node_id))
+            for node_id, capacity in capacities.items()
+        }
+        self._heap: List[Tuple[float, int, str]] = []
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.last_round = 0.0
+        with self._lock:
+            for state in self._nodes.values():
+                self._push(state)
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def _score(self, state: NodeState) -> float:
+        return state.load * (1 + (state.latency or 0.0) / self.latency_budget)
+
+    def _push(self, state: NodeState) -> None:
+        # Any older heap entry for this node is now stale and skipped lazily.
+        state.version += 1
+        if state.healthy and state.load < 1:
+            heapq.heappush(self._heap, (self._score(state), state.version, state.node_id))
+        if len(self._heap) > 4 * len(self._nodes) + 16:
+            self._heap = [entry for entry in self._heap if entry[1] == self._nodes[entry[2]].version]
+            heapq.heapify(self._heap)
+
+    def place(self, exclude: Iterable[str] = ()) -> str:
+        """Pick the best healthy node outside ``exclude`` and count a placement on it."""
+
+        exclude = set(exclude)
+        skipped = []
+        with self._lock:
+            try:
+                while self._heap:
+                    _, version, node_id = self._heap[0]
+                    state = self._nodes[node_id]
+                    if version != state.version:
+                        heapq.heappop(self._heap)
+                    elif node_id in exclude:
+                        skipped.append(heapq.heappop(self._heap))
+                    else:
+                        state.pending += 1
+                        self._push(state)
+                        return node_id
+            finally:
+                for entry in skipped:
+                    heapq.heappush(self._heap, entry)
+        raise NoEligibleNode("no healthy node with free capacity")
+
+    def record(self, node_id: str, result: Optional[ProbeResult]) -> None:
+        """Fold one probe outcome into the node's state; None means it failed."""
+
+        with self._lock:
+            state = self._nodes[node_id]
+            state.last_probe = self._clock()
+            if result is None:
+                state.failures += 1
+                if state.failures >= self.unhealthy_after and state.healthy:
+                    logger.warning("Node %s marked unhealthy after %d failed probes", node_id, state.failures)
+                    state.healthy = False
+            else:
+                if not state.healthy:
+                    logger.info("Node %s is healthy again", node_id)
+                state.healthy, state.failures = True, 0
+                peers = result.peers
+                if peers is None and self.peer_count is not None:
+                    peers = self.peer_count(node_id)
+                if state.latency is None:
+                    state.latency = result.latency
+                else:
+                    state.latency += self.alpha * (result.latency - state.latency)
+                if peers is not None:
+                    # Growth is taken at once so a burst of placements is not
+                    # underestimated; departures decay with the EWMA.
+                    state.peers = max(peers, state.peers + self.alpha * (peers - state.peers))
+                    state.pending = 0
+            self._push(state)
+
+    async def _probe_one(self, state: NodeState, limit: asyncio.Semaphore) -> None:
+        async with limit:
+            try:
+                result = await asyncio.wait_for(self.probe.probe(state), self.timeout)
+            except Exception as exc:
+                logger.debug("Probe of %s failed: %s", state.node_id, exc)
+                result = None
+        self.record(state.node_id, result)
+
+    async def probe_all(self) -> None:
+        limit = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(self._probe_one(state, limit) for state in list(self._nodes.values())))
+        self.last_round = time.perf_counter() - started
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.probe_all()
+            except Exception:
+                logger.exception("Node probe round failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self) -> List[Dict[str, object]]:
+        with self._lock:
+            return [state.as_dict() for state in sorted(self._nodes.values(), key=lambda s: s.node_id)]
+
+    @property
+    def healthy(self) -> int:
+        return sum(1 for state in self._nodes.values() if state.healthy)
@@ -0,0 +1,104 @@
+"""Local QR rendering with a content-addressed cache in object storage.
+
+The QR payload is the full client config. It is hashed, and the PNG and SVG
+renderings are stored under ``qr/<sha256>.<fmt>``. ``/provision`` only
+computes the digest and queues the render on a thread pool, so it returns at
+once. The first download waits for that render; every later download is a
+plain object read served with immutable cache headers.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import io
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional
+
+import segno
+
+from .storage import ObjectStore
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def qr_digest(payload: str) -> str:
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def qr_key(digest: str, fmt: str) -> str:
+    return f"qr/{digest}.{fmt}"
+
+
+def render(payload: str) -> Dict[str, bytes]:
+    qr = segno.make(payload, error="m", micro=False)
+    rendered = {}
+    for fmt in FORMATS:
+        buf = io.BytesIO()
+        qr.save(buf, kind=fmt, scale=5, border=2)
+        rendered[fmt] = buf.getvalue()
+    return rendered
+
+
+class QRCache:
+    def __init__(self, store: ObjectStore, workers: int = 4, known_size: int = 50_000) -> None:
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qr")
+        self._pending: Dict[str, Future] = {}
+        # Digests known to be in the store; saves an existence probe per call.
+        self._known: "OrderedDict[str, None]" = OrderedDict()
+        self._known_size = known_size
+        self._lock = threading.Lock()
+        self.renders = 0
+
+    @property
+    def pending(self) -> int:
+        """Renders queued or in progress."""
+
+        return len(self._pending)
+
+    def _remember(self, digest: str) -> None:
+        with self._lock:
+            self._known[digest] = None
+            self._known.move_to_end(digest)
+            if len(self._known) > self._known_size:
+                self._known.popitem(last=False)
+
+    def ensure(self, payload: str) -> str:
+        """Schedule rendering of ``payload`` unless it is cached; returns its digest."""
+
+        digest = qr_digest(payload)
+        with self._lock:
+            if digest in self._known or digest in self._pending:
+                return digest
+            future = self._executor.submit(self._render_and_store, digest, payload)
+            self._pending[digest] = future
+        future.add_done_callback(lambda _: self._forget_pending(digest))
+        return digest
+
+    def _forget_pending(self, digest: str) -> None:
+        with self._lock:
+            self._pending.pop(digest, None)
+
+    def _render_and_store(self, digest: str, payload: str) -> None:
+        if not self.store.exists(qr_key(digest, "png")):
+            for fmt, data in render(payload).items():
+                self.store.put(qr_key(digest, fmt), data, content_type=FORMATS[fmt])
+            self.renders += 1
+        self._remember(digest)
+
+    async def fetch(self, digest: str, fmt: str) -> Optional[bytes]:
+        with self._lock:
+            future = self._pending.get(digest)
+        if future is not None:
+            await asyncio.wrap_future(future)
+        # Reads use the default executor so they never queue behind renders.
+        return await asyncio.get_running_loop().run_in_executor(None, self.store.get, qr_key(digest, fmt))
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
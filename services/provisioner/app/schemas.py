@@ -1,6 +1,6 @@
 from datetime import datetime
-from pydantic import BaseModel
-from typing import Literal
+from pydantic import BaseModel, Field
+from typing import Dict, List, Literal, Optional
 
 
 Protocol = Literal["amneziawg", "wireguard", "openvpn"]
@@ -11,6 +11,7 @@ class ProvisionRequest(BaseModel):
     protocol: Protocol
     device_name: str
     tariff_code: str
+    node_id: Optional[str] = Field(None, description="Omit to let the node registry place the device")
 
 
 class ProvisionResponse(BaseModel):
@@ -19,3 +20,119 @@ class ProvisionResponse(BaseModel):
     qr_url: str
     expires_at: datetime
     speed_limit_mbps: int | None = None
+    node_id: Optional[str] = None
+    address: Optional[str] = None
+    public_key: Optional[str] = None
+    config_version: Optional[int] = None
+    config_url: Optional[str] = None
+    evicted: List[str] = Field(default_factory=list, description="Devices removed to stay within the limit")
+
+
+class BatchProvisionRequest(BaseModel):
+    items: List[ProvisionRequest] = Field(..., min_length=1, max_length=50_000)
+    concurrency: int = Field(64, ge=1, le=512)
+
+
+class BatchItemError(BaseModel):
+    index: int
+    error: str
+
+
+class JobStatus(BaseModel):
+    job_id: str
+    status: str
+    total: int
+    done: int
+    failed: int
+    errors: List[BatchItemError] = []
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    delivered: bool = False
+    results_url: Optional[str] = Field(None, description="Only in the submit response; carries the read token")
+
+
+class DeviceTraffic(BaseModel):
+    device_name: str
+    node_id: str
+    rx_bytes: int
+    tx_bytes: int
+
+
+class TrafficPoint(BaseModel):
+    start: datetime
+    rx_bytes: int
+    tx_bytes: int
+
+
+class TrafficUsage(BaseModel):
+    user_id: int
+    resolution: Literal["minute", "hour", "day"]
+    rx_bytes: int
+    tx_bytes: int
+    devices: List[DeviceTraffic]
+    series: List[TrafficPoint]
+
+
+class ShapingPolicy(BaseModel):
+    speed_limit_mbps: Optional[int] = Field(None, ge=1)
+    active_until: Optional[datetime] = None
+    grace_until: Optional[datetime] = None
+    grace_speed_mbps: Optional[int] = Field(None, ge=1)
+
+
+class ShapingState(ShapingPolicy):
+    user_id: int
+    current_limit_mbps: Optional[int] = None
+    devices: Dict[str, int] = {}
+
+
+class UserShapingPolicy(ShapingPolicy):
+    user_id: int
+
+
+class BatchShapingRequest(BaseModel):
+    items: List[UserShapingPolicy] = Field(..., max_length=10_000)
+
+
+class DeviceConfig(BaseModel):
+    device_name: str
+    version: int
+    protocol: Protocol
+    node_id: str
+    size: int
+    created_at: datetime
+    config_url: str
+    qr_url: str
+
+
+class DeviceSeen(BaseModel):
+    device_name: str
+    last_seen: datetime
+
+
+class DeviceSlots(BaseModel):
+    user_id: int
+    limit: Optional[int] = None
+    devices: List[DeviceSeen]
+
+
+class NodeStatus(BaseModel):
+    node_id: str
+    healthy: bool
+    capacity: int
+    peers: int
+    load: float
+    latency_ms: Optional[float] = None
+    last_probe: Optional[datetime] = None
+
+
+class PlacementRequest(BaseModel):
+    exclude: List[str] = Field(default_factory=list, max_length=100)
+
+
+class Placement(BaseModel):
+    node_id: str
+
+
+class RevokeRequest(BaseModel):
+    user_ids: List[int] = Field(..., max_length=10_000)
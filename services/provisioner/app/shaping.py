@@ -0,0 +1,369 @@
+"""Per-peer download shaping with HTB classes, reconciled incrementally.
+
+Every shaped peer gets an HTB class and a flower filter matching its tunnel
+address on the protocol's interface. The class minor number and the filter
+handle are both the address's offset inside the node subnet, so no ids have
+to be allocated or persisted.
+
+The controller keeps the subscription state per user (tariff limit, paid
+and grace deadlines) and the last state it applied. Policy and device
+changes mark a user dirty, and so does the end of a paid period (active ->
+grace), which is queued on a heap. A reconcile pass only recomputes dirty users and
+emits the minimal ``tc`` lines for them: a class change for a new rate, a
+class+filter pair for a new peer, a filter+class delete for a removed one.
+The lines are sent as one batch per node. The root qdisc is only
+(re)created the first time an interface is touched after startup, which
+also clears whatever an earlier process left behind.
+
+Policies only change when billing pushes them, so they are persisted: the
+controller hands a JSON snapshot of all policies to ``persist`` at most every
+``persist_interval`` seconds after a change, and once more on ``stop()``.
+After a restart the snapshot is loaded with ``restore_policies`` and devices
+are re-attached from the stored configs.
+"""
+
+from __future__ import annotations
+
+import abc
+import heapq
+import ipaddress
+import json
+import logging
+import subprocess
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+# Traffic of unshaped peers (unlimited tariffs) falls into this class.
+DEFAULT_CLASS = 1
+FILTER_PRIO = 10
+
+ShapeKey = Tuple[str, str, int]  # node_id, interface, class minor
+
+POLICIES_KEY = "shaping/policies.json"
+
+
+@dataclass(frozen=True)
+class Policy:
+    speed_limit_mbps: Optional[int]
+    active_until: Optional[datetime] = None
+    grace_until: Optional[datetime] = None
+    grace_speed_mbps: int = 10
+
+    def __post_init__(self) -> None:
+        # Deadlines are compared with naive UTC ``utcnow()`` like elsewhere.
+        for name in ("active_until", "grace_until"):
+            value = getattr(self, name)
+            if value is not None and value.tzinfo is not None:
+                object.__setattr__(self, name, value.astimezone(timezone.utc).replace(tzinfo=None))
+
+    def rate_at(self, now: datetime) -> Optional[int]:
+        """Limit in Mbit/s that applies at ``now``; None means unshaped."""
+
+        if self.active_until is None or now <= self.active_until:
+            return self.speed_limit_mbps
+        # Past the grace period the sweeper removes the peer; until then keep
+        # it throttled rather than letting it fall back to full speed.
+        if self.speed_limit_mbps is None:
+            return self.grace_speed_mbps
+        return min(self.speed_limit_mbps, self.grace_speed_mbps)
+
+    def next_transition(self, now: datetime) -> Optional[datetime]:
+        # Only the end of the paid period changes the rate; expiry after the
+        # grace period is the sweeper's business.
+        if self.active_until is not None and self.active_until > now:
+            return self.active_until
+        return None
+
+    def to_json(self) -> list:
+        return [
+            self.speed_limit_mbps,
+            self.active_until.isoformat() if self.active_until else None,
+            self.grace_until.isoformat() if self.grace_until else None,
+            self.grace_speed_mbps,
+        ]
+
+    @classmethod
+    def from_json(cls, data: list) -> "Policy":
+        limit, active_until, grace_until, grace_speed = data
+        return cls(
+            limit,
+            datetime.fromisoformat(active_until) if active_until else None,
+            datetime.fromisoformat(grace_until) if grace_until else None,
+            grace_speed,
+        )
+
+
+@dataclass(frozen=True)
+class Attachment:
+    node_id: str
+    interface: str
+    address: ipaddress.IPv4Address
+    minor: int
+
+
+class ShapingBackend(abc.ABC):
+    @abc.abstractmethod
+    def apply(self, node_id: str, lines: List[str]) -> None:
+        """Execute ``tc -batch`` lines on ``node_id``."""
+
+
+class DryRunBackend(ShapingBackend):
+    """Records batches instead of running them (tests, hosts without tc)."""
+
+    def __init__(self, keep: int = 100) -> None:
+        self.batches: Deque[Tuple[str, List[str]]] = deque(maxlen=keep)
+
+    def apply(self, node_id: str, lines: List[str]) -> None:
+        self.batches.append((node_id, lines))
+        logger.debug("tc batch for %s:\n%s", node_id, "\n".join(lines))
+
+
+class TcBackend(ShapingBackend):
+    """Runs the batch with the local ``tc``; needs CAP_NET_ADMIN."""
+
+    def __init__(self, tc: str = "tc", timeout: float = 30.0) -> None:
+        self.tc = tc
+        self.timeout = timeout
+
+    def apply(self, node_id: str, lines: List[str]) -> None:
+        # -force keeps going past individual errors (e.g. deleting a class
+        # that is already gone) instead of aborting the rest of the batch.
+        result = subprocess.run(
+            [self.tc, "-force", "-batch", "-"],
+            input="\n".join(lines) + "\n",
+            capture_output=True,
+            text=True,
+            timeout=self.timeout,
+        )
+        if result.returncode != 0:
+            logger.warning("tc batch on %s reported errors: %s", node_id, result.stderr.strip())
+
+
+class ShapingController:
+    def __init__(
+        self,
+        backend: ShapingBackend,
+        subnets: Dict[str, str],
+        link_mbps: int = 1000,
+        grace_speed_mbps: int = 10,
+        nodes: Optional[Set[str]] = None,
+        clock: Callable[[], datetime] = datetime.utcnow,
+        persist: Optional[Callable[[bytes], None]] = None,
+        persist_interval: float = 60.0,
+    ) -> None:
+        self.backend = backend
+        self._networks = {node_id: ipaddress.ip_network(cidr) for node_id, cidr in subnets.items()}
+        self.link_mbps = link_mbps
+        self.grace_speed_mbps = grace_speed_mbps
+        self.nodes = nodes or None  # None: shape every node
+        self._clock = clock
+        self._policies: Dict[int, Policy] = {}
+        self._devices: Dict[int, Dict[str, Attachment]] = {}
+        self._applied: Dict[ShapeKey, int] = {}  # -> rate in Mbit/s
+        self._applied_by_user: Dict[int, Set[ShapeKey]] = {}
+        self._roots: Set[Tuple[str, str]] = set()
+        self._dirty: Set[int] = set()
+        self._deadlines: List[Tuple[datetime, int]] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.commands_issued = 0
+        self._persist = persist
+        self.persist_interval = persist_interval
+        self._policies_changed = False
+        self._persisted_at = float("-inf")
+
+    @property
+    def pending(self) -> int:
+        """Users whose tc state awaits the next reconcile."""
+
+        return len(self._dirty)
+
+    def set_policy(self, user_id: int, policy: Policy) -> None:
+        with self._lock:
+            if self._policies.get(user_id) == policy:
+                return
+            self._policies[user_id] = policy
+            self._policies_changed = True
+            self._dirty.add(user_id)
+            deadline = policy.next_transition(self._clock())
+            if deadline is not None:
+                heapq.heappush(self._deadlines, (deadline, user_id))
+
+    def policy(self, user_id: int) -> Optional[Policy]:
+        return self._policies.get(user_id)
+
+    def policies_snapshot(self) -> bytes:
+        with self._lock:
+            self._policies_changed = False
+            return json.dumps({user_id: policy.to_json() for user_id, policy in self._policies.items()}).encode()
+
+    def restore_policies(self, raw: bytes) -> int:
+        """Load a ``policies_snapshot()``; policies set since startup win."""
+
+        restored = 0
+        for user_id, data in json.loads(raw).items():
+            user_id = int(user_id)
+            if user_id not in self._policies:
+                self.set_policy(user_id, Policy.from_json(data))
+                restored += 1
+        return restored
+
+    def persist(self, force: bool = False) -> bool:
+        """Hand the policies to ``persist`` if they changed and the interval passed."""
+
+        if self._persist is None or not self._policies_changed:
+            return False
+        if not force and time.monotonic() - self._persisted_at < self.persist_interval:
+            return False
+        self._persisted_at = time.monotonic()
+        try:
+            self._persist(self.policies_snapshot())
+        except Exception:
+            self._policies_changed = True  # retried on the next pass
+            raise
+        return True
+
+    def attach(self, user_id: int, device_name: str, node_id: str, interface: str, address: ipaddress.IPv4Address) -> None:
+        if self.nodes is not None and node_id not in self.nodes:
+            self.detach(user_id, device_name)
+            return
+        minor = int(address) - int(self._networks[node_id].network_address)
+        attachment = Attachment(node_id, interface, address, minor)
+        with self._lock:
+            devices = self._devices.setdefault(user_id, {})
+            if devices.get(device_name) != attachment:
+                devices[device_name] = attachment
+                self._dirty.add(user_id)
+
+    def detach(self, user_id: int, device_name: str) -> None:
+        with self._lock:
+            devices = self._devices.get(user_id)
+            if devices and devices.pop(device_name, None) is not None:
+                if not devices:
+                    del self._devices[user_id]
+                self._dirty.add(user_id)
+
+    def reconcile(self) -> int:
+        """Apply pending changes; returns the number of tc lines issued."""
+
+        now = self._clock()
+        batches: Dict[str, List[str]] = {}
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                # Entries left over from replaced policies only cause a no-op recompute.
+                _, user_id = heapq.heappop(self._deadlines)
+                self._dirty.add(user_id)
+            dirty, self._dirty = self._dirty, set()
+            for user_id in dirty:
+                self._reconcile_user(user_id, now, batches)
+        issued = 0
+        for node_id, lines in batches.items():
+            self.backend.apply(node_id, lines)
+            issued += len(lines)
+        self.commands_issued += issued
+        return issued
+
+    def _desired(self, user_id: int, now: datetime) -> Dict[ShapeKey, Tuple[Attachment, int]]:
+        policy = self._policies.get(user_id)
+        rate = policy.rate_at(now) if policy else None
+        if rate is None:
+            return {}
+        return {
+            (a.node_id, a.interface, a.minor): (a, rate)
+            for a in self._devices.get(user_id, {}).values()
+        }
+
+    def _reconcile_user(self, user_id: int, now: datetime, batches: Dict[str, List[str]]) -> None:
+        desired = self._desired(user_id, now)
+        applied = self._applied_by_user.get(user_id, set())
+        for key in applied - desired.keys():
+            node_id, iface, minor = key
+            batches.setdefault(node_id, []).extend(
+                [
+                    f"filter del dev {iface} parent 1: protocol ip prio {FILTER_PRIO} handle {minor} flower",
+                    f"class del dev {iface} classid 1:{minor:x}",
+                ]
+            )
+            del self._applied[key]
+        for key, (attachment, rate) in desired.items():
+            node_id, iface, minor = key
+            current = self._applied.get(key)
+            if current == rate:
+                continue
+            lines = batches.setdefault(node_id, [])
+            if (node_id, iface) not in self._roots:
+                lines.extend(self._root_lines(iface))
+                self._roots.add((node_id, iface))
+            verb = "change" if current is not None else "replace"
+            lines.append(f"class {verb} dev {iface} parent 1: classid 1:{minor:x} htb rate {rate}mbit ceil {rate}mbit")
+            if current is None:
+                lines.append(f"qdisc replace dev {iface} parent 1:{minor:x} fq_codel")
+                lines.append(
+                    f"filter replace dev {iface} parent 1: protocol ip prio {FILTER_PRIO} handle {minor} "
+                    f"flower dst_ip {attachment.address} classid 1:{minor:x}"
+                )
+            self._applied[key] = rate
+        if desired:
+            self._applied_by_user[user_id] = set(desired)
+        else:
+            self._applied_by_user.pop(user_id, None)
+
+    def _root_lines(self, iface: str) -> List[str]:
+        return [
+            f"qdisc replace dev {iface} root handle 1: htb default {DEFAULT_CLASS:x}",
+            f"class replace dev {iface} parent 1: classid 1:{DEFAULT_CLASS:x} htb rate {self.link_mbps}mbit",
+            f"qdisc replace dev {iface} parent 1:{DEFAULT_CLASS:x} fq_codel",
+        ]
+
+    def applied_rates(self, user_id: int) -> Dict[str, int]:
+        """Device name -> applied limit in Mbit/s for the user's shaped devices."""
+
+        with self._lock:
+            return {
+                name: self._applied[(a.node_id, a.interface, a.minor)]
+                for name, a in self._devices.get(user_id, {}).items()
+                if (a.node_id, a.interface, a.minor) in self._applied
+            }
+
+    def start(self, interval: float) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="shaping", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+        try:
+            self.persist(force=True)
+        except Exception:
+            logger.exception("Could not save shaping policies")
+
+    def _run(self, interval: float) -> None:
+        while not self._stop.is_set():
+            try:
+                self.reconcile()
+            except Exception:
+                logger.exception("Shaping reconcile failed")
+            try:
+                self.persist()
+            except Exception:
+                logger.exception("Could not save shaping policies")
+            self._stop.wait(interval)
+
+
+def build_shaping_backend(settings: Settings) -> ShapingBackend:
+    if settings.shaping_backend == "tc":
+        return TcBackend()
+    return DryRunBackend()
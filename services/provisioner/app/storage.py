@@ -0,0 +1,201 @@
+"""Object storage for generated artefacts (QR codes, configs).
+
+``MinioObjectStore`` talks to the bucket configured by ``MINIO_*``;
+``FileSystemObjectStore`` is a drop-in stand-in for tests and local runs.
+"""
+
+from __future__ import annotations
+
+import abc
+import io
+import logging
+import os
+import tempfile
+from datetime import timedelta
+from typing import Iterator, Optional
+from urllib.parse import urlparse
+
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+
+class ObjectStore(abc.ABC):
+    @abc.abstractmethod
+    def put(self, key: str, data: bytes, content_type: str = "application/octet-stream") -> None:
+        ...
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abc.abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        """Remove ``key``; missing keys are not an error."""
+
+    @abc.abstractmethod
+    def keys(self, prefix: str) -> Iterator[str]:
+        """Every key under ``prefix``, in no particular order."""
+
+    def stream(self, key: str, chunk_size: int = 64 * 1024) -> Optional[Iterator[bytes]]:
+        """Chunks of the object, or None if it does not exist."""
+
+        data = self.get(key)
+        return None if data is None else iter([data])
+
+    def presign(self, key: str, expires: timedelta) -> Optional[str]:
+        """Time-limited download URL, or None if the backend cannot issue one."""
+
+        return None
+
+    def ensure_ready(self) -> None:
+        """Create the bucket/directory if needed; called once at startup."""
+
+
+class FileSystemObjectStore(ObjectStore):
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f"invalid object key {key!r}")
+        return path
+
+    def ensure_ready(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+
+    def put(self, key: str, data: bytes, content_type: str = "application/octet-stream") -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write-then-rename so readers never observe a partial object.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), "rb") as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def delete(self, key: str) -> None:
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def keys(self, prefix: str) -> Iterator[str]:
+        top = self._path(prefix)
+        for dirpath, _, filenames in os.walk(top):
+            for name in filenames:
+                if not name.startswith("tmp"):  # put() in progress
+                    yield os.path.relpath(os.path.join(dirpath, name), self.root).replace(os.sep, "/")
+
+    def stream(self, key: str, chunk_size: int = 64 * 1024) -> Optional[Iterator[bytes]]:
+        try:
+            fh = open(self._path(key), "rb")
+        except FileNotFoundError:
+            return None
+
+        def chunks() -> Iterator[bytes]:
+            with fh:
+                while True:
+                    chunk = fh.read(chunk_size)
+                    if not chunk:
+                        return
+                    yield chunk
+
+        return chunks()
+
+
+class MinioObjectStore(ObjectStore):
+    def __init__(self, client, bucket: str) -> None:
+        self.client = client
+        self.bucket = bucket
+
+    def ensure_ready(self) -> None:
+        if not self.client.bucket_exists(self.bucket):
+            self.client.make_bucket(self.bucket)
+
+    def put(self, key: str, data: bytes, content_type: str = "application/octet-stream") -> None:
+        self.client.put_object(self.bucket, key, io.BytesIO(data), len(data), content_type=content_type)
+
+    def get(self, key: str) -> Optional[bytes]:
+        from minio.error import S3Error
+
+        try:
+            resp = self.client.get_object(self.bucket, key)
+        except S3Error as exc:
+            if exc.code == "NoSuchKey":
+                return None
+            raise
+        try:
+            return resp.read()
+        finally:
+            resp.close()
+            resp.release_conn()
+
+    def exists(self, key: str) -> bool:
+        from minio.error import S3Error
+
+        try:
+            self.client.stat_object(self.bucket, key)
+            return True
+        except S3Error as exc:
+            if exc.code in ("NoSuchKey", "NoSuchObject"):
+                return False
+            raise
+
+    def delete(self, key: str) -> None:
+        self.client.remove_object(self.bucket, key)
+
+    def keys(self, prefix: str) -> Iterator[str]:
+        for obj in self.client.list_objects(self.bucket, prefix=prefix, recursive=True):
+            yield obj.object_name
+
+    def stream(self, key: str, chunk_size: int = 64 * 1024) -> Optional[Iterator[bytes]]:
+        from minio.error import S3Error
+
+        try:
+            resp = self.client.get_object(self.bucket, key)
+        except S3Error as exc:
+            if exc.code == "NoSuchKey":
+                return None
+            raise
+
+        def chunks() -> Iterator[bytes]:
+            try:
+                yield from resp.stream(chunk_size)
+            finally:
+                resp.close()
+                resp.release_conn()
+
+        return chunks()
+
+    def presign(self, key: str, expires: timedelta) -> Optional[str]:
+        return self.client.presigned_get_object(self.bucket, key, expires=expires)
+
+
+def build_object_store(settings: Settings) -> ObjectStore:
+    if settings.object_store == "filesystem":
+        return FileSystemObjectStore(settings.object_store_path)
+    from minio import Minio
+
+    endpoint = urlparse(settings.minio_endpoint)
+    client = Minio(
+        endpoint.netloc or endpoint.path,
+        access_key=settings.minio_root_user,
+        secret_key=settings.minio_root_password,
+        secure=endpoint.scheme == "https",
+    )
+    return MinioObjectStore(client, settings.minio_bucket)
@@ -0,0 +1,119 @@
+"""Billing's tariff catalog, as far as the provisioner needs it.
+
+Billing is the single source of truth for tariffs: the device limit and the
+speed limit of a provision come from its ``GET /tariffs``, never from the
+caller. The catalog is fetched on start and then every ``refresh_interval``
+seconds, revalidated with ``If-None-Match`` so an unchanged catalog costs an
+empty 304. The last catalog seen is handed to ``persist`` and restored on
+startup, so the provisioner keeps working while billing is down. With no
+catalog at all, lookups raise ``CatalogUnavailable`` rather than guess.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+import httpx
+from vpn_common.metrics.transports import TimedTransport
+
+logger = logging.getLogger(__name__)
+
+CATALOG_KEY = "tariffs/catalog.json"
+
+
+class CatalogUnavailable(Exception):
+    pass
+
+
+class UnknownTariff(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class TariffLimits:
+    code: str
+    devices: int
+    speed_limit_mbps: Optional[int]
+
+
+class TariffCatalog:
+    def __init__(
+        self,
+        billing_url: Optional[str],
+        persist: Optional[Callable[[bytes], None]] = None,
+        refresh_interval: float = 60.0,
+        client: Optional[httpx.Client] = None,
+    ) -> None:
+        self.billing_url = billing_url.rstrip("/") if billing_url else None
+        self._persist = persist
+        self.refresh_interval = refresh_interval
+        self._client = client
+        self._tariffs: Dict[str, TariffLimits] = {}
+        self.etag: Optional[str] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def load(self, raw: bytes) -> int:
+        """Replace the catalog with a ``GET /tariffs`` body; returns the tariff count."""
+
+        self._tariffs = {
+            t["code"]: TariffLimits(t["code"], t["devices"], t.get("speed_limit_mbps")) for t in json.loads(raw)
+        }
+        return len(self._tariffs)
+
+    def get(self, code: str) -> TariffLimits:
+        if not self._tariffs:
+            raise CatalogUnavailable("The tariff catalog has not been loaded from billing yet")
+        tariff = self._tariffs.get(code)
+        if tariff is None:
+            raise UnknownTariff(f"Unknown tariff {code!r}")
+        return tariff
+
+    def refresh(self) -> bool:
+        """Revalidate against billing; returns True when the catalog changed."""
+
+        if not self.billing_url:
+            return False
+        client = self._client or httpx.Client(timeout=5.0, transport=TimedTransport())
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        try:
+            resp = client.get(f"{self.billing_url}/tariffs", headers=headers)
+        finally:
+            if self._client is None:
+                client.close()
+        if resp.status_code == 304:
+            return False
+        resp.raise_for_status()
+        logger.info("Loaded %d tariffs from billing", self.load(resp.content))
+        self.etag = resp.headers.get("ETag")
+        if self._persist is not None:
+            try:
+                self._persist(resp.content)
+            except Exception:
+                logger.exception("Could not save the tariff catalog")
+        return True
+
+    def start(self) -> None:
+        if self._thread is None and self.billing_url:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="tariffs", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as exc:
+                # Keep serving the last known catalog while billing is unreachable.
+                logger.warning("Tariff catalog refresh failed: %s", exc)
+            self._stop.wait(self.refresh_interval)
@@ -0,0 +1,446 @@
+"""Per-peer traffic accounting from ``wg show all dump`` / ``awg show all dump``.
+
+The collector samples the cumulative per-peer byte counters every interval
+and adds the deltas to fixed-size ring buffers at minute, hour and day
+resolution. Each peer owns a slot index; every resolution keeps two flat
+``array('Q')`` buffers (rx/tx) of ``slots`` cells per peer, and all peers
+share one bucket cursor. Memory is therefore ``peers * slots`` regardless of
+how long the service has been running (about 2.2 KiB per peer with the
+default 60/48/31 slots). Advancing the cursor clears one strided column per
+resolution.
+
+On shutdown the whole store is written to object storage as one snapshot
+(``snapshot``/``restore``): a JSON header with the peer table followed by
+the raw buffers. At startup the snapshot is loaded and peers are then
+re-registered from the stored configs, so accounting resumes where it
+stopped and traffic moved while the service was down is still counted.
+"""
+
+from __future__ import annotations
+
+import abc
+import json
+import logging
+import shlex
+import subprocess
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_KEY = "traffic/snapshot.bin"
+
+# name -> bucket width in seconds
+RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+
+PeerSample = Tuple[str, int, int]
+
+
+def parse_dump(text: str) -> Iterator[PeerSample]:
+    """Yield ``(public_key, rx_bytes, tx_bytes)`` for every peer line.
+
+    Peer lines have nine tab-separated fields; interface lines have five for
+    WireGuard and more for AmneziaWG (obfuscation parameters), so the field
+    count alone tells them apart.
+    """
+
+    for line in text.splitlines():
+        parts = line.split("\t")
+        if len(parts) != 9:
+            continue
+        try:
+            yield parts[1], int(parts[6]), int(parts[7])
+        except ValueError:
+            continue
+
+
+class _Ring:
+    def __init__(self, step: int, slots: int, capacity: int) -> None:
+        self.step = step
+        self.slots = slots
+        self.rx = array("Q", bytes(8 * slots * capacity))
+        self.tx = array("Q", bytes(8 * slots * capacity))
+        self.current: Optional[int] = None  # absolute bucket number
+
+    def grow(self, extra: int) -> None:
+        self.rx.frombytes(bytes(8 * self.slots * extra))
+        self.tx.frombytes(bytes(8 * self.slots * extra))
+
+    def advance(self, now: float, capacity: int) -> None:
+        bucket = int(now // self.step)
+        if self.current is None:
+            self.current = bucket
+            return
+        if bucket <= self.current:
+            return
+        zeros = array("Q", bytes(8 * capacity))
+        for b in range(max(self.current + 1, bucket - self.slots + 1), bucket + 1):
+            pos = b % self.slots
+            self.rx[pos :: self.slots] = zeros
+            self.tx[pos :: self.slots] = zeros
+        self.current = bucket
+
+    def clear_peer(self, slot: int) -> None:
+        start = slot * self.slots
+        zeros = array("Q", bytes(8 * self.slots))
+        self.rx[start : start + self.slots] = zeros
+        self.tx[start : start + self.slots] = zeros
+
+    def series(self, peer_slots: Iterable[int]) -> List[Tuple[datetime, int, int]]:
+        if self.current is None:
+            return []
+        rx = [0] * self.slots
+        tx = [0] * self.slots
+        for slot in peer_slots:
+            start = slot * self.slots
+            for i, value in enumerate(self.rx[start : start + self.slots]):
+                rx[i] += value
+            for i, value in enumerate(self.tx[start : start + self.slots]):
+                tx[i] += value
+        points = []
+        for bucket in range(self.current - self.slots + 1, self.current + 1):
+            pos = bucket % self.slots
+            started = datetime.fromtimestamp(bucket * self.step, tz=timezone.utc)
+            points.append((started, rx[pos], tx[pos]))
+        return points
+
+
+@dataclass
+class Peer:
+    user_id: int
+    device_name: str
+    node_id: str
+    public_key: str
+
+
+class TrafficStore:
+    def __init__(
+        self,
+        minute_slots: int = 60,
+        hour_slots: int = 48,
+        day_slots: int = 31,
+        initial_capacity: int = 1024,
+    ) -> None:
+        self._capacity = initial_capacity
+        self._rings = {
+            "minute": _Ring(RESOLUTIONS["minute"], minute_slots, initial_capacity),
+            "hour": _Ring(RESOLUTIONS["hour"], hour_slots, initial_capacity),
+            "day": _Ring(RESOLUTIONS["day"], day_slots, initial_capacity),
+        }
+        self._peers: List[Optional[Peer]] = []
+        self._free: List[int] = []
+        self._by_key: Dict[str, int] = {}
+        self._by_device: Dict[Tuple[int, str], int] = {}
+        self._by_user: Dict[int, Set[int]] = {}
+        # Last raw counters seen per slot; a peer's first sample only primes them.
+        self._last_rx = array("Q", bytes(8 * initial_capacity))
+        self._last_tx = array("Q", bytes(8 * initial_capacity))
+        self._primed = bytearray(initial_capacity)
+        self._total_rx = array("Q", bytes(8 * initial_capacity))
+        self._total_tx = array("Q", bytes(8 * initial_capacity))
+        self._lock = threading.Lock()
+        self.unknown_peers = 0
+        # (user_id, device_name) of peers that moved traffic in the last ingest.
+        self.last_active: List[Tuple[int, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._by_device)
+
+    def _grow(self) -> None:
+        extra = self._capacity
+        for ring in self._rings.values():
+            ring.grow(extra)
+        for counters in (self._last_rx, self._last_tx, self._total_rx, self._total_tx):
+            counters.frombytes(bytes(8 * extra))
+        self._primed.extend(bytes(extra))
+        self._capacity += extra
+
+    def register(self, public_key: str, user_id: int, device_name: str, node_id: str) -> None:
+        """Attach ``public_key`` to a device. Re-keying a device keeps its history."""
+
+        with self._lock:
+            slot = self._by_device.get((user_id, device_name))
+            if slot is not None and self._peers[slot] == Peer(user_id, device_name, node_id, public_key):
+                return  # unchanged: keep the primed counters
+            if slot is None:
+                if self._free:
+                    slot = self._free.pop()
+                else:
+                    slot = len(self._peers)
+                    if slot >= self._capacity:
+                        self._grow()
+                    self._peers.append(None)
+                self._by_device[(user_id, device_name)] = slot
+                self._by_user.setdefault(user_id, set()).add(slot)
+            else:
+                self._by_key.pop(self._peers[slot].public_key, None)
+            self._peers[slot] = Peer(user_id, device_name, node_id, public_key)
+            self._by_key[public_key] = slot
+            self._primed[slot] = 0
+
+    def devices(self) -> List[Tuple[int, str]]:
+        with self._lock:
+            return list(self._by_device)
+
+    def _buffers(self) -> List[array]:
+        buffers = []
+        for ring in self._rings.values():
+            buffers += [ring.rx, ring.tx]
+        return buffers + [self._last_rx, self._last_tx, self._total_rx, self._total_tx]
+
+    def snapshot(self) -> bytes:
+        with self._lock:
+            header = {
+                "capacity": self._capacity,
+                "rings": {name: [ring.slots, ring.current] for name, ring in self._rings.items()},
+                "peers": [
+                    [peer.user_id, peer.device_name, peer.node_id, peer.public_key] if peer else None
+                    for peer in self._peers
+                ],
+                "free": self._free,
+            }
+            parts = [json.dumps(header).encode(), b"\n"]
+            parts += [buffer.tobytes() for buffer in self._buffers()]
+            parts.append(bytes(self._primed))
+        return b"".join(parts)
+
+    def restore(self, raw: bytes) -> int:
+        """Load a ``snapshot()`` into this empty store; returns the number of peers.
+
+        Raises ``ValueError`` if the snapshot does not fit (e.g. the number of
+        slots per resolution changed); the store is left untouched then.
+        """
+
+        head, _, body = raw.partition(b"\n")
+        header = json.loads(head)
+        capacity = header["capacity"]
+        if {name: slots for name, (slots, _) in header["rings"].items()} != {
+            name: ring.slots for name, ring in self._rings.items()
+        }:
+            raise ValueError("traffic snapshot has different ring sizes")
+        sizes = [ring.slots * capacity for ring in self._rings.values() for _ in (0, 1)] + [capacity] * 4
+        if len(body) != 8 * sum(sizes) + capacity:
+            raise ValueError("traffic snapshot is truncated")
+        with self._lock:
+            if self._peers:
+                raise ValueError("traffic store is not empty")
+            self._capacity = capacity
+            buffers, offset = [], 0
+            for size in sizes:
+                buffer = array("Q")
+                buffer.frombytes(body[offset : offset + 8 * size])
+                buffers.append(buffer)
+                offset += 8 * size
+            rings = list(self._rings.items())
+            for i, (name, ring) in enumerate(rings):
+                ring.rx, ring.tx = buffers[2 * i], buffers[2 * i + 1]
+                ring.current = header["rings"][name][1]
+            self._last_rx, self._last_tx, self._total_rx, self._total_tx = buffers[2 * len(rings) :]
+            self._primed = bytearray(body[offset:])
+            self._peers = [Peer(*peer) if peer else None for peer in header["peers"]]
+            self._free = list(header["free"])
+            for slot, peer in enumerate(self._peers):
+                if peer is None:
+                    continue
+                self._by_key[peer.public_key] = slot
+                self._by_device[(peer.user_id, peer.device_name)] = slot
+                self._by_user.setdefault(peer.user_id, set()).add(slot)
+            return len(self._by_device)
+
+    def unregister(self, user_id: int, device_name: str) -> None:
+        with self._lock:
+            slot = self._by_device.pop((user_id, device_name), None)
+            if slot is None:
+                return
+            peer = self._peers[slot]
+            self._by_key.pop(peer.public_key, None)
+            slots = self._by_user.get(user_id)
+            if slots is not None:
+                slots.discard(slot)
+                if not slots:
+                    del self._by_user[user_id]
+            for ring in self._rings.values():
+                ring.clear_peer(slot)
+            self._total_rx[slot] = self._total_tx[slot] = 0
+            self._primed[slot] = 0
+            self._peers[slot] = None
+            self._free.append(slot)
+
+    def ingest(self, samples: Iterable[PeerSample], now: Optional[float] = None) -> int:
+        """Account one dump; returns the number of known peers updated."""
+
+        now = time.time() if now is None else now
+        updated = unknown = 0
+        active: List[int] = []
+        with self._lock:
+            for ring in self._rings.values():
+                ring.advance(now, self._capacity)
+            minute, hour, day = self._rings["minute"], self._rings["hour"], self._rings["day"]
+            m_pos, m_slots = minute.current % minute.slots, minute.slots
+            h_pos, h_slots = hour.current % hour.slots, hour.slots
+            d_pos, d_slots = day.current % day.slots, day.slots
+            by_key, primed = self._by_key, self._primed
+            last_rx, last_tx = self._last_rx, self._last_tx
+            for public_key, rx, tx in samples:
+                slot = by_key.get(public_key)
+                if slot is None:
+                    unknown += 1
+                    continue
+                if primed[slot]:
+                    # Counters restart from zero when the interface is recreated.
+                    d_rx = rx - last_rx[slot] if rx >= last_rx[slot] else rx
+                    d_tx = tx - last_tx[slot] if tx >= last_tx[slot] else tx
+                    if d_rx or d_tx:
+                        i = slot * m_slots + m_pos
+                        minute.rx[i] += d_rx
+                        minute.tx[i] += d_tx
+                        i = slot * h_slots + h_pos
+                        hour.rx[i] += d_rx
+                        hour.tx[i] += d_tx
+                        i = slot * d_slots + d_pos
+                        day.rx[i] += d_rx
+                        day.tx[i] += d_tx
+                        self._total_rx[slot] += d_rx
+                        self._total_tx[slot] += d_tx
+                        active.append(slot)
+                else:
+                    primed[slot] = 1
+                last_rx[slot] = rx
+                last_tx[slot] = tx
+                updated += 1
+            peers = self._peers
+            self.last_active = [(peers[slot].user_id, peers[slot].device_name) for slot in active]
+        self.unknown_peers = unknown
+        return updated
+
+    def usage(self, user_id: int, resolution: str = "hour") -> Optional[dict]:
+        ring = self._rings[resolution]
+        with self._lock:
+            slots = sorted(self._by_user.get(user_id, ()))
+            if not slots:
+                return None
+            devices = [
+                {
+                    "device_name": self._peers[slot].device_name,
+                    "node_id": self._peers[slot].node_id,
+                    "rx_bytes": self._total_rx[slot],
+                    "tx_bytes": self._total_tx[slot],
+                }
+                for slot in slots
+            ]
+            series = ring.series(slots)
+        return {
+            "user_id": user_id,
+            "resolution": resolution,
+            "rx_bytes": sum(d["rx_bytes"] for d in devices),
+            "tx_bytes": sum(d["tx_bytes"] for d in devices),
+            "devices": devices,
+            "series": [{"start": start, "rx_bytes": rx, "tx_bytes": tx} for start, rx, tx in series],
+        }
+
+
+class DumpSource(abc.ABC):
+    @abc.abstractmethod
+    def read(self) -> Optional[str]:
+        """Return the dump text, or None when the source is unavailable."""
+
+
+class CommandSource(DumpSource):
+    def __init__(self, command: str, timeout: float = 10.0) -> None:
+        self.argv = shlex.split(command)
+        self.timeout = timeout
+        self.available = True
+
+    def read(self) -> Optional[str]:
+        if not self.available:
+            return None
+        try:
+            result = subprocess.run(self.argv, capture_output=True, text=True, timeout=self.timeout, check=True)
+        except FileNotFoundError:
+            # e.g. no AmneziaWG tools on a WireGuard-only node
+            logger.warning("%s is not installed; disabling this traffic source", self.argv[0])
+            self.available = False
+            return None
+        return result.stdout
+
+
+class FileSource(DumpSource):
+    """Reads a saved dump, standing in for the command in local runs."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def read(self) -> Optional[str]:
+        try:
+            with open(self.path, encoding="utf-8") as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+
+def build_sources(settings: Settings) -> List[DumpSource]:
+    if settings.traffic_source == "file":
+        return [FileSource(settings.traffic_fixture_path)]
+    if settings.traffic_source == "command":
+        return [CommandSource(cmd) for cmd in settings.traffic_commands.split(";") if cmd.strip()]
+    return []
+
+
+class TrafficCollector:
+    def __init__(
+        self,
+        store: TrafficStore,
+        sources: List[DumpSource],
+        interval: float = 30.0,
+        clock: Callable[[], float] = time.time,
+        on_active: Optional[Callable[[List[Tuple[int, str]], float], None]] = None,
+    ) -> None:
+        self.store = store
+        self.sources = sources
+        self.on_active = on_active
+        self.interval = interval
+        self._clock = clock
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_duration = 0.0
+        self.last_peers = 0
+
+    def collect_once(self) -> int:
+        started = time.perf_counter()
+        now = self._clock()
+        peers = 0
+        for source in self.sources:
+            text = source.read()
+            if text:
+                peers += self.store.ingest(parse_dump(text), now)
+                if self.on_active is not None and self.store.last_active:
+                    self.on_active(self.store.last_active, now)
+        self.last_duration = time.perf_counter() - started
+        self.last_peers = peers
+        return peers
+
+    def start(self) -> None:
+        if self._thread is None and self.sources:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="traffic", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.collect_once()
+            except Exception:
+                logger.exception("Traffic collection failed")
+            self._stop.wait(self.interval)
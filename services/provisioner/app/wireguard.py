@@ -0,0 +1,28 @@
+"""Plain WireGuard client config generator."""
+
+from textwrap import dedent
+
+
+def build_profile(
+    public_host: str,
+    public_port: int,
+    device_name: str,
+    address: str,
+    private_key: str,
+    server_public_key: str = "<wireguard-public-key>",
+) -> str:
+    return dedent(
+        f"""
+        # WireGuard profile generated for {device_name}
+        [Interface]
+        PrivateKey = {private_key}
+        Address = {address}
+        DNS = 1.1.1.1
+
+        [Peer]
+        PublicKey = {server_public_key}
+        Endpoint = {public_host}:{public_port}
+        AllowedIPs = 0.0.0.0/0, ::/0
+        PersistentKeepalive = 25
+        """
+    ).strip()
@@ -0,0 +1,94 @@
+"""Config store: regenerate-on-change, LRU hit rate and streaming memory.
+
+Provisions ``--devices`` devices through ``/provision`` (filesystem object
+store, in-process ASGI), then repeats the same requests and a round with
+every fifth device switching protocol. Reports per-request latency and
+object-store writes (each one a new version with a fresh keypair). The
+download endpoint is then timed for LRU hits and for cold streams. Finally
+it compares peak Python memory when serving a ``--large-mb`` object with
+``get()`` and with ``stream()``. Run from ``services/provisioner``::
+
+    OBJECT_STORE=filesystem python -m benchmarks.bench_configs --devices 2000
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ.setdefault("OBJECT_STORE", "filesystem")
+os.environ.setdefault("OBJECT_STORE_PATH", _tmp.name)
+os.environ.setdefault("BILLING_URL", "")
+os.environ.setdefault("EVENTS_BACKEND", "none")
+os.environ.setdefault("PROVISIONER_TOKEN", "bench")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.main import _config_url, app, configs, keypool, object_store, tariffs  # noqa: E402
+
+
+def _round(client: TestClient, devices: int, flip_every: int = 0):
+    writes = configs.writes
+    started = time.perf_counter()
+    for user_id in range(devices):
+        protocol = "amneziawg" if flip_every and user_id % flip_every == 0 else "wireguard"
+        resp = client.post(
+            "/provision",
+            json={"user_id": user_id, "protocol": protocol, "device_name": "phone", "tariff_code": "light"},
+        )
+        resp.raise_for_status()
+    per_request = (time.perf_counter() - started) / devices
+    return per_request, configs.writes - writes
+
+
+def _downloads(client: TestClient, devices: int) -> float:
+    started = time.perf_counter()
+    for user_id in range(devices):
+        client.get(_config_url(user_id, "phone")).raise_for_status()
+    return (time.perf_counter() - started) / devices
+
+
+def _peak(fn) -> int:
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=2000)
+    parser.add_argument("--large-mb", type=int, default=64)
+    args = parser.parse_args()
+
+    with TestClient(app, headers={"Authorization": f"Bearer {os.environ['PROVISIONER_TOKEN']}"}) as client:
+        # No billing here: a catalog in the shape of its ``GET /tariffs``.
+        tariffs.load(json.dumps([{"code": "light", "devices": 2, "speed_limit_mbps": 100}]).encode())
+        keypool.fill()
+        for label, flip in (("first provision", 0), ("unchanged re-provision", 0), ("20% switch protocol", 5)):
+            per_request, writes = _round(client, args.devices, flip)
+            # Every config write is a new version and a fresh keypair.
+            print(f"{label:<24} {per_request * 1e3:6.2f} ms/request  {writes:>5} config writes")
+
+        hot = _downloads(client, args.devices)
+        configs._bodies.clear()
+        configs._body_bytes = 0
+        cold = _downloads(client, args.devices)
+        print(f"download from LRU        {hot * 1e3:6.2f} ms  cold stream {cold * 1e3:6.2f} ms  {configs.stats()}")
+
+    blob = os.urandom(1024 * 1024) * args.large_mb
+    object_store.put("bench/large.bin", blob)
+    del blob
+    whole = _peak(lambda: len(object_store.get("bench/large.bin")))
+    streamed = _peak(lambda: sum(len(chunk) for chunk in object_store.stream("bench/large.bin")))
+    print(f"{args.large_mb} MiB object: get() peak {whole / 2**20:.1f} MiB, stream() peak {streamed / 2**10:.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
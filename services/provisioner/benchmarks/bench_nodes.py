@@ -0,0 +1,89 @@
+"""Node registry: probe round time, placement cost and how evenly users spread.
+
+Builds registries of ``--nodes`` sizes with stub probes (random latencies,
+a share of dead nodes) and reports the wall time of one concurrent probe
+round next to the sum of the probe latencies (what a sequential loop would
+take), the cost of ``place`` against a linear scan over all nodes, and the
+utilization spread after placing ``--users`` users (at most 80% of the
+healthy capacity) onto nodes of mixed capacity. Run from
+``services/provisioner``::
+
+    python -m benchmarks.bench_nodes --nodes 10,100,1000 --users 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from app.nodes import NodeRegistry, StubProbe
+
+
+def build(count: int, seed: int, dead: float):
+    rnd = random.Random(seed)
+    capacities = {f"node-{i:05d}": rnd.choice([250, 1000, 4000, 16000]) for i in range(count)}
+    latencies = {node_id: rnd.uniform(0.005, 0.15) for node_id in capacities}
+    probe = StubProbe(latencies, jitter=0.1, seed=seed)
+    registry = NodeRegistry(capacities, probe, timeout=0.5, unhealthy_after=1)
+    down = set(rnd.sample(sorted(capacities), int(count * dead)))
+    probe.latencies.update({node_id: 5.0 for node_id in down})  # time out
+    return registry, capacities, latencies, down
+
+
+def linear_place(registry: NodeRegistry) -> str:
+    best, best_score = None, float("inf")
+    for state in registry._nodes.values():
+        if state.healthy and state.load < 1:
+            score = registry._score(state)
+            if score < best_score:
+                best, best_score = state.node_id, score
+    return best
+
+
+async def main_async(args) -> None:
+    for count in (int(n) for n in args.nodes.split(",")):
+        registry, capacities, latencies, down = build(count, args.seed, args.dead)
+        started = time.perf_counter()
+        await registry.probe_all()
+        round_s = time.perf_counter() - started
+        sequential = sum(min(latencies[n], registry.timeout) for n in capacities if n not in down)
+        sequential += registry.timeout * len(down)
+
+        # Stay below what the healthy nodes can take in total.
+        users = min(args.users, int(sum(c for n, c in capacities.items() if n not in down) * 0.8))
+        samples = min(20_000, users)
+        started = time.perf_counter()
+        for _ in range(samples):
+            registry.place()
+        heap_us = (time.perf_counter() - started) / samples * 1e6
+        started = time.perf_counter()
+        for _ in range(min(samples, 200_000 // count)):
+            linear_place(registry)
+        linear_us = (time.perf_counter() - started) / min(samples, 200_000 // count) * 1e6
+
+        for _ in range(users - samples):
+            registry.place()
+        loads = [s["load"] for s in registry.snapshot() if s["healthy"]]
+        placed_on_down = sum(s["peers"] for s in registry.snapshot() if s["node_id"] in down)
+        print(
+            f"nodes={count:>5} users={users} ({len(down)} down)  probe round {round_s * 1e3:6.0f} ms "
+            f"(sequential ~{sequential:6.1f} s)  place {heap_us:5.1f} µs vs scan {linear_us:8.1f} µs  "
+            f"load min/max {min(loads):.3f}/{max(loads):.3f}, on down nodes {placed_on_down}"
+        )
+
+
+def main() -> None:
+    logging.getLogger("app.nodes").setLevel(logging.ERROR)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", default="10,100,1000")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--dead", type=float, default=0.05, help="share of nodes that never answer")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
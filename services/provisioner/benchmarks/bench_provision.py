@@ -0,0 +1,118 @@
+"""Burst provisioning throughput, e.g. after a node migration.
+
+Fires ``--burst`` concurrent ``POST /provision`` calls at the in-process app,
+once with a warm key pool and once with an empty one (every request generates
+its keypair inline), and microbenchmarks the /16 address allocator. Run from
+``services/provisioner``::
+
+    python -m benchmarks.bench_provision --burst 5000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from typing import List
+
+import httpx
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ.setdefault("OBJECT_STORE", "filesystem")
+os.environ.setdefault("OBJECT_STORE_PATH", _tmp.name)
+os.environ.setdefault("EVENTS_BACKEND", "none")
+os.environ.setdefault("PROVISIONER_TOKEN", "bench")
+
+from app import main as provisioner  # noqa: E402
+from app.ipam import AddressBook, SubnetAllocator  # noqa: E402
+from app.keys import KeyPool  # noqa: E402
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def _burst(count: int, concurrency: int, user_offset: int) -> List[float]:
+    sem = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    transport = httpx.ASGITransport(app=provisioner.app)
+    headers = {"Authorization": f"Bearer {os.environ['PROVISIONER_TOKEN']}"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://provisioner", headers=headers) as client:
+
+        async def one(i: int) -> None:
+            async with sem:
+                t = time.perf_counter()
+                resp = await client.post(
+                    "/provision",
+                    json={
+                        "user_id": user_offset + i,
+                        "protocol": "wireguard",
+                        "device_name": "phone",
+                        "tariff_code": "light",
+                    },
+                )
+                resp.raise_for_status()
+                latencies.append(time.perf_counter() - t)
+
+        await asyncio.gather(*(one(i) for i in range(count)))
+    return latencies
+
+
+def _report(label: str, latencies: List[float], elapsed: float) -> None:
+    print(
+        f"{label:<14} {len(latencies) / elapsed:>8,.0f} provisions/s  "
+        f"p50={_percentile(latencies, 50) * 1e3:.1f}ms p99={_percentile(latencies, 99) * 1e3:.1f}ms"
+    )
+
+
+def bench_allocator() -> None:
+    pool = SubnetAllocator("10.0.0.0/16")
+    t = time.perf_counter()
+    taken = [pool.allocate() for _ in range(pool.capacity)]
+    alloc_s = time.perf_counter() - t
+    t = time.perf_counter()
+    for address in taken[::2]:
+        pool.release(address)
+    for _ in range(len(taken[::2])):
+        pool.allocate()
+    churn_s = time.perf_counter() - t
+    print(
+        f"/16 allocator: {pool.capacity / alloc_s:,.0f} allocs/s to fill, "
+        f"{len(taken):,} release/alloc ops on a fragmented pool at {len(taken) / churn_s:,.0f} ops/s, "
+        f"bitmap {len(pool._bitmap):,} B"  # noqa: SLF001 - benchmark only
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--burst", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    args = parser.parse_args()
+
+    bench_allocator()
+
+    # No billing here: a catalog in the shape of its ``GET /tariffs``.
+    provisioner.tariffs.load(json.dumps([{"code": "light", "devices": 2, "speed_limit_mbps": 100}]).encode())
+    # A fresh book with a pool for every node the registry can place on.
+    provisioner.addresses = AddressBook.from_spec(provisioner.settings.node_subnets)
+    provisioner.keypool = KeyPool(size=args.burst)
+    t = time.perf_counter()
+    provisioner.keypool.fill()
+    print(f"pre-generated {len(provisioner.keypool):,} keypairs in {time.perf_counter() - t:.2f}s (off the request path)")
+
+    t = time.perf_counter()
+    latencies = asyncio.run(_burst(args.burst, args.concurrency, 0))
+    _report("warm key pool", latencies, time.perf_counter() - t)
+
+    provisioner.keypool = KeyPool(size=0)
+    t = time.perf_counter()
+    latencies = asyncio.run(_burst(args.burst, args.concurrency, args.burst))
+    _report("inline keygen", latencies, time.perf_counter() - t)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""tc churn of the shaping controller on a node with many peers.
+
+Attaches ``--peers`` devices (three per user) with mixed tariffs to a
+dry-run controller, applies the initial state, then measures what a single
+user's tariff change, a single deprovision and a batch of paid periods
+running out cost in ``tc`` lines and reconcile time. Run from
+``services/provisioner``::
+
+    python -m benchmarks.bench_shaping --peers 10000
+"""
+
+from __future__ import annotations
+
+import argparse
+import ipaddress
+import time
+from datetime import datetime, timedelta
+
+from app.shaping import DryRunBackend, Policy, ShapingController
+
+LIMITS = [100, 300, None]
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = datetime(2024, 1, 1)
+
+    def __call__(self) -> datetime:
+        return self.now
+
+
+def _reconcile(label: str, controller: ShapingController) -> None:
+    started = time.perf_counter()
+    lines = controller.reconcile()
+    print(f"{label:<34} {lines:>6} tc lines  {(time.perf_counter() - started) * 1e3:7.2f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--peers", type=int, default=10_000)
+    parser.add_argument("--expiring", type=int, default=50, help="users whose paid period ends in the last step")
+    args = parser.parse_args()
+
+    clock = Clock()
+    backend = DryRunBackend()
+    network = ipaddress.ip_network("10.7.0.0/16")
+    controller = ShapingController(backend, {"default_nl": str(network)}, clock=clock)
+
+    users = (args.peers + 2) // 3
+    for user_id in range(users):
+        active_until = clock.now + timedelta(days=30 if user_id >= args.expiring else 1)
+        controller.set_policy(user_id, Policy(LIMITS[user_id % 3], active_until=active_until))
+    for peer in range(args.peers):
+        user_id = peer // 3
+        controller.attach(user_id, f"dev{peer % 3}", "default_nl", "wg0", network.network_address + 2 + peer)
+
+    _reconcile("initial apply", controller)
+    _reconcile("no changes", controller)
+    controller.set_policy(0, Policy(300, active_until=clock.now + timedelta(days=30)))
+    _reconcile("one user 100 -> 300 Mbit", controller)
+    controller.detach(1, "dev0")
+    _reconcile("one device deprovisioned", controller)
+    clock.now += timedelta(days=2)
+    _reconcile(f"{args.expiring} users enter grace", controller)
+    print(f"last batch: {backend.batches[-1][1][:2]} ...")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Traffic collector cost for a node with many peers.
+
+Builds a synthetic ``wg show all dump`` for ``--peers`` peers and feeds it
+to ``TrafficStore`` every 30 simulated seconds for ``--days`` days. Reports
+the parse+ingest time per sample and the process RSS, which should stay flat
+as the history grows. Run from ``services/provisioner``::
+
+    python -m benchmarks.bench_traffic --peers 50000 --days 0.5
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import os
+import random
+import time
+
+from app.traffic import TrafficStore, parse_dump
+
+INTERVAL = 30
+
+
+def _rss_mib() -> float:
+    with open("/proc/self/statm") as fh:
+        return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def _dump(keys, rx, tx) -> str:
+    lines = ["wg0\tcHJpdmF0ZQ==\tcHVibGlj\t51820\toff"]
+    for i, key in enumerate(keys):
+        lines.append(f"wg0\t{key}\t(none)\t203.0.113.{i % 250}:51820\t10.7.0.0/32\t1700000000\t{rx[i]}\t{tx[i]}\t25")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--peers", type=int, default=50_000)
+    parser.add_argument("--days", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    keys = [base64.b64encode(i.to_bytes(32, "big")).decode() for i in range(args.peers)]
+    store = TrafficStore()
+    for i, key in enumerate(keys):
+        store.register(key, user_id=i // 3, device_name=f"dev{i % 3}", node_id="default_nl")
+    rx = [0] * args.peers
+    tx = [0] * args.peers
+
+    samples = int(args.days * 86400 / INTERVAL)
+    now = 1_700_000_000.0
+    timings = []
+    for n in range(samples):
+        # Only about a fifth of peers move traffic in any 30s window.
+        for i in rnd.sample(range(args.peers), args.peers // 5):
+            rx[i] += rnd.randint(1, 5_000_000)
+            tx[i] += rnd.randint(1, 500_000)
+        text = _dump(keys, rx, tx)
+        started = time.perf_counter()
+        store.ingest(parse_dump(text), now)
+        timings.append(time.perf_counter() - started)
+        now += INTERVAL
+        if n % (samples // 6 or 1) == 0:
+            print(f"day {n * INTERVAL / 86400:5.2f}: ingest {timings[-1] * 1e3:6.1f}ms  rss={_rss_mib():6.1f} MiB")
+
+    timings.sort()
+    print(f"{samples} samples of {args.peers} peers: p50 {timings[len(timings) // 2] * 1e3:.1f}ms  max {timings[-1] * 1e3:.1f}ms")
+    started = time.perf_counter()
+    usage = store.usage(42, "minute")
+    print(f"usage(user) across {len(usage['devices'])} devices: {(time.perf_counter() - started) * 1e6:.0f} µs, rss={_rss_mib():.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
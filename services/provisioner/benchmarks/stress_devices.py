@@ -0,0 +1,119 @@
+"""Concurrency stress test for device slots: parallel provisions for one user.
+
+``--threads`` workers hammer a single user with provisions of random device
+names (and some deprovisions), the way FastAPI runs the sync endpoints on its
+thread pool. A sampler thread checks the user never holds more slots than the
+tariff allows. At the end the registry, address leases, traffic peers and the
+address pool must all agree. ``--no-hold`` swaps the per-user lock for a
+no-op to show what the lock prevents. Exits non-zero on any violation. Run
+from ``services/provisioner``::
+
+    python -m benchmarks.stress_devices --threads 32 --ops 4000
+    python -m benchmarks.stress_devices --no-hold
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ.setdefault("OBJECT_STORE", "filesystem")
+os.environ.setdefault("OBJECT_STORE_PATH", _tmp.name)
+os.environ.setdefault("BILLING_URL", "")
+os.environ.setdefault("EVENTS_BACKEND", "none")
+
+from app import main as service  # noqa: E402
+from app.schemas import ProvisionRequest  # noqa: E402
+
+USER_ID = 4242
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--ops", type=int, default=4000)
+    parser.add_argument("--names", type=int, default=20, help="distinct device names")
+    parser.add_argument("--tariff", default="family")
+    parser.add_argument("--limit", type=int, default=5, help="the tariff's device count")
+    parser.add_argument("--no-hold", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    registry = service.devices
+    if args.no_hold:
+        lock = contextlib.nullcontext()
+        registry.hold = lambda user_id: lock
+    limit = args.limit
+    # No billing here: a catalog in the shape of its ``GET /tariffs``.
+    service.tariffs.load(json.dumps([{"code": args.tariff, "devices": limit, "speed_limit_mbps": None}]).encode())
+    service.keypool.fill()
+    rnd = random.Random(args.seed)
+    plan = [(rnd.random() < 0.1, f"device-{rnd.randrange(args.names)}") for _ in range(args.ops)]
+
+    over_limit = []
+    done = threading.Event()
+
+    def sample() -> None:
+        while not done.is_set():
+            count = registry.count(USER_ID)
+            if count > limit:
+                over_limit.append(count)
+            time.sleep(0)
+
+    def op(item) -> int:
+        remove, device_name = item
+        if remove:
+            service._deprovision(USER_ID, device_name)
+            return 0
+        response = service._provision(
+            ProvisionRequest(user_id=USER_ID, protocol="wireguard", device_name=device_name, tariff_code=args.tariff)
+        )
+        return len(response.evicted)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        evicted = sum(pool.map(op, plan))
+    elapsed = time.perf_counter() - started
+    done.set()
+    sampler.join()
+
+    registered = {name for name, _ in registry.devices(USER_ID)}
+    leased = set(service.addresses.devices(USER_ID))
+    usage = service.traffic.usage(USER_ID) or {"devices": []}
+    peers = {d["device_name"] for d in usage["devices"]}
+    pool_used = sum(p.used for p in service.addresses.pools.values())
+    problems = []
+    if over_limit:
+        problems.append(f"slot count exceeded {limit} in {len(over_limit)} samples (max {max(over_limit)})")
+    if len(registered) > limit:
+        problems.append(f"{len(registered)} devices registered, limit {limit}")
+    if registered != leased:
+        problems.append(f"registry {sorted(registered)} != leases {sorted(leased)}")
+    if peers != leased:
+        problems.append(f"traffic peers {sorted(peers)} != leases {sorted(leased)}")
+    if pool_used != len(leased):
+        problems.append(f"{pool_used} addresses in use for {len(leased)} leases")
+
+    print(
+        f"{args.ops} ops on one user from {args.threads} threads in {elapsed:.2f}s "
+        f"({args.ops / elapsed:,.0f}/s), {evicted} evictions, final devices {sorted(registered)}"
+    )
+    for problem in problems:
+        print("VIOLATION:", problem)
+    service.qr_cache.shutdown()
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Stale-while-revalidate cache for upstream calls.
+
+A fresh value is returned as is. A stale value (older than ``ttl`` but younger
+than ``stale_ttl``) is returned immediately while a single background refresh
+runs. With nothing usable cached, callers share one in-flight load. If a load
+fails, the last value is served for up to ``stale_ttl`` instead of an error.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+Loader = Callable[[], Awaitable[Any]]
+
+
+@dataclass
+class _Entry:
+    value: Any
+    fetched_at: float
+
+
+class SWRCache:
+    def __init__(
+        self,
+        ttl: float = 5.0,
+        stale_ttl: float = 300.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._entries: Dict[str, _Entry] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    @property
+    def refreshing(self) -> int:
+        return len(self._inflight)
+
+    def peek(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        return entry.value if entry else None
+
+    async def get(self, key: str, loader: Loader) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = self._clock() - entry.fetched_at
+            if age < self.ttl:
+                return entry.value
+            if age < self.stale_ttl:
+                self._refresh(key, loader)
+                return entry.value
+        return await asyncio.shield(self._refresh(key, loader))
+
+    def _refresh(self, key: str, loader: Loader) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader))
+            # Background refreshes may fail unobserved; errors are logged in _load.
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        return task
+
+    async def _load(self, key: str, loader: Loader) -> Any:
+        try:
+            value = await loader()
+        except Exception:
+            entry = self._entries.get(key)
+            if entry is not None and self._clock() - entry.fetched_at < self.stale_ttl:
+                logger.warning("Refreshing %s failed, serving stale value", key, exc_info=True)
+                return entry.value
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        self._entries[key] = _Entry(value, self._clock())
+        return value
@@ -1,14 +1,82 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 import httpx
 import os
+from vpn_common.metrics import observe_queue
+from vpn_common.metrics.asgi import MetricsMiddleware, metrics_response
+from vpn_common.metrics.transports import AsyncTimedTransport
 
-app = FastAPI(title="VPN Control Panel", version="0.1.0")
-templates = Jinja2Templates(directory="app/templates")
+from .cache import SWRCache
+
+logger = logging.getLogger(__name__)
 
 BILLING_URL = os.getenv("BILLING_URL", "http://billing:8000")
 PROVISIONER_URL = os.getenv("PROVISIONER_URL", "http://provisioner:8001")
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "2.0"))
+CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", "5"))
+CACHE_STALE_TTL = float(os.getenv("DASHBOARD_CACHE_STALE_TTL", "300"))
+
+cache = SWRCache(ttl=CACHE_TTL, stale_ttl=CACHE_STALE_TTL)
+# Last tariff catalog ETag seen from billing, revalidated with If-None-Match.
+_tariffs_etag: dict = {"etag": None}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled keep-alive client for the whole process.
+    app.state.http = httpx.AsyncClient(
+        timeout=httpx.Timeout(UPSTREAM_TIMEOUT),
+        transport=AsyncTimedTransport(
+            httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+        ),
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
+app = FastAPI(title="VPN Control Panel", version="0.1.0", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+observe_queue("upstream_refreshes", lambda: cache.refreshing)
+templates = Jinja2Templates(directory="app/templates")
+
+
+async def _get_tariffs(client: httpx.AsyncClient) -> list:
+    cached = cache.peek("tariffs")
+    headers = {}
+    if _tariffs_etag["etag"] and cached is not None:
+        headers["If-None-Match"] = _tariffs_etag["etag"]
+    resp = await client.get(f"{BILLING_URL}/tariffs", headers=headers)
+    if resp.status_code == 304:
+        return cached
+    resp.raise_for_status()
+    _tariffs_etag["etag"] = resp.headers.get("ETag")
+    return resp.json()
+
+
+async def _get_provisioner_health(client: httpx.AsyncClient) -> dict:
+    resp = await client.get(f"{PROVISIONER_URL}/health")
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def _get_analytics(client: httpx.AsyncClient) -> dict:
+    resp = await client.get(f"{BILLING_URL}/analytics")
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def _cached(key: str, loader, fallback):
+    try:
+        return await cache.get(key, loader)
+    except Exception as exc:
+        logger.warning("Upstream %s unavailable: %s", key, exc)
+        return fallback
 
 
 @app.get("/health")
@@ -16,18 +84,34 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return metrics_response()
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
-    async with httpx.AsyncClient() as client:
-        tariffs_resp = await client.get(f"{BILLING_URL}/tariffs")
-        tariffs_resp.raise_for_status()
-        health_resp = await client.get(f"{PROVISIONER_URL}/health")
-        health_resp.raise_for_status()
+    client: httpx.AsyncClient = request.app.state.http
+    tariffs, provisioner = await asyncio.gather(
+        _cached("tariffs", lambda: _get_tariffs(client), []),
+        _cached(
+            "provisioner_health",
+            lambda: _get_provisioner_health(client),
+            {"status": "unavailable", "bucket": "—"},
+        ),
+    )
     return templates.TemplateResponse(
         "index.html",
         {
             "request": request,
-            "tariffs": tariffs_resp.json(),
-            "provisioner": health_resp.json(),
+            "tariffs": tariffs,
+            "provisioner": provisioner,
         },
     )
+
+
+@app.get("/analytics", response_class=HTMLResponse)
+async def analytics(request: Request):
+    client: httpx.AsyncClient = request.app.state.http
+    data = await _cached("analytics", lambda: _get_analytics(client), None)
+    return templates.TemplateResponse("analytics.html", {"request": request, "analytics": data})
@@ -0,0 +1,148 @@
+"""Dashboard page latency under concurrent load against local stub upstreams.
+
+Starts stub billing/provisioner services with configurable latency, then
+serves the dashboard twice, each in its own uvicorn process: the previous
+implementation (new client per request, sequential upstream calls) and the
+current one (pooled client, concurrent calls, SWR cache). Reports p50/p99
+page latency for each.
+Run from ``web/dashboard``::
+
+    python -m benchmarks.bench_dashboard --requests 2000 --concurrency 50 --upstream-latency 0.03
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse
+
+TARIFFS = [
+    {"code": "light", "name": "Light", "price_stars": 110, "duration_days": 30, "devices": 2, "nodes": 2, "smartdns": True},
+    {"code": "family", "name": "Family", "price_stars": 200, "duration_days": 30, "devices": 5, "nodes": 4, "smartdns": True},
+]
+
+
+def stub_upstream() -> FastAPI:
+    latency = float(os.environ.get("STUB_LATENCY", "0.03"))
+    stub = FastAPI()
+
+    @stub.get("/tariffs")
+    async def tariffs():
+        await asyncio.sleep(latency)
+        return JSONResponse(TARIFFS, headers={"ETag": '"bench"'})
+
+    @stub.get("/health")
+    async def health():
+        await asyncio.sleep(latency)
+        return {"status": "ok", "bucket": "configs"}
+
+    return stub
+
+
+def legacy_app() -> FastAPI:
+    """The dashboard as it was: fresh client and serial calls per page view."""
+
+    from fastapi.templating import Jinja2Templates
+
+    legacy = FastAPI()
+    templates = Jinja2Templates(directory="app/templates")
+
+    @legacy.get("/", response_class=HTMLResponse)
+    async def index(request: Request):
+        async with httpx.AsyncClient() as client:
+            tariffs_resp = await client.get(f"{os.environ['BILLING_URL']}/tariffs")
+            tariffs_resp.raise_for_status()
+            health_resp = await client.get(f"{os.environ['PROVISIONER_URL']}/health")
+            health_resp.raise_for_status()
+        return templates.TemplateResponse(
+            "index.html",
+            {"request": request, "tariffs": tariffs_resp.json(), "provisioner": health_resp.json()},
+        )
+
+    return legacy
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def serve(target: str, env: dict, factory: bool = False) -> Iterator[str]:
+    port = _free_port()
+    cmd = [sys.executable, "-m", "uvicorn", target, "--port", str(port), "--log-level", "warning"]
+    if factory:
+        cmd.append("--factory")
+    proc = subprocess.Popen(cmd, env={**os.environ, **env})
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(200):
+            try:
+                httpx.get(url + "/openapi.json", timeout=0.2)
+                break
+            except httpx.TransportError:
+                time.sleep(0.05)
+        yield url
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def load(url: str, requests: int, concurrency: int) -> Tuple[List[float], float]:
+    latencies: List[float] = []
+    sem = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+
+        async def one() -> None:
+            async with sem:
+                t = time.perf_counter()
+                resp = await client.get(url)
+                resp.raise_for_status()
+                latencies.append(time.perf_counter() - t)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        return latencies, time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--upstream-latency", type=float, default=0.03)
+    args = parser.parse_args()
+
+    with serve("benchmarks.bench_dashboard:stub_upstream", {"STUB_LATENCY": str(args.upstream_latency)}, factory=True) as upstream:
+        env = {"BILLING_URL": upstream, "PROVISIONER_URL": upstream}
+        targets = (
+            ("legacy", "benchmarks.bench_dashboard:legacy_app", True),
+            ("pooled+swr", "app.main:app", False),
+        )
+        for label, target, factory in targets:
+            with serve(target, env, factory=factory) as url:
+                latencies, elapsed = asyncio.run(load(url + "/", args.requests, args.concurrency))
+            print(
+                f"{label:<11} {len(latencies) / elapsed:>7,.0f} pages/s  "
+                f"p50={_percentile(latencies, 50) * 1e3:6.1f}ms  p99={_percentile(latencies, 99) * 1e3:6.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()